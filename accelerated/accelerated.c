@@ -98,7 +98,7 @@ int varint_decode(unsigned PY_LONG_LONG *result,
     }
 
     shift += 7;
-  } while (shift < 64);
+  }
 
   // Error decoding varint - buffer too short.
   return 0;
@@ -304,6 +304,283 @@ error:
   return NULL;
 }
 
+// Reads the next field off the buffer into a wire format tuple of
+// (encoded_tag, encoded_length, encoded_data). Returns a new reference or NULL
+// with an exception set if the buffer is malformed. Advances buffer and
+// decrements length past the field.
+static PyObject *read_wire_format(const char **buffer, Py_ssize_t *length) {
+  Py_ssize_t tag_length = 0;
+  Py_ssize_t prefix_length = 0;
+  Py_ssize_t data_length = 0;
+  unsigned PY_LONG_LONG tag;
+  unsigned PY_LONG_LONG value;
+  const char *start = *buffer;
+  PyObject *result = NULL;
+
+  if (!varint_decode(&tag, start, *length, &tag_length)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid tag");
+    return NULL;
+  }
+
+  switch (tag & TAG_TYPE_MASK) {
+    case WIRETYPE_VARINT:
+      if (!varint_decode(&value, start + tag_length, *length - tag_length,
+                         &data_length)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Too many bytes when decoding varint.");
+        return NULL;
+      }
+      break;
+
+    case WIRETYPE_FIXED64:
+      data_length = 8;
+      break;
+
+    case WIRETYPE_FIXED32:
+      data_length = 4;
+      break;
+
+    case WIRETYPE_LENGTH_DELIMITED:
+      if (!varint_decode(&value, start + tag_length, *length - tag_length,
+                         &prefix_length)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Too many bytes when decoding varint.");
+        return NULL;
+      }
+
+      if (value > (unsigned PY_LONG_LONG)(*length - tag_length -
+                                          prefix_length)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Length tag exceeds available buffer.");
+        return NULL;
+      }
+      data_length = (Py_ssize_t)value;
+      break;
+
+    default:
+      PyErr_SetString(PyExc_ValueError, "Unexpected Tag");
+      return NULL;
+  }
+
+  if (tag_length + prefix_length + data_length > *length) {
+    PyErr_SetString(PyExc_ValueError, "Field exceeds available buffer.");
+    return NULL;
+  }
+
+  *buffer += tag_length + prefix_length + data_length;
+  *length -= tag_length + prefix_length + data_length;
+
+  result = PyTuple_New(3);
+  if (!result)
+    return NULL;
+
+  // PyTuple_SET_ITEM steals the references.
+  PyTuple_SET_ITEM(result, 0, PyString_FromStringAndSize(start, tag_length));
+  PyTuple_SET_ITEM(result, 1, PyString_FromStringAndSize(
+      start + tag_length, prefix_length));
+  PyTuple_SET_ITEM(result, 2, PyString_FromStringAndSize(
+      start + tag_length + prefix_length, data_length));
+
+  if (!PyTuple_GET_ITEM(result, 0) || !PyTuple_GET_ITEM(result, 1) ||
+      !PyTuple_GET_ITEM(result, 2)) {
+    Py_DECREF(result);
+    return NULL;
+  }
+
+  return result;
+}
+
+
+// This is the C implementation of structs.ReadIntoObject(). Known fields are
+// stored in the raw_data dict as (None, wire_format, type_info) under their
+// name, unknown fields under an increasing integer key. Repeated fields need
+// to be appended to their ProtoList which is left to the caller - they are
+// returned as a list of (type_info, wire_format) tuples.
+PyObject *py_read_into_object(PyObject *self, PyObject *args,
+                              PyObject *kwargs) {
+  const char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  Py_ssize_t count = 0;
+  PyObject *type_infos = NULL;
+  PyObject *raw_data = NULL;
+  PyObject *proto_list_class = NULL;
+  PyObject *repeated = NULL;
+  static const char *kwlist[] = {"buffer", "index", "length", "type_infos",
+                                 "raw_data", "proto_list_class", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#nnO!O!O", (char **)kwlist,
+                                   &buffer, &buffer_len, &index, &length,
+                                   &PyDict_Type, &type_infos,
+                                   &PyDict_Type, &raw_data,
+                                   &proto_list_class))
+    return NULL;
+
+  if (index < 0 || length < 0 || index > buffer_len) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters.");
+    return NULL;
+  }
+
+  buffer += index;
+  if (length == 0 || length > buffer_len - index) {
+    length = buffer_len - index;
+  }
+
+  repeated = PyList_New(0);
+  if (!repeated)
+    return NULL;
+
+  while (length > 0) {
+    PyObject *key = NULL;
+    PyObject *entry = NULL;
+    PyObject *type_info = NULL;
+    int status = 0;
+    PyObject *wire_format = read_wire_format(&buffer, &length);
+
+    if (!wire_format)
+      goto error;
+
+    // Borrowed reference.
+    type_info = PyDict_GetItem(type_infos, PyTuple_GET_ITEM(wire_format, 0));
+
+    if (!type_info) {
+      // Unknown fields are kept so they are written back unchanged.
+      key = PyInt_FromSsize_t(count);
+      entry = Py_BuildValue("(OOO)", Py_None, wire_format, Py_None);
+      count++;
+
+    } else if ((PyObject *)Py_TYPE(type_info) == proto_list_class) {
+      entry = Py_BuildValue("(OO)", type_info, wire_format);
+      if (entry)
+        status = PyList_Append(repeated, entry);
+
+      Py_XDECREF(entry);
+      Py_DECREF(wire_format);
+      if (!entry || status < 0)
+        goto error;
+
+      continue;
+
+    } else {
+      key = PyObject_GetAttrString(type_info, "name");
+      entry = Py_BuildValue("(OOO)", Py_None, wire_format, type_info);
+    }
+
+    if (key && entry)
+      status = PyDict_SetItem(raw_data, key, entry);
+
+    Py_XDECREF(key);
+    Py_XDECREF(entry);
+    Py_DECREF(wire_format);
+    if (!key || !entry || status < 0)
+      goto error;
+  }
+
+  return repeated;
+
+error:
+  Py_DECREF(repeated);
+  return NULL;
+}
+
+
+// This is the C implementation of RDFStruct.SerializeToString(). Fields which
+// are still in wire format are concatenated directly, only fields changed
+// since parsing are converted by their type descriptor.
+PyObject *py_serialize_raw_data(PyObject *self, PyObject *args) {
+  PyObject *raw_data = NULL;
+  PyObject *output = NULL;
+  PyObject *separator = NULL;
+  PyObject *result = NULL;
+  PyObject *entry = NULL;
+  Py_ssize_t pos = 0;
+
+  if (!PyArg_ParseTuple(args, "O!", &PyDict_Type, &raw_data))
+    return NULL;
+
+  output = PyList_New(0);
+  if (!output)
+    return NULL;
+
+  while (PyDict_Next(raw_data, &pos, NULL, &entry)) {
+    PyObject *python_format, *wire_format, *type_descriptor;
+    PyObject *converted = NULL;
+    Py_ssize_t i;
+    int status = 0;
+
+    if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) != 3) {
+      PyErr_SetString(PyExc_TypeError, "Invalid raw data entry.");
+      goto error;
+    }
+
+    python_format = PyTuple_GET_ITEM(entry, 0);
+    wire_format = PyTuple_GET_ITEM(entry, 1);
+    type_descriptor = PyTuple_GET_ITEM(entry, 2);
+
+    if (wire_format != Py_None) {
+      int truth = PyObject_IsTrue(python_format);
+      if (truth < 0)
+        goto error;
+
+      if (truth) {
+        PyObject *dirty = PyObject_CallMethod(type_descriptor, "IsDirty", "O",
+                                              python_format);
+        if (!dirty)
+          goto error;
+
+        truth = PyObject_IsTrue(dirty);
+        Py_DECREF(dirty);
+        if (truth < 0)
+          goto error;
+      }
+
+      if (!truth) {
+        Py_INCREF(wire_format);
+        converted = wire_format;
+      }
+    }
+
+    if (!converted) {
+      converted = PyObject_CallMethod(type_descriptor, "ConvertToWireFormat",
+                                      "O", python_format);
+      if (!converted)
+        goto error;
+    }
+
+    if (PyTuple_Check(converted)) {
+      for (i = 0; i < PyTuple_GET_SIZE(converted) && status == 0; i++) {
+        status = PyList_Append(output, PyTuple_GET_ITEM(converted, i));
+      }
+    } else {
+      // Anything else iterable, as accepted by list.extend().
+      PyObject *extended = _PyList_Extend((PyListObject *)output, converted);
+      if (!extended) {
+        status = -1;
+      } else {
+        Py_DECREF(extended);
+      }
+    }
+
+    Py_DECREF(converted);
+    if (status < 0)
+      goto error;
+  }
+
+  separator = PyString_FromStringAndSize(NULL, 0);
+  if (separator)
+    result = _PyString_Join(separator, output);
+
+  Py_XDECREF(separator);
+  Py_DECREF(output);
+  return result;
+
+error:
+  Py_DECREF(output);
+  return NULL;
+}
+
+
 /* Retrieves the semantic protobuf version
  * Returns a Python object if successful or NULL on error
  */
@@ -335,6 +612,16 @@ static PyMethodDef _semantic_methods[] = {
      METH_VARARGS | METH_KEYWORDS,
      "Split a buffer into tags and wire format data."},
 
+    {"read_into_object",
+     (PyCFunction)py_read_into_object,
+     METH_VARARGS | METH_KEYWORDS,
+     "Parse a buffer into the raw data dict of a semantic protobuf."},
+
+    {"serialize_raw_data",
+     (PyCFunction)py_serialize_raw_data,
+     METH_VARARGS,
+     "Serialize the raw data dict of a semantic protobuf."},
+
     {NULL}  /* Sentinel */
 };
 
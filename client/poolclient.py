@@ -1,5 +1,11 @@
 #!/usr/bin/env python
-"""This is the GRR client for thread pools."""
+"""This is the GRR client for thread pools.
+
+The pool doubles as a load generator for the frontends: enroll the clients once
+with --enroll_only, then run the pool with --benchmark_duration against the
+http_server and the async_http_server in turn to compare requests per second
+and latency percentiles.
+"""
 
 
 import pickle
@@ -33,6 +39,12 @@ flags.DEFINE_string("cert_file", "",
 flags.DEFINE_bool("enroll_only", False,
                   "If specified, the script will enroll all clients and exit.")
 
+flags.DEFINE_integer("benchmark_duration", 0,
+                     "If specified, the clients poll the server as fast as "
+                     "they can for this many seconds, then the script reports "
+                     "requests per second and latency percentiles and exits. "
+                     "Clients should be enrolled first using --enroll_only.")
+
 
 class PoolGRRClient(client.GRRClient, threading.Thread):
   """A GRR client for running in pool mode."""
@@ -49,11 +61,34 @@ class PoolGRRClient(client.GRRClient, threading.Thread):
     self.common_name = self.client.communicator.common_name
     self.private_key = self.client.communicator.private_key
 
+    # Latencies of the requests made and the number of failed requests, only
+    # recorded when benchmarking.
+    self.latencies = []
+    self.errors = 0
+    if flags.FLAGS.benchmark_duration:
+      self._InstrumentForBenchmark()
+
+  def _InstrumentForBenchmark(self):
+    """Times all requests and disables the backoff between polls."""
+    make_request = self.client.MakeRequest
+
+    def TimedMakeRequest(data, status):
+      start = time.time()
+      try:
+        return make_request(data, status)
+      finally:
+        self.latencies.append(time.time() - start)
+
+    self.client.MakeRequest = TimedMakeRequest
+    self.client.Wait = lambda status: None
+
   def Run(self):
     for status in self.client.Run():
       # if the status is 200 we assume we have successfully enrolled.
       if status.code == 200:
         self.enrolled = True
+      else:
+        self.errors += 1
 
       # Thread should stop now.
       if self.stop:
@@ -66,6 +101,36 @@ class PoolGRRClient(client.GRRClient, threading.Thread):
     self.Run()
 
 
+def Percentile(values, percent):
+  """Returns the given percentile of a sorted list of values."""
+  if not values:
+    return 0
+  index = int(round(percent / 100.0 * (len(values) - 1)))
+  return values[index]
+
+
+def RunBenchmark(clients, duration):
+  """Measures the request rate and latency the pool sees for duration."""
+  # Ignore the requests made while the clients were starting up.
+  for c in clients:
+    c.latencies = []
+    c.errors = 0
+
+  start_time = time.time()
+  time.sleep(duration)
+  elapsed = time.time() - start_time
+
+  latencies = sorted(sum([c.latencies for c in clients], []))
+  errors = sum(c.errors for c in clients)
+
+  print "Clients:          %d" % len(clients)
+  print "Requests:         %d (%d errors)" % (len(latencies), errors)
+  print "Requests/sec:     %.2f" % (len(latencies) / elapsed)
+  for percent in [50, 90, 99]:
+    print "p%d latency (ms): %.2f" % (percent,
+                                      Percentile(latencies, percent) * 1e3)
+
+
 def CreateClientPool(n):
   """Create n clients to run in a pool."""
   clients = []
@@ -111,6 +176,8 @@ def CreateClientPool(n):
         else:
           logging.info("%s: Enrolled %d/%d clients.", int(time.time()),
                        enrolled, n)
+    elif flags.FLAGS.benchmark_duration:
+      RunBenchmark(clients, flags.FLAGS.benchmark_duration)
     else:
       try:
         while True:
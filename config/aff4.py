@@ -19,6 +19,42 @@ config_lib.DEFINE_integer(
     "AFF4.intermediate_cache_max_size", 2000,
     "Maximum size of the AFF4 index cache.")
 
+config_lib.DEFINE_string(
+    "AFF4.shared_cache", "SharedAttributeCache",
+    "The class of the cache shared by the GRR processes on a host. The "
+    "default does not share anything, use LocalSocketSharedCache together "
+    "with a shared cache daemon to enable it.")
+
+config_lib.DEFINE_string(
+    "AFF4.shared_cache_socket", "/var/run/grr/shared_cache/cache.sock",
+    "The unix socket the shared cache daemon listens on. Its directory is "
+    "created by the daemon and must only be accessible by the user running "
+    "GRR.")
+
+config_lib.DEFINE_float(
+    "AFF4.shared_cache_timeout", 0.5,
+    "Timeout in seconds for requests to the shared cache daemon.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_age", 5,
+    "The number of seconds AFF4 objects live in the shared cache. Objects "
+    "written directly through the data store are only seen by other processes "
+    "once their entries expire, so keep this close to AFF4.cache_age.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_max_size", 100000,
+    "Maximum size of the shared AFF4 objects cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.collection_write_buffer_size", 1024 * 1024,
+    "RDFValueCollection.Add() buffers serialized items in memory and writes "
+    "them to the collection stream once this many bytes are buffered.")
+
+config_lib.DEFINE_integer(
+    "AFF4.collection_write_buffer_items", 10000,
+    "Maximum number of items RDFValueCollection.Add() buffers in memory "
+    "before writing them to the collection stream.")
+
 config_lib.DEFINE_integer(
     "AFF4.notification_rules_cache_age", 60,
     "The number of seconds AFF4 notification rules are cached.")
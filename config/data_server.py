@@ -19,6 +19,11 @@ config_lib.DEFINE_integer("Dataserver.max_connections", 5,
 config_lib.DEFINE_integer("Dataserver.port", 7000,
                           "Port for a specific data server.")
 
+config_lib.DEFINE_integer("Dataserver.rebalance_fence_timeout", 10,
+                          ("Maximum time in seconds that writes to a moving "
+                           "range wait while an online rebalance is being "
+                           "committed."))
+
 # Login information for clients of the data servers.
 config_lib.DEFINE_list("Dataserver.client_credentials", ["user:pass:rw"],
                        "List of data server client credentials, given as "
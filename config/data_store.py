@@ -123,3 +123,30 @@ config_lib.DEFINE_integer("HTTPDataStore.reconnect_timeout", 10 * 60,
 config_lib.DEFINE_integer("HTTPDataStore.retry_time", 5,
                           help=("Number of seconds to wait in-between attempts"
                                 "to reconnect to the database."))
+
+config_lib.DEFINE_integer("HTTPDataStore.max_idle_time", 5 * 60,
+                          help=("Connections to a data server which were not "
+                                "used for this many seconds are closed."))
+
+config_lib.DEFINE_integer("HTTPDataStore.connection_wait_timeout", 60,
+                          help=("Number of seconds to wait for a connection to "
+                                "a data server when all of them are in use."))
+
+# Blob store.
+config_lib.DEFINE_string("Blobstore.implementation", "DataStoreBlobStore",
+                         help="The blob store used for file contents.")
+
+config_lib.DEFINE_string("Blobstore.pack_directory",
+                         default="%(Datastore.location)/blobs",
+                         help="Directory holding the pack files of the "
+                         "PackFileBlobStore.")
+
+config_lib.DEFINE_integer("Blobstore.max_pack_size", 1024 * 1024 * 1024,
+                          help="The PackFileBlobStore starts a new pack file "
+                          "once the current one grows beyond this size.")
+
+config_lib.DEFINE_bool("Blobstore.pack_fallback_to_data_store", True,
+                       help="If set, blobs not found in the pack files are "
+                       "looked up in the data store. This keeps blobs "
+                       "written before switching to the PackFileBlobStore "
+                       "readable.")
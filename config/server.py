@@ -16,6 +16,18 @@ config_lib.DEFINE_integer("Worker.well_known_flow_lease_time", 600,
                           "Duration of a well known flow lease time in "
                           "seconds.")
 
+config_lib.DEFINE_integer("Worker.processes", 1,
+                          "Number of worker processes to run. With more than "
+                          "one, the worker runs as a supervisor splitting the "
+                          "notification shards between its children. At most "
+                          "Worker.queue_shards processes are started.")
+
+config_lib.DEFINE_integer("Worker.flow_batch_size", 0,
+                          "Number of regular flows a worker thread leases "
+                          "and processes together, prefetching all their "
+                          "requests and responses in bulk. 0 processes flows "
+                          "one at a time.")
+
 config_lib.DEFINE_integer("Worker.compaction_lease_time", 3600,
                           "Duration of collections lease time for compaction "
                           "in seconds.")
@@ -38,6 +50,18 @@ config_lib.DEFINE_integer("Worker.notification_retry_interval", 30,
                           "The queue manager retries to work on requests it "
                           "could not complete after this many seconds.")
 
+config_lib.DEFINE_string("Worker.wakeup_channel", "LocalSocketWakeupChannel",
+                         "The class used to wake up idle workers when new "
+                         "notifications are written to their queues.")
+
+config_lib.DEFINE_string("Worker.wakeup_socket_dir", "/tmp/grr_worker_wakeup",
+                         "Directory holding the sockets used by the "
+                         "LocalSocketWakeupChannel.")
+
+config_lib.DEFINE_float("Worker.wakeup_poll_interval", 0.2,
+                        "How often (in seconds) the DataStoreWakeupChannel "
+                        "checks for new signals.")
+
 # We write a journal entry for the flow when it's about to be processed.
 # If the journal entry is there after this time, the flow will get terminated.
 config_lib.DEFINE_integer(
@@ -132,6 +156,41 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_integer("Frontend.async_crypto_threads", 10,
+                          "Maximum number of threads the async frontend uses "
+                          "to decrypt and encrypt client messages.")
+
+config_lib.DEFINE_integer("Frontend.async_store_threads", 50,
+                          "Maximum number of threads the async frontend uses "
+                          "to store client messages and collect their "
+                          "responses from the data store.")
+
+config_lib.DEFINE_float("Frontend.drain_batch_window", 0,
+                        "If larger than 0, client queues drained within this "
+                        "many seconds of each other are read together in one "
+                        "data store operation.")
+
+config_lib.DEFINE_integer("Frontend.drain_max_batch_size", 100,
+                          "Maximum number of client queues leased together "
+                          "when Frontend.drain_batch_window is set.")
+
+config_lib.DEFINE_bool("Frontend.partial_message_decoding", False,
+                       "If set, messages received from clients are only "
+                       "decoded as far as needed to queue them and are "
+                       "forwarded to the workers in their original "
+                       "serialization.")
+
+config_lib.DEFINE_float("Frontend.liveness_flush_interval", 0,
+                        "If larger than 0, the ip, clock and last ping time "
+                        "of polling clients are buffered in memory and written "
+                        "to the data store at most this many seconds later. "
+                        "Otherwise they are written on every poll.")
+
+config_lib.DEFINE_integer("Frontend.liveness_max_clients", 100000,
+                          "Number of client clocks kept in memory for the "
+                          "replay check when "
+                          "Frontend.liveness_flush_interval is set.")
+
 # The Admin UI web application.
 config_lib.DEFINE_integer("AdminUI.port", 8000, "port to listen on")
 
@@ -291,6 +350,22 @@ config_lib.DEFINE_integer("StatsStore.ttl", default=60 * 60 * 24 * 3,
                           help="Maximum lifetime (in seconds) of data in the "
                           "stats store. Default is three days.")
 
+config_lib.DEFINE_integer("StatsStore.rollup_ttl_1m",
+                          default=60 * 60 * 24 * 14,
+                          help="Maximum lifetime (in seconds) of the 1 minute "
+                          "rollups of the stats store. Default is two weeks.")
+
+config_lib.DEFINE_integer("StatsStore.rollup_ttl_10m",
+                          default=60 * 60 * 24 * 90,
+                          help="Maximum lifetime (in seconds) of the 10 "
+                          "minutes rollups of the stats store. Default is 90 "
+                          "days.")
+
+config_lib.DEFINE_integer("StatsStore.rollup_ttl_1h",
+                          default=60 * 60 * 24 * 365,
+                          help="Maximum lifetime (in seconds) of the 1 hour "
+                          "rollups of the stats store. Default is a year.")
+
 config_lib.DEFINE_list("ConfigIncludes", [],
                        "List of additional config files to include. Files are "
                        "processed recursively depth-first, later values "
@@ -15,6 +15,7 @@ from grr.lib import aff4
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flow
+from grr.lib import hunt_index
 from grr.lib import hunts
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -110,11 +111,11 @@ class ApiHuntsListRenderer(api_call_renderer_base.ApiCallRenderer):
 
     return encoded_hunt_list
 
-  def _CreatedByFilter(self, username, hunt_obj):
-    return hunt_obj.creator == username
+  def _CreatedByFilter(self, username, entry):
+    return entry.creator == username
 
-  def _DescriptionContainsFilter(self, substring, hunt_obj):
-    return substring in hunt_obj.state.context.args.description
+  def _DescriptionContainsFilter(self, substring, entry):
+    return substring in entry.description
 
   def _Username(self, username, token):
     if username == "me":
@@ -151,8 +152,21 @@ class ApiHuntsListRenderer(api_call_renderer_base.ApiCallRenderer):
     else:
       return None
 
-  def RenderNonFiltered(self, args, token):
-    fd = aff4.FACTORY.Open("aff4:/hunts", mode="r", token=token)
+  def _OpenHunts(self, entries, token):
+    """Opens the hunts of the given index entries, skipping broken ones."""
+    hunt_list = []
+    for hunt in aff4.FACTORY.MultiOpen([entry.urn for entry in entries],
+                                       token=token):
+      if not isinstance(hunt, hunts.GRRHunt) or not hunt.state:
+        continue
+
+      hunt_list.append(hunt)
+
+    return hunt_list
+
+  def _RenderNonFilteredChildren(self, args, token):
+    """Lists the children of aff4:/hunts, used until the index is complete."""
+    fd = aff4.FACTORY.Open(HUNTS_ROOT_PATH, mode="r", token=token)
     children = list(fd.ListChildren())
     total_count = len(children)
     children.sort(key=operator.attrgetter("age"), reverse=True)
@@ -173,17 +187,12 @@ class ApiHuntsListRenderer(api_call_renderer_base.ApiCallRenderer):
                 count=len(hunt_list),
                 items=self._RenderHuntList(hunt_list))
 
-  def RenderFiltered(self, filter_func, args, token):
-    fd = aff4.FACTORY.Open("aff4:/hunts", mode="r", token=token)
+  def _RenderFilteredChildren(self, filter_func, min_age, args, token):
+    """Filters the children of aff4:/hunts, used until the index is complete."""
+    fd = aff4.FACTORY.Open(HUNTS_ROOT_PATH, mode="r", token=token)
     children = list(fd.ListChildren())
     children.sort(key=operator.attrgetter("age"), reverse=True)
 
-    if not args.active_within:
-      raise ValueError("active_within filter has to be used when "
-                       "any kind of filtering is done (to prevent "
-                       "queries of death)")
-
-    min_age = rdfvalue.RDFDatetime().Now() - args.active_within
     active_children = []
     for child in children:
       if child.age > min_age:
@@ -195,8 +204,8 @@ class ApiHuntsListRenderer(api_call_renderer_base.ApiCallRenderer):
     hunt_list = []
     active_children_map = {}
     for hunt in fd.OpenChildren(children=active_children):
-      if (not isinstance(hunt, hunts.GRRHunt) or not hunt.state
-          or not filter_func(hunt)):
+      if (not isinstance(hunt, hunts.GRRHunt) or not hunt.state or
+          not filter_func(hunt_index.HuntIndex.EntryForHunt(hunt))):
         continue
       active_children_map[hunt.urn] = hunt
 
@@ -217,6 +226,50 @@ class ApiHuntsListRenderer(api_call_renderer_base.ApiCallRenderer):
                 count=len(hunt_list),
                 items=self._RenderHuntList(hunt_list))
 
+  def RenderNonFiltered(self, args, token):
+    index = hunt_index.GetHuntIndex(token=token)
+    if not index.IsComplete():
+      return self._RenderNonFilteredChildren(args, token)
+
+    entries = index.ListHunts()
+    total_count = len(entries)
+    if args.count:
+      entries = entries[args.offset:args.offset + args.count]
+    else:
+      entries = entries[args.offset:]
+
+    hunt_list = self._OpenHunts(entries, token)
+
+    return dict(total_count=total_count,
+                offset=args.offset,
+                count=len(hunt_list),
+                items=self._RenderHuntList(hunt_list))
+
+  def RenderFiltered(self, filter_func, args, token):
+    if not args.active_within:
+      raise ValueError("active_within filter has to be used when "
+                       "any kind of filtering is done (to prevent "
+                       "queries of death)")
+
+    min_age = rdfvalue.RDFDatetime().Now() - args.active_within
+    index = hunt_index.GetHuntIndex(token=token)
+    if not index.IsComplete():
+      return self._RenderFilteredChildren(filter_func, min_age, args, token)
+
+    entries = [entry for entry in index.ListHunts(active_since=min_age)
+               if filter_func(entry)]
+
+    if args.count:
+      entries = entries[args.offset:args.offset + args.count]
+    else:
+      entries = entries[args.offset:]
+
+    hunt_list = self._OpenHunts(entries, token)
+
+    return dict(offset=args.offset,
+                count=len(hunt_list),
+                items=self._RenderHuntList(hunt_list))
+
   def Render(self, args, token=None):
     filter_func = self._BuildFilter(args, token)
     if not filter_func and args.active_within:
@@ -8,8 +8,10 @@ from grr.gui.api_plugins import hunt as hunt_plugin
 
 from grr.lib import aff4
 from grr.lib import access_control
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow_runner
+from grr.lib import hunt_index
 from grr.lib import hunts
 from grr.lib import test_lib
 from grr.lib.flows.general import transfer
@@ -37,6 +39,10 @@ class ApiHuntsListRendererTest(test_lib.GRRBaseTest):
   def setUp(self):
     super(ApiHuntsListRendererTest, self).setUp()
     self.renderer = hunt_plugin.ApiHuntsListRenderer()
+    # There are no hunts created before the index, so it is complete.
+    data_store.DB.Set(hunt_index.MAIN_INDEX,
+                      hunt_index.HuntIndex.COMPLETE_COLUMN, "1",
+                      token=self.token)
 
   def QueryParams(self, **kwargs):
     result = self.renderer.QuerySpec.HandleQueryParams(kwargs)
@@ -100,6 +106,21 @@ class ApiHuntsListRendererTest(test_lib.GRRBaseTest):
     self.assertEqual(create_times[0], 10 * 60 * 1000000)
     self.assertEqual(create_times[1], 9 * 60 * 1000000)
 
+  def testRunningHuntsAreAlwaysActive(self):
+    with test_lib.FakeTime(60):
+      self.CreateSampleHunt("running_hunt", token=self.token).Run()
+
+    with test_lib.FakeTime(120):
+      self.CreateSampleHunt("paused_hunt", token=self.token)
+
+    with test_lib.FakeTime(10 * 60):
+      result = self.renderer.Render(hunt_plugin.ApiHuntsListRendererArgs(
+          active_within="2m"), token=self.token)
+
+    descriptions = [r["summary"]["description"]["value"]
+                    for r in result["items"]]
+    self.assertEqual(descriptions, ["running_hunt"])
+
   def testRaisesIfCreatedByFilterUsedWithoutActiveWithinFilter(self):
     self.assertRaises(ValueError, self.renderer.Render,
                       hunt_plugin.ApiHuntsListRendererArgs(
@@ -179,6 +200,28 @@ class ApiHuntsListRendererTest(test_lib.GRRBaseTest):
         token=self.token)
     self.assertEqual(len(result["items"]), 0)
 
+  def testListsHuntsWhileTheIndexIsNotComplete(self):
+    for i in range(1, 6):
+      with test_lib.FakeTime(i * 60):
+        self.CreateSampleHunt("hunt_%d" % i, token=self.token)
+
+    # Simulate hunts created before there was an index.
+    data_store.DB.DeleteSubject(hunt_index.MAIN_INDEX, token=self.token)
+    data_store.DB.Flush()
+
+    result = self.renderer.Render(hunt_plugin.ApiHuntsListRendererArgs(
+        offset=1, count=2), token=self.token)
+    self.assertEqual(result["total_count"], 5)
+    self.assertEqual([r["summary"]["description"]["value"]
+                      for r in result["items"]], ["hunt_4", "hunt_3"])
+
+    with test_lib.FakeTime(5 * 60 + 1):
+      result = self.renderer.Render(hunt_plugin.ApiHuntsListRendererArgs(
+          description_contains="hunt", active_within="3m"), token=self.token)
+    self.assertEqual([r["summary"]["description"]["value"]
+                      for r in result["items"]],
+                     ["hunt_5", "hunt_4", "hunt_3"])
+
 
 class ApiHuntsListRendererRegressionTest(
     api_test_lib.ApiCallRendererRegressionTest):
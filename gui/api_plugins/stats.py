@@ -83,10 +83,24 @@ class ApiStatsStoreMetricRenderer(api_call_renderer_base.ApiCallRenderer):
         metric_name=args.metric_name,
         timeseries=[])
 
+    requested_duration = end_time - start_time
+    if requested_duration >= rdfvalue.Duration("30d"):
+      sampling_duration = rdfvalue.Duration("3h")
+    elif requested_duration >= rdfvalue.Duration("1w"):
+      sampling_duration = rdfvalue.Duration("30m")
+    elif requested_duration >= rdfvalue.Duration("1d"):
+      sampling_duration = rdfvalue.Duration("5m")
+    elif requested_duration >= rdfvalue.Duration("6h"):
+      sampling_duration = rdfvalue.Duration("1m")
+    else:
+      sampling_duration = rdfvalue.Duration("30s")
+
+    # Rollups with one point per sampling interval are enough.
     data = stats_store.MultiReadStats(
         process_ids=filtered_ids,
         metric_name=utils.SmartStr(args.metric_name),
-        timestamp=(start_time, end_time))
+        timestamp=(start_time, end_time),
+        max_points=requested_duration.seconds / sampling_duration.seconds)
 
     if not data:
       return result
@@ -100,14 +114,6 @@ class ApiStatsStoreMetricRenderer(api_call_renderer_base.ApiCallRenderer):
     if metric_metadata.fields_defs:
       query.InAll()
 
-    requested_duration = end_time - start_time
-    if requested_duration >= rdfvalue.Duration("1d"):
-      sampling_duration = rdfvalue.Duration("5m")
-    elif requested_duration >= rdfvalue.Duration("6h"):
-      sampling_duration = rdfvalue.Duration("1m")
-    else:
-      sampling_duration = rdfvalue.Duration("30s")
-
     if metric_metadata.metric_type == metric_metadata.MetricType.COUNTER:
       query.TakeValue().MakeIncreasing().Normalize(
           sampling_duration,
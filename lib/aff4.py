@@ -8,6 +8,7 @@ import __builtin__
 import abc
 import itertools
 import StringIO
+import threading
 import time
 import zlib
 
@@ -20,6 +21,7 @@ from grr.lib import data_store
 from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import shared_cache
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import aff4_rdfvalues
@@ -80,6 +82,7 @@ class DeletionPool(object):
     self._objects_cache = {}
     self._children_lists_cache = {}
     self._urns_for_deletion = set()
+    self._attributes_for_deletion = {}
 
     self._token = token
 
@@ -231,6 +234,25 @@ class DeletionPool(object):
     for obj in objs:
       obj.OnDelete(deletion_pool=self)
 
+  def MarkAttributesForDeletion(self, urn, attributes):
+    """Marks attributes of an object which is not deleted for deletion.
+
+    Objects being deleted use this in OnDelete() to remove what refers to them
+    from shared rows like indexes. The attributes of each urn are deleted in a
+    single data store call.
+
+    Args:
+      urn: The urn holding the attributes.
+      attributes: A list of attribute names.
+    """
+    self._attributes_for_deletion.setdefault(
+        rdfvalue.RDFURN(urn), set()).update(attributes)
+
+  @property
+  def attributes_for_deletion(self):
+    """Dict of urns to the attributes marked for deletion."""
+    return self._attributes_for_deletion
+
   @property
   def root_urns_for_deletion(self):
     """Roots of the graph of urns marked for deletion."""
@@ -272,6 +294,9 @@ class Factory(object):
     self.intermediate_cache = utils.AgeBasedCache(
         max_size=config_lib.CONFIG["AFF4.intermediate_cache_max_size"],
         max_age=config_lib.CONFIG["AFF4.intermediate_cache_age"])
+    # This cache is shared with the other processes on this host.
+    self.shared_cache = shared_cache.SharedAttributeCache.classes[
+        config_lib.CONFIG["AFF4.shared_cache"]]()
 
     # Create a token for system level actions. This token is used by other
     # classes such as HashFileStore and NSRLFilestore to create entries under
@@ -312,11 +337,28 @@ class Factory(object):
         try:
           yield subject, self.cache.Get(key)
           urns.remove(subject)
+          continue
         except KeyError:
           pass
 
+        try:
+          values = self.shared_cache.Get(self._MakeSharedCacheKey(subject,
+                                                                  age))
+        except KeyError:
+          continue
+
+        # Shared entries are not bound to a token so access has to be checked
+        # the way the data store would.
+        data_store.DB.security_manager.CheckDataStoreAccess(
+            token, [subject],
+            data_store.DB.GetRequiredResolveAccess(AFF4_PREFIXES))
+        self.cache.Put(key, values)
+        yield subject, values
+        urns.remove(subject)
+
     # If there are any urns left we get them from the database.
     if urns:
+      read_time = time.time()
       for subject, values in data_store.DB.MultiResolvePrefix(
           urns, AFF4_PREFIXES, timestamp=self.ParseAgeSpecification(age),
           token=token, limit=None):
@@ -326,6 +368,9 @@ class Factory(object):
 
         key = self._MakeCacheInvariant(subject, token, age)
         self.cache.Put(key, values)
+        self.shared_cache.Put(utils.SmartStr(subject) + ":",
+                              self._MakeSharedCacheKey(subject, age), values,
+                              read_time)
 
         yield utils.SmartUnicode(subject), values
 
@@ -343,8 +388,12 @@ class Factory(object):
     attributes[AFF4Object.SchemaCls.LAST] = [
         rdfvalue.RDFDatetime().Now().SerializeToDataStore()]
     to_delete.add(AFF4Object.SchemaCls.LAST)
-    data_store.DB.MultiSet(urn, attributes, token=token,
-                           replace=False, sync=sync, to_delete=to_delete)
+    # The shared entry is only invalidated once the write is done, otherwise
+    # a reader could put the old attributes back in between.
+    data_store.DB.MultiSet(urn, attributes, token=token, replace=False,
+                           sync=sync or self.shared_cache.enabled,
+                           to_delete=to_delete)
+    self.shared_cache.ExpirePrefix(utils.SmartStr(urn) + ":")
 
     # TODO(user): This can run in the thread pool since its not time
     # critical.
@@ -467,6 +516,22 @@ class Factory(object):
     return "%s:%s:%s" % (utils.SmartStr(urn), utils.SmartStr(token),
                          self.ParseAgeSpecification(age))
 
+  def _MakeSharedCacheKey(self, urn, age):
+    """Returns the key of an AFF4 object in the shared cache.
+
+    Unlike _MakeCacheInvariant() the key does not include the token, so the
+    entries are shared between all users. The caller must check access before
+    using an entry.
+
+    Args:
+       urn: The urn of the object.
+       age: The age policy used to build this object.
+
+    Returns:
+       A key into the shared cache, starting with the urn followed by ":".
+    """
+    return "%s:%s" % (utils.SmartStr(urn), self.ParseAgeSpecification(age))
+
   def CreateWithLock(self, urn, aff4_type, token=None, age=NEWEST_TIME,
                      ignore_cache=False, force_new_version=True,
                      blocking=True, blocking_lock_timeout=10,
@@ -569,6 +634,58 @@ class Factory(object):
 
     return obj
 
+  def MultiOpenWithLock(self, urns, aff4_type=None, token=None,
+                        age=NEWEST_TIME, lease_time=100):
+    """Opens and locks a number of urns without blocking.
+
+    The data store only supports transactions on single subjects, so every urn
+    is locked on its own. Urns locked by someone else are skipped, the objects
+    we could lock are then read with a single MultiOpen() call. As with
+    OpenWithLock(), each lock is released when the object is closed.
+
+    Args:
+      urns: The urns to open.
+      aff4_type: If this optional parameter is set, objects which are not an
+          instance of this type are skipped.
+      token: The Security Token to use for opening these items.
+      age: The age policy used to build the objects.
+      lease_time: Maximum time the objects stay locked.
+
+    Returns:
+      A list of the locked objects.
+    """
+    transactions = {}
+    result = []
+    success = False
+    try:
+      for urn in urns:
+        urn = rdfvalue.RDFURN(urn)
+        try:
+          transactions[urn] = self._AcquireLock(
+              urn, token=token, blocking=False, lease_time=lease_time)
+        except LockError:
+          pass
+
+      for obj in self.MultiOpen(transactions, mode="rw", ignore_cache=True,
+                                token=token, aff4_type=aff4_type, age=age,
+                                follow_symlinks=False):
+        obj.transaction = transactions.pop(obj.urn)
+        result.append(obj)
+
+      success = True
+
+    finally:
+      # Release the locks on objects which could not be opened. If opening
+      # failed the caller never sees the objects, so we release all of them.
+      for transaction in transactions.itervalues():
+        transaction.Abort()
+
+      if not success:
+        for obj in result:
+          obj.transaction.Abort()
+
+    return result
+
   def _AcquireLock(self, urn, token=None, blocking=None,
                    blocking_lock_timeout=None, lease_time=None,
                    blocking_sleep_interval=None):
@@ -954,8 +1071,16 @@ class Factory(object):
       except KeyError:
         pass
 
-      data_store.DB.DeleteSubject(urn_to_delete, token=token, sync=False)
+      data_store.DB.DeleteSubject(urn_to_delete, token=token,
+                                  sync=self.shared_cache.enabled)
       logging.debug(u"%s deleted from data store", urn_to_delete)
+      # Only invalidated once the subject is gone, see SetAttributes().
+      self.shared_cache.ExpirePrefix(utils.SmartStr(urn_to_delete) + ":")
+
+    for urn, attributes in deletion_pool.attributes_for_deletion.iteritems():
+      data_store.DB.DeleteAttributes(urn, list(attributes), token=token,
+                                     sync=self.shared_cache.enabled)
+      self.shared_cache.ExpirePrefix(utils.SmartStr(urn) + ":")
 
     # Ensure this is removed from the cache as well.
     self.Flush()
@@ -2520,6 +2645,20 @@ class AFF4Stream(AFF4Object):
   def Read(self, length):
     pass
 
+  def ReadInto(self, buf):
+    """Reads into a preallocated buffer.
+
+    Args:
+      buf: A writable buffer (e.g. a bytearray or a memoryview of one). At most
+           len(buf) bytes are read.
+
+    Returns:
+      The number of bytes read into the start of buf.
+    """
+    data = self.Read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
   @abc.abstractmethod
   def Write(self, data):
     pass
@@ -2573,6 +2712,24 @@ class AFF4MemoryStreamBase(AFF4Stream):
     self.size = len(contents)
     self.offset = 0
 
+  @classmethod
+  def FromContent(cls, urn, content, token=None):
+    """Returns a read only stream holding content without using the data store.
+
+    Args:
+      urn: The urn of the new stream.
+      content: The uncompressed content of the stream.
+      token: The security token.
+
+    Returns:
+      A stream opened in "r" mode.
+    """
+    result = cls(urn, mode="r", clone={}, token=token)
+    result.Initialize()
+    result.fd = StringIO.StringIO(content)
+    result.size = len(content)
+    return result
+
   def Truncate(self, offset=None):
     if offset is None:
       offset = self.offset
@@ -2582,6 +2739,16 @@ class AFF4MemoryStreamBase(AFF4Stream):
   def Read(self, length):
     return self.fd.read(int(length))
 
+  def ReadInto(self, buf):
+    offset = self.fd.tell()
+    data = self.fd.getvalue()
+    length = max(0, min(len(buf), len(data) - offset))
+
+    # Copy straight out of the content without slicing it first.
+    buf[:length] = memoryview(data)[offset:offset + length]
+    self.fd.seek(offset + length)
+    return length
+
   def Write(self, data):
     if isinstance(data, unicode):
       raise IOError("Cannot write unencoded string.")
@@ -2665,6 +2832,13 @@ class AFF4ImageBase(AFF4Stream):
   NUM_RETRIES = 10
   CHUNK_ID_TEMPLATE = "%010X"
 
+  # The number of chunks read ahead adapts to the access pattern: the window
+  # doubles while the stream is read sequentially and halves on every seek.
+  # Two windows must fit into the chunk cache.
+  READAHEAD_INITIAL = 10
+  READAHEAD_MIN = 1
+  READAHEAD_MAX = 40
+
   # This is the chunk size of each chunk. The chunksize can not be changed once
   # the object is created.
   chunksize = 64 * 1024
@@ -2672,6 +2846,13 @@ class AFF4ImageBase(AFF4Stream):
   # Subclasses should set the name of the type of stream to use for chunks.
   STREAM_TYPE = None
 
+  # The read ahead state, images pickled by older versions do not have it.
+  readahead_window = READAHEAD_INITIAL
+  _last_chunk_read = None
+  _readahead_end = 0
+  _prefetch_thread = None
+  _prefetch_urns = frozenset()
+
   class SchemaCls(AFF4Stream.SchemaCls):
     _CHUNKSIZE = Attribute("aff4:chunksize", rdfvalue.RDFInteger,
                            "Total size of each chunk.", default=64 * 1024)
@@ -2692,6 +2873,14 @@ class AFF4ImageBase(AFF4Stream):
     # A cache for segments - When we get pickled we want to discard them.
     self.chunk_cache = AFF4ObjectCache(100)
 
+    self.readahead_window = self.READAHEAD_INITIAL
+    # The last chunk read and the first chunk not yet read ahead.
+    self._last_chunk_read = None
+    self._readahead_end = 0
+    # The background thread reading ahead and the urns it is fetching.
+    self._prefetch_thread = None
+    self._prefetch_urns = set()
+
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
       # pylint: disable=protected-access
@@ -2702,6 +2891,19 @@ class AFF4ImageBase(AFF4Stream):
       self.size = 0
       self.content_last = None
 
+  def __getstate__(self):
+    """Waits for the read ahead, the thread can not be pickled."""
+    self._WaitForPrefetch()
+    state = self.__dict__.copy()
+    state.pop("_prefetch_thread", None)
+    state.pop("_prefetch_urns", None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._prefetch_thread = None
+    self._prefetch_urns = set()
+
   def SetChunksize(self, chunksize):
     # pylint: disable=protected-access
     self.Set(self.Schema._CHUNKSIZE(chunksize))
@@ -2730,6 +2932,7 @@ class AFF4ImageBase(AFF4Stream):
     return self.offset
 
   def Truncate(self, offset=0):
+    self._WaitForPrefetch()
     self._dirty = True
     self.size = offset
     self.offset = offset
@@ -2746,48 +2949,113 @@ class AFF4ImageBase(AFF4Stream):
 
     return fd
 
+  def _GetChunkUrns(self, chunks):
+    """Returns a dict mapping the chunk numbers to the urns storing them."""
+    return dict((chunk, self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk))
+                for chunk in chunks)
+
+  def _OpenChunks(self, urns):
+    """Opens the chunks stored at urns, returns the chunk streams."""
+    return [child for child in FACTORY.MultiOpen(
+        urns, mode="rw", token=self.token, age=self.age_policy)
+            if isinstance(child, AFF4Stream)]
+
+  def _FetchChunks(self, urns):
+    for fd in self._OpenChunks(urns):
+      self.chunk_cache.Put(fd.urn, fd)
+
+  def _Prefetch(self, urns):
+    """Reads chunks ahead in the background."""
+    try:
+      self._FetchChunks(urns)
+    except Exception as e:  # pylint: disable=broad-except
+      # The chunks will be read again when they are needed.
+      logging.warning("Failed to read ahead %s: %s", self.urn, e)
+
+  def _WaitForPrefetch(self):
+    if self._prefetch_thread is not None:
+      self._prefetch_thread.join()
+      self._prefetch_thread = None
+      self._prefetch_urns = set()
+
+  def _ReadAhead(self, first_chunk, background=False):
+    """Reads the chunks of one window starting at first_chunk."""
+    if self.chunksize:
+      last_chunk = max(first_chunk + 1,
+                       min(first_chunk + self.readahead_window,
+                           (self.size + self.chunksize - 1) / self.chunksize))
+    else:
+      last_chunk = first_chunk + self.readahead_window
+
+    self._readahead_end = last_chunk
+    urns = [urn for urn in self._GetChunkUrns(
+        range(first_chunk, last_chunk)).values()
+            if urn not in self.chunk_cache]
+    if not urns:
+      return
+
+    if background:
+      self._prefetch_urns = set(urns)
+      self._prefetch_thread = threading.Thread(target=self._Prefetch,
+                                               args=(urns,))
+      self._prefetch_thread.daemon = True
+      self._prefetch_thread.start()
+    else:
+      self._FetchChunks(urns)
+
   def _GetChunkForReading(self, chunk):
     """Returns the relevant chunk from the datastore and reads ahead."""
+    sequential = (self._last_chunk_read is not None and
+                  self._last_chunk_read <= chunk <= self._last_chunk_read + 1)
+    if self._last_chunk_read is not None and not sequential:
+      self.readahead_window = max(self.READAHEAD_MIN,
+                                  self.readahead_window / 2)
+    self._last_chunk_read = chunk
+
+    chunk_name = self._GetChunkUrns([chunk]).get(chunk)
+    if chunk_name is None:
+      raise ChunkNotFoundError("Cannot open chunk %s of %s" % (chunk, self.urn))
 
-    chunk_name = self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk)
     try:
       fd = self.chunk_cache.Get(chunk_name)
     except KeyError:
-      # The most common read access pattern is contiguous reading. Here we
-      # readahead to reduce round trips.
-      missing_chunks = []
-      for chunk_number in range(chunk, chunk + 10):
-        new_chunk_name = self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk_number)
-        try:
-          self.chunk_cache.Get(new_chunk_name)
-        except KeyError:
-          missing_chunks.append(new_chunk_name)
-
-      for child in FACTORY.MultiOpen(
-          missing_chunks, mode="rw", token=self.token, age=self.age_policy):
-        if isinstance(child, AFF4Stream):
-          self.chunk_cache.Put(child.urn, child)
-
-      # This should work now - otherwise we just give up.
+      if chunk_name in self._prefetch_urns:
+        self._WaitForPrefetch()
       try:
         fd = self.chunk_cache.Get(chunk_name)
       except KeyError:
-        raise ChunkNotFoundError("Cannot open chunk %s" % chunk_name)
-
-    return fd
+        self._WaitForPrefetch()
+        self._ReadAhead(chunk)
 
-  def _ReadPartial(self, length):
-    """Read as much as possible, but not more than length."""
-    chunk = self.offset / self.chunksize
-    chunk_offset = self.offset % self.chunksize
+        # This should work now - otherwise we just give up.
+        try:
+          fd = self.chunk_cache.Get(chunk_name)
+        except KeyError:
+          raise ChunkNotFoundError("Cannot open chunk %s" % chunk_name)
+
+    # While the caller consumes this window we fetch the next one. Streams
+    # open for writing are not read ahead in the background since this could
+    # race with the writes.
+    if (sequential and "w" not in self.mode and
+        self._prefetch_thread is None and
+        self._readahead_end - chunk <= self.readahead_window):
+      self.readahead_window = min(self.READAHEAD_MAX,
+                                  self.readahead_window * 2)
+      self._ReadAhead(max(self._readahead_end, chunk + 1), background=True)
+    elif (self._prefetch_thread is not None and
+          not self._prefetch_thread.is_alive()):
+      self._prefetch_thread = None
+      self._prefetch_urns = set()
 
-    available_to_read = min(length, self.chunksize - chunk_offset)
+    return fd
 
+  def _GetChunkWithRetries(self, chunk):
+    """Returns the chunk for reading, waits for chunks not synced yet."""
     retries = 0
     while retries < self.NUM_RETRIES:
       fd = self._GetChunkForReading(chunk)
       if fd:
-        break
+        return fd
       # Arriving here means we know about blobs that cannot be found in the db.
       # The most likely reason is that they have not been synced yet so we
       # retry a couple of times just in case they come in eventually.
@@ -2795,9 +3063,16 @@ class AFF4ImageBase(AFF4Stream):
       time.sleep(1)
       retries += 1
 
-    if retries >= self.NUM_RETRIES:
-      raise IOError("Chunk not found for reading.")
+    raise IOError("Chunk not found for reading.")
+
+  def _ReadPartial(self, length):
+    """Read as much as possible, but not more than length."""
+    chunk = self.offset / self.chunksize
+    chunk_offset = self.offset % self.chunksize
+
+    available_to_read = min(length, self.chunksize - chunk_offset)
 
+    fd = self._GetChunkWithRetries(chunk)
     fd.Seek(chunk_offset)
 
     result = fd.Read(available_to_read)
@@ -2805,22 +3080,50 @@ class AFF4ImageBase(AFF4Stream):
 
     return result
 
+  def _ReadPartialInto(self, view):
+    """Reads at most one chunk into view, returns the number of bytes read."""
+    chunk = self.offset / self.chunksize
+    chunk_offset = self.offset % self.chunksize
+
+    available_to_read = min(len(view), self.chunksize - chunk_offset)
+
+    fd = self._GetChunkWithRetries(chunk)
+    fd.Seek(chunk_offset)
+
+    read = fd.ReadInto(view[:available_to_read])
+    self.offset += read
+
+    return read
+
+  def ReadInto(self, buf):
+    """Reads from the chunks straight into buf."""
+    view = memoryview(buf)
+    length = max(0, min(len(view), self.size - self.offset))
+
+    position = 0
+    while position < length:
+      read = self._ReadPartialInto(view[position:length])
+      if not read:
+        break
+
+      position += read
+
+    return position
+
   def Read(self, length):
     """Read a block of data from the file."""
-    result = ""
-
     # The total available size in the file
     length = int(length)
     length = min(length, self.size - self.offset)
+    if length <= 0:
+      return ""
 
-    while length > 0:
-      data = self._ReadPartial(length)
-      if not data:
-        break
+    result = bytearray(length)
+    read = self.ReadInto(result)
+    if read < length:
+      del result[read:]
 
-      length -= len(data)
-      result += data
-    return result
+    return str(result)
 
   def _WritePartial(self, data):
     """Writes at most one chunk of data."""
@@ -2851,6 +3154,7 @@ class AFF4ImageBase(AFF4Stream):
 
   def Flush(self, sync=True):
     """Sync the chunk cache to storage."""
+    self._WaitForPrefetch()
     if self._dirty:
       self.Set(self.Schema.SIZE(self.size))
       if self.content_last is not None:
@@ -2891,7 +3195,7 @@ class AFF4NotificationRule(AFF4Object):
 # Utility functions
 class AFF4InitHook(registry.InitHook):
 
-  pre = ["ACLInit", "DataStoreInit"]
+  pre = ["ACLInit", "DataStoreInit", "SharedCacheInit"]
 
   def Run(self):
     """Delayed loading of aff4 plugins to break import cycles."""
@@ -9,6 +9,7 @@ import time
 import logging
 from grr.lib import access_control
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
@@ -429,6 +430,178 @@ class VFSAnalysisFile(VFSFile):
     pass
 
 
+class CompiledForemanRule(object):
+  """A foreman rule prepared for evaluation against many clients.
+
+  The attribute names are resolved and the values to compare against are
+  extracted once, so evaluating the rule for a client only needs the raw
+  attribute values of that client.
+  """
+
+  def __init__(self, rule):
+    self.rule = rule
+    self.created = rule.created
+    self.expires = rule.expires
+
+    # A list of (path, attribute, test) where test is a callable taking the
+    # attribute value.
+    self.conditions = []
+
+    # Rules referring to unknown attributes never match.
+    self.valid = True
+
+    for regex_rule in rule.regex_rules:
+      self._AddCondition(regex_rule,
+                         self._RegexTest(regex_rule.attribute_regex))
+
+    for integer_rule in rule.integer_rules:
+      self._AddCondition(integer_rule,
+                         self._IntegerTest(integer_rule.operator,
+                                           integer_rule.value))
+
+  def _AddCondition(self, attribute_rule, test):
+    try:
+      attribute = aff4.Attribute.NAMES[attribute_rule.attribute_name]
+    except KeyError:
+      self.valid = False
+      return
+
+    self.conditions.append((utils.SmartStr(attribute_rule.path), attribute,
+                            test))
+
+  def _RegexTest(self, attribute_regex):
+    def Test(value):
+      return bool(attribute_regex.Search(utils.SmartStr(value)))
+    return Test
+
+  def _IntegerTest(self, op, expected):
+    operators = rdf_foreman.ForemanAttributeInteger.Operator
+    if op == operators.LESS_THAN:
+      compare = lambda value: value < expected
+    elif op == operators.GREATER_THAN:
+      compare = lambda value: value > expected
+    elif op == operators.EQUAL:
+      compare = lambda value: value == expected
+    else:
+      # Unknown operator.
+      compare = lambda value: False
+
+    def Test(value):
+      try:
+        return compare(int(value))
+      except (ValueError, TypeError):
+        # Not an integer attribute.
+        return False
+    return Test
+
+  def Matches(self, objects):
+    """Evaluates the rule.
+
+    Args:
+      objects: A dict keyed by the rule paths of the client's objects that
+               exist, with values being dicts of attribute values keyed by
+               predicate.
+
+    Returns:
+      True if the rule matches.
+    """
+    if not self.valid:
+      return False
+
+    for path, attribute, test in self.conditions:
+      try:
+        values = objects[path]
+      except KeyError:
+        # The object does not exist.
+        return False
+
+      try:
+        value = values[attribute.predicate]
+      except KeyError:
+        value = attribute.GetDefault()
+
+      if not test(value):
+        return False
+
+    return True
+
+
+class ForemanRuleSet(object):
+  """The foreman rules compiled for evaluation against many clients.
+
+  The rules are grouped by the paths of the objects they need and the
+  attributes read from each, so that all the values needed to evaluate every
+  rule on a client can be fetched with a single data store read of just those
+  attributes.
+  """
+
+  def __init__(self, rules):
+    self.rules = [CompiledForemanRule(rule) for rule in rules]
+    self.latest_rule = max([rule.created for rule in self.rules] or [0])
+
+    # The relative paths of the objects needed by the rules.
+    self.paths = set()
+    self.attributes = {}
+    for rule in self.rules:
+      for path, attribute, _ in rule.conditions:
+        self.paths.add(path)
+        self.attributes[attribute.predicate] = attribute
+
+    # The type is read to find out which objects exist and the last foreman
+    # time decides if there are any new rules for the client at all.
+    last_foreman_time = VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME
+    self.predicates = sorted(set(self.attributes) | set(
+        [aff4.AFF4Object.SchemaCls.TYPE.predicate,
+         last_foreman_time.predicate]))
+
+  def ReadClient(self, client_id, token=None):
+    """Reads the attributes needed to evaluate the rules on a client.
+
+    Args:
+      client_id: The ClientURN of the client.
+      token: The security token.
+
+    Returns:
+      A tuple of the client's last foreman time in microseconds and a dict of
+      the client's objects as expected by CompiledForemanRule.Matches().
+    """
+    client_subject = utils.SmartUnicode(client_id)
+    paths_by_subject = {client_subject: []}
+    for path in self.paths:
+      paths_by_subject.setdefault(utils.SmartUnicode(client_id.Add(path)),
+                                  []).append(path)
+
+    last_foreman_time = VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME
+    last_foreman_run = 0
+    objects = {}
+    for subject, values in data_store.DB.MultiResolvePrefix(
+        list(paths_by_subject), self.predicates,
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, token=token):
+      subject = utils.SmartUnicode(subject)
+
+      decoded = {}
+      for predicate, value, timestamp in values:
+        if predicate == last_foreman_time.predicate:
+          if subject == client_subject:
+            last_foreman_run = int(last_foreman_time.attribute_type(
+                value, age=timestamp))
+          continue
+
+        attribute = self.attributes.get(predicate)
+        if attribute is None:
+          continue
+
+        try:
+          decoded[predicate] = attribute.attribute_type(value, age=timestamp)
+        except rdfvalue.DecodeError:
+          decoded[predicate] = None
+
+      for path in paths_by_subject.get(subject, []):
+        objects[path] = decoded
+
+    return last_foreman_run, objects
+
+
 class GRRForeman(aff4.AFF4Object):
   """The foreman starts flows for clients depending on rules."""
 
@@ -438,6 +611,9 @@ class GRRForeman(aff4.AFF4Object):
                            "The rules the foreman uses.",
                            default=rdf_foreman.ForemanRules())
 
+  _rule_set = None
+  _rule_set_serialized = None
+
   def ExpireRules(self):
     """Removes any rules with an expiration date in the past."""
     rules = self.Get(self.Schema.RULES)
@@ -473,47 +649,14 @@ class GRRForeman(aff4.AFF4Object):
 
     return False
 
-  def _EvaluateRules(self, objects, rule, client_id):
-    """Evaluates the rules."""
-    try:
-      # Do the attribute regex first.
-      for regex_rule in rule.regex_rules:
-        path = client_id.Add(regex_rule.path)
-        fd = objects[path]
-        attribute = aff4.Attribute.NAMES[regex_rule.attribute_name]
-        value = utils.SmartStr(fd.Get(attribute))
-        if not regex_rule.attribute_regex.Search(value):
-          return False
-
-      # Now the integer rules.
-      for integer_rule in rule.integer_rules:
-        path = client_id.Add(integer_rule.path)
-        fd = objects[path]
-        attribute = aff4.Attribute.NAMES[integer_rule.attribute_name]
-        try:
-          value = int(fd.Get(attribute))
-        except (ValueError, TypeError):
-          # Not an integer attribute.
-          return False
-        op = integer_rule.operator
-        if op == rdf_foreman.ForemanAttributeInteger.Operator.LESS_THAN:
-          if value >= integer_rule.value:
-            return False
-        elif op == rdf_foreman.ForemanAttributeInteger.Operator.GREATER_THAN:
-          if value <= integer_rule.value:
-            return False
-        elif op == rdf_foreman.ForemanAttributeInteger.Operator.EQUAL:
-          if value != integer_rule.value:
-            return False
-        else:
-          # Unknown operator.
-          return False
-
-      return True
+  def _GetRuleSet(self, rules):
+    """Returns the compiled rules, compiling them if they have changed."""
+    serialized = rules.SerializeToString()
+    if self._rule_set is None or self._rule_set_serialized != serialized:
+      self._rule_set = ForemanRuleSet(rules)
+      self._rule_set_serialized = serialized
 
-    except KeyError:
-      # The requested attribute was not found.
-      return False
+    return self._rule_set
 
   def _RunActions(self, rule, client_id):
     """Run all the actions specified in the rule.
@@ -571,53 +714,40 @@ class GRRForeman(aff4.AFF4Object):
     rules = self.Get(self.Schema.RULES)
     if not rules: return 0
 
-    client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
-    try:
-      last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
-    except AttributeError:
-      last_foreman_run = 0
+    rule_set = self._GetRuleSet(rules)
 
-    latest_rule = max([rule.created for rule in rules])
+    # A single read gets the client's last foreman time together with all the
+    # attributes the rules look at.
+    last_foreman_run, objects = rule_set.ReadClient(client_id,
+                                                    token=self.token)
 
-    if latest_rule <= int(last_foreman_run):
+    if rule_set.latest_rule <= last_foreman_run:
       return 0
 
-    # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
-    client.Close()
+    # Update the latest checked rule on the client. Only this attribute is
+    # written so there is no need to open the client object, and the write is
+    # not synced so the data store can batch it with other writes.
+    last_foreman_time = VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME
+    aff4.FACTORY.SetAttributes(
+        client_id,
+        {last_foreman_time: [last_foreman_time(
+            rule_set.latest_rule).SerializeToDataStore()]},
+        set([last_foreman_time]), add_child_index=False, sync=False,
+        token=self.token)
 
-    # For efficiency we collect all the objects we want to open first and then
-    # open them all in one round trip.
-    object_urns = {}
-    relevant_rules = []
     expired_rules = False
-
     now = time.time() * 1e6
 
-    for rule in rules:
+    actions_count = 0
+    for rule in rule_set.rules:
       if rule.expires < now:
         expired_rules = True
         continue
-      if rule.created <= int(last_foreman_run):
+      if rule.created <= last_foreman_run:
         continue
 
-      relevant_rules.append(rule)
-      for regex in rule.regex_rules:
-        aff4_object = client_id.Add(regex.path)
-        object_urns[str(aff4_object)] = aff4_object
-      for int_rule in rule.integer_rules:
-        aff4_object = client_id.Add(int_rule.path)
-        object_urns[str(aff4_object)] = aff4_object
-
-    # Retrieve all aff4 objects we need.
-    objects = {}
-    for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
-      objects[fd.urn] = fd
-
-    actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(objects, rule, client_id):
-        actions_count += self._RunActions(rule, client_id)
+      if rule.Matches(objects):
+        actions_count += self._RunActions(rule.rule, client_id)
 
     if expired_rules:
       self.ExpireRules()
@@ -9,6 +9,7 @@ import struct
 
 import logging
 
+from grr.lib import access_control
 from grr.lib import aff4
 from grr.lib import config_lib
 from grr.lib import data_store
@@ -32,6 +33,18 @@ class RDFValueCollectionView(rdf_protodict.RDFValueArray):
   """A view specifies how an RDFValueCollection is seen."""
 
 
+class SeekIndexPair(rdf_structs.RDFProtoStruct):
+  """Index offset <-> byte offset pair used in seek index."""
+
+  protobuf = jobs_pb2.SeekIndexPair
+
+
+class SeekIndex(rdf_structs.RDFProtoStruct):
+  """Seek index (collection of SeekIndexPairs, essentially)."""
+
+  protobuf = jobs_pb2.SeekIndex
+
+
 class RDFValueCollection(aff4.AFF4Object):
   """This is a collection of RDFValues."""
   # If this is set to an RDFValue class implementation, all the contained
@@ -44,6 +57,25 @@ class RDFValueCollection(aff4.AFF4Object):
   # The file object for the underlying AFF4Image stream.
   fd = None
 
+  # The byte offset of every INDEX_INTERVAL'th item is kept in the seek index.
+  INDEX_INTERVAL = 1000
+
+  # The seek index as seen by this object.
+  _seek_index = None
+
+  # Items added but not yet written to the stream, see Add().
+  _write_buffer = None
+  # The stream offset the write buffer starts at.
+  _write_buffer_offset = 0
+  # The number of items which are not completely written to the stream and
+  # the buffer position of the first item header.
+  _write_buffer_items = 0
+  _write_buffer_item_offset = 0
+  # Initialize() reads these from the config, the defaults are for collections
+  # pickled by older versions.
+  write_buffer_size = 1024 * 1024
+  max_write_buffer_items = 10000
+
   class SchemaCls(aff4.AFF4Object.SchemaCls):
     SIZE = aff4.AFF4Stream.SchemaCls.SIZE
 
@@ -54,9 +86,21 @@ class RDFValueCollection(aff4.AFF4Object):
                           "The list of attributes which will show up in "
                           "the table.", default="")
 
+    SEEK_INDEX = aff4.Attribute("aff4:seek_index", SeekIndex,
+                                "Index for seek operations.", versioned=False)
+
   def Initialize(self):
     """Initialize the internal storage stream."""
     self.stream_dirty = False
+    self._seek_index = None
+    self._write_buffer = None
+    self._write_buffer_offset = 0
+    self._write_buffer_items = 0
+    self._write_buffer_item_offset = 0
+    self.write_buffer_size = config_lib.CONFIG[
+        "AFF4.collection_write_buffer_size"]
+    self.max_write_buffer_items = config_lib.CONFIG[
+        "AFF4.collection_write_buffer_items"]
 
     try:
       self.fd = aff4.FACTORY.Open(self.urn.Add("UnversionedStream"),
@@ -89,13 +133,78 @@ class RDFValueCollection(aff4.AFF4Object):
     self.size = 0
 
   def SetChunksize(self, chunk_size):
-
+    self._FlushWriteBuffer()
     if self.fd.size != 0:
       raise ValueError("Cannot set chunk size on an existing collection.")
     self.fd.SetChunksize(chunk_size)
 
+  def _GetWriteBuffer(self):
+    if self._write_buffer is None:
+      self.fd.Seek(0, 2)
+      self._write_buffer_offset = self.fd.Tell()
+      self._write_buffer = cStringIO.StringIO()
+      self._write_buffer_items = 0
+      self._write_buffer_item_offset = 0
+
+    return self._write_buffer
+
+  def _FlushWriteBuffer(self, chunk_aligned=False):
+    """Writes the buffered items to the stream.
+
+    Args:
+      chunk_aligned: If set, only the data up to the last chunk boundary of
+                     the stream is written, the rest stays buffered.
+    """
+    if self._write_buffer is None:
+      return
+
+    data = self._write_buffer.getvalue()
+    length = len(data)
+    if chunk_aligned:
+      length -= (self._write_buffer_offset + length) % self.fd.chunksize
+      if length <= 0:
+        return
+
+    self.fd.Seek(0, 2)
+    self.fd.Write(data[:length])
+
+    if length < len(data):
+      # Count the items which are still (partly) buffered. The buffer may
+      # start in the middle of an item which ends at the first item header.
+      position = self._write_buffer_item_offset
+      items = int(position > length)
+      next_item_offset = None
+      while position < len(data):
+        if next_item_offset is None and position >= length:
+          next_item_offset = position
+        item_length, = struct.unpack("<i", data[position:position + 4])
+        position += 4 + item_length
+        if position > length:
+          items += 1
+
+      if next_item_offset is None:
+        next_item_offset = position
+
+      self._write_buffer = cStringIO.StringIO()
+      self._write_buffer.write(data[length:])
+      self._write_buffer_offset += length
+      self._write_buffer_items = items
+      self._write_buffer_item_offset = next_item_offset - length
+    else:
+      self._write_buffer = None
+
   def Flush(self, sync=False):
+    """Writes the added items to the data store.
+
+    Items added with Add() are buffered in memory and are only written to the
+    data store by Flush() or Close(). If sync is set, Flush() returns once the
+    data store has written them, otherwise they may still be queued.
+
+    Args:
+      sync: Whether to wait for the data store to write the items.
+    """
     if self.stream_dirty:
+      self._FlushWriteBuffer()
       self.Set(self.Schema.SIZE(self.size))
       self.fd.Flush(sync=sync)
 
@@ -109,7 +218,20 @@ class RDFValueCollection(aff4.AFF4Object):
     super(RDFValueCollection, self).Close(sync=sync)
 
   def Add(self, rdf_value=None, **kwargs):
-    """Add the rdf value to the collection."""
+    """Add the rdf value to the collection.
+
+    The serialized value is kept in a write buffer which is written to the
+    stream once it grows larger than AFF4.collection_write_buffer_size. Like
+    all other writes it only reaches the data store on Flush() or Close().
+
+    Args:
+      rdf_value: The value to add.
+      **kwargs: If rdf_value is None, a value of the collection's type is built
+                from these arguments.
+
+    Raises:
+      ValueError: if the value is None or not of the collection's type.
+    """
     if rdf_value is None:
       if self._rdf_type:
         rdf_value = self._rdf_type(**kwargs)  # pylint: disable=not-callable
@@ -124,12 +246,21 @@ class RDFValueCollection(aff4.AFF4Object):
       rdf_value.age.Now()
 
     data = rdf_protodict.EmbeddedRDFValue(payload=rdf_value).SerializeToString()
-    self.fd.Seek(0, 2)
-    self.fd.Write(struct.pack("<i", len(data)))
-    self.fd.Write(data)
+    buf = self._GetWriteBuffer()
+    if self.size and self.size % self.INDEX_INTERVAL == 0:
+      self._AddSeekIndexCheckpoints([SeekIndexPair(
+          index_offset=self.size,
+          byte_offset=self._write_buffer_offset + buf.tell())])
+
+    buf.write(struct.pack("<i", len(data)))
+    buf.write(data)
     self.stream_dirty = True
 
     self.size += 1
+    self._write_buffer_items += 1
+    if (buf.tell() >= self.write_buffer_size or
+        self._write_buffer_items >= self.max_write_buffer_items):
+      self._FlushWriteBuffer(chunk_aligned=True)
 
   def AddAll(self, rdf_values, callback=None):
     """Adds a list of rdfvalues to the collection."""
@@ -144,8 +275,17 @@ class RDFValueCollection(aff4.AFF4Object):
       if not rdf_value.age:
         rdf_value.age.Now()
 
+    self._FlushWriteBuffer()
+    self.fd.Seek(0, 2)
+    stream_offset = self.fd.Tell()
+    checkpoints = []
+
     buf = cStringIO.StringIO()
     for index, rdf_value in enumerate(rdf_values):
+      if self.size and self.size % self.INDEX_INTERVAL == 0:
+        checkpoints.append(SeekIndexPair(index_offset=self.size,
+                                         byte_offset=stream_offset + buf.tell()))
+
       data = rdf_protodict.EmbeddedRDFValue(
           payload=rdf_value).SerializeToString()
       buf.write(struct.pack("<i", len(data)))
@@ -159,6 +299,9 @@ class RDFValueCollection(aff4.AFF4Object):
     self.fd.Write(buf.getvalue())
     self.stream_dirty = True
 
+    if checkpoints:
+      self._AddSeekIndexCheckpoints(checkpoints)
+
   def __len__(self):
     return self.size
 
@@ -178,18 +321,108 @@ class RDFValueCollection(aff4.AFF4Object):
 
   @property
   def deprecated_current_offset(self):
+    self._FlushWriteBuffer()
     return self.fd.Tell()
 
-  def _GenerateItems(self, byte_offset=0):
-    """Generates items starting from a given byte offset."""
+  def _GetSeekIndex(self):
+    """Returns the seek index of this collection."""
+    if self._seek_index is None:
+      try:
+        self._seek_index = self.Get(self.Schema.SEEK_INDEX, SeekIndex())
+      except IOError:
+        # Write only collections can't read the stored index back, new
+        # checkpoints are merged in by the next reader.
+        self._seek_index = SeekIndex()
+
+    return self._seek_index
+
+  def _AddSeekIndexCheckpoints(self, checkpoints):
+    """Merges the given SeekIndexPairs into the seek index and stores it."""
+    merged = dict((pair.index_offset, pair)
+                  for pair in self._GetSeekIndex().checkpoints)
+    for pair in checkpoints:
+      merged[pair.index_offset] = pair
+
+    seek_index = SeekIndex()
+    for index_offset in sorted(merged):
+      seek_index.checkpoints.Append(merged[index_offset])
+    self._seek_index = seek_index
+
+    if "w" in self.mode:
+      self.Set(self.Schema.SEEK_INDEX, seek_index)
+    else:
+      # Readers store the checkpoints they found so the next reader can use
+      # them. Since the stream is append only, every checkpoint stays valid.
+      try:
+        data_store.DB.Set(self.urn, self.Schema.SEEK_INDEX.predicate,
+                          seek_index, replace=True, token=self.token)
+      except access_control.UnauthorizedAccess:
+        pass
+
+  def _SeekToItem(self, offset):
+    """Finds the byte offset of the item with the given index.
+
+    The search starts at the closest checkpoint of the seek index and skips
+    over the following items without parsing them. Checkpoints passed on the
+    way are added to the index, so collections written without an index get
+    one built lazily.
+
+    Args:
+      offset: The index of the item to look for.
+
+    Returns:
+      A tuple (index, byte_offset). index is smaller than offset if the
+      collection has fewer items.
+    """
+    index = byte_offset = 0
+    for pair in reversed(self._GetSeekIndex().checkpoints):
+      if pair.index_offset <= offset:
+        index = pair.index_offset
+        byte_offset = pair.byte_offset
+        break
+
+    self._FlushWriteBuffer()
+    new_checkpoints = []
+    self.fd.Seek(byte_offset)
+    while index < offset:
+      try:
+        length = struct.unpack("<i", self.fd.Read(4))[0]
+      except struct.error:
+        break
+
+      self.fd.Seek(length, 1)
+      index += 1
+      if index % self.INDEX_INTERVAL == 0:
+        new_checkpoints.append(SeekIndexPair(index_offset=index,
+                                             byte_offset=self.fd.Tell()))
+
+    if new_checkpoints:
+      self._AddSeekIndexCheckpoints(new_checkpoints)
+
+    return index, self.fd.Tell()
+
+  def _GenerateItems(self, byte_offset=0, index=0):
+    """Generates items starting from a given byte offset.
+
+    Args:
+      byte_offset: The offset in the stream to start reading from.
+      index: The index of the item stored at byte_offset.
+
+    Yields:
+      RDFValues stored in the collection.
+
+    Raises:
+      RuntimeError: if we are in write mode.
+    """
     if not self.fd:
       return
 
     if self.mode == "w":
       raise RuntimeError("Can not read when in write mode.")
 
+    self._FlushWriteBuffer()
     self.fd.seek(byte_offset)
-    count = 0
+    count = index
 
     while True:
       offset = self.fd.Tell()
@@ -228,7 +461,24 @@ class RDFValueCollection(aff4.AFF4Object):
     Raises:
       RuntimeError: if we are in write mode.
     """
-    return itertools.islice(self._GenerateItems(), offset, self.size)
+    if not offset:
+      return itertools.islice(self._GenerateItems(), self.size)
+
+    return self._GenerateItemsFromOffset(offset)
+
+  def _GenerateItemsFromOffset(self, offset):
+    """Generates items starting from a given index using the seek index."""
+    if not self.fd:
+      return
+
+    if self.mode == "w":
+      raise RuntimeError("Can not read when in write mode.")
+
+    index, byte_offset = self._SeekToItem(offset)
+    for item in itertools.islice(
+        self._GenerateItems(byte_offset=byte_offset, index=index),
+        max(0, self.size - index)):
+      yield item
 
   def GetItem(self, offset=0):
     for item in self.GenerateItems(offset=offset):
@@ -357,18 +607,6 @@ class ClientAnomalyCollection(RDFValueCollection):
   _rdf_type = rdf_anomaly.Anomaly
 
 
-class SeekIndexPair(rdf_structs.RDFProtoStruct):
-  """Index offset <-> byte offset pair used in seek index."""
-
-  protobuf = jobs_pb2.SeekIndexPair
-
-
-class SeekIndex(rdf_structs.RDFProtoStruct):
-  """Seek index (collection of SeekIndexPairs, essentially)."""
-
-  protobuf = jobs_pb2.SeekIndex
-
-
 class PackedVersionedCollection(RDFValueCollection):
   """A collection which uses the data store's version properties.
 
@@ -460,9 +698,6 @@ class PackedVersionedCollection(RDFValueCollection):
     DATA = aff4.Attribute("aff4:data", rdf_protodict.EmbeddedRDFValue,
                           "The embedded semantic value.", versioned=True)
 
-    SEEK_INDEX = aff4.Attribute("aff4:seek_index", SeekIndex,
-                                "Index for seek operations.", versioned=False)
-
     ADDITION_JOURNAL = aff4.Attribute("aff4:addition_journal",
                                       rdfvalue.RDFInteger,
                                       "Journal of Add(), AddAll(), and "
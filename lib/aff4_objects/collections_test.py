@@ -134,6 +134,144 @@ class TestCollections(test_lib.AFF4ObjectTest):
 
     self.assertRaises(ValueError, fd.AddAll, [None])
 
+  def testSeekIndexIsWrittenByAddAndAddAll(self):
+    urn = "aff4:/test/collection"
+    with utils.Stubber(collections.RDFValueCollection, "INDEX_INTERVAL", 10):
+      fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                               mode="w", token=self.token)
+      for i in range(35):
+        fd.Add(rdf_flows.GrrMessage(request_id=i))
+      fd.AddAll([rdf_flows.GrrMessage(request_id=i) for i in range(35, 70)])
+      fd.Close()
+
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      seek_index = fd.Get(fd.Schema.SEEK_INDEX)
+      self.assertEqual([pair.index_offset for pair in seek_index.checkpoints],
+                       [10, 20, 30, 40, 50, 60])
+
+      for i in range(70):
+        self.assertEqual(fd[i].request_id, i)
+        self.assertEqual(fd[i].id, i)
+
+      self.assertEqual([x.request_id for x in fd.GenerateItems(offset=65)],
+                       range(65, 70))
+      self.assertIsNone(fd[70])
+
+  def testSeekIndexIsBuiltLazilyOnFirstRead(self):
+    urn = "aff4:/test/collection"
+    fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                             mode="w", token=self.token)
+    fd.AddAll([rdf_flows.GrrMessage(request_id=i) for i in range(50)])
+    fd.Close()
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertFalse(fd.IsAttributeSet(fd.Schema.SEEK_INDEX))
+
+    with utils.Stubber(collections.RDFValueCollection, "INDEX_INTERVAL", 10):
+      self.assertEqual(fd[45].request_id, 45)
+
+      aff4.FACTORY.Flush()
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      seek_index = fd.Get(fd.Schema.SEEK_INDEX)
+      self.assertEqual([pair.index_offset for pair in seek_index.checkpoints],
+                       [10, 20, 30, 40])
+      self.assertEqual(fd[47].request_id, 47)
+
+  def testAddIsBufferedUntilFlush(self):
+    urn = "aff4:/test/collection"
+    fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                             mode="w", token=self.token)
+    for i in range(10):
+      fd.Add(rdf_flows.GrrMessage(request_id=i))
+
+    # Nothing was written to the stream yet.
+    self.assertEqual(fd.fd.size, 0)
+
+    fd.Flush()
+    self.assertGreater(fd.fd.size, 0)
+    fd.Close()
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertEqual([x.request_id for x in fd], range(10))
+
+  def testWriteBufferIsWrittenInWholeChunks(self):
+    urn = "aff4:/test/collection"
+    with test_lib.ConfigOverrider({
+        "AFF4.collection_write_buffer_size": 1024}):
+      with utils.Stubber(collections.RDFValueCollection, "INDEX_INTERVAL", 10):
+        fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                                 mode="w", token=self.token)
+        fd.SetChunksize(512)
+        for i in range(500):
+          fd.Add(rdf_flows.GrrMessage(request_id=i))
+
+          # Only whole chunks are written before the collection is flushed.
+          self.assertEqual(fd.fd.size % 512, 0)
+
+        self.assertGreater(fd.fd.size, 0)
+        fd.Close()
+
+        fd = aff4.FACTORY.Open(urn, token=self.token)
+        self.assertEqual(len(fd), 500)
+        for i in range(0, 500, 7):
+          self.assertEqual(fd[i].request_id, i)
+        self.assertEqual([x.request_id for x in fd], range(500))
+
+  def testPartialFlushesCountTheItemsStillBuffered(self):
+    urn = "aff4:/test/collection"
+    with test_lib.ConfigOverrider({
+        "AFF4.collection_write_buffer_items": 3}):
+      fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                               mode="w", token=self.token)
+      fd.SetChunksize(64)
+
+      item_ends = []
+      for i in range(100):
+        message = rdf_flows.GrrMessage(request_id=i, args="X" * (i % 50))
+        fd.Add(message)
+        data = rdf_protodict.EmbeddedRDFValue(
+            payload=message).SerializeToString()
+        item_ends.append((item_ends[-1] if item_ends else 0) + 4 + len(data))
+
+        # pylint: disable=protected-access
+        self.assertEqual(fd._write_buffer_items,
+                         len([end for end in item_ends if end > fd.fd.size]))
+        # pylint: enable=protected-access
+
+      fd.Close()
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertEqual([x.request_id for x in fd], range(100))
+
+  def testCollectionsPickledWithoutWriteBufferCanBeAddedTo(self):
+    urn = "aff4:/test/collection"
+    fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                             mode="w", token=self.token)
+    for name in ["_write_buffer_offset", "_write_buffer_items",
+                 "_write_buffer_item_offset", "write_buffer_size",
+                 "max_write_buffer_items"]:
+      del fd.__dict__[name]
+
+    for i in range(5):
+      fd.Add(rdf_flows.GrrMessage(request_id=i))
+    fd.Close()
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertEqual([x.request_id for x in fd], range(5))
+
+  def testBufferedItemsAreReadable(self):
+    urn = "aff4:/test/collection"
+    fd = aff4.FACTORY.Create(urn, "RDFValueCollection",
+                             mode="rw", token=self.token)
+    for i in range(5):
+      fd.Add(rdf_flows.GrrMessage(request_id=i))
+
+    self.assertEqual([x.request_id for x in fd], range(5))
+
+    fd.Add(rdf_flows.GrrMessage(request_id=5))
+    self.assertEqual(fd[5].request_id, 5)
+    fd.Close()
+
 
 class TestPackedVersionedCollection(test_lib.AFF4ObjectTest):
   """Test for PackedVersionedCollection."""
@@ -6,6 +6,7 @@ import hashlib
 import StringIO
 
 from grr.lib import aff4
+from grr.lib import blob_store
 from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import rdfvalue
@@ -84,6 +85,15 @@ class HashList(rdfvalue.RDFBytes):
         self._value[idx * self.HASH_SIZE: (idx + 1) * self.HASH_SIZE])
 
 
+def _OpenBlobs(urns, token=None):
+  """Reads the blobs stored at urns from the blob store, returns streams."""
+  urns = dict((urn, urn.Basename().decode("hex")) for urn in urns)
+  blobs = blob_store.BLOB_STORE.ReadBlobs(urns.values(), token=token)
+
+  return [aff4.AFF4MemoryStream.FromContent(urn, blobs[digest], token=token)
+          for urn, digest in urns.iteritems() if digest in blobs]
+
+
 class BlobImage(aff4.AFF4Image):
   """An AFF4 stream which stores chunks by hashes.
 
@@ -93,8 +103,8 @@ class BlobImage(aff4.AFF4Image):
   # Size of a sha256 hash
   _HASH_SIZE = 32
 
-  # How many chunks we read ahead
-  _READAHEAD = 5
+  # How many chunks we read ahead initially.
+  READAHEAD_INITIAL = 5
 
   def Initialize(self):
     super(BlobImage, self).Initialize()
@@ -117,42 +127,20 @@ class BlobImage(aff4.AFF4Image):
     """Chunks must be added using the AddBlob() method."""
     raise NotImplementedError("Direct writing of HashImage not allowed.")
 
-  def _GetChunkForReading(self, chunk):
-    """Retrieve the relevant blob from the AFF4 data store or cache."""
-    result = None
-    offset = chunk * self._HASH_SIZE
-    self.index.seek(offset)
-
-    chunk_name = self.index.read(self._HASH_SIZE)
-    try:
-      result = self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      # Read ahead a few chunks.
-      self.index.seek(offset)
-      readahead = {}
-
-      for _ in range(self._READAHEAD):
-        name = self.index.read(self._HASH_SIZE)
-        if name and name not in self.chunk_cache:
-          urn = aff4.ROOT_URN.Add("blobs").Add(name.encode("hex"))
-          readahead[urn] = name
-
-      fds = aff4.FACTORY.MultiOpen(readahead, mode="r", token=self.token)
-      for fd in fds:
-        name = readahead[fd.urn]
-
-        # Remember the right fd
-        if name == chunk_name:
-          result = fd
-
-        # Put back into the cache
-        self.chunk_cache.Put(readahead[fd.urn], fd)
-
-    if result is None:
-      raise IOError("Chunk '%s' not found for reading!" % chunk)
+  def _GetChunkUrns(self, chunks):
+    """Looks up the blobs storing the chunks in the hash index."""
+    result = {}
+    for chunk in chunks:
+      self.index.seek(chunk * self._HASH_SIZE)
+      name = self.index.read(self._HASH_SIZE)
+      if name:
+        result[chunk] = aff4.ROOT_URN.Add("blobs").Add(name.encode("hex"))
 
     return result
 
+  def _OpenChunks(self, urns):
+    return _OpenBlobs(urns, token=self.token)
+
   def FromBlobImage(self, fd):
     """Copy this file cheaply from another BlobImage."""
     self.content_dirty = True
@@ -184,16 +172,9 @@ class BlobImage(aff4.AFF4Image):
       if not blob:
         break
       blob_hash = hashlib.sha256(blob).digest()
-      blob_urn = rdfvalue.RDFURN("aff4:/blobs").Add(blob_hash.encode("hex"))
-
-      try:
-        fd = aff4.FACTORY.Open(blob_urn, "AFF4MemoryStream", mode="r",
-                               token=self.token)
-      except IOError:
-        fd = aff4.FACTORY.Create(blob_urn, "AFF4MemoryStream", mode="w",
-                                 token=self.token)
-        fd.Write(blob)
-        fd.Close(sync=True)
+      if not blob_store.BLOB_STORE.CheckBlobsExist(
+          [blob_hash], token=self.token)[blob_hash]:
+        blob_store.BLOB_STORE.WriteBlobs({blob_hash: blob}, token=self.token)
 
       self.AddBlob(blob_hash, len(blob))
 
@@ -258,8 +239,8 @@ class HashImage(aff4.AFF4Image):
   # Size of a sha256 hash
   _HASH_SIZE = 32
 
-  # How many chunks we read ahead
-  _READAHEAD = 5
+  # How many chunks we read ahead initially.
+  READAHEAD_INITIAL = 5
   _data_dirty = False
 
   def Initialize(self):
@@ -276,38 +257,27 @@ class HashImage(aff4.AFF4Image):
     """Chunks must be added using the AddBlob() method."""
     raise NotImplementedError("Direct writing of HashImage not allowed.")
 
-  def _GetChunkForReading(self, chunk):
-    """Retrieve the relevant blob from the AFF4 data store or cache."""
-    result = None
+  def _GetChunkUrns(self, chunks):
+    """Looks up the blobs storing the chunks in the hash index."""
     self._OpenIndex()
-    self.index.Seek(chunk * self._HASH_SIZE)
-
-    chunk_name = self.index.Read(self._HASH_SIZE)
-    try:
-      result = self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      # Read ahead a few chunks.
-      self.index.Seek(-self._HASH_SIZE, whence=1)
-      readahead = {}
-
-      for _ in range(self._READAHEAD):
-        name = self.index.Read(self._HASH_SIZE)
-        if name and name not in self.chunk_cache:
-          urn = aff4.ROOT_URN.Add("blobs").Add(name.encode("hex"))
-          readahead[urn] = name
-
-      fds = aff4.FACTORY.MultiOpen(readahead, mode="r", token=self.token)
-      for fd in fds:
-        name = readahead[fd.urn]
+    result = {}
+    for chunk in chunks:
+      self.index.Seek(chunk * self._HASH_SIZE)
+      name = self.index.Read(self._HASH_SIZE)
+      if name:
+        result[chunk] = aff4.ROOT_URN.Add("blobs").Add(name.encode("hex"))
 
-        # Remember the right fd
-        if name == chunk_name:
-          result = fd
+    return result
 
-        # Put back into the cache
-        self.chunk_cache.Put(readahead[fd.urn], fd)
+  def _OpenChunks(self, urns):
+    return _OpenBlobs(urns, token=self.token)
 
-    return result
+  def _GetChunkForReading(self, chunk):
+    """Returns None if the blob is not found so it can be retried."""
+    try:
+      return super(HashImage, self)._GetChunkForReading(chunk)
+    except aff4.ChunkNotFoundError:
+      return None
 
   def Close(self, sync=True):
     if self._data_dirty:
@@ -375,6 +345,10 @@ class AFF4SparseImage(BlobImage):
 
     return "".join(result)
 
+  def ReadInto(self, buf):
+    # Sparse images are read through _ReadPartial() which knows about holes.
+    return aff4.AFF4Stream.ReadInto(self, buf)
+
   def _GetChunkForReading(self, chunk):
     """Retrieve the relevant blob from the AFF4 data store or cache."""
     result = None
@@ -391,7 +365,7 @@ class AFF4SparseImage(BlobImage):
       readahead = {}
 
       # Read all the hashes in one go, then split up the result.
-      chunks = self.index.read(self._HASH_SIZE * self._READAHEAD)
+      chunks = self.index.read(self._HASH_SIZE * self.READAHEAD_INITIAL)
       chunk_names = [chunks[i:i + self._HASH_SIZE]
                      for i in xrange(0, len(chunks), self._HASH_SIZE)]
 
@@ -407,7 +381,7 @@ class AFF4SparseImage(BlobImage):
         except aff4.ChunkNotFoundError:
           pass
 
-      fds = aff4.FACTORY.MultiOpen(readahead, mode="r", token=self.token)
+      fds = _OpenBlobs(readahead, token=self.token)
       for fd in fds:
         name = readahead[fd.urn]
 
@@ -542,6 +516,10 @@ class AFF4SparseIndex(aff4.AFF4Image):
     while data:
       data = self._WritePartial(data)
 
+  def ReadInto(self, buf):
+    # Reads are bounded by the last chunk rather than the size.
+    return aff4.AFF4Stream.ReadInto(self, buf)
+
   def Read(self, length):
     """Read a block of data from the file."""
     result = ""
@@ -31,11 +31,19 @@ stored as datastore row attributes.
 Statistics is written to the data store by StatsStoreWorker. It periodically
 fetches values for all the metrics and writes them to corresponding
 object on AFF4.
+
+Raw values are only kept for StatsStore.ttl seconds and reading a long time
+range from them is slow. StatsStoreProcessData.Compact(), run periodically by
+the StatsStoreCompactor cron job, downsamples them into rollups (see ROLLUPS)
+kept as aff4:stats_store_rollup/<resolution>/<metric name> attributes. Every
+version of such an attribute is a block of packed (timestamp, value) arrays
+covering a fixed time range, and is timestamped with the start of that range.
 """
 
 
 
 import re
+import struct
 import threading
 import time
 
@@ -132,6 +140,111 @@ class StatsStoreMetricsMetadata(structs.RDFProtoStruct):
     return result
 
 
+class StatsStoreSeries(structs.RDFProtoStruct):
+  """Values of a metric for some fields values, stored as packed arrays."""
+
+  protobuf = jobs_pb2.StatsStoreSeries
+
+  def SetPoints(self, points):
+    """Stores a list of (timestamp, value, count) tuples.
+
+    Args:
+      points: List of (timestamp, value, count) tuples. Counts are only set
+              for distributions, and are None otherwise.
+    """
+    num_points = len(points)
+    self.timestamps = struct.pack("<%dQ" % num_points,
+                                  *[point[0] for point in points])
+    self.values = struct.pack("<%dd" % num_points,
+                              *[point[1] for point in points])
+    if points and points[0][2] is not None:
+      self.counts = struct.pack("<%dQ" % num_points,
+                                *[point[2] for point in points])
+
+  def GetPoints(self):
+    """Returns the list of (timestamp, value, count) tuples of the series."""
+    num_points = len(self.timestamps) / 8
+    timestamps = struct.unpack("<%dQ" % num_points, self.timestamps)
+    values = struct.unpack("<%dd" % num_points, self.values)
+    if self.counts:
+      counts = struct.unpack("<%dQ" % num_points, self.counts)
+    else:
+      counts = [None] * num_points
+
+    return zip(timestamps, values, counts)
+
+
+class StatsStoreBlock(structs.RDFProtoStruct):
+  """Values of a metric in a rollup over a fixed time range."""
+
+  protobuf = jobs_pb2.StatsStoreBlock
+
+
+class StatsStoreRollup(object):
+  """A copy of the stats data keeping one point per resolution interval."""
+
+  def __init__(self, name, block_size):
+    """Constructor.
+
+    Args:
+      name: Resolution of the rollup, as a human readable duration.
+      block_size: Duration of the time range covered by each block.
+    """
+    self.name = name
+    self.prefix = "aff4:stats_store_rollup/%s/" % name
+    self.resolution = rdfvalue.Duration(name).microseconds
+    self.block_size = rdfvalue.Duration(block_size).microseconds
+
+  @property
+  def ttl(self):
+    """Lifetime of the rollup, in microseconds."""
+    return config_lib.CONFIG["StatsStore.rollup_ttl_%s" % self.name] * 1000000
+
+
+# Rollups, from the finest to the coarsest. Each one is built from the
+# previous one, the first one from the raw stats.
+ROLLUPS = [StatsStoreRollup("1m", "1d"),
+           StatsStoreRollup("10m", "1w"),
+           StatsStoreRollup("1h", "30d")]
+
+
+def _IsNumeric(metric_metadata):
+  """Only numeric metrics and distributions are rolled up."""
+  return metric_metadata.value_type != stats.MetricMetadata.ValueType.STR
+
+
+def _Downsample(points, resolution, average=False):
+  """Keeps one point per resolution interval of a sorted list of points.
+
+  Args:
+    points: Sorted list of (timestamp, value, count) tuples.
+    resolution: Length of the intervals, in microseconds.
+    average: If True, points get the mean value of their interval (used for
+             gauges). Otherwise they get the last one (used for counters and
+             distributions, which only grow).
+
+  Returns:
+    A list of (timestamp, value, count) tuples, timestamped with the last
+    point of their interval.
+  """
+  result = []
+  values = []
+  interval = None
+  for timestamp, value, count in points:
+    point_interval = timestamp - timestamp % resolution
+    if point_interval != interval:
+      interval = point_interval
+      values = []
+      result.append(None)
+
+    values.append(value)
+    if average:
+      value = float(sum(values)) / len(values)
+    result[-1] = (timestamp, value, count)
+
+  return result
+
+
 class StatsStoreProcessData(aff4.AFF4Object):
   """Stores stats data for a particular process."""
 
@@ -149,6 +262,13 @@ class StatsStoreProcessData(aff4.AFF4Object):
         creates_new_object_version=False,
         versioned=False)
 
+    COMPACTED_UNTIL = aff4.Attribute(
+        "aff4:stats_store_process_data/compacted_until",
+        rdfvalue.RDFDatetime,
+        "Stats written before this time are in the rollups.",
+        creates_new_object_version=False,
+        versioned=False)
+
   def WriteMetadataDescriptors(self, metrics_metadata, sync=False,
                                timestamp=None):
     current_metadata = self.Get(self.Schema.METRICS_METADATA,
@@ -215,6 +335,204 @@ class StatsStoreProcessData(aff4.AFF4Object):
     data_store.DB.DeleteAttributes(self.urn, predicates, start=start,
                                    end=end, token=self.token, sync=sync)
 
+  def _ReadRawSeries(self, metrics_metadata, start, end):
+    """Reads the raw values of numeric metrics in [start, end).
+
+    Args:
+      metrics_metadata: Dictionary of metric name to MetricMetadata.
+      start: Start of the time range, in microseconds.
+      end: End of the time range, in microseconds.
+
+    Returns:
+      A dictionary of metric name to a dictionary of fields values tuple to a
+      sorted list of (timestamp, value, count) tuples.
+    """
+    series = {}
+    for predicate, value_string, timestamp in data_store.DB.ResolvePrefix(
+        self.urn, self.STATS_STORE_PREFIX, timestamp=(start, end - 1),
+        token=self.token):
+      metric_name = predicate[len(self.STATS_STORE_PREFIX):]
+      metadata = metrics_metadata.get(metric_name)
+      if metadata is None or not _IsNumeric(metadata):
+        continue
+
+      stored_value = StatsStoreValue(value_string)
+      if metadata.value_type == stats.MetricMetadata.ValueType.DISTRIBUTION:
+        point = (timestamp, stored_value.distribution_value.sum,
+                 stored_value.distribution_value.count)
+      else:
+        point = (timestamp, stored_value.value, None)
+
+      fields_values = tuple(stored_field_value.value for stored_field_value
+                            in stored_value.fields_values)
+      series.setdefault(metric_name, {}).setdefault(fields_values, []).append(
+          point)
+
+    for metric_series in series.itervalues():
+      for points in metric_series.itervalues():
+        points.sort()
+
+    return series
+
+  def ReadRollup(self, rollup, start, end, metric_name=None):
+    """Reads the values of a rollup in [start, end).
+
+    Args:
+      rollup: The StatsStoreRollup to read.
+      start: Start of the time range, in microseconds.
+      end: End of the time range, in microseconds.
+      metric_name: If set, only metrics starting with this name are read.
+
+    Returns:
+      A dictionary of metric name to a dictionary of fields values tuple to a
+      sorted list of (timestamp, value, count) tuples.
+    """
+    series = {}
+    if end <= start:
+      return series
+
+    # Blocks are timestamped with the start of their time range.
+    first_block = start - start % rollup.block_size
+    for predicate, value_string, _ in data_store.DB.ResolvePrefix(
+        self.urn, rollup.prefix + (metric_name or ""),
+        timestamp=(first_block, end - 1), token=self.token):
+      metric_series = series.setdefault(predicate[len(rollup.prefix):], {})
+      for block_series in StatsStoreBlock(value_string).series:
+        fields_values = tuple(stored_field_value.value for stored_field_value
+                              in block_series.fields_values)
+        metric_series.setdefault(fields_values, []).extend(
+            point for point in block_series.GetPoints()
+            if start <= point[0] < end)
+
+    for metric_series in series.itervalues():
+      for points in metric_series.itervalues():
+        points.sort()
+
+    return series
+
+  def _WriteRollup(self, rollup, metrics_metadata, series, start, end):
+    """Replaces the blocks of a rollup covering [start, end).
+
+    Args:
+      rollup: The StatsStoreRollup to write.
+      metrics_metadata: Dictionary of metric name to MetricMetadata.
+      series: All the values of the replaced blocks, as returned by
+              ReadRollup().
+      start: Start of the time range, in microseconds.
+      end: End of the time range, in microseconds.
+    """
+    first_block = start - start % rollup.block_size
+    last_block = (end - 1) - (end - 1) % rollup.block_size
+
+    to_set = {}
+    for metric_name, metric_series in series.iteritems():
+      fields_defs = metrics_metadata[metric_name].fields_defs
+
+      blocks = {}
+      for fields_values, points in metric_series.iteritems():
+        for point in points:
+          block_start = point[0] - point[0] % rollup.block_size
+          blocks.setdefault(block_start, {}).setdefault(
+              fields_values, []).append(point)
+
+      for block_start, block_series in sorted(blocks.iteritems()):
+        block = StatsStoreBlock(start=block_start)
+        for fields_values, points in sorted(block_series.iteritems()):
+          store_fields_values = []
+          for field_def, field_value in zip(fields_defs, fields_values):
+            store_field_value = StatsStoreFieldValue()
+            store_field_value.SetValue(field_value, field_def.field_type)
+            store_fields_values.append(store_field_value)
+
+          store_series = StatsStoreSeries(fields_values=store_fields_values)
+          store_series.SetPoints(points)
+          block.series.Append(store_series)
+
+        to_set.setdefault(rollup.prefix + metric_name, []).append(
+            (block, block_start))
+
+    predicates = [rollup.prefix + name for name in metrics_metadata]
+    data_store.DB.DeleteAttributes(self.urn, predicates, start=first_block,
+                                   end=last_block, token=self.token)
+    if to_set:
+      data_store.DB.MultiSet(self.urn, to_set, replace=False, token=self.token)
+
+  def Compact(self):
+    """Adds the stats written since the last compaction to the rollups.
+
+    Only the intervals since the last compaction are computed: the finest
+    rollup from the raw values, every other one from the previous rollup.
+    Blocks holding new points are rewritten and expired blocks are deleted.
+
+    Returns:
+      The number of points added to the rollups.
+    """
+    metrics_metadata = self.Get(self.Schema.METRICS_METADATA,
+                                default=StatsStoreMetricsMetadata()).AsDict()
+    metrics_metadata = dict((name, metadata)
+                            for name, metadata in metrics_metadata.iteritems()
+                            if _IsNumeric(metadata))
+
+    now = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+    finest = ROLLUPS[0].resolution
+    # Values of the last complete interval may still be on their way, leave
+    # it for the next compaction.
+    end = now - now % finest - finest
+
+    start = self.Get(self.Schema.COMPACTED_UNTIL)
+    if start:
+      start = int(start)
+    else:
+      start = max(0, now - config_lib.CONFIG["StatsStore.ttl"] * 1000000)
+      start -= start % finest
+
+    if end <= start:
+      return 0
+
+    num_points = 0
+    previous_rollup = None
+    for rollup in ROLLUPS:
+      # The interval holding start has to be computed again, from its start.
+      rollup_start = start - start % rollup.resolution
+      if previous_rollup is None:
+        source = self._ReadRawSeries(metrics_metadata, rollup_start, end)
+      else:
+        source = self.ReadRollup(previous_rollup, rollup_start, end)
+
+      # Points of the block before rollup_start are kept as they are.
+      series = self.ReadRollup(
+          rollup, rollup_start - rollup_start % rollup.block_size,
+          rollup_start)
+      series = dict((name, metric_series)
+                    for name, metric_series in series.iteritems()
+                    if name in metrics_metadata)
+
+      for metric_name, metric_series in source.iteritems():
+        metadata = metrics_metadata.get(metric_name)
+        if metadata is None:
+          continue
+
+        average = metadata.metric_type == stats.MetricMetadata.MetricType.GAUGE
+        for fields_values, points in metric_series.iteritems():
+          points = _Downsample(points, rollup.resolution, average=average)
+          series.setdefault(metric_name, {}).setdefault(
+              fields_values, []).extend(points)
+          num_points += len(points)
+
+      self._WriteRollup(rollup, metrics_metadata, series, rollup_start, end)
+      previous_rollup = rollup
+
+    for rollup in ROLLUPS:
+      # Only delete blocks whose whole time range has expired.
+      expired = now - rollup.ttl - rollup.block_size
+      if expired > 0:
+        data_store.DB.DeleteAttributes(
+            self.urn, [rollup.prefix + name for name in metrics_metadata],
+            start=0, end=expired, sync=False, token=self.token)
+
+    self.Set(self.Schema.COMPACTED_UNTIL(end))
+    return num_points
+
 
 class StatsStore(aff4.AFF4Volume):
   """Implementation of the long-term storage of collected stats data.
@@ -285,25 +603,202 @@ class StatsStore(aff4.AFF4Volume):
     return results
 
   def ReadStats(self, process_id=None, metric_name=None,
-                timestamp=ALL_TIMESTAMPS, limit=10000):
+                timestamp=ALL_TIMESTAMPS, limit=10000, max_points=None):
     """Reads stats values from the data store for the current process."""
     if not process_id:
       raise ValueError("process_id can't be None")
 
     results = self.MultiReadStats(process_ids=[process_id],
                                   metric_name=metric_name,
-                                  timestamp=timestamp, limit=limit)
+                                  timestamp=timestamp, limit=limit,
+                                  max_points=max_points)
     try:
       return results[process_id]
     except KeyError:
       return {}
 
+  def _ChooseRollup(self, start, end, max_points):
+    """Chooses the rollup to read max_points points per series from.
+
+    Args:
+      start: Start of the time range, in microseconds.
+      end: End of the time range, in microseconds.
+      max_points: Number of points wanted over the time range.
+
+    Returns:
+      The coarsest StatsStoreRollup still covering the time range with at
+      least max_points points, or the finest one covering the time range.
+      None if the raw values should be read instead: when even the finest
+      rollup has fewer points than wanted and the raw values still go back to
+      start, or when no rollup goes back to start.
+    """
+    now = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+    interval = (end - start) / max_points
+
+    if (ROLLUPS[0].resolution > interval and
+        start >= now - config_lib.CONFIG["StatsStore.ttl"] * 1000000):
+      return None
+
+    chosen = None
+    for rollup in ROLLUPS:
+      if start < now - rollup.ttl:
+        continue
+
+      if chosen is None or rollup.resolution <= interval:
+        chosen = rollup
+
+    return chosen
+
+  def _AddValue(self, part_results, metric_name, metadata, fields_values,
+                value, timestamp):
+    """Adds a value to the results of a process."""
+    if metadata.fields_defs:
+      current_dict = part_results.setdefault(metric_name, {})
+      for field_value in fields_values[:-1]:
+        new_dict = {}
+        current_dict.setdefault(field_value, new_dict)
+        current_dict = new_dict
+
+      result_values_list = current_dict.setdefault(fields_values[-1], [])
+    else:
+      result_values_list = part_results.setdefault(metric_name, [])
+
+    result_values_list.append((value, timestamp))
+
+  def _AddRawValues(self, part_results, subject_metadata, subject_results):
+    """Adds raw values read from the data store to the results."""
+    for predicate, value_string, timestamp in subject_results:
+      metric_name = predicate[len(StatsStoreProcessData.STATS_STORE_PREFIX):]
+
+      try:
+        metadata = subject_metadata[metric_name]
+      except KeyError:
+        continue
+
+      stored_value = StatsStoreValue(value_string)
+
+      fields_values = []
+      if metadata.fields_defs:
+        for stored_field_value in stored_value.fields_values:
+          fields_values.append(stored_field_value.value)
+
+      self._AddValue(part_results, metric_name, metadata, fields_values,
+                     stored_value.value, timestamp)
+
+  def _AddRollupValues(self, part_results, subject_metadata, series):
+    """Adds values read from a rollup to the results."""
+    for metric_name, metric_series in sorted(series.iteritems()):
+      try:
+        metadata = subject_metadata[metric_name]
+      except KeyError:
+        continue
+
+      for fields_values, points in sorted(metric_series.iteritems()):
+        for timestamp, value, count in points:
+          if (metadata.value_type ==
+              stats.MetricMetadata.ValueType.DISTRIBUTION):
+            distribution = stats.Distribution()
+            distribution.sum = value
+            distribution.count = count
+            value = distribution
+          elif metadata.value_type == stats.MetricMetadata.ValueType.INT:
+            value = int(round(value))
+
+          self._AddValue(part_results, metric_name, metadata,
+                         list(fields_values), value, timestamp)
+
+  def _MultiReadRollup(self, rollup, process_ids, metric_name, start, end,
+                       limit):
+    """Reads a rollup, completed by the raw values since the last compaction.
+
+    String metrics are not rolled up, all their values are read from the raw
+    values.
+
+    Args:
+      rollup: The StatsStoreRollup to read.
+      process_ids: Process ids to read the stats of.
+      metric_name: If set, only metrics starting with this name are read.
+      start: Start of the time range, in microseconds.
+      end: End of the time range (inclusive), in microseconds.
+      limit: Maximum number of raw values to read.
+
+    Returns:
+      Results in the same format as MultiReadStats().
+    """
+    subjects = [self.DATA_STORE_ROOT.Add(process_id)
+                for process_id in process_ids]
+    subjects_data = aff4.FACTORY.MultiOpen(subjects, mode="r", token=self.token,
+                                           aff4_type="StatsStoreProcessData")
+
+    results = {}
+    for subject_data in subjects_data:
+      subject_metadata = subject_data.Get(
+          subject_data.Schema.METRICS_METADATA).AsDict()
+      compacted_until = int(subject_data.Get(
+          subject_data.Schema.COMPACTED_UNTIL, default=0))
+
+      part_results = {}
+      series = subject_data.ReadRollup(rollup, start,
+                                       min(end + 1, compacted_until),
+                                       metric_name=metric_name)
+      self._AddRollupValues(part_results, subject_metadata, series)
+
+      string_predicates = [
+          StatsStoreProcessData.STATS_STORE_PREFIX + name
+          for name, metadata in subject_metadata.iteritems()
+          if not _IsNumeric(metadata) and name.startswith(metric_name or "")]
+      string_end = min(end, compacted_until - 1)
+      if string_predicates and start <= string_end:
+        subject_results = data_store.DB.ResolveMulti(
+            subject_data.urn, string_predicates,
+            timestamp=(start, string_end), limit=limit, token=self.token)
+        self._AddRawValues(part_results, subject_metadata,
+                           sorted(subject_results, key=lambda x: x[2]))
+
+      raw_start = max(start, compacted_until)
+      if raw_start <= end:
+        subject_results = data_store.DB.ResolvePrefix(
+            subject_data.urn,
+            StatsStoreProcessData.STATS_STORE_PREFIX + (metric_name or ""),
+            timestamp=(raw_start, end), limit=limit, token=self.token)
+        self._AddRawValues(part_results, subject_metadata,
+                           sorted(subject_results, key=lambda x: x[2]))
+
+      results[subject_data.urn.Basename()] = part_results
+
+    return results
+
   def MultiReadStats(self, process_ids=None, metric_name=None,
-                     timestamp=ALL_TIMESTAMPS, limit=10000):
-    """Reads historical data for multiple process ids at once."""
+                     timestamp=ALL_TIMESTAMPS, limit=10000, max_points=None):
+    """Reads historical data for multiple process ids at once.
+
+    Args:
+      process_ids: Process ids to read the stats of. All of them by default.
+      metric_name: If set, only metrics starting with this name are read.
+      timestamp: Time range to read, or ALL_TIMESTAMPS.
+      limit: Maximum number of raw values to read.
+      max_points: If set and timestamp is a time range, values are read from
+                  the coarsest rollup giving about this many points per series
+                  over the time range. Values written since the last
+                  compaction are still read from the raw values. String
+                  metrics are not rolled up, they are always read from the
+                  raw values.
+
+    Returns:
+      A dictionary of process id to a dictionary of metric name to a list of
+      (value, timestamp) tuples. Values of metrics with fields are in nested
+      dictionaries, one level per field.
+    """
     if not process_ids:
       process_ids = self.ListUsedProcessIds()
 
+    if max_points and isinstance(timestamp, (list, tuple)):
+      start, end = [int(x) for x in timestamp]
+      rollup = self._ChooseRollup(start, end, max_points)
+      if rollup is not None:
+        return self._MultiReadRollup(rollup, process_ids, metric_name, start,
+                                     end, limit)
+
     multi_metadata = self.MultiReadMetadata(process_ids=process_ids)
 
     subjects = [self.DATA_STORE_ROOT.Add(process_id)
@@ -323,32 +818,7 @@ class StatsStore(aff4.AFF4Volume):
       subject_metadata = multi_metadata.get(subject.Basename(), {})
 
       part_results = {}
-      for predicate, value_string, timestamp in subject_results:
-        metric_name = predicate[len(StatsStoreProcessData.STATS_STORE_PREFIX):]
-
-        try:
-          metadata = subject_metadata[metric_name]
-        except KeyError:
-          continue
-
-        stored_value = StatsStoreValue(value_string)
-
-        fields_values = []
-        if metadata.fields_defs:
-          for stored_field_value in stored_value.fields_values:
-            fields_values.append(stored_field_value.value)
-
-          current_dict = part_results.setdefault(metric_name, {})
-          for field_value in fields_values[:-1]:
-            new_dict = {}
-            current_dict.setdefault(field_value, new_dict)
-            current_dict = new_dict
-
-          result_values_list = current_dict.setdefault(fields_values[-1], [])
-        else:
-          result_values_list = part_results.setdefault(metric_name, [])
-
-        result_values_list.append((stored_value.value, timestamp))
+      self._AddRawValues(part_results, subject_metadata, subject_results)
 
       results[subject.Basename()] = part_results
 
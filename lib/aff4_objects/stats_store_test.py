@@ -1007,6 +1007,159 @@ class StatsStoreDataQueryTest(test_lib.AFF4ObjectTest):
     self.assertAlmostEqual(query.In("counter").TakeValue().Mean(), 3)
 
 
+class StatsStoreRollupsTest(test_lib.AFF4ObjectTest):
+  """Tests for the rollups of the stats store."""
+
+  # A day boundary, so that all the rollups intervals start there.
+  START = 100 * 24 * 60 * 60
+
+  def setUp(self):
+    super(StatsStoreRollupsTest, self).setUp()
+
+    self.process_id = "some_pid"
+    self.stats_store = aff4.FACTORY.Create(
+        None, "StatsStore", mode="w", token=self.token)
+
+  def Time(self, seconds):
+    """Returns a timestamp in microseconds, relative to START."""
+    return (self.START + seconds) * 1000000
+
+  def WriteStats(self, seconds):
+    self.stats_store.WriteStats(process_id=self.process_id,
+                                timestamp=self.Time(seconds), sync=True)
+
+  def Compact(self, seconds):
+    with test_lib.FakeTime(self.START + seconds):
+      with aff4.FACTORY.Open(self.stats_store.urn.Add(self.process_id),
+                             aff4_type="StatsStoreProcessData", mode="rw",
+                             token=self.token) as process_data:
+        return process_data.Compact()
+
+  def ReadStats(self, seconds, start, end, max_points):
+    with test_lib.FakeTime(self.START + seconds):
+      return self.stats_store.ReadStats(
+          process_id=self.process_id,
+          timestamp=(self.Time(start), self.Time(end)),
+          max_points=max_points)
+
+  def WriteCounter(self, num_minutes, fields=None):
+    """Increments a counter and writes it every 20 seconds."""
+    for i in range(num_minutes * 3):
+      stats.STATS.IncrementCounter("counter", fields=fields)
+      self.WriteStats(i * 20)
+
+  def testSeriesArePacked(self):
+    points = [(42, 1.5, None), (43, 2.5, None)]
+    series = stats_store.StatsStoreSeries()
+    series.SetPoints(points)
+    self.assertEqual(len(series.timestamps), 16)
+    self.assertFalse(series.counts)
+
+    series = stats_store.StatsStoreSeries(series.SerializeToString())
+    self.assertEqual(series.GetPoints(), points)
+
+  def testRollupIsChosenByTheNumberOfPoints(self):
+    stats.STATS.RegisterCounterMetric("counter")
+    self.WriteCounter(30)
+    self.assertEqual(self.Compact(3600), 30 + 3 + 1)
+
+    # One point per minute, with the last value of each minute.
+    stats_history = self.ReadStats(3600, 0, 30 * 60, max_points=30)
+    self.assertEqual(stats_history["counter"],
+                     [(3 * i + 3, self.Time(i * 60 + 40))
+                      for i in range(30)])
+
+    # One point per 10 minutes.
+    stats_history = self.ReadStats(3600, 0, 30 * 60, max_points=3)
+    self.assertEqual(stats_history["counter"],
+                     [(30 * i + 30, self.Time(i * 600 + 580))
+                      for i in range(3)])
+
+  def testRawValuesAreReadSinceTheLastCompaction(self):
+    stats.STATS.RegisterGaugeMetric("float_gauge", float)
+    for i in range(20):
+      stats.STATS.SetGaugeValue("float_gauge", float(i))
+      self.WriteStats(i * 30)
+
+    # The minute in progress and the one before it are not compacted.
+    self.Compact(8 * 60 + 30)
+
+    # Gauges get the mean value of every minute.
+    stats_history = self.ReadStats(8 * 60 + 30, 0, 10 * 60, max_points=10)
+    self.assertEqual(stats_history["float_gauge"],
+                     [(2 * i + 0.5, self.Time(i * 60 + 30)) for i in range(7)] +
+                     [(i, self.Time(i * 30)) for i in range(14, 20)])
+
+  def testStringMetricsAreReadFromTheRawValues(self):
+    stats.STATS.RegisterGaugeMetric("str_gauge", str)
+    for i in range(20):
+      stats.STATS.SetGaugeValue("str_gauge", "value_%d" % i)
+      self.WriteStats(i * 30)
+
+    self.Compact(8 * 60 + 30)
+
+    # Values from before and after the last compaction are all read.
+    stats_history = self.ReadStats(8 * 60 + 30, 0, 10 * 60, max_points=10)
+    self.assertEqual(stats_history["str_gauge"],
+                     [("value_%d" % i, self.Time(i * 30)) for i in range(20)])
+
+  def testDistributionsAreRolledUp(self):
+    stats.STATS.RegisterEventMetric("event")
+    for i in range(6):
+      stats.STATS.RecordEvent("event", 0.5)
+      self.WriteStats(i * 20)
+
+    self.Compact(3600)
+
+    stats_history = self.ReadStats(3600, 0, 120, max_points=2)
+    self.assertEqual([(value.sum, value.count, timestamp)
+                      for value, timestamp in stats_history["event"]],
+                     [(1.5, 3, self.Time(40)), (3.0, 6, self.Time(100))])
+
+  def testIncrementalCompaction(self):
+    stats.STATS.RegisterCounterMetric("counter", fields=[("source", str)])
+    self.WriteCounter(30, fields=["http"])
+
+    # The second 10 minutes interval is only partly compacted at first.
+    self.Compact(15 * 60 + 30)
+    self.Compact(3600)
+
+    stats_history = self.ReadStats(3600, 0, 30 * 60, max_points=3)
+    self.assertEqual(stats_history["counter"]["http"],
+                     [(30 * i + 30, self.Time(i * 600 + 580))
+                      for i in range(3)])
+
+    stats_history = self.ReadStats(3600, 0, 30 * 60, max_points=30)
+    self.assertEqual(len(stats_history["counter"]["http"]), 30)
+
+  def testRawValuesAreReadForMorePointsThanTheFinestRollupHas(self):
+    stats.STATS.RegisterCounterMetric("counter")
+    self.WriteCounter(2)
+    self.Compact(3600)
+
+    # Two minutes with six points wanted is finer than the 1m rollup.
+    stats_history = self.ReadStats(3600, 0, 2 * 60, max_points=6)
+    self.assertEqual(stats_history["counter"],
+                     [(i + 1, self.Time(i * 20)) for i in range(6)])
+
+    # Once the raw values are gone the 1m rollup is the best we have.
+    with test_lib.ConfigOverrider({"StatsStore.ttl": 60}):
+      stats_history = self.ReadStats(3600, 0, 2 * 60, max_points=6)
+    self.assertEqual(stats_history["counter"],
+                     [(3, self.Time(40)), (6, self.Time(100))])
+
+  def testRawValuesAreReadWhenRollupsDoNotGoBackFarEnough(self):
+    stats.STATS.RegisterCounterMetric("counter")
+    self.WriteCounter(1)
+    self.Compact(3600)
+
+    two_years = 2 * 365 * 24 * 60 * 60
+    stats_history = self.ReadStats(two_years, 0, 60, max_points=1)
+    self.assertEqual(stats_history["counter"],
+                     [(1, self.Time(0)), (2, self.Time(20)),
+                      (3, self.Time(40))])
+
+
 def main(argv):
   test_lib.main(argv)
 
@@ -431,6 +431,10 @@ class FullAccessControlManager(BasicAccessControlManager):
     h.Allow("aff4:/client_index")
     h.Allow("aff4:/client_index/*")
 
+    # Index of hunts, used to list hunts without opening them.
+    h.Allow("aff4:/hunt_index")
+    h.Allow("aff4:/hunt_index/*")
+
     # ACL namespace contains approval objects for accessing clients and hunts.
     h.Allow("aff4:/ACL")
     h.Allow("aff4:/ACL/*")
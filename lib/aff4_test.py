@@ -5,6 +5,7 @@
 
 import itertools
 import os
+import pickle
 import threading
 import time
 
@@ -846,6 +847,74 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     for i in range(100):
       self.assertEqual(fd.Read(13), "Test%08X\n" % i)
 
+  def testAFF4ImageReadAheadAdaptsToAccessPattern(self):
+    path = "/C.12345/readahead"
+    with aff4.FACTORY.Create(path, "AFF4Image", token=self.token) as fd:
+      fd.SetChunksize(10)
+      for i in range(500):
+        fd.Write("Test%05X\n" % i)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    self.assertEqual(fd.readahead_window, fd.READAHEAD_INITIAL)
+
+    # Sequential reads grow the window and return the right data.
+    for i in range(500):
+      self.assertEqual(fd.Read(10), "Test%05X\n" % i)
+    self.assertEqual(fd.readahead_window, fd.READAHEAD_MAX)
+
+    # Random reads shrink it again.
+    for i in range(10):
+      fd.Seek(((i * 7919) % 500) * 10)
+      self.assertEqual(fd.Read(10), "Test%05X\n" % ((i * 7919) % 500))
+    self.assertEqual(fd.readahead_window, fd.READAHEAD_MIN)
+
+  def testAFF4ImageCanBePickledWhileReading(self):
+    path = "/C.12345/readahead"
+    with aff4.FACTORY.Create(path, "AFF4Image", token=self.token) as fd:
+      fd.SetChunksize(10)
+      for i in range(100):
+        fd.Write("Test%05X\n" % i)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    for i in range(20):
+      self.assertEqual(fd.Read(10), "Test%05X\n" % i)
+
+    restored = pickle.loads(pickle.dumps(fd))
+    # pylint: disable=protected-access
+    self.assertIsNone(restored._prefetch_thread)
+    # pylint: enable=protected-access
+    for i in range(20, 100):
+      self.assertEqual(restored.Read(10), "Test%05X\n" % i)
+
+    # Images pickled before the read ahead existed do not have its state.
+    state = fd.__getstate__()
+    for name in ["readahead_window", "_last_chunk_read", "_readahead_end"]:
+      state.pop(name)
+    old = fd.__class__.__new__(fd.__class__)
+    old.__dict__.update(state)
+    old.Seek(500)
+    self.assertEqual(old.Read(10), "Test%05X\n" % 50)
+    old.Flush()
+
+  def testAFF4ImageReadInto(self):
+    path = "/C.12345/readinto"
+    data = "".join("Test%05X\n" % i for i in range(100))
+    with aff4.FACTORY.Create(path, "AFF4Image", token=self.token) as fd:
+      fd.SetChunksize(64)
+      fd.Write(data)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    fd.Seek(5)
+    buf = bytearray(500)
+    self.assertEqual(fd.ReadInto(memoryview(buf)[100:]), 400)
+    self.assertEqual(str(buf[100:]), data[5:405])
+    self.assertEqual(fd.Tell(), 405)
+
+    # Reads stop at the end of the image.
+    self.assertEqual(fd.ReadInto(buf), len(data) - 405)
+    self.assertEqual(str(buf[:len(data) - 405]), data[405:])
+    self.assertEqual(fd.ReadInto(buf), 0)
+
   def WriteImage(self, path, prefix="Test", timestamp=0, classname="AFF4Image"):
     with utils.Stubber(time, "time", lambda: timestamp):
       fd = aff4.FACTORY.Create(path, classname, mode="w", token=self.token)
@@ -1417,6 +1486,30 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
           self.assertRaises(aff4.LockError, fd.Close)
           self.assertRaises(aff4.LockError, fd.Flush)
 
+  def testMultiOpenWithLockReleasesLocksOnError(self):
+    urns = [rdfvalue.RDFURN("aff4:/C.000000000000000%d" % i) for i in range(3)]
+    for urn in urns:
+      with aff4.FACTORY.Create(urn, "VFSGRRClient", mode="w",
+                               token=self.token) as client:
+        client.Set(client.Schema.HOSTNAME("client1"))
+
+    multi_open = aff4.FACTORY.MultiOpen
+
+    def MultiOpen(*args, **kwargs):
+      for i, obj in enumerate(multi_open(*args, **kwargs)):
+        if i == 1:
+          raise IOError("Data store failure.")
+        yield obj
+
+    with utils.Stubber(aff4.FACTORY, "MultiOpen", MultiOpen):
+      self.assertRaises(IOError, aff4.FACTORY.MultiOpenWithLock, urns,
+                        token=self.token)
+
+    # None of the objects stays locked.
+    for urn in urns:
+      with aff4.FACTORY.OpenWithLock(urn, token=self.token, blocking=False):
+        pass
+
   def testUpdateLeaseRaisesIfObjectIsNotLocked(self):
     client = aff4.FACTORY.Create(self.client_id, "VFSGRRClient", mode="w",
                                  token=self.token)
@@ -1894,6 +1987,74 @@ class ForemanTests(test_lib.AFF4ObjectTest):
         rules = foreman.Get(foreman.Schema.RULES)
         self.assertEqual(len(rules), num_rules)
 
+  def CreateWindowsRule(self, created, regex="Windows"):
+    rule = rdf_foreman.ForemanRule(
+        created=int(created * 1e6), expires=int((created + 3600) * 1e6),
+        description="Test rule")
+    rule.regex_rules.Append(
+        attribute_name=aff4_grr.VFSGRRClient.SchemaCls.SYSTEM.name,
+        attribute_regex=regex)
+    rule.actions.Append(flow_name="Test Flow",
+                        argv=rdf_protodict.Dict(foo="bar"))
+    return rule
+
+  def testClientObjectIsNotOpened(self):
+    client_id = rdf_client.ClientURN("C.0000000000000031")
+    fd = aff4.FACTORY.Create(client_id, "VFSGRRClient", token=self.token)
+    fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Windows 7"))
+    fd.Close()
+
+    now = time.time()
+    foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+    rule_set = foreman.Schema.RULES()
+    rule_set.Append(self.CreateWindowsRule(now))
+    foreman.Set(foreman.Schema.RULES, rule_set)
+    foreman.Close()
+
+    opened = []
+    original_open = aff4.FACTORY.Open
+
+    def Open(urn, *args, **kwargs):
+      opened.append(rdfvalue.RDFURN(urn))
+      return original_open(urn, *args, **kwargs)
+
+    self.clients_launched = []
+    with utils.MultiStubber((flow.GRRFlow, "StartFlow", self.StartFlow),
+                            (aff4.FACTORY, "Open", Open)):
+      foreman.AssignTasksToClient(client_id)
+
+    self.assertEqual(self.clients_launched, [(client_id, "Test Flow")])
+    self.assertNotIn(client_id, opened)
+
+    fd = aff4.FACTORY.Open(client_id, token=self.token)
+    self.assertEqual(fd.Get(fd.Schema.LAST_FOREMAN_TIME),
+                     rdfvalue.RDFDatetime(int(now * 1e6)))
+
+  def testChangedRulesAreReevaluated(self):
+    client_id = rdf_client.ClientURN("C.0000000000000032")
+    fd = aff4.FACTORY.Create(client_id, "VFSGRRClient", token=self.token)
+    fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Windows 7"))
+    fd.Close()
+
+    now = time.time()
+    foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+    rule_set = foreman.Schema.RULES()
+    rule_set.Append(self.CreateWindowsRule(now - 10, regex="Linux"))
+    foreman.Set(foreman.Schema.RULES, rule_set)
+
+    self.clients_launched = []
+    with utils.Stubber(flow.GRRFlow, "StartFlow", self.StartFlow):
+      foreman.AssignTasksToClient(client_id)
+      self.assertEqual(self.clients_launched, [])
+
+      # Rules modified in place must not be served from the compiled rules.
+      rule_set = foreman.Get(foreman.Schema.RULES)
+      rule_set.Append(self.CreateWindowsRule(now))
+      foreman.Set(foreman.Schema.RULES, rule_set)
+
+      foreman.AssignTasksToClient(client_id)
+      self.assertEqual(self.clients_launched, [(client_id, "Test Flow")])
+
 
 class AFF4TestLoader(test_lib.GRRTestLoader):
   base_class = test_lib.AFF4ObjectTest
@@ -153,8 +153,8 @@ def CheckCondition(condition, check_object):
     ConditionError: If condition is bad.
   """
   try:
-    of = objectfilter.Parser(condition).Parse()
-    compiled_filter = of.Compile(objectfilter.BaseFilterImplementation)
+    compiled_filter = objectfilter.Compile(
+        condition, objectfilter.BaseFilterImplementation)
     return compiled_filter.Matches(check_object)
   except objectfilter.Error as e:
     raise ConditionError(e)
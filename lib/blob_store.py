@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""Content addressed storage for the blobs making up file contents.
+
+Files downloaded from clients are split into chunks which are stored once per
+sha256 digest and referenced from BlobImages and HashImages. Blobs used to be
+stored as AFF4MemoryStreams under aff4:/blobs, going through the same row
+oriented path as all metadata. The blob store hides where they live behind
+three bulk calls so stores better suited to large binary data can be used.
+
+Override the class used with the Blobstore.implementation config option.
+"""
+
+
+import fcntl
+import os
+import struct
+import threading
+import zlib
+
+from grr.lib import aff4
+from grr.lib import config_lib
+from grr.lib import registry
+from grr.lib import stats
+
+
+class BlobStore(object):
+  """The base class for blob stores."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  def WriteBlobs(self, blobs, compressed_blobs=None, token=None):
+    """Stores blobs.
+
+    Blobs already in the store may be skipped.
+
+    Args:
+      blobs: A dict mapping sha256 digests to the blob contents.
+      compressed_blobs: An optional dict with the zlib compressed contents of
+                        some of the blobs, keyed by digest. Stores keeping
+                        blobs compressed use these instead of compressing
+                        them again.
+      token: A security token.
+    """
+    raise NotImplementedError()
+
+  def ReadBlobs(self, digests, token=None):
+    """Reads blobs.
+
+    Args:
+      digests: An iterable of sha256 digests.
+      token: A security token.
+
+    Returns:
+      A dict mapping the digests found to the blob contents.
+    """
+    raise NotImplementedError()
+
+  def CheckBlobsExist(self, digests, token=None):
+    """Checks which blobs are in the store.
+
+    Args:
+      digests: An iterable of sha256 digests.
+      token: A security token.
+
+    Returns:
+      A dict mapping each digest to True if the blob is in the store.
+    """
+    raise NotImplementedError()
+
+
+def _Compress(blobs, compressed_blobs):
+  compressed_blobs = compressed_blobs or {}
+  return dict((digest, compressed_blobs.get(digest) or zlib.compress(data))
+              for digest, data in blobs.iteritems())
+
+
+class DataStoreBlobStore(BlobStore):
+  """Keeps blobs as AFF4MemoryStreams under aff4:/blobs in the data store."""
+
+  BLOBS_URN = aff4.ROOT_URN.Add("blobs")
+
+  def _BlobUrns(self, digests):
+    return dict((self.BLOBS_URN.Add(digest.encode("hex")), digest)
+                for digest in digests)
+
+  def WriteBlobs(self, blobs, compressed_blobs=None, token=None):
+    compressed = _Compress(blobs, compressed_blobs)
+    for urn, digest in self._BlobUrns(blobs).iteritems():
+      fd = aff4.FACTORY.Create(urn, "AFF4MemoryStream", mode="w", token=token)
+      fd.OverwriteAndClose(compressed[digest], len(blobs[digest]), sync=True)
+
+    stats.STATS.IncrementCounter("blob_store_writes", len(blobs))
+
+  def ReadBlobs(self, digests, token=None):
+    urns = self._BlobUrns(digests)
+    result = {}
+    for fd in aff4.FACTORY.MultiOpen(urns, mode="r", token=token):
+      if isinstance(fd, aff4.AFF4MemoryStreamBase):
+        result[urns[fd.urn]] = fd.Read(fd.size)
+
+    return result
+
+  def CheckBlobsExist(self, digests, token=None):
+    urns = self._BlobUrns(digests)
+    existing = set(stat["urn"] for stat in aff4.FACTORY.Stat(urns,
+                                                             token=token))
+    return dict((digest, urn in existing) for urn, digest in urns.iteritems())
+
+
+class PackFileBlobStore(BlobStore):
+  """Appends blobs to pack files in a local directory.
+
+  Every blob is written zlib compressed to the end of the current pack file, a
+  new pack is started once it grows beyond Blobstore.max_pack_size. The index
+  file maps each digest to the pack, offset and length of its blob. Both are
+  only ever appended to, so processes sharing the directory see each other's
+  blobs by reading the index records added since they last looked. Writers
+  hold an exclusive lock on the index file and write the pack data before the
+  index records pointing at it.
+  """
+
+  INDEX_RECORD = struct.Struct("<32sIQI")
+  PACK_NAME_TEMPLATE = "pack.%08d"
+
+  def __init__(self, path=None, max_pack_size=None):
+    super(PackFileBlobStore, self).__init__()
+    self.path = path or config_lib.CONFIG["Blobstore.pack_directory"]
+    self.max_pack_size = (max_pack_size or
+                          config_lib.CONFIG["Blobstore.max_pack_size"])
+    self.index_path = os.path.join(self.path, "index")
+
+    # Blobs written before switching to this store are still in the data
+    # store.
+    self.fallback = None
+    if config_lib.CONFIG["Blobstore.pack_fallback_to_data_store"]:
+      self.fallback = DataStoreBlobStore()
+
+    if not os.path.isdir(self.path):
+      os.makedirs(self.path)
+    open(self.index_path, "ab").close()
+
+    self.lock = threading.RLock()
+    # Maps digests to (pack, offset, length) tuples.
+    self.index = {}
+    # How much of the index file we have read so far.
+    self.index_offset = 0
+    self.last_pack = 0
+    # Open file handles of the packs we read from.
+    self.pack_fds = {}
+
+  def _PackPath(self, pack):
+    return os.path.join(self.path, self.PACK_NAME_TEMPLATE % pack)
+
+  def _RefreshIndex(self):
+    """Reads the index records added since we last looked."""
+    with self.lock:
+      with open(self.index_path, "rb") as fd:
+        fd.seek(self.index_offset)
+        data = fd.read()
+
+      # A writer may be half way through appending a record.
+      length = len(data) - len(data) % self.INDEX_RECORD.size
+      for offset in xrange(0, length, self.INDEX_RECORD.size):
+        digest, pack, pack_offset, blob_length = self.INDEX_RECORD.unpack_from(
+            data, offset)
+        self.index[digest] = (pack, pack_offset, blob_length)
+        self.last_pack = max(self.last_pack, pack)
+
+      self.index_offset += length
+
+  def _CheckIndex(self, digests):
+    """Returns the digests not in the index, refreshing it if needed."""
+    with self.lock:
+      missing = [digest for digest in digests if digest not in self.index]
+      if missing:
+        self._RefreshIndex()
+        missing = [digest for digest in missing if digest not in self.index]
+
+    return missing
+
+  def WriteBlobs(self, blobs, compressed_blobs=None, token=None):
+    new_digests = set(self._CheckIndex(blobs))
+    if not new_digests:
+      return
+
+    compressed = _Compress(
+        dict((digest, blobs[digest]) for digest in new_digests),
+        compressed_blobs)
+
+    with self.lock:
+      with open(self.index_path, "ab") as index_fd:
+        fcntl.flock(index_fd, fcntl.LOCK_EX)
+        try:
+          # Drop a record left half written by a crashed writer.
+          index_fd.seek(0, 2)
+          index_size = index_fd.tell()
+          if index_size % self.INDEX_RECORD.size:
+            index_fd.truncate(index_size -
+                              index_size % self.INDEX_RECORD.size)
+
+          self._RefreshIndex()
+          records = self._AppendToPacks(
+              [(digest, data) for digest, data in compressed.iteritems()
+               if digest not in self.index])
+
+          index_fd.write("".join(records))
+          index_fd.flush()
+          os.fsync(index_fd.fileno())
+        finally:
+          fcntl.flock(index_fd, fcntl.LOCK_UN)
+
+      self._RefreshIndex()
+
+    stats.STATS.IncrementCounter("blob_store_writes", len(records))
+
+  def _AppendToPacks(self, blobs):
+    """Writes blobs to the packs, returns the index records for them."""
+    records = []
+    if not blobs:
+      return records
+
+    pack = max(self.last_pack, 1)
+    pack_fd = open(self._PackPath(pack), "ab")
+    try:
+      pack_fd.seek(0, 2)
+      offset = pack_fd.tell()
+      for digest, data in blobs:
+        if offset and offset + len(data) > self.max_pack_size:
+          pack_fd.flush()
+          os.fsync(pack_fd.fileno())
+          pack_fd.close()
+
+          pack += 1
+          pack_fd = open(self._PackPath(pack), "ab")
+          offset = 0
+
+        pack_fd.write(data)
+        records.append(self.INDEX_RECORD.pack(digest, pack, offset, len(data)))
+        offset += len(data)
+
+      pack_fd.flush()
+      os.fsync(pack_fd.fileno())
+    finally:
+      pack_fd.close()
+
+    return records
+
+  def _GetPackFile(self, pack):
+    try:
+      return self.pack_fds[pack]
+    except KeyError:
+      fd = self.pack_fds[pack] = open(self._PackPath(pack), "rb")
+      return fd
+
+  def ReadBlobs(self, digests, token=None):
+    digests = list(digests)
+    missing = self._CheckIndex(digests)
+
+    compressed = {}
+    with self.lock:
+      # Read each pack front to back.
+      for (pack, offset, length), digest in sorted(
+          (self.index[digest], digest) for digest in digests
+          if digest in self.index):
+        fd = self._GetPackFile(pack)
+        fd.seek(offset)
+        compressed[digest] = fd.read(length)
+
+    result = dict((digest, zlib.decompress(data))
+                  for digest, data in compressed.iteritems())
+
+    if missing and self.fallback:
+      result.update(self.fallback.ReadBlobs(missing, token=token))
+
+    return result
+
+  def CheckBlobsExist(self, digests, token=None):
+    digests = list(digests)
+    missing = self._CheckIndex(digests)
+    result = dict((digest, True) for digest in digests)
+
+    if missing:
+      if self.fallback:
+        result.update(self.fallback.CheckBlobsExist(missing, token=token))
+      else:
+        result.update((digest, False) for digest in missing)
+
+    return result
+
+
+BLOB_STORE = None
+
+
+class BlobStoreInit(registry.InitHook):
+  """Init hook class for the blob store."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("blob_store_writes")
+
+    global BLOB_STORE  # pylint: disable=global-statement
+
+    BLOB_STORE = BlobStore.classes[
+        config_lib.CONFIG["Blobstore.implementation"]]()
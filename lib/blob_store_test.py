@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Tests for the blob stores."""
+
+
+import hashlib
+import os
+import StringIO
+
+from grr.lib import aff4
+from grr.lib import blob_store
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class BlobStoreTestMixin(object):
+  """Tests common to all the blob stores."""
+
+  def CreateBlobStore(self):
+    raise NotImplementedError()
+
+  def setUp(self):
+    super(BlobStoreTestMixin, self).setUp()
+    self.blob_store = self.CreateBlobStore()
+    self.blobs = {}
+    for i in range(10):
+      data = "blob %d" % i * 1000
+      self.blobs[hashlib.sha256(data).digest()] = data
+
+  def testWriteAndReadBlobs(self):
+    self.blob_store.WriteBlobs(self.blobs, token=self.token)
+
+    self.assertEqual(self.blob_store.ReadBlobs(self.blobs, token=self.token),
+                     self.blobs)
+
+  def testReadMissingBlobs(self):
+    self.blob_store.WriteBlobs(self.blobs, token=self.token)
+
+    missing = hashlib.sha256("missing").digest()
+    digests = list(self.blobs)[:3] + [missing]
+    result = self.blob_store.ReadBlobs(digests, token=self.token)
+    self.assertItemsEqual(result, digests[:3])
+
+  def testCheckBlobsExist(self):
+    digests = sorted(self.blobs)
+    self.blob_store.WriteBlobs(dict((digest, self.blobs[digest])
+                                    for digest in digests[:5]),
+                               token=self.token)
+
+    result = self.blob_store.CheckBlobsExist(digests, token=self.token)
+    self.assertEqual(result, dict((digest, i < 5)
+                                  for i, digest in enumerate(digests)))
+
+  def testWriteCompressedBlobs(self):
+    digest, data = self.blobs.items()[0]
+    self.blob_store.WriteBlobs({digest: data},
+                               compressed_blobs={digest: data.encode("zlib")},
+                               token=self.token)
+
+    self.assertEqual(self.blob_store.ReadBlobs([digest], token=self.token),
+                     {digest: data})
+
+  def testBlobImageReadsFromBlobStore(self):
+    data = os.urandom(200 * 1024)
+    with utils.Stubber(blob_store, "BLOB_STORE", self.blob_store):
+      fd = aff4.FACTORY.Create("aff4:/C.1234/blobimage", "BlobImage",
+                               token=self.token)
+      fd.SetChunksize(64 * 1024)
+      fd.AppendContent(StringIO.StringIO(data))
+      fd.Close()
+
+      fd = aff4.FACTORY.Open("aff4:/C.1234/blobimage", token=self.token)
+      self.assertEqual(fd.Read(len(data)), data)
+
+
+class DataStoreBlobStoreTest(BlobStoreTestMixin, test_lib.GRRBaseTest):
+  """Tests for the data store blob store."""
+
+  def CreateBlobStore(self):
+    return blob_store.DataStoreBlobStore()
+
+  def testBlobsAreStoredInAFF4(self):
+    digest, data = self.blobs.items()[0]
+    self.blob_store.WriteBlobs({digest: data}, token=self.token)
+
+    fd = aff4.FACTORY.Open(aff4.ROOT_URN.Add("blobs").Add(digest.encode("hex")),
+                           token=self.token)
+    self.assertEqual(fd.Read(len(data)), data)
+
+
+class PackFileBlobStoreTest(BlobStoreTestMixin, test_lib.GRRBaseTest):
+  """Tests for the pack file blob store."""
+
+  def CreateBlobStore(self, max_pack_size=None):
+    with test_lib.ConfigOverrider({
+        "Blobstore.pack_fallback_to_data_store": False}):
+      return blob_store.PackFileBlobStore(
+          path=os.path.join(self.temp_dir, "blobs"),
+          max_pack_size=max_pack_size)
+
+  def testBlobsAreAppendedToPacks(self):
+    self.blob_store = self.CreateBlobStore(max_pack_size=100)
+    self.blob_store.WriteBlobs(self.blobs, token=self.token)
+
+    packs = sorted(name for name in os.listdir(self.blob_store.path)
+                   if name.startswith("pack."))
+    self.assertGreater(len(packs), 1)
+
+    self.assertEqual(self.blob_store.ReadBlobs(self.blobs, token=self.token),
+                     self.blobs)
+
+  def testDuplicateBlobsAreWrittenOnce(self):
+    self.blob_store.WriteBlobs(self.blobs, token=self.token)
+    index_size = os.path.getsize(self.blob_store.index_path)
+
+    self.blob_store.WriteBlobs(self.blobs, token=self.token)
+    self.assertEqual(os.path.getsize(self.blob_store.index_path), index_size)
+
+  def testBlobsWrittenByOtherStoresAreVisible(self):
+    other_store = self.CreateBlobStore()
+    self.assertFalse(any(self.blob_store.CheckBlobsExist(
+        self.blobs, token=self.token).values()))
+
+    other_store.WriteBlobs(self.blobs, token=self.token)
+
+    self.assertTrue(all(self.blob_store.CheckBlobsExist(
+        self.blobs, token=self.token).values()))
+    self.assertEqual(self.blob_store.ReadBlobs(self.blobs, token=self.token),
+                     self.blobs)
+
+  def testPartialIndexRecordIsDropped(self):
+    digests = sorted(self.blobs)
+    self.blob_store.WriteBlobs({digests[0]: self.blobs[digests[0]]},
+                               token=self.token)
+
+    # A writer crashed while appending to the index.
+    with open(self.blob_store.index_path, "ab") as fd:
+      fd.write("torn")
+
+    store = self.CreateBlobStore()
+    store.WriteBlobs({digests[1]: self.blobs[digests[1]]}, token=self.token)
+    self.assertEqual(os.path.getsize(store.index_path),
+                     2 * store.INDEX_RECORD.size)
+
+    store = self.CreateBlobStore()
+    self.assertEqual(store.ReadBlobs(digests[:2], token=self.token),
+                     dict((digest, self.blobs[digest])
+                          for digest in digests[:2]))
+
+  def testFallbackToDataStore(self):
+    digest, data = self.blobs.items()[0]
+    blob_store.DataStoreBlobStore().WriteBlobs({digest: data},
+                                               token=self.token)
+    self.assertFalse(self.blob_store.CheckBlobsExist(
+        [digest], token=self.token)[digest])
+
+    store = blob_store.PackFileBlobStore(
+        path=os.path.join(self.temp_dir, "blobs"))
+    self.assertTrue(store.CheckBlobsExist([digest], token=self.token)[digest])
+    self.assertEqual(store.ReadBlobs([digest], token=self.token),
+                     {digest: data})
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
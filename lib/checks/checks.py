@@ -511,11 +511,36 @@ class CheckRegistry(object):
 
   triggers = triggers.Triggers()
 
+  # The ids of the checks triggered by each condition, nested as
+  # os_name -> cpe -> label -> artifact -> set of check ids. Conditions which
+  # do not restrict an attribute are filed under None.
+  trigger_index = {}
+
   @classmethod
   def Clear(cls):
     """Remove all checks and triggers from the registry."""
     cls.checks = {}
     cls.triggers = triggers.Triggers()
+    cls.trigger_index = {}
+
+  @classmethod
+  def _IndexCheck(cls, check):
+    for condition in check.triggers.conditions:
+      cls.trigger_index.setdefault(
+          condition.os_name or None, {}).setdefault(
+              condition.cpe or None, {}).setdefault(
+                  condition.label or None, {}).setdefault(
+                      condition.artifact, set()).add(check.check_id)
+
+  @classmethod
+  def _UnindexCheck(cls, check):
+    for condition in check.triggers.conditions:
+      try:
+        cls.trigger_index[condition.os_name or None][condition.cpe or None][
+            condition.label or None][condition.artifact].discard(
+                check.check_id)
+      except KeyError:
+        pass
 
   @classmethod
   def RegisterCheck(cls, check, source="unknown", overwrite_if_exists=False):
@@ -525,8 +550,11 @@ class CheckRegistry(object):
                             "overwrite_if_exists is set to False." %
                             check.check_id)
     check.loaded_from = source
+    if check.check_id in cls.checks:
+      cls._UnindexCheck(cls.checks[check.check_id])
     cls.checks[check.check_id] = check
     cls.triggers.Update(check.triggers, check)
+    cls._IndexCheck(check)
 
   @staticmethod
   def _AsList(arg):
@@ -561,6 +589,41 @@ class CheckRegistry(object):
     for condition in itertools.product(artifact, os_name, cpe, labels):
       yield condition
 
+  @classmethod
+  def _MatchingTriggers(cls, os_name=None, cpe=None, labels=None):
+    """Finds the indexed conditions that apply to a host.
+
+    Only the parts of the index matching one of the host's attributes, or
+    not restricting the attribute at all, are visited. As with Conditions(),
+    an empty list for any attribute means there are no conditions at all.
+
+    Args:
+      os_name: 0+ OS names.
+      cpe: 0+ CPE identifiers.
+      labels: 0+ GRR labels.
+
+    Yields:
+      Dicts mapping artifact names to the ids of the checks they trigger.
+    """
+    os_names = cls._AsList(os_name)
+    cpes = cls._AsList(cpe)
+    labels = cls._AsList(labels)
+    if not (os_names and cpes and labels):
+      return
+
+    for os_key in set(os_names + [None]):
+      cpe_map = cls.trigger_index.get(os_key)
+      if not cpe_map:
+        continue
+      for cpe_key in set(cpes + [None]):
+        label_map = cpe_map.get(cpe_key)
+        if not label_map:
+          continue
+        for label_key in set(labels + [None]):
+          artifact_map = label_map.get(label_key)
+          if artifact_map:
+            yield artifact_map
+
   @classmethod
   def FindChecks(cls, artifact=None, os_name=None, cpe=None, labels=None,
                  restrict_checks=None):
@@ -583,14 +646,12 @@ class CheckRegistry(object):
       the check_ids that apply.
     """
     check_ids = set()
-    conditions = list(cls.Conditions(artifact, os_name, cpe, labels))
-    for chk_id, chk in cls.checks.iteritems():
-      if restrict_checks and chk_id not in restrict_checks:
-        continue
-      for condition in conditions:
-        if chk.triggers.Match(*condition):
-          check_ids.add(chk_id)
-          break  # No need to keep checking other conditions.
+    artifacts = cls._AsList(artifact)
+    for artifact_map in cls._MatchingTriggers(os_name, cpe, labels):
+      for artifact_name in artifacts:
+        check_ids.update(artifact_map.get(artifact_name, ()))
+    if restrict_checks:
+      check_ids.intersection_update(restrict_checks)
     return check_ids
 
   @classmethod
@@ -608,12 +669,13 @@ class CheckRegistry(object):
       the artifacts that should be collected.
     """
     results = set()
-    for condition in cls.Conditions(None, os_name, cpe, labels):
-      trigger = condition[1:]
-      for chk in cls.checks.values():
-        if restrict_checks and chk.check_id not in restrict_checks:
+    for artifact_map in cls._MatchingTriggers(os_name, cpe, labels):
+      for artifact_name, check_ids in artifact_map.iteritems():
+        if not check_ids:
           continue
-        results.update(chk.triggers.Artifacts(*trigger))
+        if restrict_checks and check_ids.isdisjoint(restrict_checks):
+          continue
+        results.add(artifact_name)
     return results
 
   @classmethod
@@ -635,14 +697,16 @@ class CheckRegistry(object):
     """
     # All the conditions that apply to this host.
     artifacts = host_data.keys()
-    check_ids = cls.FindChecks(artifacts, os_name, cpe, labels)
+    check_ids = cls.FindChecks(artifacts, os_name, cpe, labels,
+                               restrict_checks=restrict_checks)
+    if not check_ids:
+      return
+
     conditions = list(cls.Conditions(artifacts, os_name, cpe, labels))
     for check_id in check_ids:
       # skip if check in list of excluded checks
       if exclude_checks and check_id in exclude_checks:
         continue
-      if restrict_checks and check_id not in restrict_checks:
-        continue
       try:
         chk = cls.checks[check_id]
         yield chk.Parse(conditions, host_data)
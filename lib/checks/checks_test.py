@@ -28,6 +28,16 @@ WMI_SW = []
 SSHD_CFG = []
 
 
+def SyntheticCheck(check_id, artifact, os_name=None, label=None):
+  target = {}
+  if os_name:
+    target["os"] = [os_name]
+  if label:
+    target["label"] = [label]
+  return checks.Check(check_id=check_id, match="ANY", method=[{
+      "match": "ANY", "target": target, "probe": [{"artifact": artifact}]}])
+
+
 def GetDPKGData():
   if DPKG_SW:
     return DPKG_SW
@@ -286,6 +296,51 @@ class CheckRegistryTests(test_lib.GRRBaseTest):
         os_name="Linux", restrict_checks=["SW-CHECK"]))
     self.assertItemsEqual(expect, result)
 
+  def testOverwrittenChecksAreReindexed(self):
+    checks.CheckRegistry.RegisterCheck(
+        SyntheticCheck("REINDEX-CHECK", "ReindexArtifact", os_name="Linux"),
+        overwrite_if_exists=True)
+    self.assertIn("REINDEX-CHECK", checks.CheckRegistry.FindChecks(
+        artifact="ReindexArtifact", os_name="Linux"))
+
+    checks.CheckRegistry.RegisterCheck(
+        SyntheticCheck("REINDEX-CHECK", "OtherArtifact", label="bar"),
+        overwrite_if_exists=True)
+    self.assertNotIn("REINDEX-CHECK", checks.CheckRegistry.FindChecks(
+        artifact="ReindexArtifact", os_name="Linux"))
+    self.assertNotIn("ReindexArtifact", checks.CheckRegistry.SelectArtifacts(
+        os_name="Linux"))
+    self.assertIn("REINDEX-CHECK", checks.CheckRegistry.FindChecks(
+        artifact="OtherArtifact", os_name="Linux", labels=["foo", "bar"]))
+    self.assertIn("OtherArtifact", checks.CheckRegistry.SelectArtifacts(
+        labels="bar"))
+
+  def testPartiallyMatchingTargetsDoNotTriggerChecks(self):
+    checks.CheckRegistry.RegisterCheck(
+        SyntheticCheck("PARTIAL-CHECK", "PartialArtifact", os_name="Linux",
+                       label="baz"), overwrite_if_exists=True)
+    self.assertNotIn("PARTIAL-CHECK", checks.CheckRegistry.FindChecks(
+        artifact="PartialArtifact", os_name="Linux"))
+    self.assertNotIn("PARTIAL-CHECK", checks.CheckRegistry.FindChecks(
+        artifact="PartialArtifact", labels="baz"))
+    self.assertIn("PARTIAL-CHECK", checks.CheckRegistry.FindChecks(
+        artifact="PartialArtifact", os_name=["Darwin", "Linux"],
+        labels="baz"))
+
+  def testEmptyAttributeListsGiveNoConditions(self):
+    checks.CheckRegistry.RegisterCheck(
+        SyntheticCheck("ANY-HOST-CHECK", "AnyHostArtifact"),
+        overwrite_if_exists=True)
+    self.assertIn("ANY-HOST-CHECK", checks.CheckRegistry.FindChecks(
+        artifact="AnyHostArtifact", os_name="Linux"))
+    self.assertFalse(list(checks.CheckRegistry.Conditions(
+        "AnyHostArtifact", "Linux", labels=[])))
+    self.assertFalse(checks.CheckRegistry.FindChecks(
+        artifact="AnyHostArtifact", os_name="Linux", labels=[]))
+    self.assertFalse(checks.CheckRegistry.SelectArtifacts(
+        os_name="Linux", labels=[]))
+    self.assertFalse(checks.CheckRegistry.SelectArtifacts(os_name=[]))
+
 
 class ProcessHostDataTests(checks_test_lib.HostCheckTest):
 
@@ -579,6 +634,64 @@ class HintDefinitionTests(ChecksTestBase):
     self.assertEqual(generic_format.strip(), probe_2.hint.format)
 
 
+class CheckRegistryBenchmarks(test_lib.AverageMicroBenchmarks):
+  """Times the selection of checks for a host."""
+
+  REPEATS = 100
+  units = "us"
+
+  def setUp(self):
+    super(CheckRegistryBenchmarks, self).setUp()
+    registry = checks.CheckRegistry
+    self.saved = (registry.checks, registry.triggers, registry.trigger_index)
+    registry.Clear()
+
+    # 500 checks over 100 artifacts, most of them restricted to an OS and some
+    # to a label.
+    os_names = ["Linux", "Windows", "Darwin", None]
+    for i in range(500):
+      registry.RegisterCheck(SyntheticCheck(
+          "CHECK-%d" % i, "Artifact%d" % (i % 100), os_name=os_names[i % 4],
+          label="label%d" % (i % 20) if i % 3 == 0 else None))
+
+    # A host with many artifacts and labels.
+    self.artifacts = ["Artifact%d" % i for i in range(0, 100, 2)]
+    self.labels = ["label%d" % i for i in range(10)]
+
+  def tearDown(self):
+    super(CheckRegistryBenchmarks, self).tearDown()
+    registry = checks.CheckRegistry
+    registry.checks, registry.triggers, registry.trigger_index = self.saved
+
+  def testFindChecks(self):
+    def FindChecks():
+      return len(checks.CheckRegistry.FindChecks(
+          self.artifacts, "Linux", labels=self.labels))
+
+    def ScanChecks():
+      # What FindChecks used to do: try every condition on every check.
+      conditions = list(checks.CheckRegistry.Conditions(
+          self.artifacts, "Linux", None, self.labels))
+      check_ids = set()
+      for check_id, chk in checks.CheckRegistry.checks.iteritems():
+        for condition in conditions:
+          if chk.triggers.Match(*condition):
+            check_ids.add(check_id)
+            break
+      return len(check_ids)
+
+    self.assertEqual(FindChecks(), ScanChecks())
+    self.TimeIt(ScanChecks, "Scan all checks", repetitions=3)
+    self.TimeIt(FindChecks, "Trigger index lookup")
+
+  def testSelectArtifacts(self):
+    def SelectArtifacts():
+      return len(checks.CheckRegistry.SelectArtifacts(
+          "Windows", labels=self.labels))
+
+    self.TimeIt(SelectArtifacts, "Trigger index lookup")
+
+
 def main(argv):
   # Run the full test suite
   test_lib.GrrTestProgram(argv=argv)
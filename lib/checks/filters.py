@@ -223,8 +223,8 @@ class ObjectFilter(Filter):
 
   def _Compile(self, expression):
     try:
-      of = objectfilter.Parser(expression).Parse()
-      return of.Compile(objectfilter.LowercaseAttributeFilterImplementation)
+      return objectfilter.Compile(
+          expression, objectfilter.LowercaseAttributeFilterImplementation)
     except objectfilter.Error as e:
       raise DefinitionError(e)
 
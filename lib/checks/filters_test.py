@@ -2,6 +2,7 @@
 """Tests for grr.lib.checks.filters."""
 import collections
 from grr.lib import flags
+from grr.lib import objectfilter
 from grr.lib import test_lib
 from grr.lib.checks import checks
 from grr.lib.checks import filters
@@ -432,6 +433,59 @@ class HandlerTests(test_lib.GRRBaseTest):
     self.assertItemsEqual(expected, handler.Parse(self.all))
 
 
+class ObjectFilterBenchmarks(test_lib.AverageMicroBenchmarks):
+  """Times object filters over the results of many hosts."""
+
+  REPEATS = 10
+  units = "ms"
+
+  def setUp(self):
+    super(ObjectFilterBenchmarks, self).setUp()
+    self.stat_entries = [
+        rdf_client.StatEntry(
+            pathspec=rdf_paths.PathSpec(path="/etc/file%d" % i),
+            st_mode=0o100644 | (i % 3 << 1), st_uid=i % 5)
+        for i in range(2000)]
+    self.processes = [
+        rdf_client.Process(name="proc%d" % (i % 50), pid=i,
+                           cmdline=["/usr/bin/proc%d" % (i % 50), "-d"])
+        for i in range(2000)]
+
+  def _TimeFilters(self, name, objs, expression, matches):
+    def Uncompiled():
+      filt = objectfilter.Parser(expression).Parse().Compile(
+          objectfilter.LowercaseAttributeFilterImplementation)
+      # One host at a time, as checks used to do.
+      results = []
+      for i in range(0, len(objs), 20):
+        results.extend(filt.Filter(objs[i:i + 20]))
+      self.assertEqual(len(results), matches)
+
+    def Cached():
+      results = []
+      for i in range(0, len(objs), 20):
+        results.extend(filters.ObjectFilter().Parse(objs[i:i + 20], expression))
+      self.assertEqual(len(results), matches)
+
+    def Batch():
+      filt = objectfilter.Compile(
+          expression, objectfilter.LowercaseAttributeFilterImplementation)
+      self.assertEqual(len(filt.Filter(objs)), matches)
+
+    self.TimeIt(Uncompiled, "%s: compiled per host" % name)
+    self.TimeIt(Cached, "%s: cached filter per host" % name)
+    self.TimeIt(Batch, "%s: one batch" % name)
+
+  def testStatEntries(self):
+    self._TimeFilters("StatEntry", self.stat_entries,
+                      "st_uid is 0 and st_mode > 33188", 133)
+
+  def testProcesses(self):
+    self._TimeFilters("Process", self.processes,
+                      "name is 'proc7' or cmdline contains '/usr/bin/proc8'",
+                      80)
+
+
 def main(argv):
   test_lib.main(argv)
 
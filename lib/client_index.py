@@ -24,6 +24,9 @@ class ClientIndex(keyword_index.AFF4KeywordIndex):
   END_TIME_PREFIX = "end_date:"
   END_TIME_PREFIX_LEN = len(END_TIME_PREFIX)
 
+  # Every client is associated with ".".
+  UNIVERSAL_KEYWORDS = frozenset(["."])
+
   # We accept and return client URNs, but store client ids,
   # e.g. "C.00aaeccbb45f33a3".
 
@@ -90,7 +93,9 @@ class ClientIndex(keyword_index.AFF4KeywordIndex):
 
     # If there are any unversioned keywords in the query, add the universal
     # keyword so we are assured to have an accurate last update time for each
-    # client.
+    # client. Lookup() reads the rarest keyword first, so the universal keyword
+    # is only probed for the clients matching the other keywords and the
+    # directory of its compacted blocks tells us which blocks to read.
     last_seen_map = None
     if unversioned_keywords:
       filtered_keywords.append(".")
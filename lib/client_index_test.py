@@ -2,8 +2,11 @@
 """Tests for grr.lib.client_index."""
 
 
+import time
+
 from grr.lib import aff4
 from grr.lib import client_index
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import test_lib
 from grr.lib import utils
@@ -279,6 +282,59 @@ class ClientIndexTest(test_lib.AFF4ObjectTest):
                           [m[host] for host in hosts])
 
 
+class ClientIndexBenchmarks(test_lib.MicroBenchmarks):
+  """Measures client index lookups in a large fleet.
+
+  These tests should be run with --labels=benchmark
+  """
+  units = "s"
+
+  CLIENTS = 500000
+
+  def _WritePostingList(self, index, keyword, client_ids, timestamp):
+    data_store.DB.MultiSet(
+        index.urn.Add(keyword),
+        dict((index.INDEX_COLUMN_FORMAT % client_id, [("", timestamp)])
+             for client_id in client_ids),
+        token=self.token)
+
+  def _TimeLookups(self, index, suffix):
+    queries = [["host:rare"],
+               ["host:rare", "label:common"],
+               ["+host:rare"],
+               ["+host:rare", "label:common"],
+               ["."]]
+    for keywords in queries:
+      start_time = time.time()
+      results = index.LookupClients(keywords)
+      self.AddResult("LookupClients(%s) %s" % (keywords, suffix),
+                     time.time() - start_time, len(results))
+
+  @test_lib.SetLabel("benchmark")
+  def testLookupClients(self):
+    urn = "aff4:/client-index-benchmark/"
+    index = aff4.FACTORY.Create(urn, aff4_type="ClientIndex", mode="rw",
+                                token=self.token)
+    now = int(time.time() * 1e6)
+    client_ids = ["C.%016x" % (i * 2654435761) for i in xrange(self.CLIENTS)]
+
+    start_time = time.time()
+    self._WritePostingList(index, ".", client_ids, now)
+    self._WritePostingList(index, "label:common", client_ids[::2], now)
+    self._WritePostingList(index, "host:rare", client_ids[::50000], now)
+    self.AddResult("Write %d clients" % self.CLIENTS,
+                   time.time() - start_time, 1)
+
+    # Lookups never compact the lists they read.
+    self._TimeLookups(index, "uncompacted")
+
+    start_time = time.time()
+    index.CompactPostingLists([".", "label:common", "host:rare"])
+    self.AddResult("Compact posting lists", time.time() - start_time, 1)
+
+    self._TimeLookups(index, "compacted")
+
+
 def main(argv):
   test_lib.main(argv)
 
@@ -23,6 +23,7 @@ from grr.lib import type_info
 from grr.lib import utils
 
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import structs as rdf_structs
 
 # Constants.
 ENCRYPT = 1
@@ -316,6 +317,106 @@ class ReceivedCipher(Cipher):
         pass
 
 
+class ReceivedMessage(object):
+  """A GrrMessage received from a client, only decoded as far as needed.
+
+  The frontend only looks at a few fields of the messages it receives before
+  queueing them for the workers. Instead of parsing every message into a
+  GrrMessage and serializing it again, we keep the serialized message and only
+  decode the routing fields, on first access.
+
+  Fields set by the frontend, e.g. auth_state and source, are appended to the
+  serialized message when it is written - when parsing a protobuf the last
+  occurrence of a field wins.
+  """
+
+  ROUTING_FIELDS = frozenset(["session_id", "request_id", "response_id",
+                              "type", "priority", "task_id"])
+
+  # Fields which can be set in addition to the routing fields.
+  SETTABLE_FIELDS = ROUTING_FIELDS | frozenset(["auth_state", "source"])
+
+  # Maps the encoded tags of the routing fields to their type descriptors.
+  _routing_type_infos = None
+
+  def __init__(self, data, **kwargs):
+    self.__dict__.update(data=data, _wire_formats={}, _values={}, _changed=[],
+                         _message=None)
+
+    routing_type_infos = self._GetRoutingTypeInfos()
+    for wire_format in rdf_structs.SplitBuffer(data):
+      type_info_obj = routing_type_infos.get(wire_format[0])
+      if type_info_obj is not None:
+        self._wire_formats[type_info_obj.name] = wire_format
+
+    for attr, value in kwargs.iteritems():
+      setattr(self, attr, value)
+
+  @classmethod
+  def _GetRoutingTypeInfos(cls):
+    if cls._routing_type_infos is None:
+      cls._routing_type_infos = dict(
+          (type_info_obj.encoded_tag, type_info_obj)
+          for type_info_obj in (rdf_flows.GrrMessage.type_infos.get(name)
+                                for name in cls.ROUTING_FIELDS))
+
+    return cls._routing_type_infos
+
+  def __getattr__(self, attr):
+    if attr not in self.SETTABLE_FIELDS:
+      raise AttributeError("'%s' object has no attribute '%s'" % (
+          self.__class__.__name__, attr))
+
+    try:
+      return self._values[attr]
+    except KeyError:
+      pass
+
+    if attr not in self.ROUTING_FIELDS:
+      return self.ToGrrMessage().Get(attr)
+
+    type_info_obj = rdf_flows.GrrMessage.type_infos.get(attr)
+    wire_format = self._wire_formats.get(attr)
+    if wire_format is None:
+      result = type_info_obj.GetDefault()
+    else:
+      result = type_info_obj.ConvertFromWireFormat(wire_format)
+
+    self._values[attr] = result
+    return result
+
+  def __setattr__(self, attr, value):
+    if attr not in self.SETTABLE_FIELDS:
+      raise AttributeError("Field %s can not be set." % attr)
+
+    type_info_obj = rdf_flows.GrrMessage.type_infos.get(attr)
+    self._values[attr] = type_info_obj.Validate(value)
+    if attr not in self._changed:
+      self._changed.append(attr)
+
+    self.__dict__["_message"] = None
+
+  @property
+  def payload(self):
+    return self.ToGrrMessage().payload
+
+  def SerializeToString(self):
+    """Returns the serialized message, including the fields we set."""
+    output = [self.data]
+    for attr in self._changed:
+      output.extend(rdf_flows.GrrMessage.type_infos.get(
+          attr).ConvertToWireFormat(self._values[attr]))
+
+    return "".join(output)
+
+  def ToGrrMessage(self):
+    """Returns the fully parsed GrrMessage."""
+    if self._message is None:
+      self.__dict__["_message"] = rdf_flows.GrrMessage(self.SerializeToString())
+
+    return self._message
+
+
 class Communicator(object):
   """A class responsible for encoding and decoding comms."""
   server_name = None
@@ -476,6 +577,39 @@ class Communicator(object):
     Raises:
       DecodingError: If decompression fails.
     """
+    data = self._DecompressMessageListData(signed_message_list)
+
+    try:
+      result = rdf_flows.MessageList(data)
+    except rdfvalue.DecodeError:
+      raise DecodingError("RDFValue parsing failed.")
+
+    return result
+
+  def SplitMessageList(self, signed_message_list):
+    """Splits the message data from signed_message_list into messages.
+
+    Args:
+      signed_message_list: A SignedMessageList rdfvalue with some data in it.
+
+    Returns:
+      a list of ReceivedMessage objects.
+
+    Raises:
+      DecodingError: If decompression or splitting fails.
+    """
+    data = self._DecompressMessageListData(signed_message_list)
+    job_tag = rdf_flows.MessageList.type_infos.get("job").encoded_tag
+
+    try:
+      return [ReceivedMessage(encoded_field)
+              for encoded_tag, _, encoded_field in rdf_structs.SplitBuffer(data)
+              if encoded_tag == job_tag]
+    except (IndexError, ValueError):
+      raise DecodingError("RDFValue parsing failed.")
+
+  def _DecompressMessageListData(self, signed_message_list):
+    """Returns the serialized MessageList in signed_message_list."""
     compression = signed_message_list.compression
     if compression == rdf_flows.SignedMessageList.CompressionType.UNCOMPRESSED:
       data = signed_message_list.message_list
@@ -489,18 +623,15 @@ class Communicator(object):
     else:
       raise DecodingError("Compression scheme not supported")
 
-    try:
-      result = rdf_flows.MessageList(data)
-    except rdfvalue.DecodeError:
-      raise DecodingError("RDFValue parsing failed.")
-
-    return result
+    return data
 
-  def DecodeMessages(self, response_comms):
+  def DecodeMessages(self, response_comms, partial=False):
     """Extract and verify server message.
 
     Args:
         response_comms: A ClientCommunication rdfvalue
+        partial: If True, the messages are returned as ReceivedMessage objects
+                 which only decode the fields needed to route them.
 
     Returns:
        list of messages and the CN where they came from.
@@ -538,7 +669,10 @@ class Communicator(object):
       except rdfvalue.DecodeError as e:
         raise DecryptionError(str(e))
 
-      message_list = self.DecompressMessageList(signed_message_list)
+      if partial:
+        messages = self.SplitMessageList(signed_message_list)
+      else:
+        messages = self.DecompressMessageList(signed_message_list).job
 
     else:
       # The message is not encrypted. We do not allow unencrypted
@@ -551,11 +685,11 @@ class Communicator(object):
         response_comms.api_version)
 
     # Mark messages as authenticated and where they came from.
-    for msg in message_list.job:
+    for msg in messages:
       msg.auth_state = auth_state
       msg.source = cipher.cipher_metadata.source
 
-    return (message_list.job, cipher.cipher_metadata.source,
+    return (messages, cipher.cipher_metadata.source,
             signed_message_list.timestamp)
 
   def VerifyMessageSignature(
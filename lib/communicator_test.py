@@ -19,6 +19,7 @@ from grr.client import comms
 from grr.lib import aff4
 from grr.lib import communicator
 from grr.lib import config_lib
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import queues
@@ -151,6 +152,138 @@ class ClientCommsTest(test_lib.GRRBaseTest):
     self.assertEqual(decoded_messages[0].auth_state,
                      rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
 
+  def testPartialDecoding(self):
+    """Test that partially decoded messages match the fully decoded ones."""
+    self.MakeClientAFF4Record()
+
+    message_list = rdf_flows.MessageList()
+    for i in range(1, 11):
+      message = rdf_flows.GrrMessage(
+          session_id=rdfvalue.SessionID(base="aff4:/flows",
+                                        queue=queues.FLOWS,
+                                        flow_name=i),
+          request_id=i, response_id=2 * i, name="OMG it's a string",
+          payload=rdfvalue.RDFInteger(i))
+      if i == 10:
+        message.type = rdf_flows.GrrMessage.Type.STATUS
+      message_list.job.Append(message)
+
+    # Use increasing timestamps so neither is considered a replay.
+    response_comms = rdf_flows.ClientCommunication()
+    self.client_communicator.EncodeMessages(message_list, response_comms,
+                                            timestamp=1000)
+    decoded_messages, source, _ = self.server_communicator.DecodeMessages(
+        response_comms)
+
+    response_comms = rdf_flows.ClientCommunication()
+    self.client_communicator.EncodeMessages(message_list, response_comms,
+                                            timestamp=2000)
+    partial_messages, partial_source, _ = (
+        self.server_communicator.DecodeMessages(response_comms, partial=True))
+
+    self.assertEqual(partial_source, source)
+    self.assertEqual(len(partial_messages), len(decoded_messages))
+    for decoded, partial in zip(decoded_messages, partial_messages):
+      self.assertTrue(isinstance(partial, communicator.ReceivedMessage))
+      for field in communicator.ReceivedMessage.ROUTING_FIELDS:
+        self.assertEqual(getattr(partial, field), getattr(decoded, field))
+
+      self.assertEqual(partial.auth_state,
+                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+      self.assertEqual(partial.auth_state, decoded.auth_state)
+      self.assertEqual(partial.source, decoded.source)
+      self.assertEqual(partial.payload, decoded.payload)
+      self.assertEqual(rdf_flows.GrrMessage(partial.SerializeToString()),
+                       decoded)
+
+  def testReceivedMessageFieldsCanBeChanged(self):
+    message = rdf_flows.GrrMessage(session_id="aff4:/flows/W:1234",
+                                   request_id=1, response_id=2)
+    received = communicator.ReceivedMessage(message.SerializeToString(),
+                                            source="C.1234567812345678")
+
+    received.response_id = 5
+    self.assertEqual(received.response_id, 5)
+    self.assertRaises(AttributeError, setattr, received, "name", "foo")
+
+    message.response_id = 5
+    message.source = "C.1234567812345678"
+    self.assertEqual(rdf_flows.GrrMessage(received.SerializeToString()),
+                     message)
+    self.assertEqual(received.ToGrrMessage(), message)
+
+  def _CreateBufferingCommunicator(self):
+    with test_lib.ConfigOverrider({"Frontend.liveness_flush_interval": 3600}):
+      return ServerCommunicatorFake(certificate=self.server_certificate,
+                                    private_key=self.server_private_key,
+                                    token=self.token)
+
+  def _GetClientPing(self):
+    client = aff4.FACTORY.Open(self.client_communicator.common_name,
+                               token=self.token, ignore_cache=True)
+    return client.Get(client.Schema.PING)
+
+  def testLivenessUpdatesAreBuffered(self):
+    """Test that pings are only written when the liveness buffer is flushed."""
+    self.MakeClientAFF4Record()
+    self.server_communicator = self._CreateBufferingCommunicator()
+
+    decoded_messages = self.ClientServerCommunicate()
+    self.assertEqual(decoded_messages[0].auth_state,
+                     rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+    self.assertIsNone(self._GetClientPing())
+
+    self.server_communicator.liveness_buffer.Flush()
+    self.assertIsNotNone(self._GetClientPing())
+
+  def testLivenessUpdatesAreKeptWhenTheFlushFails(self):
+    """Test that updates are written by the next flush after a failure."""
+    self.MakeClientAFF4Record()
+    self.server_communicator = self._CreateBufferingCommunicator()
+    self.ClientServerCommunicate()
+
+    def Fail():
+      raise IOError("Data store unavailable.")
+
+    liveness_buffer = self.server_communicator.liveness_buffer
+    with utils.Stubber(data_store.DB, "Flush", Fail):
+      self.assertRaises(IOError, liveness_buffer.Flush)
+    self.assertEqual(len(liveness_buffer.pending), 1)
+
+    liveness_buffer.Flush()
+    self.assertFalse(liveness_buffer.pending)
+    self.assertIsNotNone(self._GetClientPing())
+
+  def testBufferedServerReplayAttack(self):
+    """Test that replays are detected before the clock is written."""
+    self.MakeClientAFF4Record()
+    self.server_communicator = self._CreateBufferingCommunicator()
+
+    self.ClientServerCommunicate(timestamp=2000)
+    (decoded_messages, _, _) = self.server_communicator.DecryptMessage(
+        self.cipher_text)
+    self.assertEqual(decoded_messages[0].auth_state,
+                     rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
+
+    # An older message is rejected as well.
+    decoded_messages = self.ClientServerCommunicate(timestamp=1000)
+    self.assertEqual(decoded_messages[0].auth_state,
+                     rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
+
+  def testBufferedClockIsUsedByOtherFrontends(self):
+    """Test that a flushed clock is seen by a frontend restarted later."""
+    self.MakeClientAFF4Record()
+    self.server_communicator = self._CreateBufferingCommunicator()
+
+    self.ClientServerCommunicate(timestamp=2000)
+    self.server_communicator.liveness_buffer.Stop()
+
+    self.server_communicator = self._CreateBufferingCommunicator()
+    (decoded_messages, _, _) = self.server_communicator.DecryptMessage(
+        self.cipher_text)
+    self.assertEqual(decoded_messages[0].auth_state,
+                     rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
+
   def testCompression(self):
     """Tests that the compression works."""
     with test_lib.ConfigOverrider({
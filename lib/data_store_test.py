@@ -2187,3 +2187,58 @@ class DataStoreBenchmarks(test_lib.MicroBenchmarks):
                    (end_time - start_time) / self.n, self.n)
 
     self.assertEqual(len(self.fails), 0)
+
+
+class DataStoreMultiResolveBenchmarks(test_lib.MicroBenchmarks):
+  """Compares per-subject and batched prefix resolution.
+
+  These tests should be run with --labels=benchmark
+  """
+  units = "s"
+
+  subject_counts = [10, 100, 10000]
+
+  def setUp(self):
+    super(DataStoreMultiResolveBenchmarks, self).setUp()
+    self.InitDatastore()
+
+  def tearDown(self):
+    super(DataStoreMultiResolveBenchmarks, self).tearDown()
+    self.DestroyDatastore()
+
+  def InitDatastore(self):
+    """Initiates custom data store."""
+
+  def DestroyDatastore(self):
+    """Destroys custom data store."""
+
+  def _WriteSubjects(self, subjects):
+    for subject in subjects:
+      data_store.DB.MultiSet(subject, {"metadata:hostname": ["host"],
+                                       "metadata:os": ["Linux"],
+                                       "metadata:clock": [1234]},
+                             token=self.token)
+    data_store.DB.Flush()
+
+  @test_lib.SetLabel("benchmark")
+  def testMultiResolvePrefix(self):
+    for nr_subjects in self.subject_counts:
+      subjects = ["aff4:/C.%016X" % i for i in xrange(nr_subjects)]
+      self._WriteSubjects(subjects)
+
+      start_time = time.time()
+      for subject in subjects:
+        data_store.DB.ResolvePrefix(subject, "metadata:",
+                                    timestamp=data_store.DB.NEWEST_TIMESTAMP,
+                                    token=self.token)
+      self.AddResult("ResolvePrefix per subject (%d subjects)" % nr_subjects,
+                     time.time() - start_time, nr_subjects)
+
+      start_time = time.time()
+      results = dict(data_store.DB.MultiResolvePrefix(
+          subjects, "metadata:", timestamp=data_store.DB.NEWEST_TIMESTAMP,
+          token=self.token))
+      self.AddResult("MultiResolvePrefix (%d subjects)" % nr_subjects,
+                     time.time() - start_time, nr_subjects)
+
+      self.assertEqual(len(results), nr_subjects)
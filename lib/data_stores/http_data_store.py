@@ -4,9 +4,12 @@
 
 import base64
 import binascii
+import collections
 import httplib
+import itertools
 import random
 import re
+import select
 import socket
 import threading
 import time
@@ -17,6 +20,7 @@ import logging
 from grr.lib import access_control
 from grr.lib import config_lib
 from grr.lib import data_store
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.data_stores import common
 from grr.lib.rdfvalues import data_server as rdf_data_server
@@ -60,16 +64,29 @@ class HTTPDataStoreError(Error):
 
 
 class DataServerConnection(object):
-  """Represents one connection to a data server."""
+  """Represents one connection to a data server.
+
+  Requests are pipelined: every command carries a request_id which the data
+  server copies to its response, so several requests can be in flight on the
+  connection at the same time and each response is handed to whoever waits
+  for it.
+  """
 
   def __init__(self, server):
     self.conn = None
     self.sock = None
     self.lock = threading.Lock()
     self.server = server
-    # Mark pending requests and subjects that are scheduled to change on
-    # the database.
-    self.requests = []
+    # Requests sent but not yet answered, by request_id and in the order they
+    # were sent. They are replayed if the connection breaks.
+    self.requests = collections.OrderedDict()
+    # Ids of the requests somebody waits a response for. Responses to the
+    # other requests are only checked for errors.
+    self.waiting = set()
+    # Responses read but not yet claimed, by request_id.
+    self.responses = {}
+    self.request_ids = itertools.count(1)
+    self.last_used = time.time()
     self._DoConnection()
 
   def Address(self):
@@ -93,26 +110,43 @@ class DataServerConnection(object):
         raise HTTPDataStoreError("Could not read reply from data server.")
       replylen = sutils.SIZE_PACKER.unpack(replylen_str)[0]
       reply = self._ReadExactly(replylen)
-      response = rdf_data_store.DataStoreResponse(reply)
-      CheckResponseStatus(response)
-      return response
+      return rdf_data_store.DataStoreResponse(reply)
     except (socket.error, socket.timeout) as e:
       logging.warning("Cannot read reply from server %s:%d : %s",
                       self.Address(), self.Port(), e)
       return None
 
+  def _HandleReply(self, response):
+    """Matches a response to its request."""
+    if response.HasField("request_id"):
+      request_id = response.request_id
+    else:
+      # Data servers without request ids answer in order.
+      request_id = next(iter(self.requests))
+
+    self.requests.pop(request_id, None)
+    if request_id in self.waiting:
+      self.waiting.remove(request_id)
+      self.responses[request_id] = response
+    else:
+      CheckResponseStatus(response)
+
+  def _ReadAndHandleReply(self):
+    response = self._ReadReply()
+    if not response:
+      return False
+
+    self._HandleReply(response)
+    return True
+
   def _Sync(self):
     """Read responses from the pending requests."""
     self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.read_timeout"])
     while self.requests:
-      response = self._ReadReply()
-      if not response:
+      if not self._ReadAndHandleReply():
         # Could not read response. Let's exit and force a reconnection
         # followed by a replay.
-        # TODO(user): Maybe we need to assign an unique ID for each
-        # request so that the server knows which ones were already applied.
         return False
-      self.requests.pop()
     return True
 
   def _SendRequest(self, command):
@@ -190,19 +224,16 @@ class DataServerConnection(object):
     """Send all the requests again."""
     if self.requests:
       logging.info("Replaying the failed requests")
-    while self.requests:
-      req = self.requests[-1]
+    for req in self.requests.values():
       if not self._SendRequest(req):
         return False
       self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.replay_timeout"])
-      response = self._ReadReply()
-      if not response:
+      if not self._ReadAndHandleReply():
         # Could not read response. Let's exit and force a reconnection
         # followed by a replay.
-        # TODO(user): Maybe we need to assign an unique ID for each
-        # request so that the server knows which ones were already applied.
+        # TODO(user): The server does not know which requests were already
+        # applied before the connection broke, so these are applied again.
         return False
-      self.requests.pop()
     return True
 
   def _DoConnection(self):
@@ -224,37 +255,56 @@ class DataServerConnection(object):
   def _RedoConnection(self):
     logging.warning("Attempt to reconnect with %s:%d", self.Address(),
                     self.Port())
+    stats.STATS.IncrementCounter("http_data_store_reconnects")
     self._DoConnection()
 
+  def _StartRequest(self, command):
+    command.request_id = next(self.request_ids)
+    while not self._SendRequest(command):
+      self._RedoConnection()
+    self.requests[command.request_id] = command
+    return command.request_id
+
   @utils.Synchronized
   def MakeRequestAndContinue(self, command, unused_subject):
     """Make request but do not sync with the data server."""
-    while not self._SendRequest(command):
-      self._RedoConnection()
-    self.requests.insert(0, command)
+    self._StartRequest(command)
     return None
 
   @utils.Synchronized
+  def SendRequest(self, command):
+    """Sends a request without waiting for the response.
+
+    Args:
+      command: The DataStoreCommand to send.
+
+    Returns:
+      The request id to pass to GetResponse().
+    """
+    request_id = self._StartRequest(command)
+    self.waiting.add(request_id)
+    return request_id
+
+  @utils.Synchronized
+  def GetResponse(self, request_id):
+    """Waits for the response to a request made with SendRequest()."""
+    while request_id not in self.responses:
+      self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.read_timeout"])
+      if not self._ReadAndHandleReply():
+        # Must reconnect and resend the pending requests.
+        self._RedoConnection()
+
+    return CheckResponseStatus(self.responses.pop(request_id))
+
+  @utils.Synchronized
+  def DiscardResponse(self, request_id):
+    """Stops waiting for the response to a request made with SendRequest()."""
+    self.waiting.discard(request_id)
+    self.responses.pop(request_id, None)
+
   def SyncAndMakeRequest(self, command):
     """Make a request to the data server and return the response."""
-    if not self._Sync():
-      # Must reconnect and resend requests.
-      self._RedoConnection()
-    # At this point, we have a synchronized connection.
-    while not self._SendRequest(command):
-      self._RedoConnection()
-    self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.read_timeout"])
-    response = self._ReadReply()
-    if not response:
-      # Must reconnect and resend the request.
-      while True:
-        self._RedoConnection()
-        if not self._SendRequest(command):
-          continue
-        response = self._ReadReply()
-        if response:
-          break
-    return response
+    return self.GetResponse(self.SendRequest(command))
 
   @utils.Synchronized
   def Sync(self):
@@ -263,24 +313,66 @@ class DataServerConnection(object):
     self._RedoConnection()
     return self._Sync()
 
+  @utils.Synchronized
+  def CheckHealth(self):
+    """Reconnects if the data server has dropped the connection."""
+    if self.requests:
+      # Replies are on their way, a broken connection shows when reading them.
+      return
+
+    try:
+      readable, _, _ = select.select([self.sock], [], [], 0)
+    except (select.error, socket.error):
+      readable = True
+
+    # With nothing pending the data server has nothing to send, so a readable
+    # socket means it was closed.
+    if readable:
+      self._RedoConnection()
+
   def NumPendingRequests(self):
     return len(self.requests)
 
   def Close(self):
     self.conn.close()
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.server.PutConnection(self)
+
 
 class DataServer(object):
-  """A DataServer object contains connections a data server."""
+  """A DataServer object contains connections a data server.
+
+  The connections are kept in a bounded pool. Each request checks a
+  connection out and returns it when done. Threads get back the connection
+  they used last if it is free, which keeps their requests in order.
+
+  Usage:
+
+  with server.GetConnection() as connection:
+    connection.SyncAndMakeRequest(...)
+  """
 
   def __init__(self, addr, port):
     self.addr = addr
     self.port = port
     self.conn = httplib.HTTPConnection(self.Address(), self.Port())
     self.lock = threading.Lock()
+    self.connection_returned = threading.Condition(self.lock)
     self.max_connections = config_lib.CONFIG["Dataserver.max_connections"]
+    self.max_idle_time = config_lib.CONFIG["HTTPDataStore.max_idle_time"]
+    self.wait_timeout = config_lib.CONFIG[
+        "HTTPDataStore.connection_wait_timeout"]
+    self.thread_local = threading.local()
     # Start with a single connection.
     self.connections = [DataServerConnection(self)]
+    # The connections which are not checked out, least recently used first.
+    self.idle = list(self.connections)
+    # Number of connections being opened.
+    self.opening = 0
 
   def Port(self):
     return self.port
@@ -292,6 +384,7 @@ class DataServer(object):
     for conn in self.connections:
       conn.Close()
     self.connections = []
+    self.idle = []
     if self.conn:
       self.conn.close()
       self.conn = None
@@ -302,22 +395,89 @@ class DataServer(object):
       # TODO(user): Consider adding error handling here.
       conn.Sync()
 
-  @utils.Synchronized
+  def NumConnections(self):
+    return len(self.connections)
+
+  def NumIdleConnections(self):
+    return len(self.idle)
+
+  def _TakeIdleConnection(self):
+    """Takes a connection out of the idle list, None if there are none."""
+    last = getattr(self.thread_local, "connection", None)
+    if last is not None and last in self.idle:
+      self.idle.remove(last)
+      return last
+
+    if self.idle:
+      return self.idle.pop()
+
   def GetConnection(self):
-    """Return a connection to the data server."""
-    best = min(self.connections, key=lambda x: x.NumPendingRequests())
-    if best.NumPendingRequests():
-      if len(self.connections) == self.max_connections:
-        # Too many connections, use this one.
-        return best
-      new = DataServerConnection(self)
-      self.connections.append(new)
-      return new
+    """Checks out a connection to the data server.
+
+    Returns:
+      A DataServerConnection to be used as a context manager, which puts it
+      back in the pool.
+
+    Raises:
+      HTTPDataStoreError: If no connection became available in time.
+    """
+    started = time.time()
+    connection = None
+    with self.lock:
+      while True:
+        connection = self._TakeIdleConnection()
+        if connection is not None:
+          break
+
+        if len(self.connections) + self.opening < self.max_connections:
+          self.opening += 1
+          break
+
+        remaining = started + self.wait_timeout - time.time()
+        if remaining <= 0:
+          raise HTTPDataStoreError(
+              "Timed out waiting for a connection to %s:%d." %
+              (self.Address(), self.Port()))
+        self.connection_returned.wait(remaining)
+
+    if connection is None:
+      # Connecting can take a while so it is done without holding the lock.
+      try:
+        connection = DataServerConnection(self)
+      finally:
+        with self.lock:
+          self.opening -= 1
+          if connection is None:
+            self.connection_returned.notify()
+          else:
+            self.connections.append(connection)
     else:
-      return best
+      connection.CheckHealth()
 
-    # Attempt to get one connection with no pending requests.
-    return self.connections[0]
+    stats.STATS.RecordEvent("http_data_store_connection_wait_time",
+                            time.time() - started)
+    self.thread_local.connection = connection
+    return connection
+
+  @utils.Synchronized
+  def PutConnection(self, connection):
+    """Returns a connection to the pool."""
+    now = time.time()
+    connection.last_used = now
+    self.idle.append(connection)
+
+    # Close the connections which were not used for a while, but keep one.
+    for idle_connection in list(self.idle):
+      if len(self.connections) <= 1:
+        break
+
+      if (now - idle_connection.last_used > self.max_idle_time and
+          not idle_connection.NumPendingRequests()):
+        self.idle.remove(idle_connection)
+        self.connections.remove(idle_connection)
+        idle_connection.Close()
+
+    self.connection_returned.notify()
 
   def _FetchMapping(self):
     """Attempt to fetch mapping from the data server."""
@@ -367,6 +527,7 @@ class RemoteInquirer(object):
       self.servers.append(DataServer(addr, port))
     self.mapping_server = random.choice(self.servers)
     self.mapping = self.mapping_server.LoadMapping()
+    self.key_mapper = sutils.KeyMapper(self.mapping)
 
     if len(self.mapping.servers) != len(server_list):
       logging.warning("There is a mismatch between the data "
@@ -387,7 +548,7 @@ class RemoteInquirer(object):
 
   def MapKey(self, key):
     """Return the data server responsible for a given key."""
-    sid = sutils.MapKeyToServer(self.mapping, key)
+    sid = self.key_mapper.MapKey(key)
     return self.servers[sid]
 
   def GetPathing(self):
@@ -395,6 +556,7 @@ class RemoteInquirer(object):
 
   def RenewMapping(self):
     self.mapping = self.mapping_server.LoadMapping()
+    self.key_mapper = sutils.KeyMapper(self.mapping)
     return self.mapping
 
   def GetMapping(self):
@@ -447,12 +609,24 @@ class HTTPDataStore(data_store.DataStore):
 
   def __init__(self):
     super(HTTPDataStore, self).__init__()
+    stats.STATS.RegisterGaugeMetric("http_data_store_connections", int)
+    stats.STATS.RegisterGaugeMetric("http_data_store_idle_connections", int)
+    stats.STATS.RegisterEventMetric("http_data_store_connection_wait_time")
+    stats.STATS.RegisterCounterMetric("http_data_store_reconnects")
+
     self.cache = RemoteMappingCache(1000)
     self.inquirer = self.cache.GetInquirer()
     self._ComputeNewSize(self.inquirer.GetMapping(), time.time())
 
+    stats.STATS.SetGaugeCallback(
+        "http_data_store_connections",
+        lambda: sum(s.NumConnections() for s in self.inquirer.servers))
+    stats.STATS.SetGaugeCallback(
+        "http_data_store_idle_connections",
+        lambda: sum(s.NumIdleConnections() for s in self.inquirer.servers))
+
   def GetServer(self, subject):
-    return self.cache.Get(subject).GetConnection()
+    return self.cache.Get(subject)
 
   def TimestampSpecFromTimestamp(self, timestamp):
     """Create a timestamp spec from a timestamp value.
@@ -492,12 +666,61 @@ class HTTPDataStore(data_store.DataStore):
 
   def _MakeRequestSyncOrAsync(self, request, typ, sync):
     subject = request.subject[0]
-    server = self.GetServer(subject)
     cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
-    if sync:
-      return server.SyncAndMakeRequest(cmd)
-    else:
-      return server.MakeRequestAndContinue(cmd, subject)
+    with self.GetServer(subject).GetConnection() as connection:
+      if sync:
+        return connection.SyncAndMakeRequest(cmd)
+      else:
+        return connection.MakeRequestAndContinue(cmd, subject)
+
+  def _MakeScatterRequest(self, requests, typ):
+    """Makes requests to several data servers at once.
+
+    All the requests are sent before any response is read, so the data servers
+    work on them concurrently.
+
+    We hold a connection to each server until its response is read, and may
+    have to wait for a free connection to the next one. Connections are
+    therefore always checked out in the same order, by server address, so two
+    scatters can never wait for each other's connections.
+
+    Args:
+      requests: A list of (DataServer, DataStoreRequest) tuples, at most one
+                per server.
+      typ: The DataStoreCommand.Command of the requests.
+
+    Returns:
+      A list of responses in the order of the requests.
+    """
+    order = sorted(range(len(requests)), key=lambda i: (
+        requests[i][0].Address(), requests[i][0].Port()))
+
+    pending = []
+    responses = {}
+    try:
+      for i in order:
+        server, request = requests[i]
+        connection = server.GetConnection()
+        pending.append((i, connection, None))
+        cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
+        pending[-1] = (i, connection, connection.SendRequest(cmd))
+
+      for i, connection, request_id in pending:
+        responses[i] = connection.GetResponse(request_id)
+    finally:
+      for i, connection, request_id in pending:
+        if i not in responses and request_id is not None:
+          connection.DiscardResponse(request_id)
+        connection.server.PutConnection(connection)
+
+    return [responses[i] for i in range(len(requests))]
+
+  def _GroupSubjectsByServer(self, subjects):
+    """Returns a dict of lists of subjects keyed by their data server."""
+    result = collections.OrderedDict()
+    for subject in subjects:
+      result.setdefault(self.cache.Get(subject), []).append(subject)
+    return result
 
   def DeleteAttributes(self, subject, attributes, start=None, end=None,
                        sync=True, token=None):
@@ -554,28 +777,45 @@ class HTTPDataStore(data_store.DataStore):
 
   def MultiResolvePrefix(self, subjects, attribute_prefix,
                          timestamp=None, limit=None, token=None):
-    """MultiResolvePrefix."""
-    typ = rdf_data_server.DataStoreCommand.Command.MULTI_RESOLVE_PREFIX
-    results = {}
-    remaining_limit = limit
-    for subject in subjects:
-      request = self._MakeRequest([subject], attribute_prefix,
-                                  timestamp=timestamp, token=token,
-                                  limit=remaining_limit)
+    """MultiResolvePrefix.
 
-      response = self._MakeSyncRequest(request, typ)
+    Subjects are grouped by data server and every data server gets a single
+    request for all its subjects. The requests run concurrently.
+    """
+    subjects = list(subjects)
+    requests = []
+    for server, server_subjects in self._GroupSubjectsByServer(
+        subjects).iteritems():
+      requests.append((server, self._MakeRequest(
+          server_subjects, attribute_prefix, timestamp=timestamp, token=token,
+          limit=limit)))
 
-      if response.results:
-        result_set = response.results[0]
+    typ = rdf_data_server.DataStoreCommand.Command.MULTI_RESOLVE_PREFIX
+    server_results = {}
+    for response in self._MakeScatterRequest(requests, typ):
+      for result_set in response.results:
         values = [(pred, self._Decode(value), ts)
                   for (pred, value, ts) in result_set.payload]
-        if limit:
-          if len(values) >= remaining_limit:
-            results[result_set.subject] = values[:remaining_limit]
-            return results.iteritems()
-          remaining_limit -= len(values)
+        server_results[utils.SmartUnicode(result_set.subject)] = (
+            result_set.subject, values)
+
+    # Put the results back in the order of the subjects, the limit applies to
+    # the total number of values.
+    results = collections.OrderedDict()
+    remaining_limit = limit
+    for subject in subjects:
+      try:
+        subject, values = server_results.pop(utils.SmartUnicode(subject))
+      except KeyError:
+        continue
+
+      if limit:
+        if len(values) >= remaining_limit:
+          results[subject] = values[:remaining_limit]
+          break
+        remaining_limit -= len(values)
 
-        results[result_set.subject] = values
+      results[subject] = values
 
     return results.iteritems()
 
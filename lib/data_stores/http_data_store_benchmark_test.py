@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 """Benchmark tests for HTTP datastore."""
 
+
+import threading
+import time
+
+from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
 from grr.lib.data_stores import http_data_store_test
 
 
+def setUpModule():
+  http_data_store_test.SetupDataStore()
+
+
+def tearDownModule():
+  http_data_store_test.tearDownModule()
+
+
 class HTTPDataStoreBenchmarks(http_data_store_test.HTTPDataStoreMixin,
                               data_store_test.DataStoreBenchmarks):
   """Benchmark the HTTP remote data store abstraction."""
@@ -18,6 +31,49 @@ class HTTPDataStoreCSVBenchmarks(
   """Benchmark the HTTP remote data store."""
 
 
+class HTTPDataStoreConnectionPoolBenchmarks(
+    http_data_store_test.HTTPDataStoreMixin, test_lib.MicroBenchmarks):
+  """Benchmark many threads sharing the connections to the data servers.
+
+  These tests should be run with --labels=benchmark
+  """
+  units = "s"
+
+  pool_sizes = [1, 5]
+  thread_counts = [1, 4, 16]
+  requests_per_thread = 200
+
+  def _MakeRequests(self, thread_id):
+    subject = "aff4:/pool_benchmark/%d" % thread_id
+    for i in xrange(self.requests_per_thread):
+      data_store.DB.Set(subject, "metadata:value", str(i), token=self.token)
+      data_store.DB.Resolve(subject, "metadata:value", token=self.token)
+
+  @test_lib.SetLabel("benchmark")
+  def testConcurrentRequests(self):
+    """Concurrent writes and reads with different pool sizes."""
+    # Pools only grow so the smallest size has to go first.
+    for pool_size in self.pool_sizes:
+      for server in data_store.DB.inquirer.servers:
+        server.max_connections = pool_size
+
+      for thread_count in self.thread_counts:
+        threads = [threading.Thread(target=self._MakeRequests, args=(i,))
+                   for i in range(thread_count)]
+
+        start_time = time.time()
+        for thread in threads:
+          thread.start()
+        for thread in threads:
+          thread.join()
+
+        self.AddResult(
+            "%d threads, %d connections per server" % (thread_count,
+                                                       pool_size),
+            time.time() - start_time,
+            thread_count * self.requests_per_thread * 2)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -17,10 +17,14 @@ import logging
 from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 
 from grr.lib.data_stores import http_data_store
 from grr.lib.data_stores import sqlite_data_store
+from grr.lib.rdfvalues import data_server as rdf_data_server
+from grr.lib.rdfvalues import data_store as rdf_data_store
 
 from grr.server.data_server import data_server
 
@@ -195,6 +199,156 @@ class HTTPDataStoreTest(HTTPDataStoreMixin,
     # Disabled for now.
     pass
 
+  def testMultiResolvePrefixMakesOneRequestPerServer(self):
+    subjects = ["aff4:/C.%016X" % i for i in range(50)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.Set(subject, "metadata:value", str(i), token=self.token)
+
+    commands = []
+    send_request = http_data_store.DataServerConnection.SendRequest
+
+    def SendRequest(connection, command):
+      commands.append(command)
+      return send_request(connection, command)
+
+    with utils.Stubber(http_data_store.DataServerConnection, "SendRequest",
+                       SendRequest):
+      results = list(data_store.DB.MultiResolvePrefix(
+          reversed(subjects), "metadata:", token=self.token))
+
+    self.assertLessEqual(len(commands), len(HTTP_DB))
+    self.assertEqual(sum(len(command.request.subject) for command in commands),
+                     len(subjects))
+
+    # Results come in the order the subjects were given.
+    self.assertEqual([subject for subject, _ in results],
+                     list(reversed(subjects)))
+    for subject, values in results:
+      self.assertEqual(values[0][1], str(subjects.index(subject)))
+
+    results = list(data_store.DB.MultiResolvePrefix(
+        subjects, "metadata:", limit=10, token=self.token))
+    self.assertTrue(results)
+    self.assertLessEqual(sum(len(values) for _, values in results), 10)
+
+  def testScattersCheckOutConnectionsInServerOrder(self):
+    subjects = ["aff4:/C.%016X" % i for i in range(50)]
+    servers = []
+    get_connection = http_data_store.DataServer.GetConnection
+
+    def GetConnection(server):
+      servers.append((server.Address(), server.Port()))
+      return get_connection(server)
+
+    with utils.Stubber(http_data_store.DataServer, "GetConnection",
+                       GetConnection):
+      for ordered_subjects in (subjects, list(reversed(subjects))):
+        del servers[:]
+        list(data_store.DB.MultiResolvePrefix(
+            ordered_subjects, "metadata:", token=self.token))
+        self.assertEqual(servers, sorted(servers))
+        self.assertEqual(len(servers), len(HTTP_DB))
+
+  def testResponsesAreMatchedToRequests(self):
+    for i in range(3):
+      data_store.DB.Set("aff4:/pipelined", "metadata:%d" % i, str(i),
+                        token=self.token)
+
+    server = data_store.DB.GetServer("aff4:/pipelined")
+    typ = rdf_data_server.DataStoreCommand.Command.RESOLVE_MULTI
+    with server.GetConnection() as connection:
+      request_ids = []
+      for i in range(3):
+        request = data_store.DB._MakeRequest(
+            ["aff4:/pipelined"], ["metadata:%d" % i], token=self.token)
+        request_ids.append(connection.SendRequest(
+            rdf_data_server.DataStoreCommand(command=typ, request=request)))
+
+      # Several requests are in flight and responses can be claimed in any
+      # order.
+      for i in reversed(range(3)):
+        response = connection.GetResponse(request_ids[i])
+        self.assertEqual(response.request_id, request_ids[i])
+        self.assertEqual(
+            data_store.DB._Decode(response.results[0].payload[0][1]), str(i))
+
+      self.assertEqual(connection.NumPendingRequests(), 0)
+
+
+class DataServerConnectionPoolTest(test_lib.GRRBaseTest):
+  """Tests the pool of connections to a data server."""
+
+  def setUp(self):
+    super(DataServerConnectionPoolTest, self).setUp()
+    self.server = http_data_store.DataServer("127.0.0.1", PORT[0])
+    self.server.max_connections = 2
+    self.server.wait_timeout = 0
+
+  def tearDown(self):
+    super(DataServerConnectionPoolTest, self).tearDown()
+    self.server.Close()
+
+  def testThreadsGetTheirLastConnectionBack(self):
+    connections = {}
+
+    def CheckOut(name):
+      with self.server.GetConnection() as connection:
+        connections.setdefault(name, []).append(connection)
+
+    with self.server.GetConnection():
+      # Another thread needs a second connection while this one is in use.
+      thread = threading.Thread(target=CheckOut, args=("thread",))
+      thread.start()
+      thread.join()
+
+    for _ in range(3):
+      CheckOut("main")
+
+    self.assertEqual(self.server.NumConnections(), 2)
+    self.assertEqual(len(set(connections["main"])), 1)
+    self.assertNotEqual(connections["main"][0], connections["thread"][0])
+
+  def testPoolIsBounded(self):
+    first = self.server.GetConnection()
+    second = self.server.GetConnection()
+    self.assertNotEqual(first, second)
+
+    self.assertRaises(http_data_store.HTTPDataStoreError,
+                      self.server.GetConnection)
+
+    self.server.PutConnection(first)
+    self.assertEqual(self.server.GetConnection(), first)
+
+  def testIdleConnectionsAreClosed(self):
+    first = self.server.GetConnection()
+    second = self.server.GetConnection()
+    self.assertEqual(self.server.NumConnections(), 2)
+
+    self.server.max_idle_time = 60
+    self.server.PutConnection(first)
+    first.last_used -= 120
+    self.server.PutConnection(second)
+
+    self.assertEqual(self.server.NumConnections(), 1)
+    self.assertEqual(self.server.NumIdleConnections(), 1)
+
+  def testDroppedConnectionsAreReopened(self):
+    with self.server.GetConnection() as connection:
+      connection.sock.close()
+
+    reconnects = stats.STATS.GetMetricValue("http_data_store_reconnects")
+    with self.server.GetConnection() as connection:
+      request = data_store.DB._MakeRequest(["aff4:/reopened"], ["metadata:"],
+                                           token=self.token)
+      typ = rdf_data_server.DataStoreCommand.Command.RESOLVE_MULTI
+      response = connection.SyncAndMakeRequest(
+          rdf_data_server.DataStoreCommand(command=typ, request=request))
+      self.assertEqual(response.status,
+                       rdf_data_store.DataStoreResponse.Status.OK)
+
+    self.assertEqual(stats.STATS.GetMetricValue("http_data_store_reconnects"),
+                     reconnects + 1)
+
 
 def main(args):
   test_lib.main(args)
@@ -4,6 +4,7 @@
 """An implementation of a data store based on mysql."""
 
 
+import hashlib
 import logging
 import Queue
 import re
@@ -21,6 +22,10 @@ from grr.lib import data_store
 from grr.lib import utils
 
 
+# Maximum number of subjects resolved by a single SELECT ... IN (...) query.
+MAX_SUBJECTS_PER_QUERY = 1000
+
+
 # pylint: disable=nonstandard-exception
 class Error(data_store.Error):
   """Base class for all exceptions in this module."""
@@ -236,20 +241,49 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
   def MultiResolvePrefix(self, subjects, attribute_prefix, timestamp=None,
                          limit=None, token=None):
-    """Result multiple subjects using one or more attribute regexps."""
-    result = {}
+    """Result multiple subjects using one or more attribute regexps.
 
+    Subjects are resolved in batches of MAX_SUBJECTS_PER_QUERY with a single
+    query per batch and prefix. The limit applies to the total number of
+    values returned.
+    """
+    subjects = list(subjects)
+    self.security_manager.CheckDataStoreAccess(
+        token, subjects, self.GetRequiredResolveAccess(attribute_prefix))
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_regex = [attribute_prefix + ".*"]
+    else:
+      attribute_regex = [prefix + ".*" for prefix in attribute_prefix]
+
+    # Rows only carry the subject hash so we map it back to the subject the
+    # caller passed in.
+    subjects_by_hash = {}
     for subject in subjects:
-      values = self.ResolvePrefix(subject, attribute_prefix, token=token,
-                                  timestamp=timestamp, limit=limit)
+      subject_hash = hashlib.md5(utils.SmartStr(subject)).digest()
+      subjects_by_hash.setdefault(subject_hash, subject)
+    unique_subjects = [utils.SmartUnicode(subject)
+                       for subject in subjects_by_hash.itervalues()]
 
-      if values:
-        result[subject] = values
-        if limit:
-          limit -= len(values)
+    result = {}
+    for i in xrange(0, len(unique_subjects), MAX_SUBJECTS_PER_QUERY):
+      batch = unique_subjects[i:i + MAX_SUBJECTS_PER_QUERY]
+      for regex in attribute_regex:
+        if limit is not None and limit <= 0:
+          return result.iteritems()
+
+        query, args = self._BuildMultiQuery(batch, regex, timestamp, limit)
+        rows = self.ExecuteQuery(query, args)
+
+        for row in rows:
+          subject = subjects_by_hash[str(row["subject_hash"])]
+          attribute = row["attribute"]
+          value = self._Decode(attribute, row["value"])
+          result.setdefault(subject, []).append(
+              (attribute, value, row["timestamp"]))
 
-      if limit is not None and limit <= 0:
-        break
+        if limit:
+          limit -= len(rows)
 
     return result.iteritems()
 
@@ -536,28 +570,10 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     if attribute is not None:
       if is_regex:
         tables += " JOIN attributes ON aff4.attribute_hash=attributes.hash"
-        regex = re.match(r"(^[a-zA-Z0-9_\- /:]+)(.*)", attribute)
-        if not regex:
-          # If attribute has no prefix just rlike
-          criteria += " AND attributes.attribute rlike %s"
-          args.append(attribute)
-        else:
-          rlike = regex.groups()[1]
-
-          if rlike:
-             # If there is a regex component attempt to replace with like
-            like = regex.groups()[0] + "%"
-            criteria += " AND attributes.attribute like %s"
-            args.append(like)
-
-            # If the regex portion is not a match all regex then add rlike
-            if not (rlike == ".*" or rlike == ".+"):
-              criteria += " AND attributes.attribute rlike %s"
-              args.append(rlike)
-          else:
-            # If no regex component then treat as full attribute
-            criteria += " AND aff4.attribute_hash=unhex(md5(%s))"
-            args.append(attribute)
+        regex_criteria, regex_args = self._BuildAttributeRegexCriteria(
+            attribute)
+        criteria += regex_criteria
+        args.extend(regex_args)
       else:
         criteria += " AND aff4.attribute_hash=unhex(md5(%s))"
         args.append(attribute)
@@ -591,6 +607,80 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return (query, args)
 
+  def _BuildAttributeRegexCriteria(self, attribute_regex):
+    """Build the criteria matching attributes against a regex."""
+    criteria = ""
+    args = []
+    regex = re.match(r"(^[a-zA-Z0-9_\- /:]+)(.*)", attribute_regex)
+    if not regex:
+      # If attribute has no prefix just rlike
+      criteria += " AND attributes.attribute rlike %s"
+      args.append(attribute_regex)
+    else:
+      rlike = regex.groups()[1]
+
+      if rlike:
+        # If there is a regex component attempt to replace with like
+        like = regex.groups()[0] + "%"
+        criteria += " AND attributes.attribute like %s"
+        args.append(like)
+
+        # If the regex portion is not a match all regex then add rlike
+        if not (rlike == ".*" or rlike == ".+"):
+          criteria += " AND attributes.attribute rlike %s"
+          args.append(rlike)
+      else:
+        # If no regex component then treat as full attribute
+        criteria += " AND aff4.attribute_hash=unhex(md5(%s))"
+        args.append(attribute_regex)
+
+    return criteria, args
+
+  def _BuildMultiQuery(self, subjects, attribute_regex, timestamp=None,
+                       limit=None):
+    """Build a SELECT query resolving an attribute regex for many subjects."""
+    subjects_criteria = "WHERE aff4.subject_hash IN (%s)" % ", ".join(
+        ["unhex(md5(%s))"] * len(subjects))
+    args = list(subjects)
+    criteria = subjects_criteria
+    tables = "FROM aff4 JOIN attributes ON aff4.attribute_hash=attributes.hash"
+    sorting = ""
+
+    regex_criteria, regex_args = self._BuildAttributeRegexCriteria(
+        attribute_regex)
+    criteria += regex_criteria
+    args.extend(regex_args)
+
+    # Limit to time range if specified
+    if isinstance(timestamp, (tuple, list)):
+      criteria += " AND aff4.timestamp >= %s AND aff4.timestamp <= %s"
+      args.append(int(timestamp[0]))
+      args.append(int(timestamp[1]))
+
+    fields = ("aff4.subject_hash, aff4.value, aff4.timestamp, "
+              "attributes.attribute")
+
+    # Modify fields and sorting for timestamps.
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      tables += (" JOIN (SELECT aff4.subject_hash, aff4.attribute_hash, "
+                 "MAX(aff4.timestamp) timestamp %s %s "
+                 "GROUP BY aff4.subject_hash, aff4.attribute_hash) maxtime ON "
+                 "aff4.subject_hash=maxtime.subject_hash AND "
+                 "aff4.attribute_hash=maxtime.attribute_hash AND "
+                 "aff4.timestamp=maxtime.timestamp") % (tables, criteria)
+      criteria = subjects_criteria
+      args.extend(subjects)
+    else:
+      # Always order results.
+      sorting = "ORDER BY aff4.timestamp DESC"
+    # Add limit if set.
+    if limit:
+      sorting += " LIMIT %s" % int(limit)
+
+    query = " ".join(["SELECT", fields, tables, criteria, sorting])
+
+    return (query, args)
+
   def _BuildDelete(self, subject, attribute=None, timestamp=None):
     """Build the DELETE query to be executed."""
     subjects_q = {
@@ -20,6 +20,12 @@ class MysqlAdvancedDataStoreCSVBenchmarks(
   """Benchmark the mysql data store abstraction."""
 
 
+class MysqlAdvancedDataStoreMultiResolveBenchmarks(
+    mysql_advanced_data_store_test.MysqlAdvancedTestMixin,
+    data_store_test.DataStoreMultiResolveBenchmarks):
+  """Benchmark batched prefix resolution in the mysql data store."""
+
+
 def main(args):
   test_lib.main(args)
 
@@ -6,6 +6,7 @@ SQLite database files are created by taking the root of each AFF4 object.
 
 
 
+import collections
 import os
 import re
 import stat
@@ -32,6 +33,9 @@ SQLITE_DETECT_TYPES = 0
 SQLITE_FACTORY = sqlite3.Connection
 SQLITE_CACHED_STATEMENTS = 20
 SQLITE_PAGE_SIZE = 1024
+# Maximum number of subjects passed to a single IN (...) clause. SQLite limits
+# the number of host parameters in a statement to 999 by default.
+SQLITE_MAX_SUBJECTS_PER_QUERY = 500
 
 
 class SqliteConnectionCache(utils.FastStore):
@@ -148,6 +152,12 @@ class SqliteConnectionCache(utils.FastStore):
   def KillObject(self, conn):
     conn.Close()
 
+  def DestinationKey(self, subject):
+    """Returns the key of the database file holding the subject."""
+    filename, directory = common.ResolveSubjectDestination(subject,
+                                                           self.path_regexes)
+    return common.MakeDestinationKey(directory, filename)
+
   @utils.Synchronized
   def Get(self, subject):
     """This will create the connection if needed so should not fail."""
@@ -313,6 +323,62 @@ class SqliteConnection(object):
     data = self.Execute(query, args).fetchall()
     return data
 
+  @utils.Synchronized
+  def MultiGetNewestFromPrefix(self, subjects, prefix, limit=None):
+    """Returns the newest values matching 'prefix' for several subjects.
+
+    Args:
+     subjects: A list of subjects stored in this database file.
+     prefix: The attribute prefix.
+     limit: The maximum number of records to return over all subjects.
+
+    Returns:
+     A list of the form (subject, attribute, value, timestamp).
+    """
+    pattern = prefix + "%"
+    args = [utils.SmartStr(subject) for subject in subjects]
+    query = """SELECT subject, predicate, MAX(timestamp), value FROM tbl
+               WHERE subject IN (%s) AND predicate LIKE ?
+               GROUP BY subject, predicate""" % ", ".join("?" * len(args))
+    args.append(pattern)
+
+    if limit:
+      query += " LIMIT ?"
+      args.append(limit)
+
+    # Reorder columns.
+    data = self.Execute(query, args).fetchall()
+    return [(sub, pred, val, ts) for sub, pred, ts, val in data]
+
+  @utils.Synchronized
+  def MultiGetValuesFromPrefix(self, subjects, prefix, start, end,
+                               limit=None):
+    """Returns the values matching 'prefix' for several subjects.
+
+    Args:
+     subjects: A list of subjects stored in this database file.
+     prefix: The attribute prefix.
+     start: The start timestamp.
+     end: The end timestamp.
+     limit: The maximum number of values to return over all subjects.
+
+    Returns:
+     A list of the form (subject, attribute, value, timestamp).
+    """
+    pattern = prefix + "%"
+    args = [utils.SmartStr(subject) for subject in subjects]
+    query = """SELECT subject, predicate, value, timestamp FROM tbl
+               WHERE subject IN (%s) AND predicate LIKE ?
+                     AND timestamp >= ? AND timestamp <= ?
+                     ORDER BY timestamp DESC""" % ", ".join("?" * len(args))
+    args.extend([pattern, start, end])
+
+    if limit:
+      query += " LIMIT ?"
+      args.append(limit)
+
+    return self.Execute(query, args).fetchall()
+
   @utils.Synchronized
   def GetValues(self, subject, attribute, start, end, limit=None):
     """Returns the values of the attribute between 'start' and 'end'.
@@ -591,21 +657,60 @@ class SqliteDataStore(data_store.DataStore):
 
   def MultiResolvePrefix(self, subjects, attribute_prefix, timestamp=None,
                          limit=None, token=None):
-    """Result multiple subjects using one or more attribute prefixes."""
-    result = {}
+    """Result multiple subjects using one or more attribute prefixes.
 
-    remaining_limit = limit
+    Subjects are grouped by the database file they are stored in, so every
+    file is queried once per prefix (in batches of
+    SQLITE_MAX_SUBJECTS_PER_QUERY subjects) rather than once per subject. The
+    limit applies to the total number of values returned.
+    """
+    subjects = list(subjects)
+    self.security_manager.CheckDataStoreAccess(
+        token, subjects, self.GetRequiredResolveAccess(attribute_prefix))
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+
+    start, end = self._GetStartEndTimestamp(timestamp)
+
+    # Group the subjects by database file, keeping the order they were given.
+    # The database returns subjects as strings so we need to map them back to
+    # what the caller passed in.
+    destinations = collections.OrderedDict()
+    original_subjects = {}
     for subject in subjects:
-      values = self.ResolvePrefix(subject, attribute_prefix, token=token,
-                                  timestamp=timestamp, limit=remaining_limit)
-
-      if values:
-        if limit:
-          if len(values) >= remaining_limit:
-            result[subject] = values[:remaining_limit]
-            return result.iteritems()
-          remaining_limit -= len(values)
-        result[subject] = values
+      subject_str = utils.SmartStr(subject)
+      if subject_str in original_subjects:
+        continue
+      original_subjects[subject_str] = subject
+      key = self.cache.DestinationKey(subject)
+      destinations.setdefault(key, []).append(subject_str)
+
+    result = {}
+    remaining_limit = limit
+    for destination_subjects in destinations.itervalues():
+      with self.cache.Get(destination_subjects[0]) as sqlite_connection:
+        for i in xrange(0, len(destination_subjects),
+                        SQLITE_MAX_SUBJECTS_PER_QUERY):
+          batch = destination_subjects[i:i + SQLITE_MAX_SUBJECTS_PER_QUERY]
+          for prefix in attribute_prefix:
+            if limit and remaining_limit <= 0:
+              return result.iteritems()
+
+            if timestamp == self.NEWEST_TIMESTAMP:
+              data = sqlite_connection.MultiGetNewestFromPrefix(
+                  batch, prefix, remaining_limit)
+            else:
+              data = sqlite_connection.MultiGetValuesFromPrefix(
+                  batch, prefix, start, end, remaining_limit)
+
+            for subject, attribute, value, ts in data:
+              value = self._Decode(attribute, value)
+              result.setdefault(original_subjects[subject], []).append(
+                  (attribute, value, ts))
+
+            if limit:
+              remaining_limit -= len(data)
 
     return result.iteritems()
 
@@ -19,6 +19,12 @@ class SqliteDataStoreCSVBenchmarks(sqlite_data_store_test.SqliteTestMixin,
   """Benchmark the SQLite data store abstraction."""
 
 
+class SqliteDataStoreMultiResolveBenchmarks(
+    sqlite_data_store_test.SqliteTestMixin,
+    data_store_test.DataStoreMultiResolveBenchmarks):
+  """Benchmark batched prefix resolution in the SQLite data store."""
+
+
 def main(args):
   test_lib.main(args)
 
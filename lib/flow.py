@@ -43,6 +43,7 @@ self.state.context.args: The flow runners args. This is an instance of
 
 import functools
 import operator
+import threading
 import time
 
 
@@ -1439,12 +1440,157 @@ class ServerPubKeyCache(communicator.PubKeyCache):
       return cert.GetPubKey()
 
 
+class ClientLivenessBuffer(object):
+  """Buffers the liveness attributes written on every client poll.
+
+  Each authenticated poll updates the CLIENT_IP, CLOCK and PING attributes of
+  the client. Instead of a synchronous data store write per poll, the latest
+  values for each client are kept here and written out together every
+  flush_interval seconds, so the data store lags behind by at most that long.
+
+  The clocks of recently seen clients are kept in memory for the replay check.
+  Clients we have not seen recently have their clock read from the data store.
+  Other frontends only see a client's new clock once it has been flushed.
+  """
+
+  def __init__(self, flush_interval=10, max_clients=100000, token=None):
+    self.flush_interval = flush_interval
+    self.token = token
+    self.lock = threading.RLock()
+    # Maps client ids to the newest client clock we accepted.
+    self.clocks = utils.FastStore(max_clients)
+    # Maps client ids to the (ip, clock, ping) values not yet written.
+    self.pending = {}
+    self.flush_thread = None
+    self.running = False
+
+  def _GetClock(self, client):
+    """Returns the last accepted clock of the client in microseconds."""
+    client_id = str(client.urn.Basename())
+    try:
+      return self.clocks.Get(client_id)
+    except KeyError:
+      pass
+
+    # The cached client object may have been opened long ago, get the clock
+    # the other frontends wrote since.
+    fd = aff4.FACTORY.Open(client.urn, mode="r", token=self.token,
+                           ignore_cache=True)
+    return long(fd.Get(fd.Schema.CLOCK) or 0)
+
+  def _GetLatestClock(self, client_id):
+    """Returns the clock accepted for the client by this frontend, if any."""
+    try:
+      return self.clocks.Get(client_id)
+    except KeyError:
+      return 0
+
+  def Update(self, client, ip, client_time):
+    """Records a client poll if its clock is newer than the last one seen.
+
+    Args:
+      client: The VFSGRRClient object of the polling client.
+      ip: The source ip of the poll.
+      client_time: The timestamp of the client's message list.
+
+    Returns:
+      A tuple (accepted, remote_time) where accepted is False if the message
+      list is not newer than the last one we accepted, i.e. it may have been
+      replayed, and remote_time is the clock we compared against.
+    """
+    client_id = str(client.urn.Basename())
+    # This may read from the data store, so it is done without holding the
+    # lock all polls go through.
+    remote_time = self._GetClock(client)
+
+    with self.lock:
+      # Another poll of the same client may have been accepted meanwhile.
+      remote_time = max(remote_time, self._GetLatestClock(client_id))
+      if client_time <= remote_time:
+        return False, remote_time
+
+      self.clocks.Put(client_id, client_time)
+      self.pending[client.urn] = (ip, client_time, rdfvalue.RDFDatetime().Now())
+      stats.STATS.SetGaugeValue("grr_frontendserver_liveness_pending",
+                                len(self.pending))
+
+    self._StartFlushThread()
+    return True, remote_time
+
+  def _StartFlushThread(self):
+    with self.lock:
+      if self.flush_thread is not None:
+        return
+
+      self.running = True
+      self.flush_thread = threading.Thread(target=self._FlushLoop,
+                                           name="ClientLivenessFlusher")
+      self.flush_thread.daemon = True
+      self.flush_thread.start()
+
+  def _FlushLoop(self):
+    while self.running:
+      time.sleep(self.flush_interval)
+      try:
+        self.Flush()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Error flushing client liveness updates: %s", e)
+
+  def Flush(self):
+    """Writes the buffered liveness attributes of all clients."""
+    with self.lock:
+      pending, self.pending = self.pending, {}
+
+    if not pending:
+      return
+
+    start_time = time.time()
+    try:
+      for urn, (ip, client_time, ping) in pending.iteritems():
+        client = aff4.FACTORY.Create(urn, "VFSGRRClient", mode="w",
+                                     force_new_version=False,
+                                     object_exists=True, token=self.token)
+        client.Set(client.Schema.CLIENT_IP(ip))
+        client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
+        client.Set(client.Schema.PING, ping)
+        client.Close(sync=False)
+
+      data_store.DB.Flush()
+    except Exception:
+      # Retry on the next flush, unless the client has polled again since.
+      with self.lock:
+        for urn, update in pending.iteritems():
+          self.pending.setdefault(urn, update)
+        stats.STATS.SetGaugeValue("grr_frontendserver_liveness_pending",
+                                  len(self.pending))
+      raise
+
+    stats.STATS.RecordEvent("grr_frontendserver_liveness_flush_size",
+                            len(pending))
+    logging.debug("Flushed liveness updates of %d clients in %s seconds.",
+                  len(pending), time.time() - start_time)
+
+  def Stop(self):
+    """Stops the flush thread and writes out everything still buffered."""
+    self.running = False
+    self.Flush()
+
+
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
   def __init__(self, certificate, private_key, token=None):
     self.client_cache = utils.FastStore(1000)
     self.token = token
+
+    self.liveness_buffer = None
+    flush_interval = config_lib.CONFIG["Frontend.liveness_flush_interval"]
+    if flush_interval > 0:
+      self.liveness_buffer = ClientLivenessBuffer(
+          flush_interval=flush_interval,
+          max_clients=config_lib.CONFIG["Frontend.liveness_max_clients"],
+          token=token)
+
     super(ServerCommunicator, self).__init__(certificate=certificate,
                                              private_key=private_key)
     self.pub_key_cache = ServerPubKeyCache(self.client_cache, token=token)
@@ -1490,11 +1636,23 @@ class ServerCommunicator(communicator.Communicator):
                                     len(self.client_cache))
 
         ip = response_comms.orig_request.source_ip
+        client_time = long(signed_message_list.timestamp or 0)
+
+        if self.liveness_buffer:
+          accepted, remote_time = self.liveness_buffer.Update(
+              client, ip, client_time)
+          if not accepted:
+            logging.debug("Message desynchronized: %s > %s", int(client_time),
+                          long(remote_time))
+            return rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED
+
+          stats.STATS.IncrementCounter("grr_authenticated_messages")
+          return result
+
         client.Set(client.Schema.CLIENT_IP(ip))
 
         # The very first packet we see from the client we do not have its clock
         remote_time = client.Get(client.Schema.CLOCK) or 0
-        client_time = signed_message_list.timestamp or 0
         if client_time > long(remote_time):
           stats.STATS.IncrementCounter("grr_authenticated_messages")
 
@@ -1521,6 +1679,144 @@ class ServerCommunicator(communicator.Communicator):
     return result
 
 
+class ClientQueueDrainBatcher(object):
+  """Coalesces concurrent client queue drains into one data store operation.
+
+  Every client poll leases the tasks in its own queue. When many clients poll
+  at the same time this results in a lot of small transactions. Instead, the
+  first drain request waits for up to batch_window seconds for other requests
+  to arrive and then reads all the queues at once with
+  QueueManager.MultiQueryAndOwn(), which only leases (in a transaction) the
+  queues that have tasks. The leased tasks are handed back to the threads
+  waiting on each queue.
+  """
+
+  def __init__(self, batch_window=0.05, max_batch_size=100, token=None):
+    self.batch_window = batch_window
+    self.max_batch_size = max_batch_size
+    self.token = token
+    self.lock = threading.Lock()
+    self.batch_full = threading.Condition(self.lock)
+    self.pending = []
+    self.leader_active = False
+
+  def Lease(self, queue, limit, lease_seconds):
+    """Leases up to limit tasks from queue, possibly batched with others.
+
+    Args:
+      queue: The client queue to lease tasks from.
+      limit: The maximum number of tasks to lease.
+      lease_seconds: The tasks will be leased for this long.
+
+    Returns:
+      A tuple of (tasks, status_found) where tasks is a list of GrrMessage()
+      objects leased and status_found is the set of those tasks which were
+      leased before and already have a status queued for them.
+    """
+    request = _DrainRequest(queue, limit, lease_seconds)
+
+    with self.lock:
+      self.pending.append(request)
+      if self.leader_active:
+        if len(self.pending) >= self.max_batch_size:
+          self.batch_full.notify()
+        is_leader = False
+      else:
+        self.leader_active = True
+        is_leader = True
+
+    if not is_leader:
+      request.wakeup.wait()
+      if request.done:
+        return request.result
+
+      # The previous leader handed the pending requests over to us.
+
+    try:
+      self._LeadBatches(request)
+    finally:
+      with self.lock:
+        if self.pending:
+          # Requests which arrived while we were running the last batch need a
+          # new leader.
+          self.pending[0].wakeup.set()
+        else:
+          self.leader_active = False
+
+    return request.result
+
+  def _LeadBatches(self, own_request):
+    """Runs batches until our own request has been served."""
+    while not own_request.done:
+      with self.lock:
+        if len(self.pending) < self.max_batch_size:
+          self.batch_full.wait(self.batch_window)
+
+        batch = []
+        seen_queues = set()
+        remaining = []
+        for request in self.pending:
+          # The same queue can not be leased twice within one batch - leave
+          # duplicates for the next one.
+          if (request.queue in seen_queues or
+              len(batch) >= self.max_batch_size):
+            remaining.append(request)
+          else:
+            seen_queues.add(request.queue)
+            batch.append(request)
+        self.pending = remaining
+
+      self._RunBatch(batch)
+
+  def _RunBatch(self, batch):
+    """Leases the tasks for a batch of requests and wakes up their threads."""
+    start_time = time.time()
+    stats.STATS.RecordEvent("grr_frontendserver_drain_batch_size", len(batch))
+
+    limits = dict((request.queue, request.limit) for request in batch)
+    lease_seconds = max(request.lease_seconds for request in batch)
+
+    results = {}
+    status_found = set()
+    try:
+      with queue_manager.QueueManager(token=self.token) as manager:
+        results = manager.MultiQueryAndOwn(
+            limits.keys(), lease_seconds=lease_seconds, limit=limits)
+
+        # Check all the retransmitted messages of the batch in one go.
+        initial_ttl = rdf_flows.GrrMessage().task_ttl
+        retransmitted = [task for tasks in results.values() for task in tasks
+                         if task.task_ttl < initial_ttl - 1]
+        if retransmitted:
+          status_found = manager.MultiCheckStatus(retransmitted)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error draining client queues: %s", e)
+
+    now = time.time()
+    for request in batch:
+      request.result = (results.get(request.queue, []), status_found)
+      stats.STATS.RecordEvent("grr_frontendserver_drain_batch_latency",
+                              start_time - request.created)
+      request.done = True
+      request.wakeup.set()
+
+    logging.debug("Drained %d client queues in %s seconds.",
+                  len(batch), now - start_time)
+
+
+class _DrainRequest(object):
+  """A client queue waiting to be drained by the ClientQueueDrainBatcher."""
+
+  def __init__(self, queue, limit, lease_seconds):
+    self.queue = queue
+    self.limit = limit
+    self.lease_seconds = lease_seconds
+    self.created = time.time()
+    self.result = ([], set())
+    self.done = False
+    self.wakeup = threading.Event()
+
+
 class FrontEndServer(object):
   """This is the front end server.
 
@@ -1559,6 +1855,17 @@ class FrontEndServer(object):
         max_threads=config_lib.CONFIG["Threadpool.size"])
     self.thread_pool.Start()
 
+    self.partial_message_decoding = config_lib.CONFIG[
+        "Frontend.partial_message_decoding"]
+
+    self.drain_batcher = None
+    drain_batch_window = config_lib.CONFIG["Frontend.drain_batch_window"]
+    if drain_batch_window > 0:
+      self.drain_batcher = ClientQueueDrainBatcher(
+          batch_window=drain_batch_window,
+          max_batch_size=config_lib.CONFIG["Frontend.drain_max_batch_size"],
+          token=self.token)
+
     # Well known flows are run on the front end.
     self.well_known_flows = (
         WellKnownFlow.GetAllWellKnownFlows(token=self.token))
@@ -1567,6 +1874,11 @@ class FrontEndServer(object):
       if well_known_flow not in config_lib.CONFIG["Frontend.well_known_flows"]:
         del self.well_known_flows[well_known_flow]
 
+  def Stop(self):
+    """Writes out the client liveness updates still buffered."""
+    if self._communicator.liveness_buffer:
+      self._communicator.liveness_buffer.Stop()
+
   def SetThrottleCallBack(self, callback):
     self.throttle_callback = callback
 
@@ -1657,16 +1969,53 @@ class FrontEndServer(object):
        tuple of (source, message_count) where message_count is the number of
        messages received from the client with common name source.
     """
-    messages, source, timestamp = self._communicator.DecodeMessages(
-        request_comms)
+    messages, source, timestamp = self.DecodeMessageBundle(request_comms)
+
+    message_list, tasks = self.ProcessDecodedMessages(
+        source, messages, request_comms.queue_size)
+
+    self.EncodeMessageList(message_list, tasks, response_comms, source,
+                           timestamp, request_comms.api_version)
+
+    return source, len(messages)
+
+  def DecodeMessageBundle(self, request_comms):
+    """Decrypts and authenticates the messages sent by the client.
+
+    This is the CPU bound part of HandleMessageBundles(), frontends which
+    pipeline requests can run it on a different thread pool than the data store
+    bound ProcessDecodedMessages().
+
+    Args:
+       request_comms: A ClientCommunication rdfvalue with messages sent by the
+       client.
+
+    Returns:
+       tuple of (messages, source, timestamp) as returned by the communicator.
+    """
+    return self._communicator.DecodeMessages(
+        request_comms, partial=self.partial_message_decoding)
+
+  def ProcessDecodedMessages(self, source, messages, client_queue_size):
+    """Receives the client's messages and collects the messages for it.
+
+    Args:
+       source: The client the messages came from.
+       messages: The decoded GrrMessages sent by the client.
+       client_queue_size: The number of messages queued on the client.
 
+    Returns:
+       tuple of (message_list, tasks) where message_list is a MessageList of
+       messages for the client and tasks are the tasks those messages were
+       leased from.
+    """
     now = time.time()
     if messages:
       # Receive messages in line.
       self.ReceiveMessages(source, messages)
 
     # We send the client a maximum of self.max_queue_size messages
-    required_count = max(0, self.max_queue_size - request_comms.queue_size)
+    required_count = max(0, self.max_queue_size - client_queue_size)
     tasks = []
 
     message_list = rdf_flows.MessageList()
@@ -1682,20 +2031,36 @@ class FrontEndServer(object):
     else:
       stats.STATS.IncrementCounter("grr_frontendserver_handle_throttled_num")
 
+    return message_list, tasks
+
+  def EncodeMessageList(self, message_list, tasks, response_comms, source,
+                        timestamp, api_version):
+    """Encrypts the messages for the client into response_comms.
+
+    Args:
+       message_list: A MessageList with the messages for the client.
+       tasks: The tasks the messages were leased from.
+       response_comms: A ClientCommunication rdfvalue to fill.
+       source: The client the messages are destined to.
+       timestamp: The timestamp of the client's request.
+       api_version: The api version the client used.
+
+    Raises:
+       communicator.UnknownClientCert: if we don't have the client's
+       certificate yet. The tasks are rescheduled in this case.
+    """
     # Encode the message_list in the response_comms using the same API version
     # the client used.
     try:
       self._communicator.EncodeMessages(
           message_list, response_comms, destination=str(source),
-          timestamp=timestamp, api_version=request_comms.api_version)
+          timestamp=timestamp, api_version=api_version)
     except communicator.UnknownClientCert:
       # We can not encode messages to the client yet because we do not have the
       # client certificate - return them to the queue so we can try again later.
       queue_manager.QueueManager(token=self.token).Schedule(tasks)
       raise
 
-    return source, len(messages)
-
   def DrainTaskSchedulerQueueForClient(self, client, max_count,
                                        response_message):
     """Drains the client's Task Scheduler queue.
@@ -1722,32 +2087,42 @@ class FrontEndServer(object):
     client = rdf_client.ClientURN(client)
 
     start_time = time.time()
+    initial_ttl = rdf_flows.GrrMessage().task_ttl
+
     # Drain the queue for this client
-    new_tasks = queue_manager.QueueManager(token=self.token).QueryAndOwn(
-        queue=client.Queue(), limit=max_count,
-        lease_seconds=self.message_expiry_time)
+    if self.drain_batcher:
+      new_tasks, status_found = self.drain_batcher.Lease(
+          client.Queue(), max_count, self.message_expiry_time)
+    else:
+      new_tasks = queue_manager.QueueManager(token=self.token).QueryAndOwn(
+          queue=client.Queue(), limit=max_count,
+          lease_seconds=self.message_expiry_time)
+
+      retransmitted = [task for task in new_tasks
+                       if task.task_ttl < initial_ttl - 1]
+      status_found = set()
+      if retransmitted:
+        with queue_manager.QueueManager(token=self.token) as manager:
+          status_found = manager.MultiCheckStatus(retransmitted)
 
-    initial_ttl = rdf_flows.GrrMessage().task_ttl
-    check_before_sending = []
     result = []
+    dequeue = []
     for task in new_tasks:
-      if task.task_ttl < initial_ttl - 1:
-        # This message has been leased before.
-        check_before_sending.append(task)
-      else:
+      if task.task_ttl >= initial_ttl - 1:
         response_message.job.Append(task)
         result.append(task)
 
-    if check_before_sending:
-      with queue_manager.QueueManager(token=self.token) as manager:
-        status_found = manager.MultiCheckStatus(check_before_sending)
+      # This message has been leased before. All messages that don't have a
+      # status yet should be sent again.
+      elif task not in status_found:
+        result.append(task)
+      else:
+        dequeue.append(task)
 
-        # All messages that don't have a status yet should be sent again.
-        for task in check_before_sending:
-          if task not in status_found:
-            result.append(task)
-          else:
-            manager.DeQueueClientRequest(client, task.task_id)
+    if dequeue:
+      with queue_manager.QueueManager(token=self.token) as manager:
+        for task in dequeue:
+          manager.DeQueueClientRequest(client, task.task_id)
 
     stats.STATS.IncrementCounter("grr_messages_sent", len(result))
     logging.debug("Drained %d messages for %s in %s seconds.",
@@ -1788,7 +2163,7 @@ class FrontEndServer(object):
           status = rdf_flows.GrrStatus(msg.payload)
           if status.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
             # A client crashed while performing an action, fire an event.
-            Events.PublishEvent("ClientCrash", rdf_flows.GrrMessage(msg),
+            Events.PublishEvent("ClientCrash", _FullMessage(msg),
                                 token=self.token)
 
       sessions_handled = []
@@ -1822,7 +2197,7 @@ class FrontEndServer(object):
         if msg.session_id.FlowName() in self.well_known_flows:
           # This message should be processed directly on the front end.
           flow = self.well_known_flows[msg.session_id.FlowName()]
-          flow.ProcessMessage(msg)
+          flow.ProcessMessage(_FullMessage(msg))
           flow.HeartBeat()
 
           # Remove the notification from the well known flows.
@@ -1849,6 +2224,14 @@ class FrontEndServer(object):
     return result
 
 
+def _FullMessage(msg):
+  """Returns a GrrMessage copy of a GrrMessage or ReceivedMessage."""
+  if isinstance(msg, communicator.ReceivedMessage):
+    return rdf_flows.GrrMessage(msg.ToGrrMessage())
+
+  return rdf_flows.GrrMessage(msg)
+
+
 def ProcessCompletedRequests(flow_obj, thread_pool, reqs):
   flow_obj.ProcessCompletedRequests(thread_pool, reqs)
 
@@ -1877,6 +2260,9 @@ class FlowInit(registry.InitHook):
         "frontend_inactive_request_count", fields=[("source", str)])
     stats.STATS.RegisterEventMetric(
         "frontend_request_latency", fields=[("source", str)])
+    # Requests waiting for a thread in the async frontend's pipeline stages.
+    stats.STATS.RegisterGaugeMetric(
+        "frontend_async_backlog", int, fields=[("stage", str)])
 
     # Counters defined here
     stats.STATS.RegisterCounterMetric("grr_flow_completed_count")
@@ -1891,11 +2277,22 @@ class FlowInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_unknown_clients")
     stats.STATS.RegisterCounterMetric("grr_well_known_flow_requests")
     stats.STATS.RegisterCounterMetric("grr_worker_states_run")
+    stats.STATS.RegisterCounterMetric("grr_worker_responses_processed")
     stats.STATS.RegisterCounterMetric("grr_worker_well_known_flow_requests")
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_throttled_num")
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_throttle_setting", str)
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
+    # Number of client queues leased together by the ClientQueueDrainBatcher
+    # and the time drain requests waited for their batch to start.
+    stats.STATS.RegisterEventMetric("grr_frontendserver_drain_batch_size",
+                                    bins=[1, 2, 5, 10, 20, 50, 100, 200, 500])
+    stats.STATS.RegisterEventMetric("grr_frontendserver_drain_batch_latency")
+    # Clients with liveness updates waiting in the ClientLivenessBuffer and
+    # the number of clients written per flush.
+    stats.STATS.RegisterGaugeMetric("grr_frontendserver_liveness_pending", int)
+    stats.STATS.RegisterEventMetric("grr_frontendserver_liveness_flush_size",
+                                    bins=[1, 10, 100, 1000, 10000, 100000])
 
     # Flow-aware counters
     stats.STATS.RegisterCounterMetric("flow_starts",
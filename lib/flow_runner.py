@@ -487,6 +487,8 @@ class FlowRunner(object):
             self.flow_obj.HeartBeat()
             self._Process(request, responses, thread_pool=thread_pool,
                           events=processing)
+            stats.STATS.IncrementCounter("grr_worker_responses_processed",
+                                         len(responses))
 
           # Quit early if we are no longer alive.
           else:
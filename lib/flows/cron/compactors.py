@@ -8,12 +8,14 @@ import logging
 from grr.lib import aff4
 from grr.lib import config_lib
 from grr.lib import flow
+from grr.lib import keyword_index
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
 
 from grr.lib.aff4_objects import collections
 from grr.lib.aff4_objects import cronjobs
+from grr.lib.aff4_objects import stats_store
 
 
 class PackedVersionedCollectionCompactor(cronjobs.SystemCronFlow):
@@ -69,6 +71,70 @@ class PackedVersionedCollectionCompactor(cronjobs.SystemCronFlow):
       return False
 
 
+class StatsStoreCompactor(cronjobs.SystemCronFlow):
+  """A Compactor which adds the latest stats to the stats store rollups."""
+
+  frequency = rdfvalue.Duration("10m")
+  lifetime = rdfvalue.Duration("40m")
+
+  @flow.StateHandler()
+  def Start(self):
+    """Compact the stats of every process."""
+    store = aff4.FACTORY.Create(stats_store.StatsStore.DATA_STORE_ROOT,
+                                aff4_type="StatsStore", mode="rw",
+                                token=self.token)
+    lease_time = config_lib.CONFIG["Worker.compaction_lease_time"]
+
+    for process_id in store.ListUsedProcessIds():
+      self.HeartBeat()
+      urn = store.urn.Add(process_id)
+      try:
+        with aff4.FACTORY.OpenWithLock(
+            urn, lease_time=lease_time, aff4_type="StatsStoreProcessData",
+            blocking=False, token=self.token) as fd:
+          num_points = fd.Compact()
+          self.Log("Added %d points to the rollups of %s", num_points, urn)
+      except aff4.LockError:
+        stats.STATS.IncrementCounter("compactor_locking_errors")
+        logging.error("Trying to compact locked stats: %s", urn)
+
+
+class KeywordIndexCompactor(cronjobs.SystemCronFlow):
+  """A Compactor which compacts the changed posting lists of keyword indexes."""
+
+  frequency = rdfvalue.Duration("10m")
+  lifetime = rdfvalue.Duration("40m")
+
+  @flow.StateHandler()
+  def Start(self):
+    """Compact the posting lists which have grown since they were compacted."""
+    freeze_timestamp = rdfvalue.RDFDatetime().Now()
+    keyword_urns_by_index = {}
+    for index_urn, keyword_urn in (
+        keyword_index.AFF4KeywordIndex.QueryNotifications(
+            timestamp=freeze_timestamp, token=self.token)):
+      keyword_urns_by_index.setdefault(index_urn, []).append(keyword_urn)
+
+    # Only one instance of a cron job runs at a time, so the posting lists are
+    # never compacted concurrently. Indexes are written without ever being
+    # closed, so they have no type we could check.
+    for index_urn, keyword_urns in keyword_urns_by_index.iteritems():
+      self.HeartBeat()
+      index = aff4.FACTORY.Create(index_urn, aff4_type="AFF4KeywordIndex",
+                                  mode="rw", object_exists=True,
+                                  token=self.token)
+      # Relative to the index, these give the keyword urns again.
+      keywords = [urn.RelativeName(index_urn) for urn in keyword_urns]
+      num_compacted = index.CompactPostingLists(
+          keywords, min_changes=index.COMPACTION_THRESHOLD)
+      self.Log("Compacted %d posting lists in %s", num_compacted, index_urn)
+
+      # Lists changed after freeze_timestamp keep their notification. Lists
+      # which are still small are queued again by their next change.
+      keyword_index.AFF4KeywordIndex.DeleteNotifications(
+          keyword_urns, end=freeze_timestamp, token=self.token)
+
+
 class CompactorsInitHook(registry.InitHook):
 
   pre = ["StatsInit"]
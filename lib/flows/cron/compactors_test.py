@@ -6,8 +6,11 @@
 from grr.lib import aff4
 from grr.lib import flags
 from grr.lib import flow
+from grr.lib import keyword_index
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
+from grr.lib.aff4_objects import stats_store
 # pylint: disable=unused-import
 from grr.lib.flows.cron import compactors as _
 # pylint: enable=unused-import
@@ -150,6 +153,59 @@ class PackedVersionedCollectionCompactorTest(test_lib.FlowTestsBaseclass):
                           if "aff4:/tmp/coll" in l.log_message))
 
 
+class StatsStoreCompactorTest(test_lib.FlowTestsBaseclass):
+  """Test for StatsStoreCompactor."""
+
+  def testCompactsAllProcesses(self):
+    stats.STATS.RegisterCounterMetric("counter")
+    stats.STATS.IncrementCounter("counter")
+
+    store = aff4.FACTORY.Create(None, "StatsStore", mode="w", token=self.token)
+    for process_id in ["pid1", "pid2"]:
+      store.WriteStats(process_id=process_id, timestamp=42 * 1000000,
+                       sync=True)
+
+    with test_lib.FakeTime(3600):
+      for _ in test_lib.TestFlowHelper("StatsStoreCompactor",
+                                       token=self.token):
+        pass
+
+    for process_id in ["pid1", "pid2"]:
+      fd = aff4.FACTORY.Open(store.urn.Add(process_id), token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.COMPACTED_UNTIL), 59 * 60 * 1000000)
+
+      # The counter is now in the 1 minute rollup.
+      series = fd.ReadRollup(stats_store.ROLLUPS[0], 0, 3600 * 1000000)
+      self.assertEqual(series["counter"][()], [(42 * 1000000, 1, None)])
+
+
+
+class KeywordIndexCompactorTest(test_lib.FlowTestsBaseclass):
+  """Test for KeywordIndexCompactor."""
+
+  def testCompactsChangedPostingLists(self):
+    index = aff4.FACTORY.Create("aff4:/index1/", aff4_type="AFF4KeywordIndex",
+                                mode="rw", token=self.token)
+    for i in range(20):
+      index.AddKeywordsForName("C.%02X" % i, ["popular_keyword", "."])
+    index.AddKeywordsForName("C.00", ["rare_keyword"])
+
+    with utils.Stubber(keyword_index.AFF4KeywordIndex,
+                       "COMPACTION_THRESHOLD", 10):
+      for _ in test_lib.TestFlowHelper("KeywordIndexCompactor",
+                                       token=self.token):
+        pass
+
+    directories = index._ReadDirectories(["popular_keyword", ".",
+                                          "rare_keyword"])
+    self.assertEqual(sorted(directories), [".", "popular_keyword"])
+    self.assertEqual(len(index.Lookup(["popular_keyword", "."])), 20)
+
+    # All the notifications written before the compactor ran are gone.
+    self.assertFalse(list(keyword_index.AFF4KeywordIndex.QueryNotifications(
+        token=self.token)))
+
+
 def main(argv):
   # Run the full test suite
   test_lib.GrrTestProgram(argv=argv)
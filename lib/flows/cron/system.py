@@ -15,6 +15,7 @@ from grr.lib import data_store
 from grr.lib import export_utils
 from grr.lib import flow
 from grr.lib import flow_runner
+from grr.lib import hunt_index
 from grr.lib import hunts
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -361,6 +362,20 @@ class PurgeClientStats(cronjobs.SystemCronFlow):
     data_store.DB.Flush()
 
 
+class HuntIndexCronFlow(cronjobs.SystemCronFlow):
+  """Adds the hunts created before there was a hunt index to the index."""
+
+  frequency = rdfvalue.Duration("1h")
+
+  @flow.StateHandler()
+  def Start(self):
+    index = aff4.FACTORY.Create(hunt_index.MAIN_INDEX, aff4_type="HuntIndex",
+                                mode="rw", object_exists=True,
+                                token=self.token)
+    if not index.IsComplete():
+      index.Rebuild()
+
+
 def GetSystemForemanRule(os_string):
   return rdf_foreman.ForemanAttributeRegex(
       attribute_name="System", attribute_regex=os_string)
@@ -8,6 +8,7 @@ import zlib
 
 import logging
 from grr.lib import aff4
+from grr.lib import blob_store
 from grr.lib import flow
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -189,8 +190,16 @@ class HashTracker(object):
   def __init__(self, hash_response, is_known=False):
     self.hash_response = hash_response
     self.is_known = is_known
-    self.blob_urn = rdfvalue.RDFURN("aff4:/blobs").Add(
-        hash_response.data.encode("hex"))
+    # The sha256 digest of the blob.
+    self.digest = hash_response.data
+
+  def __setstate__(self, state):
+    # Trackers pickled by older versions have a blob urn instead of a digest.
+    if "digest" not in state:
+      state.pop("blob_urn", None)
+      state["digest"] = state["hash_response"].data
+
+    self.__dict__.update(state)
 
 
 class FileTracker(object):
@@ -579,7 +588,7 @@ class MultiGetFileMixin(object):
     hash_tracker = HashTracker(hash_response)
     file_tracker.hash_list.append(hash_tracker)
 
-    self.state.blobs_we_need.add(hash_tracker.blob_urn)
+    self.state.blobs_we_need.add(hash_tracker.digest)
 
     if len(self.state.blobs_we_need) > self.MIN_CALL_TO_FILE_STORE:
       self.FetchFileContent()
@@ -593,9 +602,16 @@ class MultiGetFileMixin(object):
     if not self.state.pending_files:
       return
 
-    # Check if we have all the blobs in the blob AFF4 namespace..
-    stats = aff4.FACTORY.Stat(self.state.blobs_we_need, token=self.token)
-    blobs_we_have = set([x["urn"] for x in stats])
+    # Flows started by older versions track blob urns instead of digests.
+    blobs_we_need = set()
+    for blob in self.state.blobs_we_need:
+      if isinstance(blob, rdfvalue.RDFURN):
+        blob = blob.Basename().decode("hex")
+      blobs_we_need.add(blob)
+
+    # Check which of the blobs we already have in the blob store.
+    blobs_we_have = blob_store.BLOB_STORE.CheckBlobsExist(
+        blobs_we_need, token=self.token)
     self.state.blobs_we_need = set()
 
     # Now iterate over all the blobs and add them directly to the blob image.
@@ -604,7 +620,7 @@ class MultiGetFileMixin(object):
         # Make sure we read the correct pathspec on the client.
         hash_tracker.hash_response.pathspec = file_tracker.pathspec
 
-        if hash_tracker.blob_urn in blobs_we_have:
+        if blobs_we_have.get(hash_tracker.digest):
           # If we have the data we may call our state directly.
           self.CallState([hash_tracker.hash_response],
                          next_state="WriteBuffer",
@@ -816,26 +832,29 @@ class TransferStore(flow.WellKnownFlow):
     if read_buffer.data:
       data = read_buffer.data
 
+      cdata = None
       if (read_buffer.compression ==
           rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION):
         cdata = data
         data = zlib.decompress(cdata)
-      elif (read_buffer.compression ==
+      elif (read_buffer.compression !=
             rdf_protodict.DataBlob.CompressionType.UNCOMPRESSED):
-        cdata = zlib.compress(data)
-      else:
         raise RuntimeError("Unsupported compression")
 
       # The hash is done on the uncompressed data
       digest = hashlib.sha256(data).digest()
-      urn = rdfvalue.RDFURN("aff4:/blobs").Add(digest.encode("hex"))
 
-      fd = aff4.FACTORY.Create(urn, "AFF4MemoryStream", mode="w",
-                               token=self.token)
-      fd.OverwriteAndClose(cdata, len(data), sync=True)
+      # Blob stores compressing their blobs can reuse the client's compression.
+      compressed_blobs = None
+      if cdata is not None:
+        compressed_blobs = {digest: cdata}
+
+      blob_store.BLOB_STORE.WriteBlobs({digest: data},
+                                       compressed_blobs=compressed_blobs,
+                                       token=self.token)
 
       logging.debug("Got blob %s (length %s)", digest.encode("hex"),
-                    len(cdata))
+                    len(data))
 
 
 class SendFile(flow.GRRFlow):
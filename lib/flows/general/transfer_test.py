@@ -4,6 +4,7 @@
 
 import hashlib
 import os
+import pickle
 
 from grr.client.client_actions import standard
 from grr.lib import action_mocks
@@ -231,6 +232,19 @@ class TestTransfer(test_lib.FlowTestsBaseclass):
 
     self.assertEqual(hash_obj.sha1, expected_hash)
 
+  def testHashTrackersPickledWithBlobUrnsAreLoaded(self):
+    hash_response = rdf_client.BufferReference(
+        data=hashlib.sha256("foo").digest())
+    tracker = transfer.HashTracker(hash_response)
+    # Trackers used to keep the urn of the blob.
+    del tracker.digest
+    tracker.blob_urn = aff4.ROOT_URN.Add("blobs").Add(
+        hash_response.data.encode("hex"))
+
+    tracker = pickle.loads(pickle.dumps(tracker))
+    self.assertEqual(tracker.digest, hash_response.data)
+    self.assertFalse(hasattr(tracker, "blob_urn"))
+
 
 def main(argv):
   # Run the full test suite
@@ -2,6 +2,7 @@
 """Unittest for grr frontend server."""
 
 
+import threading
 
 
 from grr.lib import communicator
@@ -11,6 +12,7 @@ from grr.lib import flags
 from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
@@ -303,7 +305,7 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
     class MockCommunicator(object):
       """A fake that simulates an unenrolled client."""
 
-      def DecodeMessages(self, *unused_args):
+      def DecodeMessages(self, *unused_args, **unused_kw):
         """For simplicity client sends an empty request."""
         return ([], client_id, 100)
 
@@ -419,6 +421,82 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
         [True] * 2 + [False] * (rdf_flows.GrrMessage().task_ttl - 2))
 
 
+class GRRFEServerBatchedDrainTest(GRRFEServerTest):
+  """Runs the GRRFEServer tests with client queue drains batched."""
+
+  def setUp(self):
+    self.batch_overrider = test_lib.ConfigOverrider({
+        "Frontend.drain_batch_window": 0.01})
+    self.batch_overrider.Start()
+    super(GRRFEServerBatchedDrainTest, self).setUp()
+
+  def tearDown(self):
+    super(GRRFEServerBatchedDrainTest, self).tearDown()
+    self.batch_overrider.Stop()
+
+  def testConcurrentDrainsAreBatched(self):
+    client_ids = self.SetupClients(5)
+    for client_id in client_ids:
+      flow.GRRFlow.StartFlow(client_id=client_id, flow_name="SendingFlow",
+                             message_count=2, token=self.token)
+
+    results = {}
+
+    def Drain(client_id):
+      results[client_id] = self.server.DrainTaskSchedulerQueueForClient(
+          client_id, 100, rdf_flows.MessageList())
+
+    batch_count = stats.STATS.GetMetricValue(
+        "grr_frontendserver_drain_batch_size").count
+
+    threads = [threading.Thread(target=Drain, args=(client_id,))
+               for client_id in client_ids]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    for client_id in client_ids:
+      self.assertEqual(len(results[client_id]), 2)
+
+    self.assertLess(stats.STATS.GetMetricValue(
+        "grr_frontendserver_drain_batch_size").count - batch_count, 5)
+
+
+class GRRFEServerPartialDecodingTest(GRRFEServerTest):
+  """Runs the GRRFEServer tests with partially decoded client messages."""
+
+  def setUp(self):
+    super(GRRFEServerPartialDecodingTest, self).setUp()
+
+    receive_messages = self.server.ReceiveMessages
+
+    def ReceivePartiallyDecoded(client_id, messages):
+      return receive_messages(client_id, [
+          communicator.ReceivedMessage(message.SerializeToString())
+          for message in messages])
+
+    self.server.ReceiveMessages = ReceivePartiallyDecoded
+
+  def testClientCrashIsPublished(self):
+    flow_obj = self.FlowSetup("FlowOrderTest")
+    status = rdf_flows.GrrStatus(
+        status=rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED)
+    message = rdf_flows.GrrMessage(
+        request_id=1, response_id=1, task_id=15,
+        session_id=flow_obj.session_id, payload=status,
+        type=rdf_flows.GrrMessage.Type.STATUS)
+
+    published = []
+    with utils.Stubber(flow.Events, "PublishEvent",
+                       lambda name, msg, **_: published.append((name, msg))):
+      self.server.ReceiveMessages(self.client_id, [message])
+
+    self.assertEqual(len(published), 1)
+    self.assertEqual(published[0][0], "ClientCrash")
+    self.assertRDFValueEqual(published[0][1], message)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""An index of hunts, ordered by their last activity.
+
+Listing hunts used to mean opening every child of aff4:/hunts, which gets
+slow once there are thousands of them. The index keeps a small entry per hunt
+with what the hunt list shows and filters on: creation time, creator, state
+and description. All the entries live in a single row, one column per hunt,
+and each entry is written with the time of the hunt's last creation or state
+change so the whole list can be read, filtered and paged with a single data
+store read.
+
+The index is only written by the workers and cron jobs. Hunts created before
+the index existed are added by the HuntIndexCronFlow system cron job, until
+then readers have to check IsComplete() and list aff4:/hunts instead.
+"""
+
+
+import logging
+
+from grr.lib import aff4
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib.rdfvalues import hunts as rdf_hunts
+
+# The system's primary hunt index.
+MAIN_INDEX = rdfvalue.RDFURN("aff4:/hunt_index")
+
+HUNTS_ROOT = rdfvalue.RDFURN("aff4:/hunts")
+
+
+class HuntIndex(aff4.AFF4Object):
+  """An index of hunts."""
+
+  ENTRY_PREFIX = "hunt_index:entry:"
+  ENTRY_PREFIX_LEN = len(ENTRY_PREFIX)
+  ENTRY_COLUMN_FORMAT = ENTRY_PREFIX + "%s"
+
+  # Set once the hunts created before the index existed have been added.
+  COMPLETE_COLUMN = "hunt_index:complete"
+
+  @classmethod
+  def EntryColumn(cls, hunt_urn):
+    """Returns the column holding the entry of a hunt."""
+    return cls.ENTRY_COLUMN_FORMAT % rdfvalue.RDFURN(hunt_urn).Basename()
+
+  @classmethod
+  def EntryForHunt(cls, hunt_obj):
+    """Returns the HuntIndexEntry describing a hunt."""
+    return rdf_hunts.HuntIndexEntry(
+        urn=hunt_obj.urn,
+        create_time=hunt_obj.GetRunner().context.create_time,
+        creator=hunt_obj.creator,
+        state=hunt_obj.Get(hunt_obj.Schema.STATE),
+        description=hunt_obj.state.context.args.description)
+
+  def AddHunt(self, hunt_obj, timestamp=None, sync=True):
+    """Adds a hunt to the index or updates its entry.
+
+    Args:
+      hunt_obj: The GRRHunt to index.
+      timestamp: The time of the hunt's last activity in microseconds since
+                 the epoch, defaults to now.
+      sync: Sync to data store immediately.
+    """
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+
+    data_store.DB.Set(
+        self.urn, self.EntryColumn(hunt_obj.urn),
+        self.EntryForHunt(hunt_obj).SerializeToString(), replace=True,
+        token=self.token, sync=sync, timestamp=timestamp)
+
+  def ListHunts(self, active_since=None):
+    """Lists the indexed hunts.
+
+    Args:
+      active_since: If given, only hunts which are running or were created or
+                    changed state since this RDFDatetime are listed.
+
+    Returns:
+      A list of HuntIndexEntry, most recently active first. The age of each
+      entry is the time of the hunt's last activity.
+    """
+    entries = []
+    for _, value, timestamp in data_store.DB.ResolvePrefix(
+        self.urn, self.ENTRY_PREFIX, timestamp=data_store.DB.NEWEST_TIMESTAMP,
+        token=self.token):
+      entry = rdf_hunts.HuntIndexEntry(value,
+                                       age=rdfvalue.RDFDatetime(timestamp))
+      if (active_since is not None and entry.age < active_since and
+          entry.state != "STARTED"):
+        continue
+
+      entries.append(entry)
+
+    entries.sort(key=lambda entry: entry.age, reverse=True)
+    return entries
+
+  def IsComplete(self):
+    """Returns True if all existing hunts have been added to the index."""
+    return bool(data_store.DB.Resolve(self.urn, self.COMPLETE_COLUMN,
+                                      token=self.token)[0])
+
+  def Rebuild(self):
+    """Adds all the hunts under aff4:/hunts to the index.
+
+    Hunts are indexed when they are created or change state, this is only
+    needed once for the hunts created before the index existed. Hunts already
+    in the index are left alone, their entries may be newer than what we read.
+    This opens every hunt and writes to the index, see HuntIndexCronFlow.
+    """
+    indexed = set(entry.urn for entry in self.ListHunts())
+    hunts_root = aff4.FACTORY.Open(HUNTS_ROOT, mode="r", token=self.token)
+    last_active = dict((urn, urn.age) for urn in hunts_root.ListChildren()
+                       if urn not in indexed)
+
+    count = 0
+    for hunt_obj in aff4.FACTORY.MultiOpen(last_active, aff4_type="GRRHunt",
+                                           token=self.token):
+      if not hunt_obj.state:
+        continue
+
+      last_active_time = last_active[hunt_obj.urn]
+      self.AddHunt(hunt_obj, sync=False,
+                   timestamp=last_active_time.AsMicroSecondsFromEpoch())
+      count += 1
+
+    data_store.DB.Set(self.urn, self.COMPLETE_COLUMN, "1", token=self.token)
+    logging.info("Added %d hunts to the hunt index.", count)
+
+
+def GetHuntIndex(token=None):
+  """Returns the main hunt index for reading."""
+  return aff4.FACTORY.Create(MAIN_INDEX, aff4_type="HuntIndex", mode="r",
+                             object_exists=True, force_new_version=False,
+                             token=token)
+
+
+def IndexHunt(hunt_obj):
+  """Adds a hunt to the main index or updates its entry."""
+  aff4.FACTORY.Create(MAIN_INDEX, aff4_type="HuntIndex", mode="rw",
+                      object_exists=True,
+                      token=hunt_obj.token).AddHunt(hunt_obj)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Tests for grr.lib.hunt_index."""
+
+
+from grr.lib import aff4
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import flow_runner
+from grr.lib import hunt_index
+from grr.lib import hunts
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+# pylint: disable=unused-import
+from grr.lib.flows.cron import system as _
+# pylint: enable=unused-import
+from grr.lib.flows.general import transfer
+from grr.lib.rdfvalues import paths as rdf_paths
+
+
+class HuntIndexTest(test_lib.AFF4ObjectTest):
+
+  def CreateHunt(self, description):
+    return hunts.GRRHunt.StartHunt(
+        hunt_name="GenericHunt",
+        description=description,
+        flow_runner_args=flow_runner.FlowRunnerArgs(flow_name="GetFile"),
+        flow_args=transfer.GetFileArgs(
+            pathspec=rdf_paths.PathSpec(
+                path="/tmp/evil.txt",
+                pathtype=rdf_paths.PathSpec.PathType.OS)),
+        client_rate=0, token=self.token)
+
+  def GetIndex(self):
+    return aff4.FACTORY.Create(hunt_index.MAIN_INDEX, aff4_type="HuntIndex",
+                               mode="rw", object_exists=True, token=self.token)
+
+  def testHuntsAreIndexedWhenCreated(self):
+    with test_lib.FakeTime(1000):
+      hunt_obj = self.CreateHunt("foo hunt")
+
+    entries = self.GetIndex().ListHunts()
+    self.assertEqual(len(entries), 1)
+
+    entry = entries[0]
+    self.assertEqual(entry.urn, hunt_obj.urn)
+    self.assertEqual(entry.create_time,
+                     rdfvalue.RDFDatetime().FromSecondsFromEpoch(1000))
+    self.assertEqual(entry.creator, self.token.username)
+    self.assertEqual(entry.state, "PAUSED")
+    self.assertEqual(entry.description, "foo hunt")
+    self.assertEqual(entry.age,
+                     rdfvalue.RDFDatetime().FromSecondsFromEpoch(1000))
+
+  def testStateChangesUpdateTheEntry(self):
+    with test_lib.FakeTime(1000):
+      hunt_obj = self.CreateHunt("foo hunt")
+
+    with test_lib.FakeTime(2000):
+      hunt_obj.Run()
+
+    entry, = self.GetIndex().ListHunts()
+    self.assertEqual(entry.state, "STARTED")
+    self.assertEqual(entry.create_time,
+                     rdfvalue.RDFDatetime().FromSecondsFromEpoch(1000))
+    self.assertEqual(entry.age,
+                     rdfvalue.RDFDatetime().FromSecondsFromEpoch(2000))
+
+    hunt_obj.Stop()
+
+    entry, = self.GetIndex().ListHunts()
+    self.assertEqual(entry.state, "STOPPED")
+
+  def testListHuntsIsOrderedByLastActivity(self):
+    hunt_objs = []
+    for i in range(1, 4):
+      with test_lib.FakeTime(i * 1000):
+        hunt_objs.append(self.CreateHunt("hunt_%d" % i))
+    urns = [hunt_obj.urn for hunt_obj in hunt_objs]
+
+    with test_lib.FakeTime(5000):
+      hunt_objs[0].Run()
+
+    self.assertEqual([entry.urn for entry in self.GetIndex().ListHunts()],
+                     [urns[0], urns[2], urns[1]])
+
+  def testListHuntsActiveSince(self):
+    hunt_objs = []
+    for i in range(1, 4):
+      with test_lib.FakeTime(i * 1000):
+        hunt_objs.append(self.CreateHunt("hunt_%d" % i))
+    urns = [hunt_obj.urn for hunt_obj in hunt_objs]
+
+    with test_lib.FakeTime(1500):
+      hunt_objs[0].Run()
+
+    # The first hunt is running so it counts as active.
+    entries = self.GetIndex().ListHunts(
+        active_since=rdfvalue.RDFDatetime().FromSecondsFromEpoch(2500))
+    self.assertEqual([entry.urn for entry in entries], [urns[2], urns[0]])
+
+  def testDeletedHuntsAreRemoved(self):
+    urns = [self.CreateHunt("hunt_%d" % i).urn for i in range(3)]
+
+    aff4.FACTORY.Delete(urns[1], token=self.token)
+
+    self.assertEqual(
+        sorted(entry.urn for entry in self.GetIndex().ListHunts()),
+        sorted([urns[0], urns[2]]))
+
+  def testExistingHuntsAreAddedByTheCronJob(self):
+    urns = []
+    for i in range(1, 4):
+      with test_lib.FakeTime(i * 1000):
+        urns.append(self.CreateHunt("hunt_%d" % i).urn)
+
+    # Simulate hunts created before there was an index.
+    data_store.DB.DeleteSubject(hunt_index.MAIN_INDEX, token=self.token)
+    data_store.DB.Flush()
+
+    # Reading the index does not build it.
+    index = hunt_index.GetHuntIndex(token=self.token)
+    self.assertFalse(index.IsComplete())
+    self.assertFalse(index.ListHunts())
+
+    for _ in test_lib.TestFlowHelper("HuntIndexCronFlow", token=self.token):
+      pass
+
+    index = hunt_index.GetHuntIndex(token=self.token)
+    self.assertTrue(index.IsComplete())
+    self.assertEqual([entry.urn for entry in index.ListHunts()],
+                     list(reversed(urns)))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -26,6 +26,7 @@ from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import flow_runner
+from grr.lib import hunt_index
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import registry
@@ -275,6 +276,7 @@ class HuntRunner(flow_runner.FlowRunner):
     # Start the hunt.
     self.flow_obj.Set(self.flow_obj.Schema.STATE("STARTED"))
     self.flow_obj.Flush()
+    hunt_index.IndexHunt(self.flow_obj)
 
     if not self.args.add_foreman_rules:
       return
@@ -317,6 +319,7 @@ class HuntRunner(flow_runner.FlowRunner):
     self._RemoveForemanRule()
     self.flow_obj.Set(self.flow_obj.Schema.STATE("COMPLETED"))
     self.flow_obj.Flush()
+    hunt_index.IndexHunt(self.flow_obj)
 
   def Pause(self):
     """Pauses the hunt (removes Foreman rules, does not touch expiry time)."""
@@ -331,6 +334,7 @@ class HuntRunner(flow_runner.FlowRunner):
 
     self.flow_obj.Set(self.flow_obj.Schema.STATE("PAUSED"))
     self.flow_obj.Flush()
+    hunt_index.IndexHunt(self.flow_obj)
 
     self._CreateAuditEvent("HUNT_PAUSED")
 
@@ -346,6 +350,7 @@ class HuntRunner(flow_runner.FlowRunner):
 
     self.flow_obj.Set(self.flow_obj.Schema.STATE("STOPPED"))
     self.flow_obj.Flush()
+    hunt_index.IndexHunt(self.flow_obj)
 
     self._CreateAuditEvent("HUNT_STOPPED")
 
@@ -586,6 +591,9 @@ class GRRHunt(flow.GRRFlow):
                      for client_id in clients_ids]
     deletion_pool.MultiMarkForDeletion(symlinks_urns)
 
+    deletion_pool.MarkAttributesForDeletion(
+        hunt_index.MAIN_INDEX, [hunt_index.HuntIndex.EntryColumn(self.urn)])
+
   @flow.StateHandler()
   def RunClient(self, client_id):
     """This method runs the hunt on a specific client.
@@ -640,6 +648,7 @@ class GRRHunt(flow.GRRFlow):
     runner.RunStateMethod("Start")
 
     hunt_obj.Flush()
+    hunt_index.IndexHunt(hunt_obj)
 
     try:
       flow_name = args.flow_runner_args.flow_name
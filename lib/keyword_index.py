@@ -4,13 +4,145 @@
 An aff4 keyword index class which associates keywords with names and makes it
 possible to search for those names which match all keywords.
 
+Each keyword is stored in its own row. New names are added as one column each
+(the uncompacted tail of the posting list). Compaction moves the tail into
+blocks of sorted, delta encoded names, with a small directory of the blocks
+which also holds the size of the list. Lookups read the smallest list first
+and only probe the other lists for the names found so far.
+
+Writes queue the changed posting lists for the KeywordIndexCompactor cron job,
+lookups never write.
 """
 
 
+import bisect
+import zlib
 
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import structs as rdf_structs
+
+
+def _EncodeBlock(entries):
+  """Encodes a sorted list of (name, timestamp) tuples.
+
+  Every name is stored as the length of the prefix it shares with the previous
+  name followed by the rest of the name, timestamps as zigzag encoded deltas to
+  the previous timestamp.
+
+  Args:
+    entries: A list of (name, timestamp) tuples sorted by name.
+
+  Returns:
+    The compressed block.
+  """
+  result = []
+  previous_name = ""
+  previous_timestamp = 0
+  for name, timestamp in entries:
+    shared = 0
+    max_shared = min(len(name), len(previous_name))
+    while shared < max_shared and name[shared] == previous_name[shared]:
+      shared += 1
+
+    delta = timestamp - previous_timestamp
+    result.append(rdf_structs.VarintEncode(shared))
+    result.append(rdf_structs.VarintEncode(len(name) - shared))
+    result.append(name[shared:])
+    result.append(rdf_structs.VarintEncode(
+        (delta << 1) if delta >= 0 else ((-delta) << 1) - 1))
+
+    previous_name = name
+    previous_timestamp = timestamp
+
+  return zlib.compress("".join(result))
+
+
+def _DecodeBlock(block):
+  """Decodes a block written by _EncodeBlock into (name, timestamp) tuples."""
+  data = zlib.decompress(block)
+  result = []
+  name = ""
+  timestamp = 0
+  pos = 0
+  while pos < len(data):
+    shared, pos = rdf_structs.VarintReader(data, pos)
+    length, pos = rdf_structs.VarintReader(data, pos)
+    name = name[:shared] + data[pos:pos + length]
+    pos += length
+
+    delta, pos = rdf_structs.VarintReader(data, pos)
+    if delta & 1:
+      timestamp -= (delta + 1) >> 1
+    else:
+      timestamp += delta >> 1
+
+    result.append((name, timestamp))
+
+  return result
+
+
+class PostingListDirectory(object):
+  """The blocks of a compacted posting list.
+
+  Lists the first name and the number of names of each block.
+  """
+
+  def __init__(self, first_names=None, counts=None):
+    self.first_names = first_names or []
+    self.counts = counts or []
+
+  @property
+  def size(self):
+    return sum(self.counts)
+
+  def BlocksFor(self, names):
+    """Returns the numbers of the blocks which may hold names."""
+    result = set()
+    for name in names:
+      block = bisect.bisect_right(self.first_names, name) - 1
+      if block >= 0:
+        result.add(block)
+
+    return sorted(result)
+
+  def SerializeToString(self):
+    result = []
+    for name, count in zip(self.first_names, self.counts):
+      result.append(rdf_structs.VarintEncode(len(name)))
+      result.append(name)
+      result.append(rdf_structs.VarintEncode(count))
+
+    return "".join(result)
+
+  @classmethod
+  def FromString(cls, data):
+    result = cls()
+    pos = 0
+    while pos < len(data):
+      length, pos = rdf_structs.VarintReader(data, pos)
+      result.first_names.append(data[pos:pos + length])
+      pos += length
+      count, pos = rdf_structs.VarintReader(data, pos)
+      result.counts.append(count)
+
+    return result
+
+
+class _PostingListRow(object):
+  """The parts of a posting list as read from its row."""
+
+  def __init__(self, keyword):
+    self.keyword = keyword
+    # Uncompacted names and the time they were added.
+    self.tail = {}
+    # Names removed and the time they were removed.
+    self.removed = {}
+    self.blocks = {}
+    self.directory = None
+    self.raw_directory = None
 
 
 class AFF4KeywordIndex(aff4.AFF4Object):
@@ -20,6 +152,40 @@ class AFF4KeywordIndex(aff4.AFF4Object):
   INDEX_PREFIX_LEN = len(INDEX_PREFIX)
   INDEX_COLUMN_FORMAT = INDEX_PREFIX + "%s"
 
+  # Names removed from the compacted blocks.
+  REMOVED_PREFIX = "kw_removed:"
+  REMOVED_PREFIX_LEN = len(REMOVED_PREFIX)
+  REMOVED_COLUMN_FORMAT = REMOVED_PREFIX + "%s"
+
+  BLOCK_PREFIX = "kw_block:"
+  BLOCK_PREFIX_LEN = len(BLOCK_PREFIX)
+  BLOCK_COLUMN_FORMAT = BLOCK_PREFIX + "%08d"
+  DIRECTORY_COLUMN = "kw_directory:blocks"
+
+  # All the columns of a posting list start with this.
+  POSTING_LIST_PREFIX = "kw_"
+
+  # The number of names in each compacted block.
+  BLOCK_SIZE = 4096
+
+  # The compactor only compacts posting lists with at least this many names
+  # added or removed since the last compaction. We also assume this is roughly
+  # the size of lists which were never compacted.
+  COMPACTION_THRESHOLD = 1000
+
+  # Keywords associated with (almost) every name. Their lists are the largest
+  # even when they were never compacted, so lookups always read them last.
+  UNIVERSAL_KEYWORDS = frozenset()
+
+  # Changed posting lists are queued here for the compactor.
+  NOTIFICATION_QUEUE = "aff4:/cron/keyword_index_compactor"
+  NOTIFICATION_PREFIX = "index:changed/"
+  NOTIFICATION_COLUMN_FORMAT = NOTIFICATION_PREFIX + "%s"
+
+  # Lists are probed for the names found so far instead of being read in full
+  # as long as there are at most this many names.
+  PROBE_LIMIT = 1000
+
   # The lowest and highest legal timestamps.
   FIRST_TIMESTAMP = 0
   LAST_TIMESTAMP = (2 ** 63) - 2  # maxint64 - 1
@@ -27,30 +193,53 @@ class AFF4KeywordIndex(aff4.AFF4Object):
   def _KeywordToURN(self, keyword):
     return self.urn.Add(keyword)
 
-  def Lookup(self, keywords, **kwargs):
+  def Lookup(self, keywords, start_time=FIRST_TIMESTAMP,
+             end_time=LAST_TIMESTAMP, last_seen_map=None):
     """Finds objects associated with keywords.
 
-    Find the names related to all keywords.
+    Find the names related to all keywords. The smallest posting list is read
+    first, the others are only probed for the names found so far.
 
     Args:
       keywords: A collection of keywords that we are interested in.
-      **kwargs: Additional arguments to be passed to the underlying call to
-        ReadPostingLists
+      start_time: Only considers keywords added at or after this point in time.
+      end_time: Only considers keywords at or before this point in time.
+      last_seen_map: If present, is treated as a dict and populated to map pairs
+        (keyword, name) to the timestamp of the latest connection found. This
+        is only guaranteed to hold the names matching all keywords.
     Returns:
       A set of potentially relevant names.
 
     """
+    keywords = list(set(keywords))
+    if not keywords:
+      return set()
 
-    posting_lists = self.ReadPostingLists(keywords, **kwargs)
+    directories = self._ReadDirectories(keywords)
+    sizes = dict((keyword, self.COMPACTION_THRESHOLD) for keyword in keywords)
+    for keyword, row in directories.iteritems():
+      sizes[keyword] += row.directory.size
+    keywords.sort(key=lambda k: (k in self.UNIVERSAL_KEYWORDS, sizes[k], k))
 
-    results = posting_lists.values()
-    relevant_set = results[0]
+    relevant_set = None
+    for keyword in keywords:
+      if relevant_set is None or len(relevant_set) > self.PROBE_LIMIT:
+        hits = self._ReadPostingLists([keyword], start_time, end_time)[keyword]
+      else:
+        hits = self._ProbePostingList(keyword, relevant_set, start_time,
+                                      end_time, known=directories.get(keyword))
 
-    for hits in results:
-      relevant_set &= hits
+      if relevant_set is None:
+        relevant_set = set(hits)
+      else:
+        relevant_set.intersection_update(hits)
+
+      if last_seen_map is not None:
+        for name in relevant_set:
+          last_seen_map[(keyword, name)] = hits[name]
 
       if not relevant_set:
-        return relevant_set
+        break
 
     return relevant_set
 
@@ -68,23 +257,258 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       A dict mapping each keyword to a set of relevant names.
 
     """
-    keyword_urns = {self._KeywordToURN(k): k for k in keywords}
     result = {}
-    for kw in keywords:
-      result[kw] = set()
-
-    for keyword_urn, value in data_store.DB.MultiResolvePrefix(
-        keyword_urns.keys(), self.INDEX_PREFIX,
-        timestamp=(start_time, end_time+1), token=self.token):
-      for column, _, ts in value:
-        kw = keyword_urns[keyword_urn]
-        name = column[self.INDEX_PREFIX_LEN:]
-        result[kw].add(name)
-        if last_seen_map is not None:
-          last_seen_map[(kw, name)] = max(last_seen_map.get((kw, name), -1), ts)
+    for keyword, hits in self._ReadPostingLists(keywords, start_time,
+                                                end_time).iteritems():
+      result[keyword] = set(hits)
+      if last_seen_map is not None:
+        for name, timestamp in hits.iteritems():
+          last_seen_map[(keyword, name)] = timestamp
+
+    return result
+
+  def CompactPostingLists(self, keywords, min_changes=0):
+    """Moves the uncompacted names of the keywords into blocks.
+
+    This writes to the posting lists and is meant to be called by the
+    KeywordIndexCompactor cron job with the index opened with a lock.
+
+    Args:
+      keywords: A collection of keywords.
+      min_changes: Only compacts posting lists with at least this many names
+        added or removed since they were last compacted.
+
+    Returns:
+      The number of posting lists compacted.
+    """
+    if min_changes:
+      keywords = [keyword for keyword, changes in
+                  self._CountChanges(keywords).iteritems()
+                  if changes >= min_changes]
+
+    rows = self._ReadRows(keywords)
+    for row in rows.itervalues():
+      self._CompactPostingList(row)
+
+    data_store.DB.Flush()
+    return len(rows)
+
+  @classmethod
+  def ScheduleNotifications(cls, index_urn, keyword_urns, sync=False,
+                            token=None):
+    """Queues the posting lists at keyword_urns for the compactor.
+
+    All the notifications are written to the queue in one operation.
+
+    Args:
+      index_urn: The urn of the index the posting lists belong to.
+      keyword_urns: The urns of the changed posting lists.
+      sync: If true we block until the notifications are written.
+      token: An ACL token.
+    """
+    values = dict((cls.NOTIFICATION_COLUMN_FORMAT % keyword_urn, [index_urn])
+                  for keyword_urn in keyword_urns)
+    if values:
+      data_store.DB.MultiSet(cls.NOTIFICATION_QUEUE, values, replace=True,
+                             token=token, sync=sync)
+
+  @classmethod
+  def QueryNotifications(cls, timestamp=None, token=None):
+    """Yields (index urn, keyword urn) of the queued posting lists."""
+
+    if token is None:
+      raise ValueError("token can't be None")
+
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime().Now()
+
+    for attribute, index_urn, _ in data_store.DB.ResolvePrefix(
+        cls.NOTIFICATION_QUEUE, cls.NOTIFICATION_PREFIX,
+        timestamp=(0, timestamp), token=token):
+      yield (rdfvalue.RDFURN(index_urn),
+             rdfvalue.RDFURN(attribute[len(cls.NOTIFICATION_PREFIX):]))
+
+  @classmethod
+  def DeleteNotifications(cls, keyword_urns, end=None, token=None):
+    """Delete notifications for given keyword urns."""
+
+    if token is None:
+      raise ValueError("token can't be None")
+
+    predicates = [cls.NOTIFICATION_COLUMN_FORMAT % urn for urn in keyword_urns]
+    data_store.DB.DeleteAttributes(cls.NOTIFICATION_QUEUE, predicates,
+                                   end=end, token=token, sync=True)
+
+  def _CountChanges(self, keywords):
+    """Counts the names added or removed since the lists were compacted."""
+    keyword_urns = dict((self._KeywordToURN(k), k) for k in keywords)
+    result = dict((k, 0) for k in keywords)
+    for prefix in self.INDEX_PREFIX, self.REMOVED_PREFIX:
+      for keyword_urn, values in data_store.DB.MultiResolvePrefix(
+          keyword_urns.keys(), prefix,
+          timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token):
+        result[keyword_urns[keyword_urn]] += len(values)
+
+    return result
+
+  def _ParseRow(self, row, values):
+    """Sorts the (attribute, value, timestamp) tuples of a row into row."""
+    for attribute, value, timestamp in values:
+      if attribute.startswith(self.INDEX_PREFIX):
+        row.tail[attribute[self.INDEX_PREFIX_LEN:]] = timestamp
+      elif attribute.startswith(self.REMOVED_PREFIX):
+        row.removed[attribute[self.REMOVED_PREFIX_LEN:]] = timestamp
+      elif attribute.startswith(self.BLOCK_PREFIX):
+        row.blocks[int(attribute[self.BLOCK_PREFIX_LEN:])] = value
+      elif attribute == self.DIRECTORY_COLUMN:
+        row.raw_directory = value
+        row.directory = PostingListDirectory.FromString(utils.SmartStr(value))
+
+    return row
+
+  def _ReadRows(self, keywords):
+    """Reads the posting lists of the keywords, returns _PostingListRows."""
+    keyword_urns = dict((self._KeywordToURN(k), k) for k in keywords)
+    result = dict((k, _PostingListRow(k)) for k in keywords)
+    for keyword_urn, values in data_store.DB.MultiResolvePrefix(
+        keyword_urns.keys(), self.POSTING_LIST_PREFIX,
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token):
+      keyword = keyword_urns[keyword_urn]
+      self._ParseRow(result[keyword], values)
+
+    return result
+
+  def _ReadDirectories(self, keywords):
+    """Returns _PostingListRows holding the directories of compacted lists."""
+    keyword_urns = dict((self._KeywordToURN(k), k) for k in keywords)
+    result = {}
+    for keyword_urn, values in data_store.DB.MultiResolvePrefix(
+        keyword_urns.keys(), self.DIRECTORY_COLUMN,
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token):
+      keyword = keyword_urns[keyword_urn]
+      row = self._ParseRow(_PostingListRow(keyword), values)
+      if row.directory:
+        result[keyword] = row
 
     return result
 
+  def _MergeRow(self, row, names=None):
+    """Returns a dict mapping the names in the posting list to timestamps.
+
+    Args:
+      row: A _PostingListRow.
+      names: If set, only these names are returned.
+
+    Returns:
+      A dict mapping names to the time they were last added.
+    """
+    result = {}
+    if row.directory:
+      for block in range(len(row.directory.counts)):
+        if block not in row.blocks:
+          continue
+
+        for name, timestamp in _DecodeBlock(utils.SmartStr(row.blocks[block])):
+          if names is not None and name not in names:
+            continue
+          if row.removed.get(name, -1) < timestamp:
+            result[name] = timestamp
+
+    # Names in the tail were added after they were last removed.
+    for name, timestamp in row.tail.iteritems():
+      if names is not None and name not in names:
+        continue
+      result[name] = max(result.get(name, -1), timestamp)
+
+    return result
+
+  def _FilterByTime(self, hits, start_time, end_time):
+    return dict((name, timestamp) for name, timestamp in hits.iteritems()
+                if start_time <= timestamp <= end_time)
+
+  def _ReadPostingLists(self, keywords, start_time, end_time):
+    """Reads posting lists in full."""
+    result = {}
+    for keyword, row in self._ReadRows(keywords).iteritems():
+      result[keyword] = self._FilterByTime(self._MergeRow(row), start_time,
+                                           end_time)
+
+    return result
+
+  def _ProbePostingList(self, keyword, names, start_time, end_time,
+                        known=None):
+    """Returns the timestamps of those names found in a posting list.
+
+    Args:
+      keyword: The keyword of the posting list.
+      names: The names to look for.
+      start_time: Only considers names added at or after this point in time.
+      end_time: Only considers names added at or before this point in time.
+      known: A _PostingListRow holding the directory of the list, if known.
+
+    Returns:
+      A dict mapping the names found to the time they were last added.
+    """
+    names = sorted(names)
+    attributes = ([self.INDEX_COLUMN_FORMAT % name for name in names] +
+                  [self.REMOVED_COLUMN_FORMAT % name for name in names] +
+                  [self.DIRECTORY_COLUMN])
+
+    known = known or _PostingListRow(keyword)
+    while True:
+      block_attributes = []
+      if known.directory:
+        block_attributes = [self.BLOCK_COLUMN_FORMAT % block
+                            for block in known.directory.BlocksFor(names)]
+
+      row = self._ParseRow(_PostingListRow(keyword), data_store.DB.ResolveMulti(
+          self._KeywordToURN(keyword), attributes + block_attributes,
+          timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token))
+
+      # If the list was compacted since we read the directory we might have
+      # read the wrong blocks.
+      if row.raw_directory == known.raw_directory:
+        break
+      known = row
+
+    return self._FilterByTime(self._MergeRow(row, names=set(names)),
+                              start_time, end_time)
+
+  def _CompactPostingList(self, row):
+    """Rewrites the blocks of a posting list to include its tail."""
+    entries = sorted((utils.SmartStr(name), timestamp)
+                     for name, timestamp in self._MergeRow(row).iteritems())
+
+    directory = PostingListDirectory()
+    values = {}
+    for block, offset in enumerate(xrange(0, len(entries), self.BLOCK_SIZE)):
+      block_entries = entries[offset:offset + self.BLOCK_SIZE]
+      directory.first_names.append(block_entries[0][0])
+      directory.counts.append(len(block_entries))
+      values[self.BLOCK_COLUMN_FORMAT % block] = [_EncodeBlock(block_entries)]
+    values[self.DIRECTORY_COLUMN] = [directory.SerializeToString()]
+
+    old_blocks = len(row.directory.counts) if row.directory else 0
+    subject = self._KeywordToURN(row.keyword)
+    data_store.DB.MultiSet(
+        subject, values,
+        to_delete=[self.BLOCK_COLUMN_FORMAT % block for block in
+                   xrange(len(directory.counts), old_blocks)],
+        sync=False, token=self.token)
+
+    # Names added or removed again while we were compacting are newer than
+    # the ones we have read and are kept, so every name is only deleted up to
+    # the time we have read.
+    for prefix, names in ((self.INDEX_COLUMN_FORMAT, row.tail),
+                          (self.REMOVED_COLUMN_FORMAT, row.removed)):
+      names_by_timestamp = {}
+      for name, timestamp in names.iteritems():
+        names_by_timestamp.setdefault(timestamp, []).append(prefix % name)
+
+      for timestamp, attributes in names_by_timestamp.iteritems():
+        data_store.DB.DeleteAttributes(subject, attributes, end=timestamp,
+                                       sync=False, token=self.token)
+
   def AddKeywordsForName(self, name, keywords, sync=True, timestamp=None,
                          **kwargs):
     """Associates keywords with name.
@@ -100,11 +524,13 @@ class AFF4KeywordIndex(aff4.AFF4Object):
     """
     if timestamp is None:
       timestamp = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
-    for keyword in set(keywords):
+    keyword_urns = [self._KeywordToURN(keyword) for keyword in set(keywords)]
+    for keyword_urn in keyword_urns:
       data_store.DB.Set(
-          self._KeywordToURN(keyword),
+          keyword_urn,
           self.INDEX_COLUMN_FORMAT % name, "",
           token=self.token, sync=False, timestamp=timestamp, **kwargs)
+    self.ScheduleNotifications(self.urn, keyword_urns, token=self.token)
     if sync:
       data_store.DB.Flush()
 
@@ -116,10 +542,18 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       keywords: A collection of keywords.
       sync: Sync to data store immediately.
     """
-    for keyword in set(keywords):
+    timestamp = rdfvalue.RDFDatetime().Now().AsMicroSecondsFromEpoch()
+    keyword_urns = [self._KeywordToURN(keyword) for keyword in set(keywords)]
+    for keyword_urn in keyword_urns:
       data_store.DB.DeleteAttributes(
-          self._KeywordToURN(keyword),
+          keyword_urn,
           self.INDEX_COLUMN_FORMAT % name,
           token=self.token, sync=False)
+      # The name may also be in one of the compacted blocks.
+      data_store.DB.Set(
+          keyword_urn,
+          self.REMOVED_COLUMN_FORMAT % name, "",
+          token=self.token, sync=False, timestamp=timestamp)
+    self.ScheduleNotifications(self.urn, keyword_urns, token=self.token)
     if sync:
       data_store.DB.Flush()
@@ -3,8 +3,11 @@
 
 
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flags
+from grr.lib import keyword_index
 from grr.lib import test_lib
+from grr.lib import utils
 
 
 class KeywordIndexTest(test_lib.AFF4ObjectTest):
@@ -83,6 +86,200 @@ class KeywordIndexTest(test_lib.AFF4ObjectTest):
     self.assertEqual(1009 * 1000000, ls_map[("popular_keyword2", "C.000000")])
 
 
+  def testBlockEncoding(self):
+    entries = [("C.%016X" % (i * 7919), 1000000 - i * 17 + (i % 3) * 50)
+               for i in range(100)]
+    block = keyword_index._EncodeBlock(entries)
+    self.assertEqual(keyword_index._DecodeBlock(block), entries)
+
+  def _CreateCompactedIndex(self):
+    index = aff4.FACTORY.Create("aff4:/index3/",
+                                aff4_type="AFF4KeywordIndex",
+                                mode="rw",
+                                token=self.token)
+    for i in range(100):
+      with test_lib.FakeTime(1000 + i):
+        index.AddKeywordsForName("C.%02X" % i, ["popular_keyword1"])
+        if i % 10 == 0:
+          index.AddKeywordsForName("C.%02X" % i, ["rare_keyword"])
+
+    index.CompactPostingLists(["popular_keyword1", "rare_keyword"])
+    return index
+
+  def testCompactedPostingLists(self):
+    with utils.Stubber(keyword_index.AFF4KeywordIndex, "BLOCK_SIZE", 16):
+      index = self._CreateCompactedIndex()
+
+      # The tail was moved into the blocks.
+      self.assertFalse(data_store.DB.ResolvePrefix(
+          index.urn.Add("popular_keyword1"), index.INDEX_PREFIX,
+          token=self.token))
+      directory = index._ReadDirectories(["popular_keyword1"])[
+          "popular_keyword1"].directory
+      self.assertEqual(directory.counts, [16] * 6 + [4])
+
+      self.assertEqual(len(index.Lookup(["popular_keyword1"])), 100)
+      self.assertEqual(len(index.Lookup(["popular_keyword1"],
+                                        start_time=1025 * 1000000,
+                                        end_time=1034 * 1000000)), 10)
+
+      # New names go to the tail and are found together with the blocks.
+      with test_lib.FakeTime(2000):
+        index.AddKeywordsForName("C.05", ["rare_keyword"])
+        index.AddKeywordsForName("C.FF", ["popular_keyword1", "rare_keyword"])
+
+      ls_map = {}
+      results = index.Lookup(["popular_keyword1", "rare_keyword"],
+                             last_seen_map=ls_map)
+      self.assertEqual(results, set(["C.%02X" % i for i in range(0, 100, 10)] +
+                                    ["C.05", "C.FF"]))
+      self.assertEqual(ls_map[("popular_keyword1", "C.05")], 1005 * 1000000)
+      self.assertEqual(ls_map[("rare_keyword", "C.05")], 2000 * 1000000)
+      self.assertEqual(ls_map[("popular_keyword1", "C.1E")], 1030 * 1000000)
+
+  def testLookupProbesLargerPostingLists(self):
+    with utils.Stubber(keyword_index.AFF4KeywordIndex, "BLOCK_SIZE", 16):
+      index = self._CreateCompactedIndex()
+      index.AddKeywordsForName("C.01", ["very_rare_keyword"])
+      index.AddKeywordsForName("C.02", ["very_rare_keyword"])
+
+      decoded = []
+      decode_block = keyword_index._DecodeBlock
+
+      def DecodeBlock(block):
+        result = decode_block(block)
+        decoded.append(result)
+        return result
+
+      with utils.Stubber(keyword_index, "_DecodeBlock", DecodeBlock):
+        results = index.Lookup(["popular_keyword1", "very_rare_keyword"])
+
+      self.assertEqual(results, set(["C.01", "C.02"]))
+      # Only the block holding the two names found was read from the popular
+      # list.
+      self.assertEqual(len(decoded), 1)
+
+  def testRemoveCompactedNames(self):
+    index = self._CreateCompactedIndex()
+
+    index.RemoveKeywordsForName("C.0A", ["rare_keyword", "popular_keyword1"])
+    self.assertEqual(len(index.Lookup(["rare_keyword"])), 9)
+    self.assertEqual(len(index.Lookup(["popular_keyword1", "rare_keyword"])), 9)
+
+    index.CompactPostingLists(["rare_keyword"])
+    self.assertEqual(len(index.Lookup(["rare_keyword"])), 9)
+
+    index.AddKeywordsForName("C.0A", ["rare_keyword"])
+    self.assertEqual(len(index.Lookup(["rare_keyword"])), 10)
+
+  def testLookupsDoNotCompactPostingLists(self):
+    index = aff4.FACTORY.Create("aff4:/index4/",
+                                aff4_type="AFF4KeywordIndex",
+                                mode="rw",
+                                token=self.token)
+    with utils.Stubber(keyword_index.AFF4KeywordIndex,
+                       "COMPACTION_THRESHOLD", 10):
+      for i in range(20):
+        index.AddKeywordsForName("C.%02X" % i, ["popular_keyword1"])
+      self.assertEqual(len(index.Lookup(["popular_keyword1"])), 20)
+      self.assertFalse(index._ReadDirectories(["popular_keyword1"]))
+
+  def testCompactOnlyChangedPostingLists(self):
+    index = aff4.FACTORY.Create("aff4:/index4/",
+                                aff4_type="AFF4KeywordIndex",
+                                mode="rw",
+                                token=self.token)
+    for i in range(20):
+      index.AddKeywordsForName("C.%02X" % i, ["popular_keyword1"])
+    index.AddKeywordsForName("C.00", ["rare_keyword"])
+
+    self.assertEqual(index.CompactPostingLists(
+        ["popular_keyword1", "rare_keyword"], min_changes=10), 1)
+    directories = index._ReadDirectories(["popular_keyword1", "rare_keyword"])
+    self.assertEqual(directories.keys(), ["popular_keyword1"])
+    self.assertEqual(directories["popular_keyword1"].directory.size, 20)
+
+    # Once compacted, lists only count the changes since.
+    index.RemoveKeywordsForName("C.01", ["popular_keyword1"])
+    self.assertEqual(index.CompactPostingLists(["popular_keyword1"],
+                                               min_changes=10), 0)
+    self.assertEqual(len(index.Lookup(["popular_keyword1"])), 19)
+
+  def testNamesAddedWhileCompactingAreKept(self):
+    index = aff4.FACTORY.Create("aff4:/index5/",
+                                aff4_type="AFF4KeywordIndex",
+                                mode="rw",
+                                token=self.token)
+    index.AddKeywordsForName("C.01", ["keyword"], timestamp=1000)
+    index.AddKeywordsForName("C.02", ["keyword"], timestamp=3000)
+    row = index._ReadRows(["keyword"])["keyword"]
+
+    # C.01 is added again after we read the list, but at an earlier time
+    # than C.02.
+    index.AddKeywordsForName("C.01", ["keyword"], timestamp=2000)
+    index._CompactPostingList(row)
+    data_store.DB.Flush()
+
+    ls_map = {}
+    self.assertEqual(index.Lookup(["keyword"], last_seen_map=ls_map),
+                     set(["C.01", "C.02"]))
+    self.assertEqual(ls_map[("keyword", "C.01")], 2000)
+    self.assertEqual(ls_map[("keyword", "C.02")], 3000)
+
+  def testUniversalKeywordsAreReadLast(self):
+    index = aff4.FACTORY.Create("aff4:/index6/",
+                                aff4_type="AFF4KeywordIndex",
+                                mode="rw",
+                                token=self.token)
+    for i in range(10):
+      index.AddKeywordsForName("C.%02X" % i, ["."])
+    index.AddKeywordsForName("C.01", [".", "rare_keyword"])
+    # Only the rare keyword is compacted, so it looks larger than the
+    # uncompacted universal keyword.
+    index.CompactPostingLists(["rare_keyword"])
+
+    read = []
+    read_posting_lists = index._ReadPostingLists
+
+    def ReadPostingLists(keywords, *args):
+      read.extend(keywords)
+      return read_posting_lists(keywords, *args)
+
+    with utils.Stubber(index, "_ReadPostingLists", ReadPostingLists):
+      with utils.Stubber(keyword_index.AFF4KeywordIndex, "UNIVERSAL_KEYWORDS",
+                         frozenset(["."])):
+        self.assertEqual(index.Lookup([".", "rare_keyword"]), set(["C.01"]))
+
+    self.assertEqual(read, ["rare_keyword"])
+
+  def testNotificationsAreWrittenOncePerUpdate(self):
+    index = aff4.FACTORY.Create("aff4:/index7/",
+                                aff4_type="AFF4KeywordIndex",
+                                mode="rw",
+                                token=self.token)
+    keywords = ["keyword%d" % i for i in range(10)]
+    queue = keyword_index.AFF4KeywordIndex.NOTIFICATION_QUEUE
+    writes = []
+    multi_set = data_store.DB.MultiSet
+
+    def MultiSet(subject, *args, **kwargs):
+      if utils.SmartStr(subject) == queue:
+        writes.append(subject)
+      return multi_set(subject, *args, **kwargs)
+
+    with utils.Stubber(data_store.DB, "MultiSet", MultiSet):
+      index.AddKeywordsForName("C.01", keywords)
+      self.assertEqual(len(writes), 1)
+
+      index.RemoveKeywordsForName("C.01", keywords)
+      self.assertEqual(len(writes), 2)
+
+    notifications = keyword_index.AFF4KeywordIndex.QueryNotifications(
+        token=self.token)
+    self.assertEqual(sorted(urn.Basename() for _, urn in notifications),
+                     sorted(keywords))
+
+
 def main(argv):
   test_lib.main(argv)
 
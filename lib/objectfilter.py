@@ -147,7 +147,18 @@ class Filter(object):
     """Whether object obj matches this filter."""
 
   def Filter(self, objects):
-    """Returns a list of objects that pass the filter."""
+    """Returns a list of objects that pass the filter.
+
+    This is the way to evaluate a filter over many objects: the value expanders
+    of a compiled filter remember what they learn about each type of object,
+    so the cost of resolving attribute paths is paid once per type.
+
+    Args:
+      objects: An iterable of objects.
+
+    Returns:
+      A list of the objects matching the filter.
+    """
     return filter(self.Matches, objects)
 
   def __str__(self):
@@ -233,8 +244,6 @@ class GenericBinaryOperator(BinaryOperator):
     """Takes a list of values and if at least one matches, returns True."""
     for val in values:
       try:
-        logging.debug("Operating %s with x=%s and y=%s",
-                      self.__class__.__name__, val, self.right_operand)
         if self.Operation(val, self.right_operand):
           return True
         else:
@@ -467,6 +476,30 @@ class ValueExpander(object):
 
   FIELD_SEPARATOR = "."
 
+  def __init__(self):
+    # A compiled filter expands the same few paths on every object it sees, so
+    # the split paths and what kind of object each type is are only worked out
+    # once.
+    self._paths = {}
+    self._mapping_types = {}
+
+  def _IsMapping(self, obj):
+    """Returns whether obj is dictionary-like, checking each type once."""
+    obj_type = type(obj)
+    try:
+      return self._mapping_types[obj_type]
+    except KeyError:
+      is_mapping = isinstance(obj, collections.Mapping)
+      self._mapping_types[obj_type] = is_mapping
+      return is_mapping
+
+  def _SplitPath(self, path):
+    try:
+      return self._paths[path]
+    except KeyError:
+      split_path = self._paths[path] = path.split(self.FIELD_SEPARATOR)
+      return split_path
+
   def _GetAttributeName(self, path):
     """Returns the attribute name to fetch given a path."""
     return path[0]
@@ -477,7 +510,7 @@ class ValueExpander(object):
 
   def _AtLeaf(self, attr_value):
     """Called when at a leaf value. Should yield a value."""
-    if isinstance(attr_value, collections.Mapping):
+    if self._IsMapping(attr_value):
       # If the result is a dict, return each key/value pair as a new dict.
       for k, v in attr_value.items():
         yield {k: v}
@@ -487,7 +520,7 @@ class ValueExpander(object):
   def _AtNonLeaf(self, attr_value, path):
     """Called when at a non-leaf value. Should recurse and yield values."""
     try:
-      if isinstance(attr_value, collections.Mapping):
+      if self._IsMapping(attr_value):
         # If it's dictionary-like, treat the dict key as the attribute..
         sub_obj = attr_value.get(path[1])
         if len(path) > 2:
@@ -496,7 +529,7 @@ class ValueExpander(object):
         if isinstance(sub_obj, basestring):
           # If it is a string, stop here
           yield sub_obj
-        elif isinstance(sub_obj, collections.Mapping):
+        elif self._IsMapping(sub_obj):
           # If the result is a dict, return each key/value pair as a new dict.
           for k, v in sub_obj.items():
             yield {k: v}
@@ -531,7 +564,7 @@ class ValueExpander(object):
       The values once the object is traversed.
     """
     if isinstance(path, basestring):
-      path = path.split(self.FIELD_SEPARATOR)
+      path = self._SplitPath(path)
 
     attr_name = self._GetAttributeName(path)
     attr_value = self._GetValue(obj, attr_name)
@@ -550,7 +583,7 @@ class AttributeValueExpander(ValueExpander):
   """An expander that gives values based on object attribute names."""
 
   def _GetValue(self, obj, attr_name):
-    if isinstance(obj, collections.Mapping):
+    if self._IsMapping(obj):
       return obj.get(attr_name)
     return getattr(obj, attr_name, None)
 
@@ -882,3 +915,31 @@ class DictFilterImplementation(BaseFilterImplementation):
   FILTERS = {}
   FILTERS.update(BaseFilterImplementation.FILTERS)
   FILTERS.update({"ValueExpander": DictValueExpander})
+
+
+# Compiled filters carry nothing from one evaluation to the next except what
+# their expanders learned about paths and types, so one compiled filter serves
+# all the users of an expression.
+_COMPILED_FILTERS = utils.FastStore(max_size=1000)
+
+
+def Compile(expression, filter_implementation=BaseFilterImplementation):
+  """Parses and compiles an expression, reusing earlier compilations.
+
+  Args:
+    expression: The filter expression.
+    filter_implementation: The filter implementation class to compile with.
+
+  Returns:
+    The compiled Filter.
+
+  Raises:
+    Error: If the expression is invalid.
+  """
+  key = (expression, filter_implementation)
+  try:
+    return _COMPILED_FILTERS.Get(key)
+  except KeyError:
+    compiled_filter = Parser(expression).Parse().Compile(filter_implementation)
+    _COMPILED_FILTERS.Put(key, compiled_filter)
+    return compiled_filter
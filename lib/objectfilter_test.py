@@ -532,6 +532,23 @@ AND @exported_symbols(name is 'inject')
     filter_ = parser.Compile(self.filter_imp)
     self.assertEqual(filter_.Matches(obj), False)
 
+  def testCompiledFiltersAreReused(self):
+    filter_ = objectfilter.Compile("size > 3", self.filter_imp)
+    self.assertIs(filter_, objectfilter.Compile("size > 3", self.filter_imp))
+    self.assertIsNot(filter_, objectfilter.Compile(
+        "size > 3", objectfilter.DictFilterImplementation))
+    self.assertRaises(objectfilter.ParseError, objectfilter.Compile,
+                      "size >", self.filter_imp)
+
+  def testFilterMixedTypes(self):
+    # Expanders remember which types are dictionaries, mixing them must not
+    # confuse them.
+    objs = [DummyObject("size", 4), {"size": 5}, DummyObject("size", 2),
+            {"size": 1}, DummyObject("other", 7)]
+    filter_ = objectfilter.Compile("size > 3", self.filter_imp)
+    self.assertEqual(filter_.Filter(objs), objs[:2])
+    self.assertEqual(filter_.Filter(reversed(objs)), [objs[1], objs[0]])
+
 
 if __name__ == "__main__":
   unittest.main()
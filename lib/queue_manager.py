@@ -7,6 +7,7 @@ import collections
 import os
 import random
 import socket
+import threading
 import time
 
 import logging
@@ -17,6 +18,7 @@ from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
+from grr.lib import wakeup_channel
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 
@@ -29,6 +31,89 @@ class MoreDataException(Error):
   """Raised when there is more data available."""
 
 
+class FlowStatesPrefetch(object):
+  """Completed requests and their responses of many flows, read in bulk.
+
+  Use QueueManager.PrefetchFlowStates() to create one. While it is active (as
+  a context manager), FetchCompletedRequests() and FetchCompletedResponses()
+  calls made by any QueueManager in the same thread are answered from memory
+  for the prefetched flows. The prefetched data of a flow is dropped as soon
+  as its state is changed through a QueueManager so later calls read the
+  data store again.
+  """
+
+  _local = threading.local()
+
+  def __init__(self):
+    # Both map subjects to (timestamp, rows) tuples, rows are the same
+    # (predicate, value, timestamp) tuples the data store returns.
+    self.states = {}
+    self.responses = {}
+
+  def __enter__(self):
+    self._local.__dict__.setdefault("stack", []).append(self)
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self._local.stack.pop()
+
+  @classmethod
+  def Current(cls):
+    """Returns the prefetch active in this thread, or None."""
+    stack = getattr(cls._local, "stack", None)
+    if stack:
+      return stack[-1]
+
+  def GetStates(self, subject, timestamp):
+    """Returns the prefetched rows of a state subject, or None."""
+    try:
+      prefetched_timestamp, rows = self.states[utils.SmartStr(subject)]
+    except KeyError:
+      return None
+
+    if prefetched_timestamp == timestamp:
+      return rows
+
+  def GetResponses(self, subjects, timestamp):
+    """Returns a dict of rows for these response subjects, or None.
+
+    None is returned unless all the subjects were prefetched.
+
+    Args:
+      subjects: The response subjects.
+      timestamp: The time range the responses are read for.
+    """
+    result = {}
+    for subject in subjects:
+      try:
+        prefetched_timestamp, rows = self.responses[utils.SmartStr(subject)]
+      except KeyError:
+        return None
+
+      if prefetched_timestamp != timestamp:
+        return None
+
+      if rows:
+        result[subject] = rows
+
+    return result
+
+  def Drop(self, subject):
+    """Forgets the prefetched data at or below a changed subject.
+
+    Changing a response subject also drops the state subject it belongs to.
+
+    Args:
+      subject: The state or response subject that was changed.
+    """
+    subject = utils.SmartStr(subject)
+    for prefetched in (self.states, self.responses):
+      for key in prefetched.keys():
+        if (key == subject or key.startswith(subject + "/") or
+            subject.startswith(key + "/")):
+          del prefetched[key]
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -119,16 +204,17 @@ class QueueManager(object):
     notification_shard_index = (
         QueueManager.notification_shard_counters[queue_name] %
         self.num_notification_shards)
-    if notification_shard_index > 0:
-      return queue.Add(str(notification_shard_index))
+    return self.GetNotificationShardByIndex(queue, notification_shard_index)
+
+  def GetNotificationShardByIndex(self, queue, index):
+    if index > 0:
+      return queue.Add(str(index))
     else:
       return queue
 
   def GetAllNotificationShards(self, queue):
-    result = [queue]
-    for i in range(1, self.num_notification_shards):
-      result.append(queue.Add(str(i)))
-    return result
+    return [self.GetNotificationShardByIndex(queue, i)
+            for i in range(self.num_notification_shards)]
 
   def Copy(self):
     """Return a copy of the queue manager.
@@ -207,16 +293,28 @@ class QueueManager(object):
   def FetchCompletedRequests(self, session_id, timestamp=None):
     """Fetch all the requests with a status message queued for them."""
     subject = session_id.Add("state")
-    requests = {}
-    status = {}
 
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())
 
-    for predicate, serialized, _ in self.data_store.ResolvePrefix(
-        subject, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
-        token=self.token, limit=self.request_limit, timestamp=timestamp):
+    rows = None
+    prefetch = FlowStatesPrefetch.Current()
+    if prefetch is not None:
+      rows = prefetch.GetStates(subject, timestamp)
+
+    if rows is None:
+      rows = self.data_store.ResolvePrefix(
+          subject, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
+          token=self.token, limit=self.request_limit, timestamp=timestamp)
+
+    return self._CompletedRequestsFromRows(rows)
+
+  def _CompletedRequestsFromRows(self, rows):
+    """Pairs up the requests and statuses read from a flow's state subject."""
+    requests = {}
+    status = {}
 
+    for predicate, serialized, _ in rows:
       parts = predicate.split(":", 3)
       request_id = parts[2]
       if parts[1] == "status":
@@ -263,9 +361,16 @@ class QueueManager(object):
         if projected_total_size > limit:
           break
 
-      response_data = dict(self.data_store.MultiResolvePrefix(
-          response_subjects, self.FLOW_RESPONSE_PREFIX, token=self.token,
-          timestamp=timestamp))
+      response_data = None
+      prefetch = FlowStatesPrefetch.Current()
+      if prefetch is not None:
+        response_data = prefetch.GetResponses(response_subjects, timestamp)
+
+      if response_data is None:
+        response_data = dict(self.data_store.MultiResolvePrefix(
+            response_subjects, self.FLOW_RESPONSE_PREFIX, token=self.token,
+            timestamp=timestamp))
+
       for response_urn, request in sorted(response_subjects.items()):
         responses = []
         for _, serialized, _ in response_data.get(response_urn, []):
@@ -277,6 +382,86 @@ class QueueManager(object):
         if total_size > limit:
           raise MoreDataException()
 
+  def PrefetchFlowStates(self, notifications, limit=10000):
+    """Reads the completed requests and responses of many flows at once.
+
+    The requests and statuses of all flows are read with a single
+    MultiResolvePrefix call, as are the responses to all completed requests.
+
+    Args:
+      notifications: Notifications for the flows to prefetch. Each flow's data
+                     is read for the time range (0, notification.timestamp).
+      limit: Responses are not prefetched for flows with more completed
+             responses than this, FetchCompletedResponses() reads those in
+             chunks from the data store.
+
+    Returns:
+      A FlowStatesPrefetch, to be used as a context manager around the
+      processing of these flows.
+    """
+    prefetch = FlowStatesPrefetch()
+    if not notifications:
+      return prefetch
+
+    # Data stores may hand back subjects as strings so we key by those.
+    timestamps = {}
+    for notification in notifications:
+      timestamps[utils.SmartStr(notification.session_id.Add("state"))] = (
+          notification.session_id, (0, notification.timestamp))
+    max_timestamp = (0, max(timestamp[1]
+                            for _, timestamp in timestamps.itervalues()))
+
+    states = dict((subject, []) for subject in timestamps)
+    total_rows = 0
+    for subject, rows in self.data_store.MultiResolvePrefix(
+        timestamps, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
+        token=self.token, limit=self.request_limit, timestamp=max_timestamp):
+      subject = utils.SmartStr(subject)
+      total_rows += len(rows)
+      end = int(timestamps[subject][1][1])
+      states[subject] = [row for row in rows if row[2] <= end]
+
+    # The limit applies to all subjects together so some flows might be
+    # missing data. They are better read one by one.
+    if total_rows >= self.request_limit:
+      return prefetch
+
+    response_timestamps = {}
+    for subject, rows in states.iteritems():
+      session_id, timestamp = timestamps[subject]
+      prefetch.states[subject] = (timestamp, rows)
+
+      completed_requests = list(self._CompletedRequestsFromRows(rows))
+      if sum(status.response_id for _, status in completed_requests) > limit:
+        continue
+
+      for request, _ in completed_requests:
+        response_subject = self.GetFlowResponseSubject(session_id, request.id)
+        response_timestamps[utils.SmartStr(response_subject)] = timestamp
+
+    if not response_timestamps:
+      return prefetch
+
+    for subject, timestamp in response_timestamps.iteritems():
+      prefetch.responses[subject] = (timestamp, [])
+
+    for subject, rows in self.data_store.MultiResolvePrefix(
+        response_timestamps, self.FLOW_RESPONSE_PREFIX, token=self.token,
+        timestamp=max_timestamp):
+      subject = utils.SmartStr(subject)
+      timestamp = response_timestamps[subject]
+      end = int(timestamp[1])
+      prefetch.responses[subject] = (
+          timestamp, [row for row in rows if row[2] <= end])
+
+    return prefetch
+
+  def _DropPrefetchedStates(self, subjects):
+    prefetch = FlowStatesPrefetch.Current()
+    if prefetch is not None:
+      for subject in subjects:
+        prefetch.Drop(subject)
+
   def FetchRequestsAndResponses(self, session_id, timestamp=None):
     """Fetches all outstanding requests and responses for this flow.
 
@@ -339,6 +524,7 @@ class QueueManager(object):
 
     # Efficiently drop all responses to this request.
     response_subject = self.GetFlowResponseSubject(session_id, request_state.id)
+    self._DropPrefetchedStates([session_id.Add("state")])
     self.data_store.DeleteSubject(response_subject, token=self.token)
 
   def DestroyFlowStates(self, session_id):
@@ -348,6 +534,7 @@ class QueueManager(object):
   def MultiDestroyFlowStates(self, session_ids):
     """Deletes all states in multiple flows and dequeues all client messages."""
     subjects = [session_id.Add("state") for session_id in session_ids]
+    self._DropPrefetchedStates(subjects)
     to_delete = []
 
     for subject, values in self.data_store.MultiResolvePrefix(
@@ -375,6 +562,7 @@ class QueueManager(object):
   def Flush(self):
     """Writes the changes in this object to the datastore."""
     session_ids = set(self.to_write) | set(self.to_delete)
+    self._DropPrefetchedStates(session_ids)
     for session_id in session_ids:
       try:
         self.data_store.MultiSet(session_id, self.to_write.get(session_id, {}),
@@ -397,12 +585,20 @@ class QueueManager(object):
     if self.sync and session_ids:
       self.data_store.Flush()
 
+    # Workers are only woken up once the notifications are written.
+    now = rdfvalue.RDFDatetime().Now()
+    queues_to_wake = set()
     for notification, timestamp in self.notifications.itervalues():
+      if timestamp is None or timestamp <= now:
+        queues_to_wake.add(notification.session_id.Queue())
       self.NotifyQueue(notification, timestamp=timestamp, sync=False)
 
     if self.sync:
       self.data_store.Flush()
 
+    for queue in queues_to_wake:
+      wakeup_channel.CHANNEL.Notify(queue, token=self.token)
+
     self.to_write = {}
     self.to_delete = {}
     self.client_messages_to_delete = {}
@@ -414,6 +610,8 @@ class QueueManager(object):
     if timestamp is None:
       timestamp = self.frozen_timestamp
 
+    serialized = response.SerializeToString()
+
     # Status messages cause their requests to be marked as complete. This allows
     # us to quickly enumerate all the completed requests - it is essentially an
     # index for completed requests.
@@ -422,14 +620,14 @@ class QueueManager(object):
       queue = self.to_write.setdefault(subject, {})
       queue.setdefault(
           self.FLOW_STATUS_TEMPLATE % response.request_id, []).append((
-              response.SerializeToString(), timestamp))
+              serialized, timestamp))
 
     subject = self.GetFlowResponseSubject(session_id, response.request_id)
     queue = self.to_write.setdefault(subject, {})
     queue.setdefault(
         QueueManager.FLOW_RESPONSE_TEMPLATE % (
             response.request_id, response.response_id),
-        []).append((response.SerializeToString(), timestamp))
+        []).append((serialized, timestamp))
 
   def QueueRequest(self, session_id, request_state, timestamp=None):
     if timestamp is None:
@@ -538,11 +736,22 @@ class QueueManager(object):
 
     return output_dict
 
-  def GetNotificationsByPriority(self, queue):
-    """Retrieves session ids for processing grouped by priority."""
+  def GetNotificationsByPriority(self, queue, shard_index=None):
+    """Retrieves session ids for processing grouped by priority.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      shard_index: The notification shard to read. By default successive calls
+                   go round robin over all shards.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
     # Check which sessions have new data.
     # Read all the sessions that have notifications.
-    queue_shard = self.GetNotificationShard(queue)
+    if shard_index is None:
+      queue_shard = self.GetNotificationShard(queue)
+    else:
+      queue_shard = self.GetNotificationShardByIndex(queue, shard_index)
     return self._SortByPriority(
         self._GetUnsortedNotifications(queue_shard).values(), queue)
 
@@ -697,6 +906,12 @@ class QueueManager(object):
               for session_id, data in serialized_notifications.iteritems()]),
         sync=sync, replace=False, token=self.token)
 
+    # Notifications scheduled for the future don't need a worker right now.
+    # Unsynced writes are signalled by Flush() once they are written.
+    if sync and serialized_notifications and (timestamp is None or
+                                              timestamp <= now):
+      wakeup_channel.CHANNEL.Notify(queue, token=self.token)
+
   def DeleteNotification(self, session_id, start=None, end=None):
     """This deletes the notification when all messages have been processed."""
     if not isinstance(session_id, rdfvalue.SessionID):
@@ -800,22 +1015,12 @@ class QueueManager(object):
     for predicate, task, timestamp in transaction.ResolvePrefix(
         self.TASK_PREDICATE_PREFIX,
         timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())):
-      task = rdf_flows.GrrMessage(task)
-      task.eta = timestamp
-      task.last_lease = "%s@%s:%d" % (user,
-                                      socket.gethostname(),
-                                      os.getpid())
-      # Decrement the ttl
-      task.task_ttl -= 1
-      if task.task_ttl <= 0:
+      task = self._LeaseTask(task, timestamp, user)
+      if task is None:
         # Remove the task if ttl is exhausted.
         transaction.DeleteAttribute(predicate)
         ttl_exceeded_count += 1
-        stats.STATS.IncrementCounter("grr_task_ttl_expired_count")
       else:
-        if task.task_ttl != rdf_flows.GrrMessage.max_ttl - 1:
-          stats.STATS.IncrementCounter("grr_task_retransmission_count")
-
         # Update the timestamp on the value to be in the future
         transaction.Set(predicate, task.SerializeToString(), replace=True,
                         timestamp=long(time.time() * 1e6) + lease)
@@ -828,6 +1033,70 @@ class QueueManager(object):
                    ttl_exceeded_count, transaction.subject)
     return tasks
 
+  def _LeaseTask(self, serialized_task, timestamp, user):
+    """Prepares a task for leasing, returns None if its ttl is exhausted."""
+    task = rdf_flows.GrrMessage(serialized_task)
+    task.eta = timestamp
+    task.last_lease = "%s@%s:%d" % (user,
+                                    socket.gethostname(),
+                                    os.getpid())
+    # Decrement the ttl
+    task.task_ttl -= 1
+    if task.task_ttl <= 0:
+      stats.STATS.IncrementCounter("grr_task_ttl_expired_count")
+      return None
+
+    if task.task_ttl != rdf_flows.GrrMessage.max_ttl - 1:
+      stats.STATS.IncrementCounter("grr_task_retransmission_count")
+
+    return task
+
+  def MultiQueryAndOwn(self, queues, lease_seconds=10, limit=1):
+    """Leases tasks from a number of queues at once.
+
+    All the queues are first read with a single MultiResolvePrefix() call.
+    Only the queues which have tasks are then leased, each one in its own
+    transaction like QueryAndOwn() does. This makes it a lot cheaper to drain
+    many (mostly empty) queues at the same time, while tasks still can not be
+    leased twice when the same queue is drained concurrently.
+
+    Args:
+      queues: The queues to query from.
+      lease_seconds: The tasks will be leased for this long.
+      limit: Number of values to fetch from each queue, or a dict mapping the
+             queues to their own limit.
+    Returns:
+      A dict mapping each queue to a list of GrrMessage() objects leased.
+    """
+    queues_by_name = dict((utils.SmartUnicode(queue), queue)
+                          for queue in queues)
+    result = dict((queue, []) for queue in queues)
+
+    try:
+      # Only grab attributes with timestamps in the past.
+      resolved = list(self.data_store.MultiResolvePrefix(
+          queues, self.TASK_PREDICATE_PREFIX,
+          timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now()),
+          token=self.token))
+    except data_store.Error as e:
+      logging.warning("Datastore exception: %s", e)
+      return result
+
+    for subject, values in resolved:
+      if not values:
+        continue
+
+      queue = queues_by_name[utils.SmartUnicode(subject)]
+      if isinstance(limit, dict):
+        queue_limit = limit[queue]
+      else:
+        queue_limit = limit
+
+      result[queue] = self.QueryAndOwn(queue, lease_seconds=lease_seconds,
+                                       limit=queue_limit)
+
+    return result
+
 
 class WellKnownQueueManager(QueueManager):
   """A flow manager for well known flows."""
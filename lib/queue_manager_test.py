@@ -13,6 +13,7 @@ from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 
 # pylint: mode=test
@@ -146,6 +147,63 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
       # Responses contain just the status message.
       self.assertEqual(len(responses), 1)
 
+  def _QueueCompletedRequests(self, session_id, count):
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for request_id in range(1, count + 1):
+        manager.QueueRequest(session_id, rdf_flows.RequestState(
+            id=request_id, client_id=self.client_id,
+            next_state="TestState", session_id=session_id))
+        manager.QueueResponse(session_id, rdf_flows.GrrMessage(
+            request_id=request_id, response_id=1))
+        manager.QueueResponse(session_id, rdf_flows.GrrMessage(
+            request_id=request_id, response_id=2,
+            type=rdf_flows.GrrMessage.Type.STATUS))
+
+    return rdf_flows.GrrNotification(session_id=session_id,
+                                     timestamp=rdfvalue.RDFDatetime().Now())
+
+  def testPrefetchFlowStates(self):
+    notifications = [
+        self._QueueCompletedRequests(rdfvalue.SessionID(flow_name=name), 3)
+        for name in ["prefetch1", "prefetch2"]]
+
+    manager = queue_manager.QueueManager(token=self.token)
+    expected = dict(
+        (n.session_id, list(manager.FetchCompletedResponses(
+            n.session_id, timestamp=(0, n.timestamp))))
+        for n in notifications)
+
+    prefetch = manager.PrefetchFlowStates(notifications)
+
+    def Fail(*unused_args, **unused_kwargs):
+      raise AssertionError("Prefetched data should have been used.")
+
+    with utils.MultiStubber((data_store.DB, "ResolvePrefix", Fail),
+                            (data_store.DB, "MultiResolvePrefix", Fail)):
+      with prefetch:
+        for n in notifications:
+          result = list(manager.FetchCompletedResponses(
+              n.session_id, timestamp=(0, n.timestamp)))
+          self.assertEqual(len(result), 3)
+          self.assertEqual(result, expected[n.session_id])
+
+  def testPrefetchedFlowStatesAreDroppedOnChange(self):
+    notification = self._QueueCompletedRequests(
+        rdfvalue.SessionID(flow_name="prefetch3"), 2)
+    session_id = notification.session_id
+    timestamp = (0, notification.timestamp)
+
+    manager = queue_manager.QueueManager(token=self.token)
+    with manager.PrefetchFlowStates([notification]):
+      request, _ = list(manager.FetchCompletedRequests(
+          session_id, timestamp=timestamp))[0]
+      with queue_manager.QueueManager(token=self.token) as other_manager:
+        other_manager.DeleteFlowRequestStates(session_id, request)
+
+      result = list(manager.FetchCompletedResponses(session_id,
+                                                    timestamp=timestamp))
+      self.assertEqual([r.id for r, _ in result], [2])
+
   def testDeleteFlowRequestStates(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID(flow_name="test3")
@@ -303,6 +361,35 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
         stats.STATS.GetMetricValue("grr_task_retransmission_count"),
         self.retransmission_metric_value + 1)
 
+  def testMultiQueryAndOwn(self):
+    queues = [rdfvalue.RDFURN("fooMultiSchedule%d" % i) for i in range(3)]
+    manager = queue_manager.QueueManager(token=self.token)
+    for queue in queues[:2]:
+      manager.Schedule([rdf_flows.GrrMessage(queue=queue, task_ttl=5,
+                                             session_id="aff4:/Test")
+                        for _ in range(3)])
+
+    result = manager.MultiQueryAndOwn(
+        queues, lease_seconds=100, limit={queues[0]: 2, queues[1]: 100,
+                                          queues[2]: 100})
+
+    self.assertEqual(len(result[queues[0]]), 2)
+    self.assertEqual(len(result[queues[1]]), 3)
+    self.assertEqual(result[queues[2]], [])
+    for task in result[queues[0]] + result[queues[1]]:
+      self.assertEqual(task.task_ttl, 4)
+
+    # Leased tasks can not be leased again until the lease expires.
+    self._current_mock_time += 10
+    result = manager.MultiQueryAndOwn(queues, lease_seconds=100, limit=100)
+    self.assertEqual(len(result[queues[0]]), 1)
+    self.assertEqual(len(result[queues[1]]), 0)
+
+    self._current_mock_time += 110
+    result = manager.MultiQueryAndOwn(queues, lease_seconds=100, limit=100)
+    self.assertEqual(len(result[queues[0]]), 3)
+    self.assertEqual(len(result[queues[1]]), 3)
+
   def testDelete(self):
     """Test that we can delete tasks."""
 
@@ -588,6 +675,30 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
     notifications = manager.GetNotificationsForAllShards(queues.HUNTS)
     self.assertEqual(len(notifications), 2)
 
+  def testGetNotificationsByPriorityForShard(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    expected = [rdfvalue.SessionID(base="aff4:/hunts", queue=queues.HUNTS,
+                                   flow_name=flow_name)
+                for flow_name in ["42", "43"]]
+    for session_id in expected:
+      manager.QueueNotification(session_id=session_id)
+      manager.Flush()
+
+    session_ids = []
+    for shard_index in range(manager.num_notification_shards):
+      for _ in range(manager.num_notification_shards):
+        notifications = manager.GetNotificationsByPriority(
+            queues.HUNTS, shard_index=shard_index)
+        # Reading a given shard always returns the same notifications.
+        shard_session_ids = [n.session_id for notifications_list
+                             in notifications.values()
+                             for n in notifications_list]
+        self.assertEqual(len(shard_session_ids), 1)
+
+      session_ids.extend(shard_session_ids)
+
+    self.assertItemsEqual(session_ids, expected)
+
   def testNotificationRequeueing(self):
     with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
       session_id = rdfvalue.SessionID(base="aff4:/testflows",
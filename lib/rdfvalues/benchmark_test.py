@@ -5,6 +5,7 @@
 
 from grr.lib import test_lib
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
@@ -336,3 +337,39 @@ class RDFValueBenchmark(test_lib.AverageMicroBenchmarks):
 
     self.TimeIt(RDFStructDecodeEncode)
     self.TimeIt(ProtoDecodeEncode)
+
+  def testAcceleratedDecodeEncode(self):
+    """Compare the pure python and accelerated parsers and serializers."""
+
+    s = jobs_pb2.User(**self.USER_ACCOUNT)
+    data = s.SerializeToString()
+
+    def RDFStructDecodeEncode():
+      new_s = rdf_client.User(data)
+      new_s.username = "other user"
+      return new_s.SerializeToString()
+
+    repeats = self.REPEATS / 50
+    s = jobs_pb2.MessageList()
+    for i in range(self.REPEATS):
+      s.job.add(session_id="test", name="foobar", request_id=i)
+
+    repeated_data = s.SerializeToString()
+
+    def RDFStructRepeatedDecodeEncode():
+      new_s = FastGrrMessageList(repeated_data)
+      self.assertEqual(new_s.job[100].request_id, 100)
+      return new_s.SerializeToString()
+
+    self.TimeIt(RDFStructDecodeEncode, "Accelerated RDFStruct Decode Encode")
+    self.TimeIt(RDFStructRepeatedDecodeEncode,
+                "Accelerated RDFStruct Repeated Decode Encode",
+                repetitions=repeats)
+
+    with utils.MultiStubber(
+        (rdf_structs, "ReadIntoObject", rdf_structs.PythonReadIntoObject),
+        (rdf_structs, "SerializeRawData", rdf_structs.PythonSerializeRawData)):
+      self.TimeIt(RDFStructDecodeEncode, "Python RDFStruct Decode Encode")
+      self.TimeIt(RDFStructRepeatedDecodeEncode,
+                  "Python RDFStruct Repeated Decode Encode",
+                  repetitions=repeats)
@@ -24,6 +24,10 @@ class DataServerInformation(rdf_structs.RDFProtoStruct):
   protobuf = data_server_pb2.DataServerInformation
 
 
+class DataServerVirtualNode(rdf_structs.RDFProtoStruct):
+  protobuf = data_server_pb2.DataServerVirtualNode
+
+
 class DataServerMapping(rdf_structs.RDFProtoStruct):
   protobuf = data_server_pb2.DataServerMapping
 
@@ -87,6 +91,14 @@ class DataServerRebalance(rdf_structs.RDFProtoStruct):
   protobuf = data_server_pb2.DataServerRebalance
 
 
+class DataServerRebalanceProgress(rdf_structs.RDFProtoStruct):
+  protobuf = data_server_pb2.DataServerRebalanceProgress
+
+
+class DataServerChange(rdf_structs.RDFProtoStruct):
+  protobuf = data_server_pb2.DataServerChange
+
+
 class DataStoreRegistrationRequest(rdf_structs.RDFProtoStruct):
   protobuf = data_server_pb2.DataStoreRegistrationRequest
 
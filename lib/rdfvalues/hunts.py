@@ -11,3 +11,7 @@ from grr.proto import jobs_pb2
 
 class HuntNotification(rdf_structs.RDFProtoStruct):
   protobuf = jobs_pb2.HuntNotification
+
+
+class HuntIndexEntry(rdf_structs.RDFProtoStruct):
+  protobuf = jobs_pb2.HuntIndexEntry
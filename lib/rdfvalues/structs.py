@@ -231,11 +231,50 @@ def ReadIntoObject(buff, index, value_obj, length=0):
       # Set the python_format as None so it gets converted lazily on access.
       raw_data[type_info_obj.name] = (None, wire_format, type_info_obj)
 
+
+def _AcceleratedReadIntoObject(buff, index, value_obj, length=0):
+  """Like ReadIntoObject() but parses the buffer in the _semantic module."""
+  for type_info_obj, wire_format in _semantic.read_into_object(
+      buff, index, length, value_obj.type_infos_by_encoded_tag,
+      value_obj.GetRawData(), ProtoList):
+    value_obj.Get(type_info_obj.name).wrapped_list.append((None, wire_format))
+
+
+def SerializeRawData(raw_data):
+  """Serializes the raw data dict of an RDFStruct.
+
+  Args:
+    raw_data: A dict of (python_format, wire_format, type_descriptor) tuples.
+
+  Returns:
+    The serialized protobuf. Entries which have not been changed since they
+    were parsed are written back in their original wire format.
+  """
+  output = []
+  for python_format, wire_format, type_descriptor in raw_data.itervalues():
+    if wire_format is None or (python_format and
+                               type_descriptor.IsDirty(python_format)):
+      wire_format = type_descriptor.ConvertToWireFormat(python_format)
+
+    output.extend(wire_format)
+
+  return "".join(output)
+
+# The pure python implementations, the accelerated ones must behave the same.
+PythonReadIntoObject = ReadIntoObject
+PythonSerializeRawData = SerializeRawData
+
 # pylint: disable=invalid-name
 if _semantic:
   VarintEncode = _semantic.varint_encode
   VarintReader = _semantic.varint_decode
   SplitBuffer = _semantic.split_buffer
+
+  # Extensions built from older sources do not have these.
+  if hasattr(_semantic, "read_into_object"):
+    ReadIntoObject = _AcceleratedReadIntoObject
+  if hasattr(_semantic, "serialize_raw_data"):
+    SerializeRawData = _semantic.serialize_raw_data
 # pylint: enable=invalid-name
 
 
@@ -1639,17 +1678,7 @@ class RDFStruct(rdfvalue.RDFValue):
     self.dirty = True
 
   def SerializeToString(self):
-    output = []
-    for entry in self._data.itervalues():
-      python_format, wire_format, type_descriptor = entry
-
-      if wire_format is None or (python_format and
-                                 type_descriptor.IsDirty(python_format)):
-        wire_format = type_descriptor.ConvertToWireFormat(python_format)
-
-      output.extend(wire_format)
-
-    return "".join(output)
+    return SerializeRawData(self._data)
 
   def ParseFromString(self, string):
     ReadIntoObject(string, 0, self)
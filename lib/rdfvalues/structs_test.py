@@ -225,6 +225,57 @@ class RDFStructsTest(test_base.RDFValueTestCase):
     # Check that nested fields are also preserved.
     self.assertEqual(decoded_tested.nested.foobar, "goodbye")
 
+  def _CheckAccelerated(self, name):
+    if not hasattr(structs._semantic, name):  # pylint: disable=protected-access
+      self.skipTest("The _semantic module does not implement %s." % name)
+
+  def _MakeStructWithAllFields(self):
+    tested = TestStruct(foobar="hello", int=5, repeated=["a", "b"],
+                        urn="aff4:/C.1234", type="SECOND", float=2.5)
+    tested.nested.foobar = "goodbye"
+    tested.repeat_nested.Append(foobar="Nest1")
+    tested.repeat_nested.Append(foobar="Nest2")
+    return tested
+
+  def testAcceleratedReadIntoObjectMatchesPython(self):
+    self._CheckAccelerated("read_into_object")
+    data = self._MakeStructWithAllFields().SerializeToString()
+
+    # The field with number 1 is unknown to PartialTest1.
+    for cls in [TestStruct, PartialTest1]:
+      python_result = cls()
+      structs.PythonReadIntoObject(data, 0, python_result)
+      accelerated_result = cls()
+      structs._AcceleratedReadIntoObject(  # pylint: disable=protected-access
+          data, 0, accelerated_result)
+
+      self.assertEqual(accelerated_result.GetRawData(),
+                       python_result.GetRawData())
+      self.assertEqual(accelerated_result, python_result)
+      self.assertEqual(accelerated_result.SerializeToString(), data)
+
+  def testAcceleratedReadIntoObjectRejectsInvalidData(self):
+    self._CheckAccelerated("read_into_object")
+    data = self._MakeStructWithAllFields().SerializeToString()
+
+    self.assertRaises(ValueError,
+                      structs._AcceleratedReadIntoObject,  # pylint: disable=protected-access
+                      data[:-1], 0, TestStruct())
+
+  def testAcceleratedSerializeRawDataMatchesPython(self):
+    self._CheckAccelerated("serialize_raw_data")
+    tested = TestStruct(self._MakeStructWithAllFields().SerializeToString())
+
+    # Mix fields still in wire format with changed and new ones.
+    tested.foobar = "changed"
+    tested.nested.foobar = "changed nested"
+    tested.repeat_nested[0].foobar = "changed repeated"
+    tested.repeated.Append("c")
+    data = tested.GetRawData()
+
+    self.assertEqual(structs._semantic.serialize_raw_data(data),  # pylint: disable=protected-access
+                     structs.PythonSerializeRawData(data))
+
   def testRDFStruct(self):
     tested = TestStruct()
 
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""A cache for AFF4 attributes shared by the GRR processes on a host.
+
+Every worker, frontend and GUI process keeps its own short lived cache of AFF4
+attributes, so hot objects (client summaries, foreman rules, hunts) are read
+from the data store once per process. The shared cache adds a second tier
+behind the per process cache which is kept by a cache daemon running on the
+same host (see tools/shared_cache_server.py).
+
+Writes through the AFF4 factory invalidate the shared entries of the written
+objects once the write is done. Entries read from the data store before an
+invalidation of the same object are rejected by the daemon, so a slow reader
+can not put stale data back into the cache. Objects written directly through
+the data store are not invalidated, readers can see their old attributes until
+the entries expire after AFF4.shared_cache_age seconds, just like with the per
+process cache.
+
+Entries are shared between all users, access is checked by the AFF4 factory
+before an entry is used.
+
+Override the class used with the AFF4.shared_cache config option.
+"""
+
+
+import marshal
+import os
+import socket
+import SocketServer
+import stat
+import struct
+import sys
+import threading
+import time
+
+import logging
+
+from grr.lib import config_lib
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class SharedAttributeCache(object):
+  """A shared cache which does not cache anything."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # Writes have to be synchronous when attributes are shared, or the shared
+  # entries could be invalidated before the data store is updated.
+  enabled = False
+
+  def Get(self, key):
+    """Fetches the attributes stored under key.
+
+    Args:
+      key: The cache key as returned by Factory._MakeSharedCacheKey().
+
+    Returns:
+      The cached list of (predicate, value, timestamp) tuples.
+
+    Raises:
+      KeyError: If the key is not in the cache.
+    """
+    raise KeyError(key)
+
+  def Put(self, prefix, key, values, read_time):
+    """Stores the attributes of an object.
+
+    Args:
+      prefix: The prefix used to invalidate this key (the urn followed by ":").
+      key: The cache key.
+      values: A list of (predicate, value, timestamp) tuples.
+      read_time: The time the values were read from the data store. Values
+                 read before the prefix was last invalidated are dropped.
+    """
+
+  def ExpirePrefix(self, prefix):
+    """Invalidates all the keys starting with prefix."""
+
+  def Flush(self):
+    """Removes everything from the cache."""
+
+
+class AttributeStore(utils.AgeBasedCache):
+  """The storage used by the shared cache daemon."""
+
+  def __init__(self, max_size=10000, max_age=5):
+    super(AttributeStore, self).__init__(max_size=max_size, max_age=max_age)
+    # The time each prefix was last invalidated.
+    self.invalidations = utils.AgeBasedCache(max_size=max_size,
+                                             max_age=max_age)
+
+  @utils.Synchronized
+  def Expire(self):
+    evicted = len(self._hash) - self._limit
+    super(AttributeStore, self).Expire()
+    if evicted > 0:
+      stats.STATS.IncrementCounter("aff4_shared_cache_evictions", evicted)
+
+  @utils.Synchronized
+  def PutIfCurrent(self, prefix, key, values, read_time):
+    try:
+      if self.invalidations.Get(prefix) >= read_time:
+        return
+    except KeyError:
+      pass
+
+    self.Put(key, values)
+
+  @utils.Synchronized
+  def Invalidate(self, prefix):
+    self.invalidations.Put(prefix, time.time())
+    self.ExpirePrefix(prefix)
+
+
+class InProcessSharedCache(SharedAttributeCache):
+  """Shares attributes between the factories of one process.
+
+  This is used in tests.
+  """
+
+  enabled = True
+
+  def __init__(self):
+    super(InProcessSharedCache, self).__init__()
+    self.store = AttributeStore(
+        max_size=config_lib.CONFIG["AFF4.shared_cache_max_size"],
+        max_age=config_lib.CONFIG["AFF4.shared_cache_age"])
+
+  def Get(self, key):
+    try:
+      result = self.store.Get(key)
+    except KeyError:
+      stats.STATS.IncrementCounter("aff4_shared_cache_misses")
+      raise
+
+    stats.STATS.IncrementCounter("aff4_shared_cache_hits")
+    return result
+
+  def Put(self, prefix, key, values, read_time):
+    self.store.PutIfCurrent(prefix, key, values, read_time)
+
+  def ExpirePrefix(self, prefix):
+    self.store.Invalidate(prefix)
+
+  def Flush(self):
+    self.store.Flush()
+
+
+# Not exported by the socket module of Python 2.
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+
+def _CheckPrivateDirectory(path):
+  """Checks that only our user can create and open sockets in path.
+
+  Args:
+    path: The directory holding the cache socket.
+
+  Raises:
+    socket.error: If the directory can be accessed by other users.
+  """
+  try:
+    st = os.lstat(path)
+  except OSError as e:
+    raise socket.error(e)
+
+  if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+      st.st_mode & 077):
+    raise socket.error("%s must be a directory owned by uid %d and not "
+                       "accessible by anyone else." % (path, os.getuid()))
+
+
+def _CheckPeer(sock):
+  """Checks that the other end of a unix socket runs as our user.
+
+  Peer credentials are only available on Linux, elsewhere we rely on the
+  permissions of the socket directory.
+
+  Args:
+    sock: A connected unix socket.
+
+  Raises:
+    socket.error: If the peer runs as another user.
+  """
+  if not sys.platform.startswith("linux"):
+    return
+
+  credentials = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                struct.calcsize("3i"))
+  _, uid, _ = struct.unpack("3i", credentials)
+  if uid != os.getuid():
+    raise socket.error("Shared cache peer runs as uid %d." % uid)
+
+
+def _SendMessage(sock, message):
+  _SendData(sock, marshal.dumps(message))
+
+
+def _SendData(sock, data):
+  sock.sendall(struct.pack("<I", len(data)) + data)
+
+
+def _ReceiveExactly(sock, length):
+  chunks = []
+  while length > 0:
+    chunk = sock.recv(min(length, 1024 * 1024))
+    if not chunk:
+      raise socket.error("Connection closed.")
+    chunks.append(chunk)
+    length -= len(chunk)
+
+  return "".join(chunks)
+
+
+def _ReceiveMessage(sock):
+  length, = struct.unpack("<I", _ReceiveExactly(sock, 4))
+  return marshal.loads(_ReceiveExactly(sock, length))
+
+
+class LocalSocketSharedCache(SharedAttributeCache):
+  """Talks to the cache daemon on this host through a unix socket.
+
+  The socket has to be in a directory only our user can access, and both ends
+  check that the other one runs as the same user, so messages are encoded with
+  marshal. If the daemon is not running every lookup is a miss and we retry
+  connecting every RECONNECT_INTERVAL seconds.
+  """
+
+  RECONNECT_INTERVAL = 10
+
+  enabled = True
+
+  def __init__(self):
+    super(LocalSocketSharedCache, self).__init__()
+    self.socket_path = config_lib.CONFIG["AFF4.shared_cache_socket"]
+    self.timeout = config_lib.CONFIG["AFF4.shared_cache_timeout"]
+    self.lock = threading.Lock()
+    self.sock = None
+    self.last_connect_attempt = 0
+
+  def _Call(self, *message):
+    """Sends a request to the daemon and returns its reply.
+
+    Args:
+      *message: The command followed by its arguments.
+
+    Returns:
+      The reply of the daemon.
+
+    Raises:
+      socket.error: If the daemon can not be reached.
+      ValueError: If the message can not be encoded.
+    """
+    data = marshal.dumps(message)
+
+    with self.lock:
+      if self.sock is None:
+        now = time.time()
+        if now - self.last_connect_attempt < self.RECONNECT_INTERVAL:
+          raise socket.error("Shared cache unavailable.")
+
+        self.last_connect_attempt = now
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+          _CheckPrivateDirectory(os.path.dirname(self.socket_path))
+          sock.connect(self.socket_path)
+          _CheckPeer(sock)
+        except socket.error as e:
+          logging.warning("Can not use the shared cache: %s", e)
+          sock.close()
+          raise
+
+        self.sock = sock
+
+      try:
+        _SendData(self.sock, data)
+        return _ReceiveMessage(self.sock)
+      except (socket.error, struct.error, ValueError, EOFError) as e:
+        logging.warning("Lost connection to the shared cache: %s", e)
+        self.sock.close()
+        self.sock = None
+        raise socket.error(e)
+
+  def Get(self, key):
+    try:
+      result = self._Call("get", key)
+    except socket.error:
+      result = None
+
+    if result is None:
+      stats.STATS.IncrementCounter("aff4_shared_cache_misses")
+      raise KeyError(key)
+
+    stats.STATS.IncrementCounter("aff4_shared_cache_hits")
+    return result
+
+  def Put(self, prefix, key, values, read_time):
+    try:
+      self._Call("put", prefix, key, values, read_time)
+    except (socket.error, ValueError):
+      # ValueError is raised if the values can not be marshalled.
+      pass
+
+  def ExpirePrefix(self, prefix):
+    try:
+      self._Call("expire", prefix)
+    except socket.error:
+      pass
+
+  def Flush(self):
+    try:
+      self._Call("flush")
+    except socket.error:
+      pass
+
+
+class SharedCacheRequestHandler(SocketServer.BaseRequestHandler):
+  """Serves the requests of one client process."""
+
+  def handle(self):
+    try:
+      _CheckPeer(self.request)
+    except socket.error as e:
+      logging.warning("Refusing shared cache client: %s", e)
+      return
+
+    store = self.server.store
+    while True:
+      try:
+        message = _ReceiveMessage(self.request)
+      except (socket.error, struct.error, ValueError, EOFError):
+        return
+
+      command, args = message[0], message[1:]
+      result = None
+      if command == "get":
+        try:
+          result = store.Get(*args)
+        except KeyError:
+          pass
+      elif command == "put":
+        store.PutIfCurrent(*args)
+      elif command == "expire":
+        store.Invalidate(*args)
+      elif command == "flush":
+        store.Flush()
+      else:
+        logging.warning("Unknown shared cache command %s", command)
+        return
+
+      try:
+        _SendMessage(self.request, result)
+      except socket.error:
+        return
+
+
+class SharedCacheServer(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+  """The cache daemon."""
+
+  daemon_threads = True
+
+  def __init__(self, socket_path, max_size=10000, max_age=5):
+    self.store = AttributeStore(max_size=max_size, max_age=max_age)
+
+    # Only processes running as our user may use the cache, so nothing we
+    # create is ever accessible by other users, not even for a moment.
+    old_umask = os.umask(077)
+    try:
+      socket_dir = os.path.dirname(socket_path)
+      if not os.path.exists(socket_dir):
+        os.makedirs(socket_dir, 0700)
+      _CheckPrivateDirectory(socket_dir)
+
+      if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+      SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                             SharedCacheRequestHandler)
+    finally:
+      os.umask(old_umask)
+
+
+class SharedCacheInit(registry.InitHook):
+  """Registers the shared cache metrics."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("aff4_shared_cache_hits")
+    stats.STATS.RegisterCounterMetric("aff4_shared_cache_misses")
+    stats.STATS.RegisterCounterMetric("aff4_shared_cache_evictions")
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""Tests for the shared AFF4 cache."""
+
+
+import os
+import threading
+import time
+
+from grr.lib import access_control
+from grr.lib import aff4
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import shared_cache
+from grr.lib import stats
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class SharedCacheTestMixin(object):
+  """Tests common to all the shared caches."""
+
+  def CreateCache(self):
+    raise NotImplementedError()
+
+  def setUp(self):
+    super(SharedCacheTestMixin, self).setUp()
+    self.cache = self.CreateCache()
+    self.values = [("aff4:type", "VFSFile", 1000), ("aff4:size", 10, 1000)]
+
+  def testPutAndGet(self):
+    self.assertRaises(KeyError, self.cache.Get, "aff4:/foo:token:age")
+
+    self.cache.Put("aff4:/foo:", "aff4:/foo:token:age", self.values,
+                   time.time())
+    self.assertEqual(list(self.cache.Get("aff4:/foo:token:age")), self.values)
+
+  def testExpirePrefix(self):
+    self.cache.Put("aff4:/foo:", "aff4:/foo:token:age", self.values,
+                   time.time())
+    self.cache.Put("aff4:/foobar:", "aff4:/foobar:token:age", self.values,
+                   time.time())
+
+    self.cache.ExpirePrefix("aff4:/foo:")
+    self.assertRaises(KeyError, self.cache.Get, "aff4:/foo:token:age")
+    self.cache.Get("aff4:/foobar:token:age")
+
+  def testValuesReadBeforeInvalidationAreDropped(self):
+    read_time = time.time() - 1
+    self.cache.ExpirePrefix("aff4:/foo:")
+
+    self.cache.Put("aff4:/foo:", "aff4:/foo:token:age", self.values, read_time)
+    self.assertRaises(KeyError, self.cache.Get, "aff4:/foo:token:age")
+
+  def testHitsAndMissesAreCounted(self):
+    hits = stats.STATS.GetMetricValue("aff4_shared_cache_hits")
+    misses = stats.STATS.GetMetricValue("aff4_shared_cache_misses")
+
+    self.cache.Put("aff4:/foo:", "aff4:/foo:token:age", self.values,
+                   time.time())
+    self.cache.Get("aff4:/foo:token:age")
+    self.assertRaises(KeyError, self.cache.Get, "aff4:/bar:token:age")
+
+    self.assertEqual(stats.STATS.GetMetricValue("aff4_shared_cache_hits"),
+                     hits + 1)
+    self.assertEqual(stats.STATS.GetMetricValue("aff4_shared_cache_misses"),
+                     misses + 1)
+
+
+class InProcessSharedCacheTest(SharedCacheTestMixin, test_lib.GRRBaseTest):
+  """Tests for the InProcessSharedCache."""
+
+  def CreateCache(self):
+    with test_lib.ConfigOverrider({"AFF4.shared_cache_max_size": 2}):
+      return shared_cache.InProcessSharedCache()
+
+  def testEvictionsAreCounted(self):
+    evictions = stats.STATS.GetMetricValue("aff4_shared_cache_evictions")
+    for i in range(3):
+      self.cache.Put("aff4:/%d:" % i, "aff4:/%d:token:age" % i, self.values,
+                     time.time())
+
+    self.assertEqual(stats.STATS.GetMetricValue("aff4_shared_cache_evictions"),
+                     evictions + 1)
+
+
+class LocalSocketSharedCacheTest(SharedCacheTestMixin, test_lib.GRRBaseTest):
+  """Tests the LocalSocketSharedCache against a cache daemon."""
+
+  def CreateCache(self):
+    socket_path = os.path.join(self.temp_dir, "shared_cache", "cache.sock")
+    self.server = shared_cache.SharedCacheServer(socket_path)
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+
+    with test_lib.ConfigOverrider({"AFF4.shared_cache_socket": socket_path}):
+      return shared_cache.LocalSocketSharedCache()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    super(LocalSocketSharedCacheTest, self).tearDown()
+
+  def testMissingDaemonIsAMiss(self):
+    with test_lib.ConfigOverrider({
+        "AFF4.shared_cache_socket": os.path.join(self.temp_dir, "missing")}):
+      cache = shared_cache.LocalSocketSharedCache()
+
+    cache.Put("aff4:/foo:", "aff4:/foo:token:age", self.values, time.time())
+    self.assertRaises(KeyError, cache.Get, "aff4:/foo:token:age")
+
+  def testDirectoryAccessibleByOthersIsNotUsed(self):
+    socket_dir = os.path.join(self.temp_dir, "shared_cache")
+    os.chmod(socket_dir, 0755)
+    self.assertRaises(KeyError, self.cache.Get, "aff4:/foo:token:age")
+
+    self.cache.last_connect_attempt = 0
+    os.chmod(socket_dir, 0700)
+    self.cache.Put("aff4:/foo:", "aff4:/foo:token:age", self.values,
+                   time.time())
+    self.assertEqual(self.cache.Get("aff4:/foo:token:age"), self.values)
+
+  def testSocketDirectoryIsPrivate(self):
+    socket_dir = os.path.join(self.temp_dir, "shared_cache")
+    self.assertEqual(os.stat(socket_dir).st_mode & 0777, 0700)
+    self.assertEqual(
+        os.stat(os.path.join(socket_dir, "cache.sock")).st_mode & 077, 0)
+
+
+class FactorySharedCacheTest(test_lib.GRRBaseTest):
+  """Checks that the AFF4 factory uses and invalidates the shared cache."""
+
+  def setUp(self):
+    super(FactorySharedCacheTest, self).setUp()
+    self.shared = shared_cache.InProcessSharedCache()
+    self.stubber = utils.Stubber(aff4.FACTORY, "shared_cache", self.shared)
+    self.stubber.Start()
+    self.urn = rdfvalue.RDFURN("aff4:/C.0000000000000001/fs/os/foo")
+
+  def tearDown(self):
+    self.stubber.Stop()
+    super(FactorySharedCacheTest, self).tearDown()
+
+  def testAttributesAreSharedAndInvalidated(self):
+    with aff4.FACTORY.Create(self.urn, "VFSFile", token=self.token) as fd:
+      fd.Set(fd.Schema.SIZE(10))
+
+    aff4.FACTORY.Flush()
+    aff4.FACTORY.Open(self.urn, token=self.token)
+
+    # Another process would now find the object in the shared cache.
+    aff4.FACTORY.cache.Flush()
+    hits = stats.STATS.GetMetricValue("aff4_shared_cache_hits")
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    self.assertEqual(fd.Get(fd.Schema.SIZE), 10)
+    self.assertGreater(stats.STATS.GetMetricValue("aff4_shared_cache_hits"),
+                       hits)
+
+    # Writing the object invalidates the shared entry.
+    with aff4.FACTORY.Open(self.urn, mode="rw", token=self.token) as fd:
+      fd.Set(fd.Schema.SIZE(20))
+
+    aff4.FACTORY.cache.Flush()
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    self.assertEqual(fd.Get(fd.Schema.SIZE), 20)
+
+  def testEntriesAreSharedBetweenUsers(self):
+    with aff4.FACTORY.Create(self.urn, "VFSFile", token=self.token) as fd:
+      fd.Set(fd.Schema.SIZE(10))
+
+    aff4.FACTORY.Flush()
+    aff4.FACTORY.Open(self.urn, token=self.token)
+
+    aff4.FACTORY.cache.Flush()
+    other_token = access_control.ACLToken(username="other", reason="testing")
+    hits = stats.STATS.GetMetricValue("aff4_shared_cache_hits")
+    fd = aff4.FACTORY.Open(self.urn, token=other_token)
+    self.assertEqual(fd.Get(fd.Schema.SIZE), 10)
+    self.assertGreater(stats.STATS.GetMetricValue("aff4_shared_cache_hits"),
+                       hits)
+
+    # A write by one user invalidates the entry for all of them.
+    with aff4.FACTORY.Open(self.urn, mode="rw", token=other_token) as fd:
+      fd.Set(fd.Schema.SIZE(20))
+
+    aff4.FACTORY.cache.Flush()
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    self.assertEqual(fd.Get(fd.Schema.SIZE), 20)
+
+  def testSharedEntriesCheckAccess(self):
+    with aff4.FACTORY.Create(self.urn, "VFSFile", token=self.token) as fd:
+      fd.Set(fd.Schema.SIZE(10))
+
+    aff4.FACTORY.Flush()
+    aff4.FACTORY.Open(self.urn, token=self.token)
+    aff4.FACTORY.cache.Flush()
+
+    def CheckDataStoreAccess(token, subjects, requested_access="r"):
+      _ = requested_access
+      if token.username == "denied" and str(self.urn) in map(str, subjects):
+        raise access_control.UnauthorizedAccess("Denied.")
+
+    denied_token = access_control.ACLToken(username="denied",
+                                           reason="testing")
+    with utils.Stubber(data_store.DB.security_manager, "CheckDataStoreAccess",
+                       CheckDataStoreAccess):
+      self.assertRaises(access_control.UnauthorizedAccess, aff4.FACTORY.Open,
+                        self.urn, token=denied_token)
+
+  def testSharedEntriesAreInvalidatedAfterTheWrite(self):
+    with aff4.FACTORY.Create(self.urn, "VFSFile", token=self.token) as fd:
+      fd.Set(fd.Schema.SIZE(10))
+
+    sizes = []
+
+    def ExpirePrefix(prefix):
+      # Readers must already find the new attributes in the data store.
+      if prefix == utils.SmartStr(self.urn) + ":":
+        sizes.append(data_store.DB.Resolve(self.urn, "aff4:size",
+                                           token=self.token)[0])
+
+    with utils.Stubber(self.shared, "ExpirePrefix", ExpirePrefix):
+      with aff4.FACTORY.Open(self.urn, mode="rw", token=self.token) as fd:
+        fd.Set(fd.Schema.SIZE(20))
+
+    self.assertEqual([int(size) for size in sizes], [20])
+
+  def testDeletedObjectsAreInvalidated(self):
+    with aff4.FACTORY.Create(self.urn, "VFSFile", token=self.token) as fd:
+      fd.Set(fd.Schema.SIZE(10))
+
+    aff4.FACTORY.Flush()
+    aff4.FACTORY.Open(self.urn, token=self.token)
+    aff4.FACTORY.Delete(self.urn, token=self.token)
+
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    self.assertIsNone(fd.Get(fd.Schema.SIZE))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
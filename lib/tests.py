@@ -11,6 +11,7 @@ from grr.lib import aff4_test
 from grr.lib import artifact_test
 from grr.lib import artifact_utils_test
 from grr.lib import bigquery_test
+from grr.lib import blob_store_test
 from grr.lib import build_test
 from grr.lib import client_index_test
 from grr.lib import communicator_test
@@ -25,19 +26,24 @@ from grr.lib import flow_test
 from grr.lib import flow_utils_test
 from grr.lib import front_end_test
 from grr.lib import fuse_mount_test
+from grr.lib import hunt_index_test
 from grr.lib import hunt_test
 from grr.lib import ipv6_utils_test
+from grr.lib import keyword_index_test
 from grr.lib import lexer_test
 from grr.lib import objectfilter_test
 from grr.lib import parsers_test
 from grr.lib import queue_manager_test
 from grr.lib import rekall_profile_server_test
+from grr.lib import shared_cache_test
 from grr.lib import stats_test
 from grr.lib import test_lib
 from grr.lib import threadpool_test
 from grr.lib import throttle_test
 from grr.lib import type_info_test
 from grr.lib import utils_test
+from grr.lib import wakeup_channel_test
+from grr.lib import worker_supervisor_test
 
 from grr.lib.aff4_objects import tests
 from grr.lib.builders import tests
@@ -48,5 +54,6 @@ from grr.lib.hunts import tests
 from grr.lib.local import tests
 from grr.lib.output_plugins import tests
 from grr.lib.rdfvalues import tests
+from grr.tools import async_http_server_test
 from grr.tools import entry_point_test
 # pylint: enable=unused-import
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""Channels used to wake up workers when new notifications arrive.
+
+Workers used to poll the notification queues at a fixed interval, which adds
+up to a few seconds of latency to every flow state transition. The queue
+manager now signals a wakeup channel whenever it writes notifications and
+idle workers block on the channel instead of sleeping. The polling interval
+is still used as a timeout so a lost signal only delays processing until the
+next poll.
+
+Override the class used with the Worker.wakeup_channel config option.
+"""
+
+
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+import logging
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class WakeupChannel(object):
+  """A channel that does not signal anything, workers just poll."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  def Notify(self, queue, token=None):
+    """Signals that new notifications are available in the queue.
+
+    Args:
+      queue: The queue (e.g. rdfvalue.RDFURN("aff4:/W")) notifications were
+             written to.
+      token: An ACL token.
+    """
+
+  def Wait(self, queues, timeout, token=None):
+    """Blocks until one of the queues is signalled or the timeout expires.
+
+    Args:
+      queues: The list of queues to wait for.
+      timeout: The maximum time to wait in seconds.
+      token: An ACL token.
+
+    Returns:
+      The time (in seconds since the epoch) of the earliest signal received or
+      None if no signal was received before the timeout.
+    """
+    time.sleep(timeout)
+
+
+class InProcessWakeupChannel(WakeupChannel):
+  """Signals workers running in the same process.
+
+  This is used in tests and in deployments running the frontend and the
+  worker in one process.
+  """
+
+  def __init__(self):
+    super(InProcessWakeupChannel, self).__init__()
+    self.condition = threading.Condition()
+    # Maps queue names to the time of the earliest pending signal.
+    self.pending = {}
+
+  def Notify(self, queue, token=None):
+    with self.condition:
+      self.pending.setdefault(utils.SmartStr(queue), time.time())
+      self.condition.notify_all()
+
+    stats.STATS.IncrementCounter("wakeup_channel_signals")
+
+  def Wait(self, queues, timeout, token=None):
+    queue_names = [utils.SmartStr(queue) for queue in queues]
+    deadline = time.time() + timeout
+
+    with self.condition:
+      while True:
+        notified_at = [self.pending.pop(name) for name in queue_names
+                       if name in self.pending]
+        if notified_at:
+          return min(notified_at)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return None
+
+        self.condition.wait(remaining)
+
+
+class LocalSocketWakeupChannel(WakeupChannel):
+  """Signals workers running on the same host using unix datagram sockets.
+
+  Every waiting process binds a socket in Worker.wakeup_socket_dir. Notify()
+  sends a short datagram with the queue name and the current time to all the
+  sockets in this directory. If no worker runs on this host, signals are
+  simply dropped and workers fall back to polling.
+  """
+
+  SOCKET_EXTENSION = ".sock"
+
+  def __init__(self):
+    super(LocalSocketWakeupChannel, self).__init__()
+    self.socket_dir = config_lib.CONFIG["Worker.wakeup_socket_dir"]
+    self.lock = threading.Lock()
+    self.sock = None
+    self.socket_path = None
+
+  def _GetListeningSocket(self):
+    """Binds the socket of this process, returns None on failure."""
+    with self.lock:
+      if self.sock is None:
+        path = os.path.join(self.socket_dir, "%d.%d%s" % (
+            os.getpid(), id(self), self.SOCKET_EXTENSION))
+        try:
+          if not os.path.isdir(self.socket_dir):
+            os.makedirs(self.socket_dir)
+        except OSError:
+          # Directory was created after the check.
+          pass
+
+        try:
+          if os.path.exists(path):
+            os.unlink(path)
+          sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+          sock.bind(path)
+        except (OSError, socket.error) as e:
+          logging.warning("Unable to bind wakeup socket %s: %s", path, e)
+          return None
+
+        self.sock = sock
+        self.socket_path = path
+
+      return self.sock
+
+  def Notify(self, queue, token=None):
+    try:
+      names = os.listdir(self.socket_dir)
+    except OSError:
+      # Nobody is listening on this host.
+      return
+
+    message = "%s %f" % (utils.SmartStr(queue), time.time())
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sender.setblocking(False)
+    try:
+      for name in names:
+        if not name.endswith(self.SOCKET_EXTENSION):
+          continue
+
+        path = os.path.join(self.socket_dir, name)
+        try:
+          sender.sendto(message, path)
+        except socket.error as e:
+          if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            # The socket belongs to a process which is gone.
+            try:
+              os.unlink(path)
+            except OSError:
+              pass
+          # If the receiver's buffer is full (EAGAIN) it already has pending
+          # signals so there is nothing to do.
+    finally:
+      sender.close()
+
+    stats.STATS.IncrementCounter("wakeup_channel_signals")
+
+  def Wait(self, queues, timeout, token=None):
+    sock = self._GetListeningSocket()
+    if sock is None:
+      return super(LocalSocketWakeupChannel, self).Wait(queues, timeout,
+                                                        token=token)
+
+    queue_names = set(utils.SmartStr(queue) for queue in queues)
+    deadline = time.time() + timeout
+    notified_at = None
+
+    while True:
+      if notified_at is None:
+        remaining = max(0, deadline - time.time())
+      else:
+        # We got a signal, just drain the ones that are already queued.
+        remaining = 0
+
+      readable, _, _ = select.select([sock], [], [], remaining)
+      if not readable:
+        return notified_at
+
+      data = sock.recv(4096)
+      try:
+        queue_name, timestamp = data.rsplit(" ", 1)
+        timestamp = float(timestamp)
+      except ValueError:
+        continue
+
+      if queue_name in queue_names:
+        if notified_at is None or timestamp < notified_at:
+          notified_at = timestamp
+
+  def __del__(self):
+    if self.sock is not None:
+      self.sock.close()
+      try:
+        os.unlink(self.socket_path)
+      except OSError:
+        pass
+
+
+class DataStoreWakeupChannel(WakeupChannel):
+  """Signals workers through a timestamp stored in the data store.
+
+  Notify() writes the current time into a single cell per queue, Wait() polls
+  this cell. This works across hosts and is a lot cheaper than scanning all
+  the notification shards of a queue.
+  """
+
+  WAKEUP_ATTRIBUTE = "metadata:last_notified"
+
+  def __init__(self):
+    super(DataStoreWakeupChannel, self).__init__()
+    self.poll_interval = config_lib.CONFIG["Worker.wakeup_poll_interval"]
+    # The last signal seen for each queue.
+    self.last_seen = {}
+
+  def _GetSubject(self, queue):
+    return utils.SmartStr(queue) + "/Wakeup"
+
+  def _GetLastNotified(self, queue, token=None):
+    value, _ = data_store.DB.Resolve(self._GetSubject(queue),
+                                     self.WAKEUP_ATTRIBUTE, token=token)
+    if value is None:
+      return 0
+    return int(value)
+
+  def Notify(self, queue, token=None):
+    data_store.DB.Set(self._GetSubject(queue), self.WAKEUP_ATTRIBUTE,
+                      int(time.time() * 1e6), replace=True, sync=False,
+                      token=token)
+    stats.STATS.IncrementCounter("wakeup_channel_signals")
+
+  def Wait(self, queues, timeout, token=None):
+    deadline = time.time() + timeout
+
+    while True:
+      notified_at = []
+      for queue in queues:
+        queue_name = utils.SmartStr(queue)
+        last_notified = self._GetLastNotified(queue, token=token)
+        previous = self.last_seen.get(queue_name)
+        self.last_seen[queue_name] = last_notified
+        # The first read only establishes the baseline.
+        if previous is not None and last_notified > previous:
+          notified_at.append(last_notified / 1e6)
+
+      if notified_at:
+        return min(notified_at)
+
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return None
+
+      time.sleep(min(self.poll_interval, remaining))
+
+
+CHANNEL = None
+
+
+class WakeupChannelInit(registry.InitHook):
+  """Init hook class for the wakeup channel."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("wakeup_channel_signals")
+
+    global CHANNEL  # pylint: disable=global-statement
+
+    channel_name = config_lib.CONFIG["Worker.wakeup_channel"]
+    channel_cls = WakeupChannel.classes[channel_name]
+
+    CHANNEL = channel_cls()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Tests for the worker wakeup channels."""
+
+
+import os
+import threading
+import time
+
+from grr.lib import flags
+from grr.lib import queue_manager
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib import wakeup_channel
+from grr.lib.rdfvalues import flows as rdf_flows
+
+
+class WakeupChannelTestMixin(object):
+  """Tests common to all the wakeup channels."""
+
+  def CreateChannel(self):
+    raise NotImplementedError()
+
+  def setUp(self):
+    super(WakeupChannelTestMixin, self).setUp()
+    self.queue = rdfvalue.RDFURN("W")
+    self.channel = self.CreateChannel()
+    # Channels may need a first Wait() call to start listening.
+    self.channel.Wait([self.queue], 0, token=self.token)
+
+  def testWaitTimesOutWithoutSignal(self):
+    self.assertIsNone(self.channel.Wait([self.queue], 0.1, token=self.token))
+
+  def testSignalledQueueIsWokenUp(self):
+    before = time.time()
+    self.channel.Notify(self.queue, token=self.token)
+
+    notified_at = self.channel.Wait([self.queue], 5, token=self.token)
+    self.assertIsNotNone(notified_at)
+    self.assertGreaterEqual(notified_at, before - 1)
+
+  def testOtherQueuesAreNotWokenUp(self):
+    self.channel.Notify(rdfvalue.RDFURN("DEBUG"), token=self.token)
+    self.assertIsNone(self.channel.Wait([self.queue], 0.1, token=self.token))
+
+
+class InProcessWakeupChannelTest(WakeupChannelTestMixin, test_lib.GRRBaseTest):
+  """Tests for the InProcessWakeupChannel."""
+
+  def CreateChannel(self):
+    return wakeup_channel.InProcessWakeupChannel()
+
+  def testWaitReturnsAsSoonAsSignalled(self):
+    timer = threading.Timer(0.1, self.channel.Notify, args=(self.queue,))
+    timer.start()
+    start = time.time()
+    try:
+      self.assertIsNotNone(self.channel.Wait([self.queue], 10))
+    finally:
+      timer.cancel()
+
+    self.assertLess(time.time() - start, 5)
+
+
+class LocalSocketWakeupChannelTest(WakeupChannelTestMixin,
+                                   test_lib.GRRBaseTest):
+  """Tests for the LocalSocketWakeupChannel."""
+
+  def CreateChannel(self):
+    with test_lib.ConfigOverrider({
+        "Worker.wakeup_socket_dir": os.path.join(self.temp_dir, "wakeup")}):
+      return wakeup_channel.LocalSocketWakeupChannel()
+
+  def testStaleSocketsAreRemoved(self):
+    stale_path = os.path.join(self.channel.socket_dir, "1.1.sock")
+    open(stale_path, "w").close()
+
+    self.channel.Notify(self.queue, token=self.token)
+    self.assertFalse(os.path.exists(stale_path))
+    self.assertIsNotNone(self.channel.Wait([self.queue], 5, token=self.token))
+
+
+class DataStoreWakeupChannelTest(WakeupChannelTestMixin, test_lib.GRRBaseTest):
+  """Tests for the DataStoreWakeupChannel."""
+
+  def CreateChannel(self):
+    with test_lib.ConfigOverrider({"Worker.wakeup_poll_interval": 0.01}):
+      return wakeup_channel.DataStoreWakeupChannel()
+
+
+class QueueManagerWakeupTest(test_lib.GRRBaseTest):
+  """Checks that the queue manager signals new notifications."""
+
+  def setUp(self):
+    super(QueueManagerWakeupTest, self).setUp()
+    self.channel = wakeup_channel.InProcessWakeupChannel()
+    self.stubber = utils.Stubber(wakeup_channel, "CHANNEL", self.channel)
+    self.stubber.Start()
+
+  def tearDown(self):
+    super(QueueManagerWakeupTest, self).tearDown()
+    self.stubber.Stop()
+
+  def testMultiNotifyQueueSignalsQueue(self):
+    session_id = rdfvalue.SessionID(flow_name="123456")
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.MultiNotifyQueue([rdf_flows.GrrNotification(session_id=session_id)])
+
+    self.assertIsNotNone(self.channel.Wait([session_id.Queue()], 0))
+
+  def testFutureNotificationsAreNotSignalled(self):
+    session_id = rdfvalue.SessionID(flow_name="123456")
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.MultiNotifyQueue(
+        [rdf_flows.GrrNotification(session_id=session_id)],
+        timestamp=rdfvalue.RDFDatetime().Now() + rdfvalue.Duration("1h"))
+
+    self.assertIsNone(self.channel.Wait([session_id.Queue()], 0))
+
+  def testFlushSignalsQueuedNotifications(self):
+    session_id = rdfvalue.SessionID(flow_name="123456")
+    with queue_manager.QueueManager(token=self.token) as manager:
+      manager.QueueNotification(session_id=session_id)
+      self.assertIsNone(self.channel.Wait([session_id.Queue()], 0))
+
+    self.assertIsNotNone(self.channel.Wait([session_id.Queue()], 0))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -24,6 +24,7 @@ from grr.lib import server_stubs
 from grr.lib import stats
 from grr.lib import threadpool
 from grr.lib import utils
+from grr.lib import wakeup_channel
 from grr.lib.rdfvalues import flows as rdf_flows
 
 
@@ -47,6 +48,9 @@ class GRRWorker(object):
   # target maximum time to spend on RunOnce
   RUN_ONCE_MAX_SECONDS = 300
 
+  # How often (sec) the throughput gauges are updated.
+  THROUGHPUT_INTERVAL = 60
+
   # A class global threadpool to be used for all workers.
   thread_pool = None
 
@@ -54,6 +58,10 @@ class GRRWorker(object):
   # failure on a flow, it will not attempt to grab this flow until the timeout.
   queued_flows = None
 
+  # The notification shards this worker reads, None for all of them. Set by
+  # the worker supervisor when running several workers on a host.
+  notification_shards = None
+
   def __init__(self, queues=queues_config.WORKER_LIST,
                threadpool_prefix="grr_threadpool",
                threadpool_size=None, token=None):
@@ -87,15 +95,27 @@ class GRRWorker(object):
 
     self.token = token
     self.last_active = 0
+    # Round robin counters over the notification shards, keyed by queue.
+    self.shard_counters = {}
 
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
     self.flow_lease_time = config_lib.CONFIG["Worker.flow_lease_time"]
     self.well_known_flow_lease_time = config_lib.CONFIG[
         "Worker.well_known_flow_lease_time"]
+    self.flow_batch_size = config_lib.CONFIG["Worker.flow_batch_size"]
+
+    # Counter values at the start of the current throughput interval.
+    self.throughput_start = time.time()
+    self.throughput_flows = stats.STATS.GetMetricValue(
+        "worker_flows_processed")
+    self.throughput_messages = stats.STATS.GetMetricValue(
+        "grr_worker_responses_processed")
 
   def Run(self):
     """Event loop."""
+    # The time the last wakeup signal was sent.
+    notified_at = None
     try:
       while 1:
         if master.MASTER_WATCHER.IsMaster():
@@ -103,6 +123,15 @@ class GRRWorker(object):
         else:
           processed = 0
 
+        self.UpdateThroughputStats()
+
+        if notified_at is not None:
+          if processed:
+            # RunOnce() has handed the signalled flows to the thread pool.
+            stats.STATS.RecordEvent("worker_notify_to_dispatch_latency",
+                                    max(0, time.time() - notified_at))
+          notified_at = None
+
         if processed == 0:
           logger = logging.getLogger()
           for h in logger.handlers:
@@ -113,7 +142,12 @@ class GRRWorker(object):
           else:
             interval = self.SHORT_POLLING_INTERVAL
 
-          time.sleep(interval)
+          # Block until new notifications are signalled, the polling interval
+          # is only used as a timeout in case a signal got lost.
+          notified_at = wakeup_channel.CHANNEL.Wait(self.queues, interval,
+                                                    token=self.token)
+          if notified_at is not None:
+            stats.STATS.IncrementCounter("worker_wakeups")
         else:
           self.last_active = time.time()
 
@@ -140,8 +174,17 @@ class GRRWorker(object):
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
-      notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+      shards = self.notification_shards
+      if shards is None:
+        notifications_by_priority = queue_manager.GetNotificationsByPriority(
+            queue)
+      elif shards:
+        counter = self.shard_counters.get(queue, 0)
+        self.shard_counters[queue] = counter + 1
+        notifications_by_priority = queue_manager.GetNotificationsByPriority(
+            queue, shard_index=shards[counter % len(shards)])
+      else:
+        notifications_by_priority = {}
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -188,6 +231,24 @@ class GRRWorker(object):
         return processed
     return processed
 
+  def UpdateThroughputStats(self):
+    """Updates the flows and messages per second gauges of this worker."""
+    now = time.time()
+    elapsed = now - self.throughput_start
+    if elapsed < self.THROUGHPUT_INTERVAL:
+      return
+
+    flows = stats.STATS.GetMetricValue("worker_flows_processed")
+    messages = stats.STATS.GetMetricValue("grr_worker_responses_processed")
+    stats.STATS.SetGaugeValue("worker_flows_per_second",
+                              (flows - self.throughput_flows) / elapsed)
+    stats.STATS.SetGaugeValue("worker_messages_per_second",
+                              (messages - self.throughput_messages) / elapsed)
+
+    self.throughput_start = now
+    self.throughput_flows = flows
+    self.throughput_messages = messages
+
   def ProcessStuckFlows(self, stuck_flows, queue_manager):
     stats.STATS.IncrementCounter("grr_flows_stuck", len(stuck_flows))
 
@@ -225,6 +286,7 @@ class GRRWorker(object):
     """
     now = time.time()
     processed = 0
+    batch = []
     for notification in active_notifications:
       if notification.session_id not in self.queued_flows:
         if time_limit and time.time() - now > time_limit:
@@ -232,13 +294,32 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
+
+        # Regular flows are leased and processed in batches if configured.
+        if (self.flow_batch_size and
+            notification.session_id.FlowName() not in self.well_known_flows):
+          batch.append(notification)
+          if len(batch) >= self.flow_batch_size:
+            self._QueueFlowBatch(batch, queue_manager)
+            batch = []
+          continue
+
         self.thread_pool.AddTask(target=self._ProcessMessages,
                                  args=(notification,
                                        queue_manager.Copy()),
                                  name=self.__class__.__name__)
 
+    if batch:
+      self._QueueFlowBatch(batch, queue_manager)
+
     return processed
 
+  def _QueueFlowBatch(self, notifications, queue_manager):
+    stats.STATS.RecordEvent("worker_flow_batch_size", len(notifications))
+    self.thread_pool.AddTask(target=self._ProcessFlowBatch,
+                             args=(notifications, queue_manager.Copy()),
+                             name=self.__class__.__name__)
+
   def _ProcessRegularFlowMessages(self, flow_obj, notification):
     """Processes messages for a given flow."""
     session_id = notification.session_id
@@ -347,18 +428,14 @@ class GRRWorker(object):
           responses = flow_obj.FetchAndRemoveRequestsAndResponses(session_id)
 
         flow_obj.ProcessResponses(responses, self.thread_pool)
+        stats.STATS.IncrementCounter("grr_worker_responses_processed",
+                                     len(responses))
 
       else:
         with flow_obj:
           self._ProcessRegularFlowMessages(flow_obj, notification)
 
-      elapsed = time.time() - now
-      logging.debug("Done processing %s: %s sec", session_id, elapsed)
-      stats.STATS.RecordEvent("worker_flow_processing_time", elapsed,
-                              fields=[flow_obj.Name()])
-
-      # Everything went well -> session can be run again.
-      self.queued_flows.ExpireObject(session_id)
+      self._FlowProcessed(flow_obj, session_id, now)
 
     except aff4.LockError:
       # Another worker is dealing with this flow right now, we just skip it.
@@ -383,6 +460,87 @@ class GRRWorker(object):
                                    fields=[str(type(e))])
       queue_manager.DeleteNotification(session_id)
 
+  def _FlowProcessed(self, flow_obj, session_id, start_time):
+    elapsed = time.time() - start_time
+    logging.debug("Done processing %s: %s sec", session_id, elapsed)
+    stats.STATS.RecordEvent("worker_flow_processing_time", elapsed,
+                            fields=[flow_obj.Name()])
+    stats.STATS.IncrementCounter("worker_flows_processed")
+
+    # Everything went well -> session can be run again.
+    self.queued_flows.ExpireObject(session_id)
+
+  def _ProcessFlowBatch(self, notifications, queue_manager):
+    """Leases and processes a batch of regular flows together.
+
+    The flows are locked without blocking and read in one go. All their
+    completed requests and responses are then prefetched with two
+    MultiResolvePrefix calls before the flows are run one after the other.
+    Flows we could not lock or open this way, or did not get to because the
+    batch failed, are handed to _ProcessMessages(), which deals with them as
+    usual.
+
+    Args:
+      notifications: The notifications for the flows to process.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+    """
+    notifications = dict((utils.SmartStr(notification.session_id),
+                          notification) for notification in notifications)
+    locked = []
+
+    try:
+      for flow_obj in aff4.FACTORY.MultiOpenWithLock(
+          [notification.session_id
+           for notification in notifications.itervalues()],
+          lease_time=self.flow_lease_time, token=self.token):
+        locked.append((flow_obj,
+                       notifications.pop(utils.SmartStr(flow_obj.urn))))
+
+      logging.debug("Got lock on %d flows", len(locked))
+
+      with queue_manager.PrefetchFlowStates(
+          [notification for _, notification in locked]):
+        while locked:
+          flow_obj, notification = locked.pop(0)
+          self._ProcessLockedFlow(flow_obj, notification, queue_manager)
+
+    except Exception as e:    # pylint: disable=broad-except
+      # The notifications of flows we did not get to are still in place, we
+      # release their locks and process them one by one below.
+      logging.exception("Error processing flow batch: %s", e)
+      stats.STATS.IncrementCounter("worker_session_errors",
+                                   fields=[str(type(e))])
+      for flow_obj, notification in locked:
+        flow_obj.transaction.Abort()
+        notifications[utils.SmartStr(flow_obj.urn)] = notification
+
+    for notification in notifications.itervalues():
+      self._ProcessMessages(notification, queue_manager)
+
+  def _ProcessLockedFlow(self, flow_obj, notification, queue_manager):
+    """Processes a regular flow we hold the lock on."""
+    session_id = notification.session_id
+
+    try:
+      now = time.time()
+      with flow_obj:
+        # We own the flow now, see _ProcessMessages().
+        queue_manager.DeleteNotification(session_id,
+                                         end=notification.timestamp)
+        self._ProcessRegularFlowMessages(flow_obj, notification)
+
+      self._FlowProcessed(flow_obj, session_id, now)
+
+    except FlowProcessingError:
+      pass
+
+    except Exception as e:    # pylint: disable=broad-except
+      logging.exception("Error processing session %s: %s", session_id, e)
+      stats.STATS.IncrementCounter("worker_session_errors",
+                                   fields=[str(type(e))])
+      queue_manager.DeleteNotification(session_id)
+
 
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
@@ -403,3 +561,11 @@ class WorkerInit(registry.InitHook):
     stats.STATS.RegisterEventMetric("worker_flow_processing_time",
                                     fields=[("flow", str)])
     stats.STATS.RegisterEventMetric("worker_time_to_retrieve_notifications")
+    stats.STATS.RegisterCounterMetric(
+        "worker_wakeups", docstring="Wakeups of idle workers by a signal.")
+    stats.STATS.RegisterEventMetric("worker_notify_to_dispatch_latency")
+    stats.STATS.RegisterCounterMetric("worker_flows_processed")
+    stats.STATS.RegisterGaugeMetric("worker_flows_per_second", float)
+    stats.STATS.RegisterGaugeMetric("worker_messages_per_second", float)
+    stats.STATS.RegisterEventMetric("worker_flow_batch_size",
+                                    bins=[1, 2, 5, 10, 20, 50, 100, 200, 500])
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""Runs several worker processes on one host, each on its own queue shards.
+
+A single GRRWorker is bound to one core by the GIL, and since every worker
+round robins over all the notification shards of its queues, workers started
+side by side keep contending for the same notifications. The supervisor starts
+Worker.processes worker processes and splits the notification shards among
+them. When a child dies its shards are handed to the remaining children until
+it has been replaced. The children report their stats to the supervisor,
+which adds them up in its own process so the usual stats exports cover all
+the workers on the host.
+
+Children are started by running the same command line again with
+--worker_child. They read their shard assignments as JSON lines from stdin
+and write stats reports as JSON lines to the stdout they were started with.
+"""
+
+
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+import thread
+import time
+
+
+import logging
+
+from grr.lib import config_lib
+from grr.lib import registry
+from grr.lib import stats
+
+
+def AssignShards(num_shards, slots):
+  """Splits the notification shards round robin between worker slots.
+
+  Args:
+    num_shards: The number of notification shards of each queue.
+    slots: A list of the slots of the running children.
+
+  Returns:
+    A dict mapping each slot to a list of shard indexes.
+  """
+  result = dict((slot, []) for slot in slots)
+  for shard in range(num_shards):
+    result[slots[shard % len(slots)]].append(shard)
+
+  return result
+
+
+def GetStatsReport():
+  """Returns the values of the counters and numeric gauges of this process."""
+  report = {"counters": [], "gauges": []}
+  for name, metadata in stats.STATS.GetAllMetricsMetadata().iteritems():
+    if metadata.metric_type == stats.MetricType.COUNTER:
+      kind = "counters"
+    elif (metadata.metric_type == stats.MetricType.GAUGE and
+          metadata.value_type != stats.MetricMetadata.ValueType.STR):
+      kind = "gauges"
+    else:
+      continue
+
+    if metadata.fields_defs:
+      for fields in stats.STATS.GetMetricFields(name):
+        report[kind].append(
+            [name, list(fields),
+             stats.STATS.GetMetricValue(name, fields=list(fields))])
+    else:
+      report[kind].append([name, None, stats.STATS.GetMetricValue(name)])
+
+  return report
+
+
+class ChildWorker(object):
+  """A worker process started by the supervisor."""
+
+  def __init__(self, slot, process):
+    self.slot = slot
+    self.process = process
+    self.started = time.time()
+    self.shards = None
+
+    # The last reported values, keyed by (metric name, fields).
+    self.counters = {}
+    self.gauges = {}
+    self._buffer = ""
+
+  def SendShards(self, shards):
+    """Tells the child which notification shards to work on."""
+    if shards == self.shards:
+      return
+
+    try:
+      self.process.stdin.write(json.dumps({"shards": shards}) + "\n")
+      self.process.stdin.flush()
+      self.shards = shards
+    except IOError as e:
+      # The child is going away, we will notice when it exits.
+      logging.warn("Could not send shards to worker %d: %s", self.slot, e)
+
+  def ReadReports(self):
+    """Returns the reports the child has written since we last looked."""
+    try:
+      data = os.read(self.process.stdout.fileno(), 65536)
+    except OSError:
+      return []
+
+    self._buffer += data
+    lines = self._buffer.split("\n")
+    self._buffer = lines.pop()
+
+    reports = []
+    for line in lines:
+      try:
+        reports.append(json.loads(line))
+      except ValueError:
+        logging.warn("Bad stats report from worker %d: %r", self.slot, line)
+
+    return reports
+
+
+class WorkerSupervisor(object):
+  """Starts and watches the worker processes of a host."""
+
+  # How long (sec) to wait for reports before checking on the children.
+  POLL_INTERVAL = 1
+
+  # Children dying sooner than this (sec) after starting are restarted only
+  # after RESTART_DELAY to avoid spinning on a broken setup.
+  MIN_RUN_TIME = 60
+  RESTART_DELAY = 10
+
+  def __init__(self, num_processes, num_shards=None, command=None):
+    """Constructor.
+
+    Args:
+      num_processes: The number of worker processes to run.
+      num_shards: The number of notification shards of the queues, defaults
+                  to Worker.queue_shards.
+      command: The command line starting a child, defaults to this process'
+               command line with --worker_child added.
+    """
+    if num_shards is None:
+      num_shards = config_lib.CONFIG["Worker.queue_shards"]
+
+    if num_processes > num_shards:
+      logging.warn("Only running %d workers, one per notification shard.",
+                   num_shards)
+      num_processes = num_shards
+
+    self.num_processes = num_processes
+    self.num_shards = num_shards
+
+    if command is None:
+      # The supervisor writes the stats of all its children, they must not
+      # write them as well.
+      command = [sys.executable] + sys.argv + [
+          "--worker_child", "--parameter", "StatsStore.process_id="]
+    self.command = command
+
+    # Running children keyed by slot.
+    self.children = {}
+    # Maps slots of dead children to the time they are restarted.
+    self.pending_restarts = {}
+
+  def StartChild(self, slot):
+    process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    self.children[slot] = ChildWorker(slot, process)
+    logging.info("Started worker %d (pid %d).", slot, process.pid)
+
+  def Rebalance(self):
+    """Splits the shards between the running children."""
+    if not self.children:
+      return
+
+    assignment = AssignShards(self.num_shards, sorted(self.children))
+    for slot, child in self.children.iteritems():
+      child.SendShards(assignment[slot])
+
+    stats.STATS.SetGaugeValue("worker_supervisor_children", len(self.children))
+
+  def UpdateStats(self, child, report):
+    """Adds a child's report to the stats of this process."""
+    for name, fields, value in report.get("counters", []):
+      key = (name, tuple(fields or ()))
+      delta = value - child.counters.get(key, 0)
+      child.counters[key] = value
+      if delta > 0:
+        try:
+          stats.STATS.IncrementCounter(name, delta, fields=fields)
+        except KeyError:
+          # Metrics only registered by the children are not exported.
+          pass
+
+    for name, fields, value in report.get("gauges", []):
+      child.gauges[(name, tuple(fields or ()))] = value
+
+    self._UpdateGauges()
+
+  def _UpdateGauges(self):
+    """Sets each gauge to the sum of the values reported by the children."""
+    totals = {}
+    for child in self.children.itervalues():
+      for key, value in child.gauges.iteritems():
+        totals[key] = totals.get(key, 0) + value
+
+    for (name, fields), value in totals.iteritems():
+      try:
+        stats.STATS.SetGaugeValue(name, value, fields=list(fields) or None)
+      except (KeyError, ValueError):
+        pass
+
+  def _ChildExited(self, child):
+    del self.children[child.slot]
+    stats.STATS.IncrementCounter("worker_supervisor_child_exits")
+    logging.error("Worker %d (pid %d) exited with status %s.", child.slot,
+                  child.process.pid, child.process.returncode)
+
+    # Its gauges no longer count.
+    self._UpdateGauges()
+
+    now = time.time()
+    if now - child.started < self.MIN_RUN_TIME:
+      self.pending_restarts[child.slot] = now + self.RESTART_DELAY
+    else:
+      self.pending_restarts[child.slot] = now
+
+  def RunOnce(self):
+    """Collects reports, replaces dead children and rebalances the shards."""
+    children = dict((child.process.stdout.fileno(), child)
+                    for child in self.children.itervalues())
+    if children:
+      readable, _, _ = select.select(children, [], [], self.POLL_INTERVAL)
+      for fd in readable:
+        child = children[fd]
+        for report in child.ReadReports():
+          self.UpdateStats(child, report)
+    else:
+      time.sleep(self.POLL_INTERVAL)
+
+    changed = False
+    for child in self.children.values():
+      if child.process.poll() is not None:
+        self._ChildExited(child)
+        changed = True
+
+    now = time.time()
+    for slot, restart_time in self.pending_restarts.items():
+      if restart_time <= now:
+        del self.pending_restarts[slot]
+        stats.STATS.IncrementCounter("worker_supervisor_restarts")
+        self.StartChild(slot)
+        changed = True
+
+    if changed:
+      self.Rebalance()
+
+  def Run(self):
+    for slot in range(self.num_processes):
+      self.StartChild(slot)
+    self.Rebalance()
+
+    try:
+      while True:
+        self.RunOnce()
+    except KeyboardInterrupt:
+      logging.info("Caught interrupt, stopping workers.")
+    finally:
+      self.Stop()
+
+  def Stop(self):
+    for child in self.children.itervalues():
+      # Closing stdin tells the child to exit.
+      try:
+        child.process.stdin.close()
+      except IOError:
+        pass
+
+    for child in self.children.itervalues():
+      child.process.wait()
+
+    self.children = {}
+
+
+class ChildWorkerRunner(object):
+  """Runs a GRRWorker as a child of the supervisor."""
+
+  # How often (sec) stats are reported to the supervisor.
+  REPORT_INTERVAL = 10
+
+  def __init__(self, worker_obj, control=None, report_fd=None):
+    """Constructor.
+
+    Args:
+      worker_obj: The GRRWorker to run.
+      control: The file shard assignments are read from, defaults to stdin.
+      report_fd: The file descriptor reports are written to. Defaults to
+                 stdout, which is then pointed at stderr so nothing else
+                 ends up in the reports.
+    """
+    self.worker = worker_obj
+    self.control = control or sys.stdin
+
+    if report_fd is None:
+      report_fd = os.dup(sys.stdout.fileno())
+      os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    self.report_fd = report_fd
+
+  def ReadShards(self):
+    """Applies the next shard assignment, returns False once we should exit."""
+    line = self.control.readline()
+    if not line:
+      return False
+
+    self.worker.notification_shards = json.loads(line)["shards"]
+    logging.info("Working on notification shards %s.",
+                 self.worker.notification_shards)
+    return True
+
+  def _ControlLoop(self):
+    while self.ReadShards():
+      pass
+
+    # The supervisor stopped us or went away.
+    thread.interrupt_main()
+
+  def SendReport(self):
+    os.write(self.report_fd, json.dumps(GetStatsReport()) + "\n")
+
+  def _ReportLoop(self):
+    while True:
+      time.sleep(self.REPORT_INTERVAL)
+      try:
+        self.SendReport()
+      except OSError:
+        thread.interrupt_main()
+        return
+
+  def Run(self):
+    # Don't touch any notifications before we know our shards.
+    if not self.ReadShards():
+      return
+
+    for target in (self._ControlLoop, self._ReportLoop):
+      control_thread = threading.Thread(target=target)
+      control_thread.daemon = True
+      control_thread.start()
+
+    self.worker.Run()
+
+
+class WorkerSupervisorInit(registry.InitHook):
+  """Registers the supervisor stats."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterGaugeMetric("worker_supervisor_children", int)
+    stats.STATS.RegisterCounterMetric("worker_supervisor_child_exits")
+    stats.STATS.RegisterCounterMetric("worker_supervisor_restarts")
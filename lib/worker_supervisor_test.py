@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Tests for the worker supervisor."""
+
+
+import json
+import os
+import StringIO
+import time
+
+from grr.lib import flags
+from grr.lib import stats
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib import worker_supervisor
+
+
+class FakeProcess(object):
+  """Stands in for the subprocess.Popen of a child."""
+
+  pid = 1234
+
+  def __init__(self):
+    self.returncode = None
+    self.stdin = StringIO.StringIO()
+    read_fd, self.report_fd = os.pipe()
+    self.stdout = os.fdopen(read_fd, "rb")
+
+  def poll(self):
+    return self.returncode
+
+  def wait(self):
+    return self.returncode
+
+  def SentShards(self):
+    return json.loads(self.stdin.getvalue().splitlines()[-1])["shards"]
+
+
+class FakeWorker(object):
+  notification_shards = None
+
+
+class WorkerSupervisorTest(test_lib.GRRBaseTest):
+  """Tests the worker supervisor."""
+
+  def setUp(self):
+    super(WorkerSupervisorTest, self).setUp()
+    self.supervisor = worker_supervisor.WorkerSupervisor(3, num_shards=5,
+                                                         command=["true"])
+    self.processes = []
+
+    def StartChild(slot):
+      process = FakeProcess()
+      self.processes.append(process)
+      self.supervisor.children[slot] = worker_supervisor.ChildWorker(slot,
+                                                                     process)
+
+    self.stubber = utils.MultiStubber(
+        (self.supervisor, "StartChild", StartChild),
+        (self.supervisor, "POLL_INTERVAL", 0))
+    self.stubber.Start()
+
+  def tearDown(self):
+    super(WorkerSupervisorTest, self).tearDown()
+    self.stubber.Stop()
+    for process in self.processes:
+      os.close(process.report_fd)
+      process.stdout.close()
+
+  def testAssignShards(self):
+    assignment = worker_supervisor.AssignShards(5, [0, 2, 3])
+    self.assertEqual(assignment, {0: [0, 3], 2: [1, 4], 3: [2]})
+
+  def testNoMoreChildrenThanShards(self):
+    supervisor = worker_supervisor.WorkerSupervisor(8, num_shards=5,
+                                                    command=["true"])
+    self.assertEqual(supervisor.num_processes, 5)
+
+  def testShardsAreRebalancedWhenAChildDies(self):
+    for slot in range(3):
+      self.supervisor.StartChild(slot)
+    self.supervisor.Rebalance()
+
+    shards = [process.SentShards() for process in self.processes]
+    self.assertEqual(sorted(sum(shards, [])), range(5))
+
+    self.processes[1].returncode = 1
+    self.supervisor.RunOnce()
+
+    # The survivors take over the shards until the child is restarted.
+    self.assertEqual(sorted(self.supervisor.children), [0, 2])
+    self.assertEqual(sorted(self.processes[0].SentShards() +
+                            self.processes[2].SentShards()), range(5))
+    self.assertEqual(self.supervisor.pending_restarts.keys(), [1])
+
+    self.supervisor.pending_restarts[1] = time.time()
+    self.supervisor.RunOnce()
+
+    self.assertEqual(sorted(self.supervisor.children), [0, 1, 2])
+    self.assertEqual(self.processes[3].SentShards(), shards[1])
+
+  def testChildStatsAreAddedUp(self):
+    for slot in range(2):
+      self.supervisor.StartChild(slot)
+
+    flows_processed = stats.STATS.GetMetricValue("worker_flows_processed")
+
+    for value, process in zip([3, 4], self.processes):
+      os.write(process.report_fd, json.dumps({
+          "counters": [["worker_flows_processed", None, value]],
+          "gauges": [["worker_flows_per_second", None, value / 2.0]]}) + "\n")
+    self.supervisor.RunOnce()
+
+    self.assertEqual(stats.STATS.GetMetricValue("worker_flows_processed"),
+                     flows_processed + 7)
+    self.assertEqual(stats.STATS.GetMetricValue("worker_flows_per_second"),
+                     3.5)
+
+    # Reports carry totals, only the difference is added.
+    os.write(self.processes[0].report_fd, json.dumps({
+        "counters": [["worker_flows_processed", None, 5]],
+        "gauges": [["worker_flows_per_second", None, 1.0]]}) + "\n")
+    self.supervisor.RunOnce()
+
+    self.assertEqual(stats.STATS.GetMetricValue("worker_flows_processed"),
+                     flows_processed + 9)
+    self.assertEqual(stats.STATS.GetMetricValue("worker_flows_per_second"),
+                     3.0)
+
+    # A dead child's gauges no longer count.
+    self.processes[1].returncode = 1
+    self.supervisor.RunOnce()
+    self.assertEqual(stats.STATS.GetMetricValue("worker_flows_per_second"),
+                     1.0)
+
+  def testChildWorkerRunner(self):
+    report_path = os.path.join(self.temp_dir, "reports")
+    report_fd = os.open(report_path, os.O_WRONLY | os.O_CREAT)
+    worker_obj = FakeWorker()
+    runner = worker_supervisor.ChildWorkerRunner(
+        worker_obj, control=StringIO.StringIO('{"shards": [1, 3]}\n'),
+        report_fd=report_fd)
+
+    self.assertTrue(runner.ReadShards())
+    self.assertEqual(worker_obj.notification_shards, [1, 3])
+    self.assertFalse(runner.ReadShards())
+
+    stats.STATS.IncrementCounter("worker_flows_processed")
+    runner.SendReport()
+    os.close(report_fd)
+
+    with open(report_path, "rb") as fd:
+      report = json.loads(fd.read())
+    self.assertIn(["worker_flows_processed", None,
+                   stats.STATS.GetMetricValue("worker_flows_processed")],
+                  report["counters"])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -4,11 +4,19 @@
 
 # Range for consistent hashing.
 MAX_RANGE = 2 ** 64
+# Virtual nodes given to a data server for each unit of weight.
+VIRTUAL_NODES_PER_WEIGHT = 128
 
 # Important file names for rebalancing.
 REBALANCE_DIRECTORY = ".GRR_REBALANCE"
 TRANSACTION_FILENAME = ".TRANSACTION"
 REMOVE_FILENAME = ".TRANSACTION_REMOVE"
+# Writes to the moving ranges logged during an online rebalance.
+CHANGE_LOG_FILENAME = ".TRANSACTION_LOG"
+# Changes received from other data servers, applied when committing.
+CHANGES_FILENAME = ".TRANSACTION_CHANGES"
+# Copy of a database file taken while it is still being written to.
+SNAPSHOT_FILENAME = ".TRANSACTION_SNAPSHOT"
 
 # HTTP status codes.
 RESPONSE_OK = 200
@@ -33,3 +41,6 @@ RESPONSE_IS_MASTER_SERVER = 404
 RESPONSE_INCOMPLETE_SYNC = 503
 RESPONSE_DATA_SERVER_NOT_FOUND = 409
 RESPONSE_RANGE_NOT_EMPTY = 402
+RESPONSE_CHANGES_NOT_SAVED = 500
+RESPONSE_CHANGES_NOT_REPLAYED = 500
+RESPONSE_WRITES_NOT_FENCED = 503
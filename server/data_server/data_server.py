@@ -65,6 +65,8 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
   DATA_SERVER = None
   # Mapping information sent/created by the master.
   MAPPING = None
+  # rebalance.CopyProgress of the last rebalance this server copied files for.
+  REBALANCE_PROGRESS = None
   CMDTABLE = None
   # Nonce store used for authentication.
   NONCE_STORE = None
@@ -99,6 +101,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
         "/server/register": cls.HandleRegister,
         "/server/state": cls.HandleState,
         "/server/mapping": cls.HandleMapping,
+        "/server/vnodes": cls.HandleVirtualNodeLoad,
         "/client/start": cls.HandleDataStoreService,
         "/client/handshake": cls.HandleClientHandshake,
         "/client/mapping": cls.HandleMapping,
@@ -109,12 +112,18 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
         "/rebalance/commit": cls.HandleRebalanceCommit,
         "/rebalance/perform": cls.HandleRebalancePerform,
         "/rebalance/recover": cls.HandleRebalanceRecover,
+        "/rebalance/progress": cls.HandleRebalanceProgress,
+        "/rebalance/replay": cls.HandleRebalanceReplay,
+        "/rebalance/copy-changes": cls.HandleRebalanceCopyChanges,
+        "/rebalance/fence": cls.HandleRebalanceFence,
+        "/rebalance/abort": cls.HandleRebalanceAbort,
         "/servers/add/check": cls.HandleServerAddCheck,
         "/servers/add": cls.HandleServerAdd,
         "/servers/rem/check": cls.HandleServerRemCheck,
         "/servers/rem": cls.HandleServerRem,
         "/servers/sync": cls.HandleServerSync,
-        "/servers/sync-all": cls.HandleServerSyncAll
+        "/servers/sync-all": cls.HandleServerSyncAll,
+        "/servers/vnodes": cls.HandleServersVirtualNodeLoad
         }
 
     cls.STREAMING_TABLE = {
@@ -218,6 +227,12 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
           status=rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
       response = resp.SerializeToString()
 
+    if cmd.HasField("request_id"):
+      # Concatenated protobufs are merged when parsed, so the response can be
+      # tagged without decoding it again.
+      response += rdf_data_store.DataStoreResponse(
+          request_id=cmd.request_id).SerializeToString()
+
     return sutils.SIZE_PACKER.pack(len(response)) + response
 
   def HandleRegister(self):
@@ -345,6 +360,26 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     body = self.MAPPING.SerializeToString()
     self._Response(constants.RESPONSE_OK, body)
 
+  def HandleVirtualNodeLoad(self):
+    """Returns how much data this server holds for each virtual node."""
+    if not self.MAPPING:
+      self._EmptyResponse(constants.RESPONSE_MAPPING_NOT_FOUND)
+      return
+    load = rdf_data_server.DataServerMapping(
+        vnodes=rebalance.ComputeVirtualNodeLoad(self.MAPPING))
+    self._Response(constants.RESPONSE_OK, load.SerializeToString())
+
+  def HandleServersVirtualNodeLoad(self):
+    """Call master to report the load of each virtual node."""
+    if not self.MASTER:
+      return self._EmptyResponse(constants.RESPONSE_NOT_MASTER_SERVER)
+    if not self.MASTER.AllRegistered():
+      return self._EmptyResponse(constants.RESPONSE_DATA_SERVERS_UNREACHABLE)
+    load = self.MASTER.FetchVirtualNodeLoad()
+    if load is None:
+      return self._EmptyResponse(constants.RESPONSE_DATA_SERVERS_UNREACHABLE)
+    self._Response(constants.RESPONSE_OK, load.SerializeToString())
+
   def HandleManager(self):
     if not self.MASTER:
       self._EmptyResponse(constants.RESPONSE_NOT_MASTER_SERVER)
@@ -378,23 +413,92 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     self._Response(constants.RESPONSE_OK, body)
 
   def HandleRebalanceStatistics(self):
-    """Call data server to count how much data needs to move in rebalancing."""
+    """Call data server to count how much data needs to move in rebalancing.
+
+    Once the server started copying files for the rebalance, this reports how
+    far the copy is instead of walking the database again.
+    """
     reb = rdf_data_server.DataServerRebalance(self.post_data)
-    mapping = reb.mapping
-    index = 0
-    if not self.MASTER:
-      index = self.DATA_SERVER.Index()
-    moving = rebalance.ComputeRebalanceSize(mapping, index)
-    reb.moving.Append(moving)
+    progress = self.REBALANCE_PROGRESS
+    if progress and progress.rebalance_id == reb.id:
+      reb.moving.Append(progress.bytes_total)
+      reb.progress.Append(progress.GetProgress())
+    else:
+      mapping = reb.mapping
+      index = 0
+      if not self.MASTER:
+        index = self.DATA_SERVER.Index()
+      moving = rebalance.ComputeRebalanceSize(mapping, index)
+      reb.moving.Append(moving)
     body = reb.SerializeToString()
     self._Response(constants.RESPONSE_OK, body)
 
+  @classmethod
+  def SetRebalanceProgress(cls, progress):
+    cls.REBALANCE_PROGRESS = progress
+
+  def _GetChangeLog(self, reb):
+    """Returns the change log of the given rebalance, if any."""
+    change_log = self.SERVICE.change_log
+    if change_log and change_log.rebalance.id == reb.id:
+      return change_log
+    return None
+
+  def _StopChangeLog(self, committed):
+    change_log = self.SERVICE.change_log
+    if change_log:
+      self.SERVICE.change_log = None
+      change_log.Close(committed)
+
   def HandleRebalanceCopy(self):
+    """Call data server to copy its moving files to the other servers."""
     reb = rdf_data_server.DataServerRebalance(self.post_data)
     index = 0
     if not self.MASTER:
       index = self.DATA_SERVER.Index()
-    rebalance.CopyFiles(reb, index)
+    change_log = None
+    if reb.online:
+      # Keep accepting writes, but remember those that need to move.
+      self._StopChangeLog(False)
+      change_log = rebalance.ChangeLog(reb, index)
+      self.SERVICE.change_log = change_log
+    progress = rebalance.CopyProgress(reb, index, change_log=change_log)
+    self.SetRebalanceProgress(progress)
+    if not rebalance.CopyFiles(reb, index, progress=progress,
+                               change_log=change_log):
+      self._EmptyResponse(constants.RESPONSE_FILES_NOT_COPIED)
+      return
+    self._EmptyResponse(constants.RESPONSE_OK)
+
+  def HandleRebalanceReplay(self):
+    """Call data server to send the logged changes to the other servers."""
+    reb = rdf_data_server.DataServerRebalance(self.post_data)
+    change_log = self._GetChangeLog(reb)
+    if change_log and not change_log.Replay():
+      self._EmptyResponse(constants.RESPONSE_CHANGES_NOT_REPLAYED)
+      return
+    self._EmptyResponse(constants.RESPONSE_OK)
+
+  def HandleRebalanceCopyChanges(self):
+    if not rebalance.SaveChanges(self.post_data):
+      return self._EmptyResponse(constants.RESPONSE_CHANGES_NOT_SAVED)
+    self._EmptyResponse(constants.RESPONSE_OK)
+
+  def HandleRebalanceFence(self):
+    """Call data server to stop writes to the moving ranges."""
+    reb = rdf_data_server.DataServerRebalance(self.post_data)
+    change_log = self._GetChangeLog(reb)
+    if change_log and not change_log.Fence():
+      self._EmptyResponse(constants.RESPONSE_WRITES_NOT_FENCED)
+      return
+    self._EmptyResponse(constants.RESPONSE_OK)
+
+  def HandleRebalanceAbort(self):
+    """Call data server to stop logging changes for a canceled rebalance."""
+    reb = rdf_data_server.DataServerRebalance(self.post_data)
+    if self._GetChangeLog(reb):
+      self._StopChangeLog(False)
+      logging.info("Stopped logging changes for rebalance %s", reb.id)
     self._EmptyResponse(constants.RESPONSE_OK)
 
   def HandleRebalanceCopyFile(self):
@@ -413,6 +517,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       # Not the same ID.
       self._EmptyResponse(constants.RESPONSE_WRONG_TRANSACTION)
       return
+    current.online = reb.online
     if not self.MASTER.CopyRebalanceFiles():
       self._EmptyResponse(constants.RESPONSE_FILES_NOT_COPIED)
       return
@@ -438,10 +543,13 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
   def HandleRebalancePerform(self):
     """Call data server to perform rebalance transaction."""
     reb = rdf_data_server.DataServerRebalance(self.post_data)
-    if not rebalance.MoveFiles(reb, self.MASTER):
+    if not rebalance.MoveFiles(reb, self.MASTER, service=self.SERVICE):
       logging.critical("Failed to perform transaction %s", reb.id)
       self._EmptyResponse(constants.RESPONSE_FILES_NOT_MOVED)
       return
+    if self._GetChangeLog(reb):
+      # The moved ranges are no longer ours, lift the write fence.
+      self._StopChangeLog(True)
     # Update range of servers.
     # But only for regular data servers since the master is responsible for
     # starting the operation.
@@ -449,6 +557,8 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       for i, serv in enumerate(list(reb.mapping.servers)):
         self.MAPPING.servers[i].interval.start = serv.interval.start
         self.MAPPING.servers[i].interval.end = serv.interval.end
+        self.MAPPING.servers[i].weight = serv.weight
+      self.MAPPING.vnodes = list(reb.mapping.vnodes)
       self.DATA_SERVER.SetMapping(self.MAPPING)
     # Send back server state.
     stat = self.GetStatistics()
@@ -471,6 +581,23 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     body = reb.SerializeToString()
     self._Response(constants.RESPONSE_OK, body)
 
+  def HandleRebalanceProgress(self):
+    """Call master to report the progress of the current rebalance."""
+    if not self.MASTER:
+      self._EmptyResponse(constants.RESPONSE_NOT_MASTER_SERVER)
+      return
+    reb = rdf_data_server.DataServerRebalance(self.post_data)
+    current = self.MASTER.IsRebalancing()
+    if not current or current.id != reb.id:
+      # Not the same ID.
+      self._EmptyResponse(constants.RESPONSE_WRONG_TRANSACTION)
+      return
+    progress = self.MASTER.FetchRebalanceProgress()
+    if progress is None:
+      self._EmptyResponse(constants.RESPONSE_DATA_SERVERS_UNREACHABLE)
+      return
+    self._Response(constants.RESPONSE_OK, progress.SerializeToString())
+
   def _UnpackNewServer(self):
     data = self.post_data
     addrlen_str = data[:sutils.SIZE_PACKER.size]
@@ -548,9 +675,8 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     server = self.MASTER.HasServer(addr, port)
     if not server:
       return self._EmptyResponse(constants.RESPONSE_DATA_SERVER_NOT_FOUND)
-    # Interval range must be 0.
-    interval = server.Interval()
-    if interval.start != interval.end:
+    # Interval range must be 0 or the server must not hold virtual nodes.
+    if not sutils.IsServerEmpty(self.MAPPING, server.Index()):
       return self._EmptyResponse(constants.RESPONSE_RANGE_NOT_EMPTY)
     return self._EmptyResponse(constants.RESPONSE_OK)
 
@@ -5,6 +5,7 @@
 import atexit
 import os
 import readline
+import threading
 import time
 import urlparse
 
@@ -30,6 +31,9 @@ from grr.server.data_server import utils as sutils
 class Manager(object):
   """Manage a data server group using a connection to the master."""
 
+  # Seconds between progress reports while files are copied.
+  PROGRESS_INTERVAL = 10
+
   def __init__(self):
     servers = config_lib.CONFIG["Dataserver.server_list"]
     if not servers:
@@ -92,6 +96,16 @@ class Manager(object):
     self._ShowRange(self.mapping)
 
   def _ShowRange(self, mapping):
+    if mapping.vnodes:
+      shares = sutils.VirtualNodeShares(mapping)
+      counts = [0] * len(shares)
+      for vnode in mapping.vnodes:
+        counts[vnode.server] += 1
+      for i, serv in enumerate(list(mapping.servers)):
+        print "Server %d %s:%d %d%% (weight %d, %d virtual nodes)" % (
+            i, serv.address, serv.port, shares[i] * 100, serv.weight,
+            counts[i])
+      return
     for i, serv in enumerate(list(mapping.servers)):
       addr = serv.address
       port = serv.port
@@ -135,23 +149,106 @@ class Manager(object):
                                  interval=interval)
     return new_mapping
 
-  def _Rebalance(self):
+  def _ComputeVirtualNodeMapping(self, mapping, weights=None, owners=None):
+    """Builds a new mapping that places keys with virtual nodes.
+
+    Args:
+      mapping: The current mapping.
+      weights: Dictionary of server index to new weight.
+      owners: Dictionary of token to the new server index of the node.
+
+    Returns:
+      The new mapping.
+    """
+    weights = weights or {}
+    new_mapping = rdf_data_server.DataServerMapping(
+        version=self.mapping.version + 1,
+        num_servers=self.mapping.num_servers,
+        pathing=self.mapping.pathing)
+    for i, old_server in enumerate(list(mapping.servers)):
+      new_mapping.servers.Append(index=old_server.index,
+                                 address=old_server.address,
+                                 port=old_server.port,
+                                 state=old_server.state,
+                                 interval=old_server.interval,
+                                 weight=weights.get(i, old_server.weight))
+    # Nodes that were moved by hand stay where they are.
+    current = dict((vnode.token, vnode.server) for vnode in mapping.vnodes)
+    current.update(owners or {})
+    new_mapping.vnodes = sutils.ComputeVirtualNodes(
+        list(new_mapping.servers), owners=current)
+    return new_mapping
+
+  def _Rebalance(self, online=False):
     """Starts the rebalance process."""
     if not self.mapping:
       print "Server information not available"
       return
-    # Compute total size of database.
-    servers = list(self.mapping.servers)
-    num_servers = len(servers)
-    target = 1.0 / float(num_servers)
-    perc = [target] * num_servers
-    new_mapping = self._ComputeMappingFromPercentages(self.mapping, perc)
+    if self.mapping.vnodes:
+      # Gives virtual nodes to the servers added since the last rebalance.
+      new_mapping = self._ComputeVirtualNodeMapping(self.mapping)
+    else:
+      # Compute total size of database.
+      servers = list(self.mapping.servers)
+      num_servers = len(servers)
+      target = 1.0 / float(num_servers)
+      perc = [target] * num_servers
+      new_mapping = self._ComputeMappingFromPercentages(self.mapping, perc)
     print "The new ranges will be:"
     self._ShowRange(new_mapping)
     print
-    self._DoRebalance(new_mapping)
+    self._DoRebalance(new_mapping, online=online)
+
+  def _ShowProgress(self, pool, rebalance):
+    """Prints how far the data servers are in copying files."""
+    body = rebalance.SerializeToString()
+    headers = {"Content-Length": len(body)}
+    try:
+      res = pool.urlopen("POST", "/rebalance/progress", headers=headers,
+                         body=body)
+    except urllib3.exceptions.MaxRetryError:
+      return
+    if res.status != constants.RESPONSE_OK:
+      return
+    progress = rdf_data_server.DataServerRebalance(res.data)
+    for i, prog in enumerate(list(progress.progress)):
+      line = "Server %d copied %dKB of %dKB in %d files (%dKB/s)" % (
+          i, prog.bytes_copied / 1024, prog.bytes_total / 1024,
+          prog.files_copied, prog.bytes_per_second / 1024)
+      if rebalance.online:
+        line += ", sent %d of %d changes" % (prog.changes_replayed,
+                                             prog.changes_logged)
+      print line
+
+  def _CopyFiles(self, pool, rebalance):
+    """Runs phase 2 of the rebalance while showing its progress."""
+    body = rebalance.SerializeToString()
+    headers = {"Content-Length": len(body)}
+    result = {}
 
-  def _DoRebalance(self, new_mapping):
+    def CopyFiles():
+      try:
+        result["response"] = pool.urlopen("POST", "/rebalance/phase2",
+                                          headers=headers, body=body)
+      except urllib3.exceptions.MaxRetryError:
+        pass
+
+    thread = threading.Thread(target=CopyFiles)
+    thread.start()
+    # The connection used for the rebalance must stay with the master, so the
+    # progress is requested through another one.
+    progress_pool = connectionpool.HTTPConnectionPool(self.addr, port=self.port)
+    try:
+      while thread.is_alive():
+        thread.join(self.PROGRESS_INTERVAL)
+        if thread.is_alive():
+          self._ShowProgress(progress_pool, rebalance)
+      self._ShowProgress(progress_pool, rebalance)
+    finally:
+      progress_pool.close()
+    return result.get("response")
+
+  def _DoRebalance(self, new_mapping, online=False):
     """Performs a new rebalancing operation with the master server."""
     print "Contacting master server to start re-sharding...",
     # Send mapping information to master.
@@ -183,12 +280,11 @@ class Manager(object):
     answer = raw_input("Proceed with re-sharding? (y/n) ")
     if answer != "y":
       return
+    rebalance.online = online
     body = rebalance.SerializeToString()
     headers = {"Content-Length": len(body)}
-    try:
-      res = pool.urlopen("POST", "/rebalance/phase2", headers=headers,
-                         body=body)
-    except urllib3.exceptions.MaxRetryError:
+    res = self._CopyFiles(pool, rebalance)
+    if res is None:
       print "Unable to contact server for re-sharding."
       print "Make sure the data servers are up and try again."
       return
@@ -400,15 +496,20 @@ class Manager(object):
     if not server:
       print "Server not found."
       return
-    servers = list(self.mapping.servers)
-    num_servers = len(servers)
-    # Simply set everyone else with 1/(N-1).
-    target = 1.0 / float(num_servers - 1)
-    newperc = [target] * num_servers
-    # Our server gets 0.
-    newperc[index] = 0
-    # Create new mapping structure.
-    new_mapping = self._ComputeMappingFromPercentages(self.mapping, newperc)
+    if self.mapping.vnodes:
+      # Without weight the server loses its virtual nodes.
+      new_mapping = self._ComputeVirtualNodeMapping(self.mapping,
+                                                    weights={index: 0})
+    else:
+      servers = list(self.mapping.servers)
+      num_servers = len(servers)
+      # Simply set everyone else with 1/(N-1).
+      target = 1.0 / float(num_servers - 1)
+      newperc = [target] * num_servers
+      # Our server gets 0.
+      newperc[index] = 0
+      # Create new mapping structure.
+      new_mapping = self._ComputeMappingFromPercentages(self.mapping, newperc)
     print "The new ranges will be:"
     self._ShowRange(new_mapping)
     print
@@ -419,11 +520,11 @@ class Manager(object):
   def _RemServer(self, addr, port):
     """Remove server from group."""
     # Find server.
-    server, _ = self._FindServer(addr, port)
+    server, index = self._FindServer(addr, port)
     if not server:
       print "Server not found."
       return
-    if server.interval.start != server.interval.end:
+    if not sutils.IsServerEmpty(self.mapping, index):
       print "Server has some data in it!"
       print "Giving up..."
       return
@@ -515,18 +616,97 @@ class Manager(object):
     print "\t2. Remove '//%s:%d' from the configuration file." % (addr, port)
     print "\t3. Remove the data store directory"
 
+  def _ShowVirtualNodes(self):
+    """Shows how much data each virtual node holds."""
+    if not self.mapping:
+      print "Server information not available"
+      return
+    if not self.mapping.vnodes:
+      print "Servers are not using virtual nodes, run 'vnodes enable'."
+      return
+    try:
+      res = self.pool.urlopen("POST", "/servers/vnodes",
+                              headers={"Content-Length": 0}, body="")
+    except urllib3.exceptions.MaxRetryError:
+      print "Unable to contact master..."
+      return
+    if res.status != constants.RESPONSE_OK:
+      print "Could not get the load of the virtual nodes."
+      return
+    load = rdf_data_server.DataServerMapping(res.data)
+    vnodes = list(load.vnodes)
+    total = sum(vnode.size for vnode in vnodes) or 1
+    # Heaviest nodes first, they are the ones worth moving.
+    for vnode in sorted(vnodes, key=lambda vnode: vnode.size, reverse=True):
+      print "Node %s on server %d: %dKB (%.2f%%) in %d files" % (
+          str(vnode.token).zfill(20), vnode.server, vnode.size / 1024,
+          vnode.size * 100.0 / total, vnode.num_files)
+
+  def _EnableVirtualNodes(self):
+    """Switches the key placement from intervals to virtual nodes."""
+    if not self.mapping:
+      print "Server information not available"
+      return
+    if self.mapping.vnodes:
+      print "Servers are already using virtual nodes."
+      return
+    new_mapping = self._ComputeVirtualNodeMapping(self.mapping)
+    print "The new ranges will be:"
+    self._ShowRange(new_mapping)
+    print
+    self._DoRebalance(new_mapping)
+
+  def _MoveVirtualNode(self, token, index):
+    """Moves a virtual node to another server."""
+    if not self.mapping:
+      print "Server information not available"
+      return
+    if token not in [vnode.token for vnode in self.mapping.vnodes]:
+      print "Virtual node not found."
+      return
+    if not 0 <= index < len(self.mapping.servers):
+      print "Server not found."
+      return
+    new_mapping = self._ComputeVirtualNodeMapping(self.mapping,
+                                                  owners={token: index})
+    self._DoRebalance(new_mapping)
+
+  def _SetWeight(self, addr, port, weight):
+    """Changes the share of virtual nodes of a server."""
+    if not self.mapping:
+      print "Server information not available"
+      return
+    if not self.mapping.vnodes:
+      print "Servers are not using virtual nodes, run 'vnodes enable'."
+      return
+    server, index = self._FindServer(addr, port)
+    if not server:
+      print "Server not found."
+      return
+    new_mapping = self._ComputeVirtualNodeMapping(self.mapping,
+                                                  weights={index: weight})
+    print "The new ranges will be:"
+    self._ShowRange(new_mapping)
+    print
+    self._DoRebalance(new_mapping)
+
   def _Help(self):
     """Help message."""
     print "stop\t\t\t\tStop manager."
     print "servers\t\t\t\tDisplay server information."
     print "ranges\t\t\t\tDisplay server range information."
-    print "rebalance\t\t\tRebalance server load."
+    print "rebalance [online]\t\tRebalance server load, optionally while "
+    print "\t\t\t\tkeeping the moving ranges writable."
     print "recover <transaction id>\tComplete a pending transaction."
     print "addserver <address> <port>\tAdd new server to the group."
     print ("dropserver <address> <port>\tMove all the data from the server "
            "to others.")
     print "remserver <address> <port>\tRemove server from server group."
     print "sync\t\t\t\tSync server information between data servers."
+    print "vnodes\t\t\t\tDisplay the load of each virtual node."
+    print "vnodes enable\t\t\tPlace keys using virtual nodes."
+    print "vnodes move <token> <server>\tMove a virtual node to another server."
+    print "weight <address> <port> <weight>\tChange the capacity of a server."
 
   def _HandleCommand(self, cmd, args):
     """Execute an user command."""
@@ -539,7 +719,7 @@ class Manager(object):
     elif cmd == "ranges":
       self._ShowRanges()
     elif cmd == "rebalance":
-      self._Rebalance()
+      self._Rebalance(online=args == ["online"])
     elif cmd == "recover":
       if len(args) != 1:
         print "Syntax: recover <transaction-id>"
@@ -567,6 +747,26 @@ class Manager(object):
         print "Invalid port number: %s" % args[1]
     elif cmd == "sync":
       self._Sync()
+    elif cmd == "vnodes":
+      if not args:
+        self._ShowVirtualNodes()
+      elif args == ["enable"]:
+        self._EnableVirtualNodes()
+      elif len(args) == 3 and args[0] == "move":
+        try:
+          self._MoveVirtualNode(int(args[1]), int(args[2]))
+        except ValueError:
+          print "Syntax: vnodes move <token> <server>"
+      else:
+        print "Syntax: vnodes [enable|move <token> <server>]"
+    elif cmd == "weight":
+      if len(args) != 3:
+        print "Syntax: weight <address> <port> <weight>"
+        return True
+      try:
+        self._SetWeight(args[0], int(args[1]), int(args[2]))
+      except ValueError:
+        print "Invalid port number or weight: %s %s" % (args[1], args[2])
     else:
       print "No such command:", cmd
     return True
@@ -253,6 +253,12 @@ class DataMaster(object):
     return True
 
   def CancelRebalancing(self):
+    if self.rebalance and self.rebalance.online:
+      # Data servers must stop logging changes for the moving ranges.
+      self._PostToRebalanceServers("/rebalance/abort", best_effort=True)
+    self._ResetRebalancing()
+
+  def _ResetRebalancing(self):
     self.rebalance = None
     for pool in self.rebalance_pool:
       pool.close()
@@ -273,9 +279,8 @@ class DataMaster(object):
 
   def RemoveServer(self, removed_server):
     """Remove a server. Returns None if server interval is not empty."""
-    interval = removed_server.Interval()
-    # Interval range must be 0.
-    if interval.start != interval.end:
+    # Interval range must be 0 or the server must not hold virtual nodes.
+    if not sutils.IsServerEmpty(self.mapping, removed_server.Index()):
       return None
     # Update ids of other servers.
     newserverlist = []
@@ -287,6 +292,11 @@ class DataMaster(object):
       newserverlist.append(serv.GetInfo())
     # Change list of servers.
     self.mapping.servers = newserverlist
+    vnodes = list(self.mapping.vnodes)
+    for vnode in vnodes:
+      if vnode.server > removed_server.Index():
+        vnode.server -= 1
+    self.mapping.vnodes = vnodes
     self.mapping.num_servers -= 1
     self.servers.pop(removed_server.Index())
     self.DeregisterServer(removed_server)
@@ -324,6 +334,35 @@ class DataMaster(object):
         pool.close()
     return True
 
+  def FetchVirtualNodeLoad(self):
+    """Asks data servers how much data they hold for each virtual node."""
+    load = rebalance.ComputeVirtualNodeLoad(self.mapping)
+    body = ""
+    headers = {"Content-Length": len(body)}
+    for serv in self.servers[1:]:
+      pool = connectionpool.HTTPConnectionPool(serv.Address(),
+                                               port=serv.Port())
+      try:
+        res = pool.urlopen("POST", "/server/vnodes", headers=headers,
+                           body=body)
+        if res.status != constants.RESPONSE_OK:
+          logging.warning("Could not get virtual node load from server %s:%d",
+                          serv.Address(), serv.Port())
+          return None
+        server_load = rdf_data_server.DataServerMapping(res.data)
+      except urllib3.exceptions.MaxRetryError:
+        return None
+      finally:
+        pool.close()
+      server_vnodes = list(server_load.vnodes)
+      if len(server_vnodes) != len(load):
+        # The server has a different mapping.
+        return None
+      for vnode, server_vnode in zip(load, server_vnodes):
+        vnode.size += server_vnode.size
+        vnode.num_files += server_vnode.num_files
+    return rdf_data_server.DataServerMapping(vnodes=load)
+
   def FetchRebalanceInformation(self):
     """Asks data servers for number of changes for rebalancing."""
     body = self.rebalance.SerializeToString()
@@ -350,6 +389,66 @@ class DataMaster(object):
         return False
     return True
 
+  def FetchRebalanceProgress(self):
+    """Asks data servers how far they are in copying files."""
+    body = self.rebalance.SerializeToString()
+    headers = {"Content-Length": len(body)}
+    result = rdf_data_server.DataServerRebalance(id=self.rebalance.id)
+    for pool in self.rebalance_pool:
+      try:
+        res = pool.urlopen("POST", "/rebalance/statistics", headers=headers,
+                           body=body)
+      except urllib3.exceptions.MaxRetryError:
+        return None
+      if res.status != constants.RESPONSE_OK:
+        return None
+      reb = rdf_data_server.DataServerRebalance(res.data)
+      progress = list(reb.progress)
+      if progress:
+        result.progress.Append(progress[0])
+      else:
+        # This server has not started copying yet.
+        result.progress.Append(rdf_data_server.DataServerRebalanceProgress(
+            bytes_total=list(reb.moving)[0]))
+    return result
+
+  def _PostToRebalanceServers(self, url, best_effort=False):
+    """Posts the rebalance object to all the data servers.
+
+    Args:
+      url: The handler to post to.
+      best_effort: If True, keep going after a server fails.
+
+    Returns:
+      True if all the servers succeeded.
+    """
+    body = self.rebalance.SerializeToString()
+    headers = {"Content-Length": len(body)}
+    ok = True
+    for i, pool in enumerate(self.rebalance_pool):
+      try:
+        res = pool.urlopen("POST", url, headers=headers, body=body)
+        if res.status == constants.RESPONSE_OK:
+          continue
+        logging.warning("Server %d failed %s for rebalance %s", i, url,
+                        self.rebalance.id)
+      except urllib3.exceptions.MaxRetryError:
+        logging.warning("Could not contact server %d for %s", i, url)
+      ok = False
+      if not best_effort:
+        break
+    return ok
+
+  def _ReplayRebalanceChanges(self):
+    """Fences the writes to the moving ranges and sends the logged changes."""
+    # Most of the changes are sent while writes are still accepted so that
+    # only the last few need to be sent while writes are blocked.
+    if not self._PostToRebalanceServers("/rebalance/replay"):
+      return False
+    if not self._PostToRebalanceServers("/rebalance/fence"):
+      return False
+    return self._PostToRebalanceServers("/rebalance/replay")
+
   def CopyRebalanceFiles(self):
     """Tell servers to copy files to the corresponding servers."""
     body = self.rebalance.SerializeToString()
@@ -369,6 +468,9 @@ class DataMaster(object):
 
   def RebalanceCommit(self):
     """Tell servers to commit rebalance changes."""
+    if self.rebalance.online and not self._ReplayRebalanceChanges():
+      self.CancelRebalancing()
+      return None
     # Save rebalance information to a file, so we can recover later.
     rebalance.SaveCommitInformation(self.rebalance)
     body = self.rebalance.SerializeToString()
@@ -394,10 +496,12 @@ class DataMaster(object):
     mapping = self.rebalance.mapping
     for i, serv in enumerate(list(self.mapping.servers)):
       serv.interval = mapping.servers[i].interval
+      serv.weight = mapping.servers[i].weight
+    self.mapping.vnodes = list(mapping.vnodes)
     self.rebalance.mapping = self.mapping
     self.service.SaveServerMapping(self.mapping)
     # We can finally delete the temporary file, since we have succeeded.
     rebalance.DeleteCommitInformation(self.rebalance)
     rebalance.RemoveDirectory(self.rebalance)
-    self.CancelRebalancing()
+    self._ResetRebalancing()
     return self.mapping
@@ -5,6 +5,8 @@
 import os
 import shutil
 import StringIO
+import threading
+import time
 import zlib
 
 # pylint: disable=g-import-not-at-top
@@ -18,10 +20,12 @@ except ImportError:
 
 import logging
 
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import utils
 from grr.lib.data_stores import common
 from grr.lib.rdfvalues import data_server as rdf_data_server
+from grr.lib.rdfvalues import data_store as rdf_data_store
 
 from grr.server.data_server import constants
 from grr.server.data_server import store
@@ -31,12 +35,18 @@ from grr.server.data_server import utils as sutils
 # Database files that cannot be copied.
 COPY_EXCEPTIONS = [store.BASE_MAP_SUBJECT]
 # Files that cannot be moved from inside the transaction directory.
-MOVE_EXCEPTIONS = [constants.TRANSACTION_FILENAME, constants.REMOVE_FILENAME]
+MOVE_EXCEPTIONS = [constants.TRANSACTION_FILENAME, constants.REMOVE_FILENAME,
+                   constants.CHANGE_LOG_FILENAME, constants.CHANGES_FILENAME,
+                   constants.SNAPSHOT_FILENAME]
 # Level of compression when moving Sqlite files.
 COMPRESSION_LEVEL = 3
+# Maximum size of a batch of changes sent to another data server.
+CHANGES_BATCH_SIZE = 4 * 1024 * 1024
+# Serializes the changes received from the other data servers.
+CHANGES_LOCK = threading.Lock()
 
 
-def _RecComputeRebalanceSize(mapping, server_id, dspath, subpath):
+def _RecComputeRebalanceSize(key_mapper, server_id, dspath, subpath):
   """Recursively compute the size of files that need to be moved."""
   total = 0
   fulldir = utils.JoinPath(dspath, subpath)
@@ -51,11 +61,11 @@ def _RecComputeRebalanceSize(mapping, server_id, dspath, subpath):
       logging.info("Skip %s", comp)
       continue
     if os.path.isdir(path):
-      total += _RecComputeRebalanceSize(mapping, server_id, dspath,
+      total += _RecComputeRebalanceSize(key_mapper, server_id, dspath,
                                         utils.JoinPath(subpath, comp))
     elif os.path.isfile(path):
       key = common.MakeDestinationKey(subpath, name)
-      where = sutils.MapKeyToServer(mapping, key)
+      where = key_mapper.MapKey(key)
       if where != server_id:
         logging.info("Need to move %s from %d to %d", path, server_id, where)
         total += os.path.getsize(path)
@@ -71,7 +81,48 @@ def ComputeRebalanceSize(mapping, server_id):
     return 0
   if not os.path.isdir(loc):
     return 0
-  return _RecComputeRebalanceSize(mapping, server_id, loc, "")
+  return _RecComputeRebalanceSize(sutils.KeyMapper(mapping), server_id, loc,
+                                  "")
+
+
+def _RecComputeVirtualNodeLoad(key_mapper, dspath, subpath, load):
+  """Recursively add the size of the files to their virtual nodes."""
+  fulldir = utils.JoinPath(dspath, subpath)
+  for comp in os.listdir(fulldir):
+    if comp == constants.REBALANCE_DIRECTORY:
+      continue
+    path = utils.JoinPath(fulldir, comp)
+    name, unused_extension = os.path.splitext(comp)
+    if name in COPY_EXCEPTIONS:
+      continue
+    if os.path.isdir(path):
+      _RecComputeVirtualNodeLoad(key_mapper, dspath,
+                                 utils.JoinPath(subpath, comp), load)
+    elif os.path.isfile(path):
+      vnode = load[key_mapper.VirtualNode(
+          common.MakeDestinationKey(subpath, name))]
+      vnode.size += os.path.getsize(path)
+      vnode.num_files += 1
+
+
+def ComputeVirtualNodeLoad(mapping):
+  """Computes how much data this server holds for each virtual node.
+
+  Args:
+    mapping: A DataServerMapping with virtual nodes.
+
+  Returns:
+    A list with a DataServerVirtualNode for each node of the mapping, in token
+    order, with the size and number of files filled in.
+  """
+  key_mapper = sutils.KeyMapper(mapping)
+  load = [rdf_data_server.DataServerVirtualNode(token=token, server=owner,
+                                                size=0, num_files=0)
+          for token, owner in zip(key_mapper.tokens, key_mapper.owners)]
+  loc = data_store.DB.Location()
+  if load and os.path.isdir(loc):
+    _RecComputeVirtualNodeLoad(key_mapper, loc, "", load)
+  return load
 
 
 class FileCopyWrapper(object):
@@ -181,8 +232,254 @@ def _FileWithRemoveList(database_dir, rebalance):
   return utils.JoinPath(tempdir, constants.REMOVE_FILENAME)
 
 
-def _RecCopyFiles(rebalance, server_id, dspath, subpath,
-                  pool_cache, removed_list):
+def _GetServerPool(pool_cache, server):
+  key = (server.address, server.port)
+  try:
+    return pool_cache[key]
+  except KeyError:
+    pool = connectionpool.HTTPConnectionPool(server.address, port=server.port)
+    pool_cache[key] = pool
+    return pool
+
+
+def _PackFrame(data):
+  return sutils.SIZE_PACKER.pack(len(data)) + data
+
+
+def _ReadChanges(fp, end=None):
+  """Yields the DataServerChange objects stored in a file."""
+  while end is None or fp.tell() < end:
+    size_str = fp.read(sutils.SIZE_PACKER.size)
+    if len(size_str) != sutils.SIZE_PACKER.size:
+      break
+    size = sutils.SIZE_PACKER.unpack(size_str)[0]
+    yield rdf_data_server.DataServerChange(fp.read(size))
+
+
+class CopyProgress(object):
+  """Tracks how far a data server is in copying its moving files."""
+
+  def __init__(self, rebalance, server_id, change_log=None):
+    self.rebalance_id = rebalance.id
+    moving = list(rebalance.moving)
+    self.bytes_total = 0
+    if server_id < len(moving):
+      self.bytes_total = moving[server_id]
+    self.bytes_copied = 0
+    self.files_copied = 0
+    self.change_log = change_log
+    self.start_time = time.time()
+    self.end_time = None
+
+  def FileCopied(self, size):
+    self.bytes_copied += size
+    self.files_copied += 1
+
+  def Finish(self):
+    self.end_time = time.time()
+
+  def GetProgress(self):
+    """Returns a DataServerRebalanceProgress with the current figures."""
+    elapsed = (self.end_time or time.time()) - self.start_time
+    progress = rdf_data_server.DataServerRebalanceProgress(
+        bytes_total=self.bytes_total, bytes_copied=self.bytes_copied,
+        files_copied=self.files_copied, elapsed=elapsed)
+    if elapsed > 0:
+      progress.bytes_per_second = self.bytes_copied / elapsed
+    if self.change_log:
+      progress.changes_logged = self.change_log.changes_logged
+      progress.changes_replayed = self.change_log.changes_replayed
+    return progress
+
+
+class ChangeLog(object):
+  """Records the writes to the ranges moving away from this data server.
+
+  During an online rebalance the data server keeps accepting writes while its
+  moving files are copied. Writes to subjects whose file moves are appended to
+  a log in the transaction directory. Every file is copied from a snapshot and
+  the position of the log at the time of the snapshot is remembered, so only
+  the writes that the copy missed are replayed on the destination.
+
+  While the rebalance is committed, writes to the moving ranges are fenced:
+  they wait until the new mapping is in place and then fail, since the data
+  no longer lives on this server.
+  """
+
+  # Writes and snapshots of the same file are serialized by one of these.
+  NUM_LOCKS = 64
+
+  def __init__(self, rebalance, server_id):
+    self.rebalance = rebalance
+    self.server_id = server_id
+    self.key_mapper = sutils.KeyMapper(rebalance.mapping)
+    loc = data_store.DB.Location()
+    self.directory = _CreateDirectory(loc, rebalance.id)
+    self.path = utils.JoinPath(self.directory, constants.CHANGE_LOG_FILENAME)
+    self.fp = open(self.path, "wb")
+    self.locks = [threading.Lock() for _ in xrange(self.NUM_LOCKS)]
+    self.append_lock = threading.Lock()
+    self.sequence = 0
+    # Log sequence number at the time each file was snapshotted.
+    self.snapshots = {}
+    self.replayed_offset = 0
+    self.changes_logged = 0
+    self.changes_replayed = 0
+    self.pool_cache = {}
+    # Fence state.
+    self.fence_timeout = config_lib.CONFIG["Dataserver.rebalance_fence_timeout"]
+    self.fence_condition = threading.Condition()
+    self.fenced = False
+    self.committed = False
+    self.active_writes = 0
+
+  def IsMoving(self, key):
+    if key in COPY_EXCEPTIONS:
+      return False
+    return self.key_mapper.MapKey(key) != self.server_id
+
+  def _GetLock(self, key):
+    return self.locks[hash(key) % self.NUM_LOCKS]
+
+  def _StartWrite(self):
+    with self.fence_condition:
+      deadline = time.time() + self.fence_timeout
+      while self.fenced:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise data_store.Error("Timed out waiting for rebalance %s." %
+                                 self.rebalance.id)
+        self.fence_condition.wait(remaining)
+      if self.committed:
+        raise data_store.Error("Subject was moved to another data server by "
+                               "rebalance %s." % self.rebalance.id)
+      self.active_writes += 1
+
+  def _EndWrite(self):
+    with self.fence_condition:
+      self.active_writes -= 1
+      self.fence_condition.notify_all()
+
+  def _Append(self, key, command, request):
+    cmd = rdf_data_server.DataStoreCommand(command=command, request=request)
+    with self.append_lock:
+      if self.fp.closed:
+        # The rebalance was canceled while the write was running.
+        return
+      change = rdf_data_server.DataServerChange(sequence=self.sequence,
+                                                key=key, command=cmd)
+      self.fp.write(_PackFrame(change.SerializeToString()))
+      self.sequence += 1
+      self.changes_logged += 1
+
+  def Write(self, key, command, request, write):
+    """Performs a write through write(request), logging it if it moves."""
+    if not self.IsMoving(key):
+      return write(request)
+
+    self._StartWrite()
+    try:
+      with self._GetLock(key):
+        if (command == rdf_data_server.DataStoreCommand.Command.MULTI_SET and
+            request.timestamp.type ==
+            rdf_data_store.TimestampSpec.Type.NEWEST_TIMESTAMP):
+          # The destination must store the same timestamps as we do.
+          request.timestamp = rdf_data_store.TimestampSpec(
+              type=rdf_data_store.TimestampSpec.Type.SPECIFIC_TIME,
+              start=int(time.time() * 1000000))
+        result = write(request)
+        self._Append(key, command, request)
+        return result
+    finally:
+      self._EndWrite()
+
+  def Snapshot(self, key, path):
+    """Copies a database file that is being written to, returns the copy."""
+    snapshot = utils.JoinPath(self.directory, constants.SNAPSHOT_FILENAME)
+    with self._GetLock(key):
+      shutil.copyfile(path, snapshot)
+      with self.append_lock:
+        self.snapshots[key] = self.sequence
+    return snapshot
+
+  def _ReadNewChanges(self):
+    """Yields the changes logged since the last replay."""
+    with self.append_lock:
+      self.fp.flush()
+      end = self.fp.tell()
+    with open(self.path, "rb") as fp:
+      fp.seek(self.replayed_offset)
+      for change in _ReadChanges(fp, end=end):
+        yield change
+    self.replayed_offset = end
+
+  def _SendChanges(self, server_id, frames):
+    server = self.rebalance.mapping.servers[server_id]
+    pool = _GetServerPool(self.pool_cache, server)
+    body = _PackFrame(utils.SmartStr(self.rebalance.id)) + "".join(frames)
+    try:
+      res = pool.urlopen("POST", "/rebalance/copy-changes",
+                         headers={"Content-Length": len(body)}, body=body)
+    except urllib3.exceptions.MaxRetryError:
+      logging.warning("Failed to send changes to server %d", server_id)
+      return False
+    if res.status != constants.RESPONSE_OK:
+      return False
+    self.changes_replayed += len(frames)
+    return True
+
+  def Replay(self):
+    """Sends the changes logged since the last replay to the new servers."""
+    batches = {}
+    for change in self._ReadNewChanges():
+      if change.sequence < self.snapshots.get(change.key, 0):
+        # Already in the copied file.
+        continue
+      where = self.key_mapper.MapKey(change.key)
+      frames, size = batches.get(where, ([], 0))
+      frame = _PackFrame(change.SerializeToString())
+      frames.append(frame)
+      size += len(frame)
+      if size >= CHANGES_BATCH_SIZE:
+        if not self._SendChanges(where, frames):
+          return False
+        frames, size = [], 0
+      batches[where] = (frames, size)
+
+    for where, (frames, _) in batches.iteritems():
+      if frames and not self._SendChanges(where, frames):
+        return False
+    return True
+
+  def Fence(self):
+    """Blocks new writes to the moving ranges and waits for running ones."""
+    with self.fence_condition:
+      self.fenced = True
+      deadline = time.time() + self.fence_timeout
+      while self.active_writes:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          self.fenced = False
+          self.fence_condition.notify_all()
+          return False
+        self.fence_condition.wait(remaining)
+    return True
+
+  def Close(self, committed):
+    """Stops logging and releases the writes waiting on the fence."""
+    with self.fence_condition:
+      self.fenced = False
+      self.committed = committed
+      self.fence_condition.notify_all()
+    with self.append_lock:
+      self.fp.close()
+    for pool in self.pool_cache.itervalues():
+      pool.close()
+    self.pool_cache = {}
+
+
+def _RecCopyFiles(rebalance, key_mapper, server_id, dspath, subpath,
+                  pool_cache, removed_list, progress, change_log):
   """Recursively send files for moving to the required data server."""
   fulldir = utils.JoinPath(dspath, subpath)
   mapping = rebalance.mapping
@@ -194,37 +491,47 @@ def _RecCopyFiles(rebalance, server_id, dspath, subpath,
     if name in COPY_EXCEPTIONS:
       continue
     if os.path.isdir(path):
-      result = _RecCopyFiles(rebalance, server_id, dspath,
+      result = _RecCopyFiles(rebalance, key_mapper, server_id, dspath,
                              utils.JoinPath(subpath, comp), pool_cache,
-                             removed_list)
+                             removed_list, progress, change_log)
       if not result:
         return False
       continue
     if not os.path.isfile(path):
       continue
     key = common.MakeDestinationKey(subpath, name)
-    where = sutils.MapKeyToServer(mapping, key)
+    where = key_mapper.MapKey(key)
     if where != server_id:
-      server = mapping.servers[where]
-      addr = server.address
-      port = server.port
-      key = (addr, port)
-      try:
-        pool = pool_cache[key]
-      except KeyError:
-        pool = connectionpool.HTTPConnectionPool(addr, port=port)
-        pool_cache[key] = pool
+      pool = _GetServerPool(pool_cache, mapping.servers[where])
       logging.info("Need to move %s from %d to %d", key, server_id, where)
-      if not _SendFileToServer(pool, path, subpath, comp, rebalance):
+      source = path
+      if change_log:
+        # The file is still being written to, send a consistent copy.
+        source = change_log.Snapshot(key, path)
+      if not _SendFileToServer(pool, source, subpath, comp, rebalance):
         return False
+      progress.FileCopied(os.path.getsize(source))
       removed_list.append(path)
     else:
       logging.info("File %s stays here", path)
   return True
 
 
-def CopyFiles(rebalance, server_id):
-  """Copies data store files to the corresponding data servers."""
+def CopyFiles(rebalance, server_id, progress=None, change_log=None):
+  """Copies data store files to the corresponding data servers.
+
+  Args:
+    rebalance: The DataServerRebalance object.
+    server_id: Index of this data server.
+    progress: A CopyProgress object updated as files are copied.
+    change_log: For online rebalances, the ChangeLog recording the writes to
+                the moving ranges. Files are then copied from snapshots.
+
+  Returns:
+    True if all the files were copied.
+  """
+  if progress is None:
+    progress = CopyProgress(rebalance, server_id, change_log=change_log)
   loc = data_store.DB.Location()
   if not os.path.exists(loc):
     return True
@@ -232,7 +539,14 @@ def CopyFiles(rebalance, server_id):
     return True
   pool_cache = {}
   removed_list = []
-  ok = _RecCopyFiles(rebalance, server_id, loc, "", pool_cache, removed_list)
+  try:
+    ok = _RecCopyFiles(rebalance, sutils.KeyMapper(rebalance.mapping),
+                       server_id, loc, "", pool_cache, removed_list, progress,
+                       change_log)
+  finally:
+    progress.Finish()
+    for pool in pool_cache.itervalues():
+      pool.close()
   if not ok:
     return False
   # Write list of removed files to temporary directory
@@ -243,6 +557,53 @@ def CopyFiles(rebalance, server_id):
   return True
 
 
+def SaveChanges(data):
+  """Stores the changes sent by another data server until the commit."""
+  loc = data_store.DB.Location()
+  if not os.path.exists(loc):
+    return False
+  if not os.path.isdir(loc):
+    return False
+  id_len = sutils.SIZE_PACKER.unpack(data[:sutils.SIZE_PACKER.size])[0]
+  start = sutils.SIZE_PACKER.size + id_len
+  rebalance_id = data[sutils.SIZE_PACKER.size:start]
+  tempdir = _CreateDirectory(loc, rebalance_id)
+  with CHANGES_LOCK:
+    with open(utils.JoinPath(tempdir, constants.CHANGES_FILENAME), "ab") as fp:
+      fp.write(data[start:])
+  return True
+
+
+def _ApplyChanges(tempdir, service):
+  """Applies the changes received from other data servers to the database."""
+  changes_file = utils.JoinPath(tempdir, constants.CHANGES_FILENAME)
+  if not os.path.exists(changes_file):
+    return
+  command = rdf_data_server.DataStoreCommand.Command
+  methods = {
+      command.MULTI_SET: service.MultiSet,
+      command.DELETE_ATTRIBUTES: service.DeleteAttributes,
+      command.DELETE_SUBJECT: service.DeleteSubject
+  }
+  count = 0
+  with open(changes_file, "rb") as fp:
+    for change in _ReadChanges(fp):
+      method = methods.get(change.command.command)
+      if not method:
+        logging.error("Unexpected command %d in change log",
+                      change.command.command)
+        continue
+      response = rdf_data_store.DataStoreResponse(
+          method(change.command.request))
+      if response.status != rdf_data_store.DataStoreResponse.Status.OK:
+        logging.error("Failed to apply change to %s: %s", change.key,
+                      response.status_desc)
+      count += 1
+  logging.info("Applied %d changes", count)
+  # Changes must not be applied again if the transaction is recovered.
+  os.unlink(changes_file)
+
+
 def SaveTemporaryFile(fp):
   """Store incoming database file in a temporary directory."""
   loc = data_store.DB.Location()
@@ -311,8 +672,18 @@ def _RecMoveFiles(tempdir, dspath, subpath):
       _RecMoveFiles(tempdir, dspath, utils.JoinPath(subpath, fname))
 
 
-def MoveFiles(rebalance, is_master):
-  """Commit the received files into the database."""
+def MoveFiles(rebalance, is_master, service=None):
+  """Commit the received files into the database.
+
+  Args:
+    rebalance: The DataServerRebalance object.
+    is_master: True if this data server is the master.
+    service: The DataStoreService used to apply the changes received during an
+             online rebalance.
+
+  Returns:
+    True if the files were moved.
+  """
   loc = data_store.DB.Location()
   if not os.path.exists(loc):
     return False
@@ -346,6 +717,8 @@ def MoveFiles(rebalance, is_master):
     _RecMoveFiles(tempdir, loc, "")
   except OSError:
     return False
+  if service:
+    _ApplyChanges(tempdir, service)
   # Remove temporary directory.
   # Master will remove it later.
   if not is_master:
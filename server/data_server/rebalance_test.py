@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Tests for online rebalancing of the data servers."""
+
+
+import os
+
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib.data_stores import sqlite_data_store
+from grr.lib.rdfvalues import data_server as rdf_data_server
+from grr.lib.rdfvalues import data_store as rdf_data_store
+
+from grr.server.data_server import constants
+from grr.server.data_server import rebalance
+from grr.server.data_server import store
+
+
+class RebalanceTest(test_lib.GRRBaseTest):
+  """Tests the change log used by online rebalancing."""
+
+  def setUp(self):
+    super(RebalanceTest, self).setUp()
+    self.root_path = utils.JoinPath(self.temp_dir, "rebalance_test")
+    db = sqlite_data_store.SqliteDataStore(path=self.root_path)
+    db.security_manager = test_lib.MockSecurityManager()
+    self.db_stubber = utils.Stubber(data_store, "DB", db)
+    self.db_stubber.Start()
+    self.service = store.DataStoreService(db)
+    self.subject = "aff4:/C.0000000000000001/fs/os/foo"
+
+  def tearDown(self):
+    super(RebalanceTest, self).tearDown()
+    data_store.DB.cache.Flush()
+    self.db_stubber.Stop()
+
+  def MakeRebalance(self, everything_moves=True):
+    """Makes a rebalance of two servers, moving all data to the second one."""
+    split = 0 if everything_moves else constants.MAX_RANGE
+    mapping = rdf_data_server.DataServerMapping(num_servers=2)
+    for index, (start, end) in enumerate([(0, split),
+                                          (split, constants.MAX_RANGE)]):
+      mapping.servers.Append(
+          index=index, address="127.0.0.1", port=7000 + index,
+          interval=rdf_data_server.DataServerInterval(start=start, end=end))
+    return rdf_data_server.DataServerRebalance(id="rebalance", mapping=mapping,
+                                               moving=[1024, 0])
+
+  def StartChangeLog(self, reb):
+    change_log = rebalance.ChangeLog(reb, 0)
+    self.service.change_log = change_log
+    return change_log
+
+  def Set(self, value, subject=None):
+    request = rdf_data_store.DataStoreRequest(subject=[subject or self.subject],
+                                              token=self.token)
+    request.values.Append(attribute="metadata:value").value.SetValue(value)
+    return rdf_data_store.DataStoreResponse(self.service.MultiSet(request))
+
+  def Get(self, subject=None):
+    value, _ = data_store.DB.Resolve(subject or self.subject, "metadata:value",
+                                     token=self.token)
+    return value
+
+  def ReplayChanges(self, change_log):
+    """Replays the change log, returning the changes that were sent."""
+    sent = []
+
+    def SendChanges(server_id, frames):
+      self.assertEqual(server_id, 1)
+      sent.append(frames)
+      return True
+
+    with utils.Stubber(change_log, "_SendChanges", SendChanges):
+      self.assertTrue(change_log.Replay())
+    return sent
+
+  def testOnlyWritesToMovingRangesAreLogged(self):
+    change_log = self.StartChangeLog(self.MakeRebalance(everything_moves=False))
+    self.Set("foo")
+    self.assertEqual(change_log.changes_logged, 0)
+    change_log.Close(False)
+
+    change_log = self.StartChangeLog(self.MakeRebalance())
+    self.Set("foo")
+    self.assertEqual(change_log.changes_logged, 1)
+    self.assertEqual(self.Get(), "foo")
+    change_log.Close(False)
+
+  def testReplaySkipsChangesInTheSnapshot(self):
+    change_log = self.StartChangeLog(self.MakeRebalance())
+    self.Set("before snapshot")
+
+    key = self.service.DestinationKey(self.subject)
+    path = "%s.%s" % (utils.JoinPath(self.root_path, key),
+                      sqlite_data_store.SQLITE_EXTENSION)
+    snapshot = change_log.Snapshot(key, path)
+    self.assertEqual(os.path.getsize(snapshot), os.path.getsize(path))
+
+    self.Set("after snapshot")
+    sent = self.ReplayChanges(change_log)
+    self.assertEqual(len(sent), 1)
+    self.assertEqual(len(sent[0]), 1)
+
+    # Only new changes are sent by later replays.
+    self.assertEqual(self.ReplayChanges(change_log), [])
+    self.Set("after replay")
+    self.assertEqual(len(self.ReplayChanges(change_log)), 1)
+    change_log.Close(False)
+
+  def testChangesAreAppliedOnCommit(self):
+    reb = self.MakeRebalance()
+    change_log = self.StartChangeLog(reb)
+    self.Set("foo")
+    frames = self.ReplayChanges(change_log)[0]
+    self.service.change_log = None
+    change_log.Close(True)
+
+    # Pretend the subject was never copied to this server.
+    data_store.DB.DeleteSubject(self.subject, token=self.token)
+    self.assertIsNone(self.Get())
+
+    self.assertTrue(rebalance.SaveChanges(
+        rebalance._PackFrame(reb.id) + "".join(frames)))
+    self.assertTrue(rebalance.MoveFiles(reb, True, service=self.service))
+    self.assertEqual(self.Get(), "foo")
+
+    # Changes are only applied once.
+    data_store.DB.DeleteSubject(self.subject, token=self.token)
+    self.assertTrue(rebalance.MoveFiles(reb, True, service=self.service))
+    self.assertIsNone(self.Get())
+
+  def testFencedWritesFail(self):
+    change_log = self.StartChangeLog(self.MakeRebalance())
+    change_log.fence_timeout = 0.1
+    self.assertTrue(change_log.Fence())
+
+    response = self.Set("foo")
+    self.assertEqual(response.status,
+                     rdf_data_store.DataStoreResponse.Status.DATA_STORE_ERROR)
+    self.assertIsNone(self.Get())
+
+    # Once committed, the range belongs to another server.
+    change_log.Close(True)
+    response = self.Set("foo")
+    self.assertEqual(response.status,
+                     rdf_data_store.DataStoreResponse.Status.DATA_STORE_ERROR)
+    self.assertEqual(change_log.changes_logged, 0)
+
+  def testCopyProgress(self):
+    change_log = self.StartChangeLog(self.MakeRebalance())
+    progress = rebalance.CopyProgress(change_log.rebalance, 0,
+                                      change_log=change_log)
+    progress.FileCopied(512)
+    self.Set("foo")
+    progress.Finish()
+
+    result = progress.GetProgress()
+    self.assertEqual(result.bytes_total, 1024)
+    self.assertEqual(result.bytes_copied, 512)
+    self.assertEqual(result.files_copied, 1)
+    self.assertEqual(result.changes_logged, 1)
+    self.assertEqual(result.changes_replayed, 0)
+    change_log.Close(False)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
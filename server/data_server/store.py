@@ -5,6 +5,7 @@
 import base64
 import functools
 import os
+import re
 import threading
 import time
 import uuid
@@ -101,8 +102,28 @@ class DataStoreService(object):
     old_pathing = config_lib.CONFIG.Get("Datastore.pathing")
     # Need to add a fixed rule for the file where the server mapping is stored.
     new_pathing = [r"(?P<path>" + BASE_MAP_SUBJECT + ")"] + old_pathing
-    self.pathing = new_pathing
-    self.db.RecreatePathing(self.pathing)
+    self._SetPathing(new_pathing)
+    # Set to a rebalance.ChangeLog while an online rebalance is in progress.
+    self.change_log = None
+
+  def _SetPathing(self, pathing):
+    self.pathing = pathing
+    self.path_regexes = [re.compile(path) for path in pathing]
+    self.db.RecreatePathing(pathing)
+
+  def DestinationKey(self, subject):
+    """Returns the key of the database file holding the subject."""
+    filename, directory = common.ResolveSubjectDestination(subject,
+                                                           self.path_regexes)
+    return common.MakeDestinationKey(directory, filename)
+
+  def _Write(self, command, request, write):
+    """Calls write(request), recording it if its range is being moved."""
+    change_log = self.change_log
+    if change_log is None:
+      return write(request)
+    return change_log.Write(self.DestinationKey(request.subject[0]), command,
+                            request, write)
 
   # Every service method must write to the response argument.
   # The response will then be serialized to a string.
@@ -110,7 +131,10 @@ class DataStoreService(object):
   @RPCWrapper
   def MultiSet(self, request, unused_response):
     """Set multiple attributes for a given subject at once."""
+    self._Write(rdf_data_server.DataStoreCommand.Command.MULTI_SET, request,
+                self._MultiSet)
 
+  def _MultiSet(self, request):
     values = {}
     to_delete = set()
 
@@ -170,6 +194,10 @@ class DataStoreService(object):
   @RPCWrapper
   def DeleteAttributes(self, request, unused_response):
     """Delete attributes from a given subject."""
+    self._Write(rdf_data_server.DataStoreCommand.Command.DELETE_ATTRIBUTES,
+                request, self._DeleteAttributes)
+
+  def _DeleteAttributes(self, request):
     timestamp = self.FromTimestampSpec(request.timestamp)
     subject = request.subject[0]
     sync = request.sync
@@ -181,6 +209,10 @@ class DataStoreService(object):
 
   @RPCWrapper
   def DeleteSubject(self, request, unused_response):
+    self._Write(rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT,
+                request, self._DeleteSubject)
+
+  def _DeleteSubject(self, request):
     subject = request.subject[0]
     token = request.token
     self.db.DeleteSubject(subject, token=token)
@@ -294,8 +326,7 @@ class DataStoreService(object):
     mapping = rdf_data_server.DataServerMapping(mapping_str)
     # Restore pathing information.
     if self._DifferentPathing(list(mapping.pathing)):
-      self.pathing = list(mapping.pathing)
-      self.db.RecreatePathing(self.pathing)
+      self._SetPathing(list(mapping.pathing))
     return mapping
 
   def _DifferentPathing(self, new_pathing):
@@ -318,8 +349,7 @@ class DataStoreService(object):
       # datastore to use it.
       new_pathing = list(mapping.pathing)
       if self._DifferentPathing(new_pathing):
-        self.pathing = new_pathing
-        self.db.RecreatePathing(new_pathing)
+        self._SetPathing(new_pathing)
     # SetUID is required to write to aff4:/servers_map
     token = access_control.ACLToken(username="GRRSystem").SetUID()
     self.db.MultiSet(MAP_SUBJECT, {MAP_VALUE_PREDICATE: mapping}, token=token)
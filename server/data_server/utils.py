@@ -2,6 +2,7 @@
 """Data server utilities."""
 
 
+import bisect
 import hashlib
 import struct
 
@@ -51,7 +52,107 @@ def _BisectHashList(ls, left, right, value):
     return _BisectHashList(ls, left, middle - 1, value)
 
 
+def _HashKey(key):
+  return int(hashlib.sha1(key).hexdigest()[:16], 16)
+
+
 def MapKeyToServer(mapping, key):
   """Takes some key and returns the ID of the server."""
-  hsh = int(hashlib.sha1(key).hexdigest()[:16], 16)
-  return _FindServerInMapping(mapping, hsh)
+  if mapping.vnodes:
+    return KeyMapper(mapping).MapKey(key)
+  return _FindServerInMapping(mapping, _HashKey(key))
+
+
+class KeyMapper(object):
+  """Maps keys to servers, preparing the mapping only once.
+
+  Faster than MapKeyToServer when many keys are mapped with the same mapping.
+  The mapping must not be changed while the KeyMapper is in use.
+  """
+
+  def __init__(self, mapping):
+    self.servers = list(mapping.servers)
+    vnodes = sorted((vnode.token, vnode.server) for vnode in mapping.vnodes)
+    self.tokens = [token for token, _ in vnodes]
+    self.owners = [server for _, server in vnodes]
+
+  def VirtualNode(self, key):
+    """Returns the position of the virtual node holding the key."""
+    position = bisect.bisect_left(self.tokens, _HashKey(key))
+    if position == len(self.tokens):
+      # Past the last node, wrap around the ring.
+      return 0
+    return position
+
+  def MapKey(self, key):
+    """Takes some key and returns the ID of the server."""
+    if self.tokens:
+      return self.owners[self.VirtualNode(key)]
+    return _BisectHashList(self.servers, 0, len(self.servers) - 1,
+                           _HashKey(key)).index
+
+
+def VirtualNodeTokens(server, count):
+  """Returns the tokens of the first count virtual nodes of a server.
+
+  Tokens only depend on the server location, so the nodes of a server stay in
+  place when other servers are added or removed.
+
+  Args:
+    server: The DataServerInformation of the server.
+    count: Number of tokens.
+
+  Returns:
+    A list of tokens.
+  """
+  return [_HashKey("%s:%d/%d" % (server.address, server.port, i))
+          for i in xrange(count)]
+
+
+def ComputeVirtualNodes(servers, owners=None):
+  """Computes the virtual nodes of a group of servers.
+
+  Every server gets weight * VIRTUAL_NODES_PER_WEIGHT nodes. Adding a server
+  or changing a weight only moves the keys of the nodes that appear or
+  disappear, about 1/N of the keys for each added or removed server.
+
+  Args:
+    servers: List of DataServerInformation.
+    owners: Dictionary of token to server index for the nodes that were moved
+            away from their default server.
+
+  Returns:
+    A list of DataServerVirtualNode sorted by token.
+  """
+  owners = owners or {}
+  nodes = {}
+  for index, server in enumerate(servers):
+    count = server.weight * constants.VIRTUAL_NODES_PER_WEIGHT
+    for token in VirtualNodeTokens(server, count):
+      owner = owners.get(token, index)
+      if owner >= len(servers) or not servers[owner].weight:
+        owner = index
+      nodes[token] = owner
+  return [rdf_data_server.DataServerVirtualNode(token=token, server=owner)
+          for token, owner in sorted(nodes.iteritems())]
+
+
+def VirtualNodeShares(mapping):
+  """Returns the fraction of the hash ring held by each server."""
+  shares = [0.0] * len(mapping.servers)
+  vnodes = sorted((vnode.token, vnode.server) for vnode in mapping.vnodes)
+  if not vnodes:
+    return shares
+  previous = vnodes[-1][0] - constants.MAX_RANGE
+  for token, server in vnodes:
+    shares[server] += float(token - previous) / constants.MAX_RANGE
+    previous = token
+  return shares
+
+
+def IsServerEmpty(mapping, index):
+  """Checks that no key of the mapping is placed in the given server."""
+  if mapping.vnodes:
+    return all(vnode.server != index for vnode in mapping.vnodes)
+  interval = mapping.servers[index].interval
+  return interval.start == interval.end
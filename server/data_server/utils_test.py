@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Tests for the data server utilities."""
+
+
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib.rdfvalues import data_server as rdf_data_server
+
+from grr.server.data_server import constants
+from grr.server.data_server import utils
+
+
+class KeyPlacementTest(test_lib.GRRBaseTest):
+  """Tests placing keys in the data servers."""
+
+  KEYS = ["C.%016X/fs/os/%d" % (i, i) for i in range(2000)]
+
+  def MakeMapping(self, num_servers, weights=None):
+    mapping = rdf_data_server.DataServerMapping(num_servers=num_servers)
+    for index in range(num_servers):
+      mapping.servers.Append(
+          index=index, address="127.0.0.1", port=7000 + index,
+          interval=utils.CreateStartInterval(index, num_servers))
+      if weights:
+        mapping.servers[index].weight = weights[index]
+    return mapping
+
+  def MakeVirtualNodeMapping(self, num_servers, weights=None, owners=None):
+    mapping = self.MakeMapping(num_servers, weights=weights)
+    mapping.vnodes = utils.ComputeVirtualNodes(list(mapping.servers),
+                                               owners=owners)
+    return mapping
+
+  def Placement(self, mapping):
+    key_mapper = utils.KeyMapper(mapping)
+    return [key_mapper.MapKey(key) for key in self.KEYS]
+
+  def testKeyMapperMatchesIntervals(self):
+    mapping = self.MakeMapping(3)
+    # The last server gets the end of the range.
+    mapping.servers[2].interval.end = constants.MAX_RANGE
+    self.assertEqual(self.Placement(mapping),
+                     [utils.MapKeyToServer(mapping, key) for key in self.KEYS])
+
+  def testKeysAreSpreadOverVirtualNodes(self):
+    mapping = self.MakeVirtualNodeMapping(4)
+    self.assertEqual(len(mapping.vnodes),
+                     4 * constants.VIRTUAL_NODES_PER_WEIGHT)
+
+    placement = self.Placement(mapping)
+    for index in range(4):
+      self.assertGreater(placement.count(index), len(self.KEYS) / 8)
+
+    self.assertEqual(placement,
+                     [utils.MapKeyToServer(mapping, key) for key in self.KEYS])
+
+  def testAddingAServerMovesFewKeys(self):
+    before = self.Placement(self.MakeVirtualNodeMapping(4))
+    after = self.Placement(self.MakeVirtualNodeMapping(5))
+
+    moved = [b for a, b in zip(before, after) if a != b]
+    # Keys only move to the new server, about a fifth of them.
+    self.assertEqual(set(moved), set([4]))
+    self.assertLess(len(moved), len(self.KEYS) / 3)
+
+  def testRemovingAServerMovesOnlyItsKeys(self):
+    before = self.Placement(self.MakeVirtualNodeMapping(4))
+    mapping = self.MakeVirtualNodeMapping(4, weights=[1, 1, 0, 1])
+    self.assertTrue(utils.IsServerEmpty(mapping, 2))
+    after = self.Placement(mapping)
+
+    for a, b in zip(before, after):
+      if a != 2:
+        self.assertEqual(a, b)
+      self.assertNotEqual(b, 2)
+
+  def testWeights(self):
+    mapping = self.MakeVirtualNodeMapping(2, weights=[3, 1])
+    shares = utils.VirtualNodeShares(mapping)
+    self.assertAlmostEqual(sum(shares), 1.0)
+    self.assertGreater(shares[0], 0.6)
+
+    placement = self.Placement(mapping)
+    self.assertGreater(placement.count(0), 2 * placement.count(1))
+
+  def testMovedNodesStayOnTheirServer(self):
+    mapping = self.MakeVirtualNodeMapping(3)
+    token = mapping.vnodes[0].token
+    owner = mapping.vnodes[0].server
+    new_owner = (owner + 1) % 3
+
+    moved = self.MakeVirtualNodeMapping(4, owners={token: new_owner})
+    self.assertEqual([vnode.server for vnode in moved.vnodes
+                      if vnode.token == token], [new_owner])
+
+    # Once its new server is dropped, the node goes back where it was.
+    weights = [1] * 4
+    weights[new_owner] = 0
+    dropped = self.MakeVirtualNodeMapping(4, weights=weights,
+                                          owners={token: new_owner})
+    self.assertEqual([vnode.server for vnode in dropped.vnodes
+                      if vnode.token == token], [owner])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
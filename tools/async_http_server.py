@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+"""An event loop based GRR frontend HTTP Server.
+
+The threaded http_server uses one thread per client connection, which does not
+scale to a large number of polling clients. This server handles all the socket
+I/O in a single asyncore event loop and hands complete requests to a pipeline
+of bounded thread pools:
+
+- The crypto stage decrypts the client's messages and later encrypts the
+  response.
+- The store stage receives the messages and drains the client's queue.
+
+Requests which can not be handed to a stage right away wait in the stage's
+backlog, so the number of threads is bounded no matter how many clients are
+connected.
+"""
+
+
+import asynchat
+import asyncore
+import cgi
+import collections
+import cStringIO
+import email.utils
+import mimetools
+import os
+import socket
+import threading
+import time
+
+
+import ipaddr
+
+import logging
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=g-bad-import-order
+
+from grr.lib import aff4
+from grr.lib import communicator
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import flow
+from grr.lib import master
+from grr.lib import rdfvalue
+from grr.lib import startup
+from grr.lib import stats
+from grr.lib import threadpool
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+
+
+class PipelineStage(object):
+  """A stage of the request pipeline with a bounded number of threads."""
+
+  def __init__(self, name, max_threads):
+    self.name = name
+    self.thread_pool = threadpool.ThreadPool.Factory(
+        name, min_threads=1, max_threads=max_threads)
+    self.thread_pool.Start()
+
+    # Tasks the thread pool could not accept yet.
+    self.backlog = collections.deque()
+    self.lock = threading.Lock()
+
+  def Submit(self, target, *args):
+    """Schedules target(*args) to run in this stage, never blocks."""
+    with self.lock:
+      self.backlog.append((target, args))
+    self._Dispatch()
+
+  def _Dispatch(self):
+    """Moves tasks from the backlog to the thread pool while it has room."""
+    with self.lock:
+      while self.backlog:
+        target, args = self.backlog[0]
+        try:
+          self.thread_pool.AddTask(self._Run, (target, args), name=self.name,
+                                   blocking=False, inline=False)
+        except threadpool.Full:
+          break
+        self.backlog.popleft()
+
+      stats.STATS.SetGaugeValue("frontend_async_backlog", len(self.backlog),
+                                fields=[self.name])
+
+  def _Run(self, target, args):
+    try:
+      target(*args)
+    finally:
+      # A slot in the pool just got free.
+      self._Dispatch()
+
+  def Stop(self):
+    self.thread_pool.Stop()
+
+
+class AsyncRequest(object):
+  """The state of a client POST moving through the pipeline."""
+
+  def __init__(self, connection, data):
+    self.connection = connection
+    self.data = data
+    self.start_time = time.time()
+
+    self.request_comms = None
+    self.response_comms = None
+    self.messages = None
+    self.source = None
+    self.timestamp = None
+    self.message_list = None
+    self.tasks = None
+
+
+class GRRAsyncHTTPConnection(asynchat.async_chat):
+  """A single HTTP/1.0 client connection."""
+
+  MAX_HEADER_SIZE = 64 * 1024
+
+  def __init__(self, server, sock, client_address):
+    asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+    self.server = server
+    self.client_address = client_address
+    self.closed = False
+
+    self.buffer = []
+    self.buffer_size = 0
+    self.command = None
+    self.path = None
+    self.headers = None
+    self.set_terminator("\r\n\r\n")
+
+  def collect_incoming_data(self, data):
+    self.buffer.append(data)
+    self.buffer_size += len(data)
+
+    if self.headers is None and self.buffer_size > self.MAX_HEADER_SIZE:
+      logging.info("Dropping request with oversized headers from %s",
+                   self.client_address[0])
+      self.handle_close()
+
+  def _ReadBuffer(self):
+    data = "".join(self.buffer)
+    self.buffer = []
+    self.buffer_size = 0
+    return data
+
+  def found_terminator(self):
+    if self.closed:
+      return
+
+    if self.headers is None:
+      self._ParseHeaders(self._ReadBuffer())
+    else:
+      self.set_terminator(None)
+      self.server.HandlePOST(self, self._ReadBuffer())
+
+  def _ParseHeaders(self, data):
+    """Parses the request line and the headers, then waits for the body."""
+    request_line, _, header_data = data.partition("\r\n")
+    try:
+      self.command, self.path, _ = request_line.split(" ", 2)
+    except ValueError:
+      self.handle_close()
+      return
+
+    self.headers = mimetools.Message(cStringIO.StringIO(header_data + "\r\n"))
+
+    if self.command == "GET":
+      self.set_terminator(None)
+      self.server.HandleGET(self)
+
+    elif self.command == "POST":
+      try:
+        length = int(self.headers.getheader("content-length"))
+      except (TypeError, ValueError):
+        self.server.Respond(self, "Error", status=500)
+        return
+
+      if length > 0:
+        self.set_terminator(length)
+      else:
+        self.found_terminator()
+
+    else:
+      self.server.Respond(self, "", status=404)
+
+  def handle_close(self):
+    self.closed = True
+    self.close()
+
+
+class _WakeupDispatcher(asyncore.file_dispatcher):
+  """Wakes the event loop up when responses are ready to be sent."""
+
+  def __init__(self, server):
+    self.server = server
+    self.read_fd, self.write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self.read_fd,
+                                      map=server.socket_map)
+
+  def Wakeup(self):
+    try:
+      os.write(self.write_fd, "x")
+    except OSError:
+      # The pipe is full so the loop has a pending wakeup anyways.
+      pass
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    self.recv(4096)
+    self.server.SendResponses()
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self.write_fd)
+
+
+class GRRAsyncHTTPServer(asyncore.dispatcher):
+  """The GRR event loop based HTTP frontend server."""
+
+  statustext = {200: "200 OK",
+                404: "404 Not Found",
+                406: "406 Not Acceptable",
+                500: "500 Internal Server Error"}
+
+  request_queue_size = 500
+
+  def __init__(self, server_address, frontend=None):
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    if frontend:
+      self.frontend = frontend
+    else:
+      self.frontend = flow.FrontEndServer(
+          certificate=config_lib.CONFIG["Frontend.certificate"],
+          private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+          max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
+          message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
+          max_retransmission_time=config_lib.CONFIG[
+              "Frontend.max_retransmission_time"])
+    self.server_cert = config_lib.CONFIG["Frontend.certificate"]
+
+    self.crypto_stage = PipelineStage(
+        "grr_async_frontend_crypto",
+        config_lib.CONFIG["Frontend.async_crypto_threads"])
+    self.store_stage = PipelineStage(
+        "grr_async_frontend_store",
+        config_lib.CONFIG["Frontend.async_store_threads"])
+
+    # Responses produced by the pipeline threads, sent from the event loop.
+    self.responses = collections.deque()
+    self.wakeup_dispatcher = _WakeupDispatcher(self)
+
+    self.active_counter_lock = threading.Lock()
+    self.active_counter = 0
+    self.running = True
+
+    (address, _) = server_address
+    if ipaddr.IPAddress(address).version == 4:
+      address_family = socket.AF_INET
+    else:
+      address_family = socket.AF_INET6
+
+    logging.info("Will attempt to listen on %s", server_address)
+    self.create_socket(address_family, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(server_address)
+    self.listen(self.request_queue_size)
+    self.server_address = self.socket.getsockname()
+
+    stats.STATS.SetGaugeValue("frontend_max_active_count",
+                              self.request_queue_size)
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+
+    sock, client_address = pair
+    GRRAsyncHTTPConnection(self, sock, client_address)
+
+  def serve_forever(self):
+    try:
+      while self.running:
+        asyncore.loop(timeout=1, use_poll=True, map=self.socket_map, count=1)
+    finally:
+      asyncore.close_all(map=self.socket_map)
+      self.crypto_stage.Stop()
+      self.store_stage.Stop()
+      # Write out the client liveness updates still buffered.
+      self.frontend.Stop()
+
+  def shutdown(self):
+    """Makes serve_forever() return, callable from any thread."""
+    self.running = False
+    self.wakeup_dispatcher.Wakeup()
+
+  def Respond(self, connection, data, status=200,
+              ctype="application/octet-stream", last_modified=0):
+    """Queues a response for the connection, callable from any thread."""
+    response = ("HTTP/1.0 %s\r\n"
+                "Server: GRR Server\r\n"
+                "Content-type: %s\r\n"
+                "Content-Length: %d\r\n"
+                "Last-Modified: %s\r\n"
+                "\r\n"
+                "%s") % (self.statustext[status], ctype, len(data),
+                         email.utils.formatdate(last_modified, usegmt=True),
+                         data)
+
+    self.responses.append((connection, response))
+    self.wakeup_dispatcher.Wakeup()
+
+  def SendResponses(self):
+    """Pushes the queued responses to their connections."""
+    while True:
+      try:
+        connection, response = self.responses.popleft()
+      except IndexError:
+        return
+
+      if connection.closed:
+        continue
+
+      connection.push(response)
+      connection.close_when_done()
+
+  def HandleGET(self, connection):
+    """Serves the server pem and static files."""
+    url_prefix = config_lib.CONFIG["Frontend.static_url_path_prefix"]
+    if connection.path.startswith("/server.pem"):
+      self.Respond(connection, self.server_cert)
+    elif connection.path.startswith(url_prefix):
+      self.store_stage.Submit(self.ServeStatic, connection,
+                              connection.path[len(url_prefix):])
+    else:
+      self.Respond(connection, "", status=404)
+
+  AFF4_READ_BLOCK_SIZE = 10 * 1024 * 1024
+
+  def ServeStatic(self, connection, path):
+    static_aff4_prefix = config_lib.CONFIG["Frontend.static_aff4_prefix"]
+    aff4_path = rdfvalue.RDFURN(static_aff4_prefix).Add(path)
+    try:
+      logging.info("Serving %s", aff4_path)
+      fd = aff4.FACTORY.Open(aff4_path)
+      data = []
+      while True:
+        chunk = fd.Read(self.AFF4_READ_BLOCK_SIZE)
+        if not chunk:
+          break
+        data.append(chunk)
+
+      self.Respond(connection, "".join(data))
+    except (IOError, AttributeError):
+      self.Respond(connection, "", status=404)
+
+  def HandlePOST(self, connection, data):
+    """Feeds a client POST into the pipeline."""
+    stats.STATS.IncrementCounter("frontend_request_count", fields=["async"])
+
+    if not master.MASTER_WATCHER.IsMaster():
+      # We shouldn't be getting requests from the client unless we
+      # are the active instance.
+      stats.STATS.IncrementCounter("frontend_inactive_request_count",
+                                   fields=["async"])
+      logging.info("Request sent to inactive frontend from %s",
+                   connection.client_address[0])
+
+    self._UpdateActiveCounter(1)
+    self.crypto_stage.Submit(self._RunStage, self._Decode,
+                             AsyncRequest(connection, data))
+
+  def _UpdateActiveCounter(self, delta):
+    with self.active_counter_lock:
+      self.active_counter += delta
+      stats.STATS.SetGaugeValue("frontend_active_count", self.active_counter,
+                                fields=["async"])
+
+  def _RunStage(self, stage, request):
+    """Runs a pipeline stage, responding with an error if it fails."""
+    try:
+      stage(request)
+      return
+
+    except communicator.UnknownClientCert:
+      # "406 Not Acceptable: The server can only generate a response that is not
+      # accepted by the client". This is because we can not encrypt for the
+      # client appropriately.
+      self.Respond(request.connection, "Enrollment required", status=406)
+
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error("Had to respond with status 500: %s.", e)
+      self.Respond(request.connection, "Error", status=500)
+
+    self._FinishRequest(request)
+
+  def _FinishRequest(self, request):
+    self._UpdateActiveCounter(-1)
+    stats.STATS.RecordEvent("frontend_request_latency",
+                            time.time() - request.start_time, fields=["async"])
+
+  def _Decode(self, request):
+    """Parses and decrypts the client's messages."""
+    connection = request.connection
+
+    # Get the api version
+    try:
+      api_version = int(cgi.parse_qs(connection.path.split("?")[1])["api"][0])
+    except (ValueError, KeyError, IndexError):
+      # The oldest api version we support if not specified.
+      api_version = 3
+
+    request_comms = rdf_flows.ClientCommunication(request.data)
+
+    # If the client did not supply the version in the protobuf we use the get
+    # parameter.
+    if not request_comms.api_version:
+      request_comms.api_version = api_version
+
+    source_ip = ipaddr.IPAddress(connection.client_address[0])
+
+    if source_ip.version == 6:
+      source_ip = source_ip.ipv4_mapped or source_ip
+
+    request_comms.orig_request = rdf_flows.HttpRequest(
+        raw_headers=utils.SmartStr(connection.headers),
+        source_ip=utils.SmartStr(source_ip))
+
+    request.request_comms = request_comms
+    # Reply using the same version we were requested with.
+    request.response_comms = rdf_flows.ClientCommunication(
+        api_version=request_comms.api_version)
+
+    request.messages, request.source, request.timestamp = (
+        self.frontend.DecodeMessageBundle(request_comms))
+
+    self.store_stage.Submit(self._RunStage, self._Process, request)
+
+  def _Process(self, request):
+    """Stores the client's messages and collects the messages for it."""
+    request.message_list, request.tasks = self.frontend.ProcessDecodedMessages(
+        request.source, request.messages, request.request_comms.queue_size)
+
+    self.crypto_stage.Submit(self._RunStage, self._Encode, request)
+
+  def _Encode(self, request):
+    """Encrypts the response and hands it to the event loop."""
+    self.frontend.EncodeMessageList(
+        request.message_list, request.tasks, request.response_comms,
+        request.source, request.timestamp,
+        request.request_comms.api_version)
+    stats.STATS.IncrementCounter("grr_frontendserver_handle_num")
+
+    logging.info("HTTP request from %s (%s), %d bytes - %d messages received,"
+                 " %d messages sent.",
+                 request.source, request.connection.client_address[0],
+                 len(request.data), len(request.messages),
+                 request.response_comms.num_messages)
+
+    self.Respond(request.connection,
+                 request.response_comms.SerializeToString())
+    self._FinishRequest(request)
+
+
+def CreateServer(frontend=None):
+  server_address = (config_lib.CONFIG["Frontend.bind_address"],
+                    config_lib.CONFIG["Frontend.bind_port"])
+  server = GRRAsyncHTTPServer(server_address, frontend=frontend)
+
+  sa = server.server_address
+  logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
+  return server
+
+
+def main(unused_argv):
+  """Main."""
+  config_lib.CONFIG.AddContext("HTTPServer Context")
+
+  startup.Init()
+
+  server = CreateServer()
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print "Caught keyboard interrupt, stopping"
+
+if __name__ == "__main__":
+  flags.StartMain(main)
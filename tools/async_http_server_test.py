@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Tests for the event loop based frontend HTTP server."""
+
+
+import threading
+import urllib2
+
+
+from grr.lib import communicator
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.tools import async_http_server
+
+
+class FakeFrontEndServer(object):
+  """A frontend which answers every client with its own messages."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.processed = 0
+
+  def DecodeMessageBundle(self, request_comms):
+    if request_comms.encrypted == "unknown":
+      raise communicator.UnknownClientCert("Cert not found")
+    return [], "C.1000000000000000", 0
+
+  def ProcessDecodedMessages(self, source, messages, client_queue_size):
+    with self.lock:
+      self.processed += 1
+    return rdf_flows.MessageList(), []
+
+  def EncodeMessageList(self, message_list, tasks, response_comms, source,
+                        timestamp, api_version):
+    response_comms.encrypted = "response for %s" % source
+
+  def Stop(self):
+    pass
+
+
+class GRRAsyncHTTPServerTest(test_lib.GRRBaseTest):
+  """Tests the GRRAsyncHTTPServer."""
+
+  def setUp(self):
+    super(GRRAsyncHTTPServerTest, self).setUp()
+    self.config_overrider = test_lib.ConfigOverrider({
+        # Use tiny pools so requests have to wait in the backlog.
+        "Frontend.async_crypto_threads": 1,
+        "Frontend.async_store_threads": 2})
+    self.config_overrider.Start()
+
+    self.frontend = FakeFrontEndServer()
+    self.server = async_http_server.GRRAsyncHTTPServer(
+        ("127.0.0.1", 0), frontend=self.frontend)
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+
+    self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+  def tearDown(self):
+    super(GRRAsyncHTTPServerTest, self).tearDown()
+    self.server.shutdown()
+    self.server_thread.join()
+    self.config_overrider.Stop()
+
+  def Post(self, encrypted):
+    data = rdf_flows.ClientCommunication(encrypted=encrypted)
+    return urllib2.urlopen(self.url + "/control?api=3",
+                           data.SerializeToString()).read()
+
+  def testServerPem(self):
+    data = urllib2.urlopen(self.url + "/server.pem").read()
+    self.assertEqual(data, str(config_lib.CONFIG["Frontend.certificate"]))
+
+  def testPost(self):
+    response = rdf_flows.ClientCommunication(self.Post("request"))
+    self.assertEqual(response.encrypted, "response for C.1000000000000000")
+    self.assertEqual(response.api_version, 3)
+
+  def testUnknownClientGetsEnrollmentRequired(self):
+    with self.assertRaises(urllib2.HTTPError) as e:
+      self.Post("unknown")
+
+    self.assertEqual(e.exception.code, 406)
+
+  def testConcurrentRequestsWaitInBacklog(self):
+    responses = []
+
+    def Request():
+      responses.append(self.Post("request"))
+
+    threads = [threading.Thread(target=Request) for _ in range(50)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(len(responses), 50)
+    self.assertEqual(self.frontend.processed, 50)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -69,6 +69,22 @@ class EntryPointTest(test_lib.GRRBaseTest):
                                     [run_bin] + self.extra_opts,
                                     timeout=self.default_timeout)
 
+  @test_lib.SetLabel("large")
+  def testAsyncHttpServer(self):
+    run_bin = os.path.join(self.bin_dir, "tools",
+                           "async_http_server" + self.bin_ext)
+    self.RunForTimeWithNoExceptions(self.interpreter,
+                                    [run_bin] + self.extra_opts,
+                                    timeout=self.default_timeout)
+
+  @test_lib.SetLabel("large")
+  def testSharedCacheServer(self):
+    run_bin = os.path.join(self.bin_dir, "tools",
+                           "shared_cache_server" + self.bin_ext)
+    self.RunForTimeWithNoExceptions(self.interpreter,
+                                    [run_bin] + self.extra_opts,
+                                    timeout=self.default_timeout)
+
   @test_lib.SetLabel("large")
   def testAdminUI(self):
     run_bin = os.path.join(self.bin_dir, "gui",
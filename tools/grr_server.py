@@ -25,7 +25,9 @@ from grr.lib import server_plugins
 from grr.gui import admin_ui
 from grr.lib import flags
 from grr.server.data_server import data_server
+from grr.tools import async_http_server
 from grr.tools import http_server
+from grr.tools import shared_cache_server
 from grr.worker import worker
 
 
@@ -35,12 +37,18 @@ flags.DEFINE_bool("start_worker", False,
 flags.DEFINE_bool("start_http_server", False,
                   "Start the server as HTTP server.")
 
+flags.DEFINE_bool("start_async_http_server", False,
+                  "Start the server as event loop based HTTP server.")
+
 flags.DEFINE_bool("start_ui", False,
                   "Start the server as user interface.")
 
 flags.DEFINE_bool("start_dataserver", False,
                   "Start the dataserver.")
 
+flags.DEFINE_bool("start_shared_cache", False,
+                  "Start the shared AFF4 cache daemon.")
+
 
 def main(argv):
   """Sets up all the component in their own threads."""
@@ -53,6 +61,10 @@ def main(argv):
   elif flags.FLAGS.start_http_server:
     http_server.main([argv])
 
+  # Start as an event loop based HTTP server.
+  elif flags.FLAGS.start_async_http_server:
+    async_http_server.main([argv])
+
   # Start as an AdminUI.
   elif flags.FLAGS.start_ui:
     admin_ui.main([argv])
@@ -61,6 +73,10 @@ def main(argv):
   elif flags.FLAGS.start_dataserver:
     data_server.main([argv])
 
+  # Start as the shared AFF4 cache daemon.
+  elif flags.FLAGS.start_shared_cache:
+    shared_cache_server.main([argv])
+
   # If no flags were set then raise.
   else:
     raise RuntimeError("No component specified to start")
@@ -240,6 +240,8 @@ def Serve(server):
     server.serve_forever()
   except KeyboardInterrupt:
     pass
+  finally:
+    server.frontend.Stop()
 
 
 def main(unused_argv):
@@ -254,6 +256,8 @@ def main(unused_argv):
     httpd.serve_forever()
   except KeyboardInterrupt:
     print "Caught keyboard interrupt, stopping"
+  finally:
+    httpd.frontend.Stop()
 
 if __name__ == "__main__":
   flags.StartMain(main)
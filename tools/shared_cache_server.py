@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""The daemon keeping the AFF4 cache shared by the GRR processes on a host.
+
+Run one daemon per host and set AFF4.shared_cache to LocalSocketSharedCache in
+the configuration of the workers, frontends and UIs running on the host.
+"""
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+import logging
+
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import shared_cache
+from grr.lib import startup
+
+
+def main(unused_argv):
+  """Main."""
+  startup.Init()
+
+  socket_path = config_lib.CONFIG["AFF4.shared_cache_socket"]
+  server = shared_cache.SharedCacheServer(
+      socket_path,
+      max_size=config_lib.CONFIG["AFF4.shared_cache_max_size"],
+      max_age=config_lib.CONFIG["AFF4.shared_cache_age"])
+
+  logging.info("Serving the shared AFF4 cache on %s", socket_path)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print "Caught keyboard interrupt, stopping"
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -15,6 +15,12 @@ from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import startup
 from grr.lib import worker
+from grr.lib import worker_supervisor
+
+
+flags.DEFINE_bool("worker_child", False,
+                  "Run as one of the workers started by the worker "
+                  "supervisor.")
 
 
 def main(unused_argv):
@@ -26,8 +32,17 @@ def main(unused_argv):
   # Initialise flows
   startup.Init()
   token = access_control.ACLToken(username="GRRWorker")
-  worker_obj = worker.GRRWorker(token=token)
-  worker_obj.Run()
+
+  if flags.FLAGS.worker_child:
+    worker_supervisor.ChildWorkerRunner(worker.GRRWorker(token=token)).Run()
+
+  elif config_lib.CONFIG["Worker.processes"] > 1:
+    worker_supervisor.WorkerSupervisor(
+        config_lib.CONFIG["Worker.processes"]).Run()
+
+  else:
+    worker_obj = worker.GRRWorker(token=token)
+    worker_obj.Run()
 
 if __name__ == "__main__":
   flags.StartMain(main)
@@ -16,6 +16,7 @@ from grr.lib import hunts
 from grr.lib import queue_manager
 from grr.lib import queues
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib import worker
@@ -322,6 +323,103 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
     self.assertEqual(flow_obj.state.context["current_state"],
                      "End")
 
+  def testProcessMessagesInBatches(self):
+    session_ids = []
+    for _ in range(3):
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for session_id in session_ids:
+      self.SendResponse(session_id, "Hello")
+
+    flows_processed = stats.STATS.GetMetricValue("worker_flows_processed")
+    batches = stats.STATS.GetMetricValue("worker_flow_batch_size").count
+
+    with test_lib.ConfigOverrider({"Worker.flow_batch_size": 2}):
+      worker_obj = worker.GRRWorker(token=self.token)
+      worker_obj.RunOnce()
+      worker_obj.thread_pool.Join()
+
+    self.assertEqual(RESULTS, ["Hello"] * 3)
+    self.assertEqual(stats.STATS.GetMetricValue("worker_flows_processed"),
+                     flows_processed + 3)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("worker_flow_batch_size").count,
+        batches + 2)
+
+    for session_id in session_ids:
+      flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+      self.assertEqual(flow_obj.state.context.state,
+                       rdf_flows.Flow.State.TERMINATED)
+
+  def testBatchedFlowLockedElsewhereIsSkipped(self):
+    session_ids = []
+    for _ in range(2):
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for session_id in session_ids:
+      self.SendResponse(session_id, "Hello")
+
+    lock_errors = stats.STATS.GetMetricValue("worker_flow_lock_error")
+
+    with test_lib.ConfigOverrider({"Worker.flow_batch_size": 10}):
+      worker_obj = worker.GRRWorker(token=self.token)
+      with aff4.FACTORY.OpenWithLock(session_ids[0], token=self.token):
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    self.assertEqual(RESULTS, ["Hello"])
+    self.assertEqual(stats.STATS.GetMetricValue("worker_flow_lock_error"),
+                     lock_errors + 1)
+
+    # The locked flow still has its work waiting.
+    flow_obj = aff4.FACTORY.Open(session_ids[0], token=self.token)
+    self.assertEqual(flow_obj.state.context.current_state, "Start")
+
+  def testFlowsAreProcessedWhenTheBatchFails(self):
+    session_ids = []
+    for _ in range(2):
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for session_id in session_ids:
+      self.SendResponse(session_id, "Hello")
+
+    def Fail(*unused_args, **unused_kwargs):
+      raise IOError("Data store unavailable.")
+
+    with test_lib.ConfigOverrider({"Worker.flow_batch_size": 10}):
+      with utils.Stubber(queue_manager.QueueManager, "PrefetchFlowStates",
+                         Fail):
+        worker_obj = worker.GRRWorker(token=self.token)
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    # The flows were processed one by one instead.
+    self.assertEqual(RESULTS, ["Hello"] * 2)
+    for session_id in session_ids:
+      flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+      self.assertEqual(flow_obj.state.context.state,
+                       rdf_flows.Flow.State.TERMINATED)
+
+  def testThroughputStats(self):
+    worker_obj = worker.GRRWorker(token=self.token)
+    worker_obj.throughput_start = time.time() - 10
+
+    stats.STATS.IncrementCounter("worker_flows_processed", 20)
+    stats.STATS.IncrementCounter("grr_worker_responses_processed", 50)
+    with utils.Stubber(worker_obj, "THROUGHPUT_INTERVAL", 5):
+      worker_obj.UpdateThroughputStats()
+
+    self.assertAlmostEqual(
+        stats.STATS.GetMetricValue("worker_flows_per_second"), 2, places=1)
+    self.assertAlmostEqual(
+        stats.STATS.GetMetricValue("worker_messages_per_second"), 5, places=1)
+
   def testNoKillNotificationsScheduledForHunts(self):
     worker_obj = worker.GRRWorker(token=self.token)
     initial_time = rdfvalue.RDFDatetime().FromSecondsFromEpoch(100)